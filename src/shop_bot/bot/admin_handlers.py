@@ -15,6 +15,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shop_bot.bot import keyboards
+from shop_bot.bot import outbound
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.data_manager import resource_monitor, database
 from shop_bot.data_manager.database import (
@@ -329,7 +330,7 @@ def get_admin_router() -> Router:
         start_text = f"🚀 Запущен тест скорости для хоста: <b>{host_name}</b>\n(инициатор: {initiator})"
         for aid in admin_ids:
             try:
-                await callback.bot.send_message(aid, start_text)
+                await outbound.send_message(callback.bot, aid, start_text, priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
 
@@ -382,7 +383,7 @@ def get_admin_router() -> Router:
             if wait_msg and aid == callback.from_user.id:
                 continue
             try:
-                await callback.bot.send_message(aid, text_res)
+                await outbound.send_message(callback.bot, aid, text_res, priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
 
@@ -412,7 +413,7 @@ def get_admin_router() -> Router:
         start_text = f"🚀 Запущен тест скорости для всех хостов\n(инициатор: {initiator})"
         for aid in admin_ids:
             try:
-                await callback.bot.send_message(aid, start_text)
+                await outbound.send_message(callback.bot, aid, start_text, priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
         # пробежимся по хостам
@@ -436,7 +437,7 @@ def get_admin_router() -> Router:
             if aid == callback.from_user.id or aid == callback.message.chat.id:
                 continue
             try:
-                await callback.bot.send_message(aid, text)
+                await outbound.send_message(callback.bot, aid, text, priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
 
@@ -451,7 +452,7 @@ def get_admin_router() -> Router:
             wait = await callback.message.answer("⏳ Создаю бэкап базы данных…")
         except Exception:
             wait = None
-        zip_path = backup_manager.create_backup_file()
+        zip_path = await backup_manager.create_backup_file_async()
         if not zip_path:
             if wait:
                 await wait.edit_text("❌ Не удалось создать бэкап БД")
@@ -460,7 +461,8 @@ def get_admin_router() -> Router:
             return
         # Отправим всем администраторам
         try:
-            sent = await backup_manager.send_backup_to_admins(callback.bot, zip_path)
+            # Ручной бэкап отправляем даже без изменений в БД
+            sent = await backup_manager.send_backup_to_admins(callback.bot, zip_path, force=True)
         except Exception:
             sent = 0
         txt = f"✅ Бэкап создан: <b>{zip_path.name}</b>\nОтправлено администраторам: {sent}"
@@ -488,7 +490,7 @@ def get_admin_router() -> Router:
         kb.adjust(1)
         text = (
             "⚠️ <b>Восстановление базы данных</b>\n\n"
-            "Отправьте файл <code>.zip</code> с бэкапом или файл <code>.db</code> в ответ на это сообщение.\n"
+            "Отправьте файл <code>.zip</code> или <code>.db.zst</code> с бэкапом или файл <code>.db</code> в ответ на это сообщение.\n"
             "Текущая БД предварительно будет сохранена."
         )
         try:
@@ -505,8 +507,8 @@ def get_admin_router() -> Router:
             await message.answer("❌ Пришлите файл .zip или .db")
             return
         filename = (doc.file_name or "uploaded.db").lower()
-        if not (filename.endswith('.zip') or filename.endswith('.db')):
-            await message.answer("❌ Поддерживаются только файлы .zip или .db")
+        if not (filename.endswith('.zip') or filename.endswith('.db') or filename.endswith('.zst')):
+            await message.answer("❌ Поддерживаются только файлы .zip, .db.zst или .db")
             return
         try:
             ts = datetime.now().strftime('%Y%m%d-%H%M%S')
@@ -516,7 +518,7 @@ def get_admin_router() -> Router:
         except Exception as e:
             await message.answer(f"❌ Не удалось скачать файл: {e}")
             return
-        ok = backup_manager.restore_from_file(dest)
+        ok = await asyncio.to_thread(backup_manager.restore_from_file, dest)
         await state.clear()
         if ok:
             await message.answer("✅ Восстановление выполнено успешно.\nБот и панель продолжают работу с новой БД.")
@@ -1204,10 +1206,12 @@ def get_admin_router() -> Router:
                     kb.button(text="🆘 Написать в поддержку", url=url)
                 else:
                     kb.button(text="🆘 Поддержка", callback_data="show_help")
-                await callback.bot.send_message(
+                await outbound.send_message(
+                    callback.bot,
                     user_id,
                     "🚫 Ваш аккаунт заблокирован администратором. Если это ошибка — напишите в поддержку.",
-                    reply_markup=kb.as_markup()
+                    reply_markup=kb.as_markup(),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
             except Exception:
                 pass
@@ -1312,10 +1316,12 @@ def get_admin_router() -> Router:
                 # Отправляем пользователю уведомление о разбане с кнопкой в главное меню
                 kb = InlineKeyboardBuilder()
                 kb.row(keyboards.get_main_menu_button())
-                await callback.bot.send_message(
+                await outbound.send_message(
+                    callback.bot,
                     user_id,
                     "✅ Доступ к аккаунту восстановлен администратором.",
-                    reply_markup=kb.as_markup()
+                    reply_markup=kb.as_markup(),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
             except Exception:
                 pass
@@ -1824,10 +1830,12 @@ def get_admin_router() -> Router:
                 )
             # Уведомление пользователю (если получится)
             try:
-                await callback.bot.send_message(
+                await outbound.send_message(
+                    callback.bot,
                     user_id,
                     "ℹ️ Администратор удалил один из ваших ключей. Если это ошибка — напишите в поддержку.",
-                    reply_markup=keyboards.create_support_keyboard()
+                    reply_markup=keyboards.create_support_keyboard(),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
             except Exception:
                 pass
@@ -2081,7 +2089,7 @@ def get_admin_router() -> Router:
         expiry_ms = int(host_resp["expiry_timestamp_ms"])  # в мс
         connection_link = host_resp.get("connection_string")
 
-        key_id = add_new_key(user_id, host_name, client_uuid, generated_email, expiry_ms)
+        key_id = add_new_key(user_id, host_name, client_uuid, generated_email, expiry_ms, sub_token=host_resp.get("sub_token"))
         if key_id:
             username_readable = (user.get('username') or '').strip()
             user_part = f"{user_id} (@{username_readable})" if username_readable else f"{user_id}"
@@ -2099,7 +2107,7 @@ def get_admin_router() -> Router:
                 if connection_link:
                     cs = html_escape.escape(connection_link)
                     notify_text += f"\n🔗 Подписка:\n<pre><code>{cs}</code></pre>"
-                await message.bot.send_message(user_id, notify_text, parse_mode='HTML', disable_web_page_preview=True)
+                await outbound.send_message(message.bot, user_id, notify_text, parse_mode='HTML', disable_web_page_preview=True, priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
         else:
@@ -2199,7 +2207,7 @@ def get_admin_router() -> Router:
             if ok:
                 await message.answer(f"✅ Начислено {amount:.2f} RUB на баланс пользователю {user_id}")
                 try:
-                    await message.bot.send_message(user_id, f"💰 Вам начислено {amount:.2f} RUB на баланс администратором.")
+                    await outbound.send_message(message.bot, user_id, f"💰 Вам начислено {amount:.2f} RUB на баланс администратором.", priority=outbound.PRIORITY_PAYMENT)
                 except Exception:
                     pass
             else:
@@ -2350,10 +2358,12 @@ def get_admin_router() -> Router:
             if ok:
                 await message.answer(f"✅ Списано {amount:.2f} RUB с баланса пользователя {user_id}")
                 try:
-                    await message.bot.send_message(
+                    await outbound.send_message(
+                        message.bot,
                         user_id,
                         f"➖ С вашего баланса списано {amount:.2f} RUB администратором.\nЕсли это ошибка — напишите в поддержку.",
-                        reply_markup=keyboards.create_support_keyboard()
+                        reply_markup=keyboards.create_support_keyboard(),
+                        priority=outbound.PRIORITY_PAYMENT,
                     )
                 except Exception:
                     pass
@@ -2553,7 +2563,7 @@ def get_admin_router() -> Router:
         await message.answer(f"✅ Ключ #{key_id} продлён на {days} дн.")
         # Попробуем уведомить пользователя
         try:
-            await message.bot.send_message(int(key.get('user_id')), f"ℹ️ Администратор продлил ваш ключ #{key_id} на {days} дн.")
+            await outbound.send_message(message.bot, int(key.get('user_id')), f"ℹ️ Администратор продлил ваш ключ #{key_id} на {days} дн.", priority=outbound.PRIORITY_SUPPORT)
         except Exception:
             pass
 
@@ -2670,23 +2680,34 @@ def get_admin_router() -> Router:
         failed_count = 0
         banned_count = 0
 
+        recipients = []
         for user in users:
-            user_id = user['telegram_id']
             if user.get('is_banned'):
                 banned_count += 1
                 continue
-            try:
-                await bot.copy_message(
+            recipients.append(user['telegram_id'])
+
+        # Темп задаёт общий диспетчер исходящих сообщений (полоса marketing уступает платежам и поддержке),
+        # поэтому отправляем пачками без собственных пауз
+        for start in range(0, len(recipients), 100):
+            chunk = recipients[start:start + 100]
+            results = await asyncio.gather(*[
+                outbound.call(
+                    bot, "copy_message",
                     chat_id=user_id,
                     from_chat_id=original_message.chat.id,
                     message_id=original_message.message_id,
-                    reply_markup=final_keyboard
+                    reply_markup=final_keyboard,
+                    priority=outbound.PRIORITY_MARKETING,
                 )
-                sent_count += 1
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                failed_count += 1
-                logger.warning(f"Failed to send broadcast message to user {user_id}: {e}")
+                for user_id in chunk
+            ], return_exceptions=True)
+            for user_id, result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    failed_count += 1
+                    logger.warning(f"Failed to send broadcast message to user {user_id}: {result}")
+                else:
+                    sent_count += 1
 
         await callback.message.answer(
             f"✅ Рассылка завершена!\n\n"
@@ -2717,9 +2738,11 @@ def get_admin_router() -> Router:
             set_referral_balance(user_id, 0)
             set_referral_balance_all(user_id, 0)
             await message.answer(f"✅ Выплата {balance:.2f} RUB пользователю {user_id} подтверждена.")
-            await message.bot.send_message(
+            await outbound.send_message(
+                message.bot,
                 user_id,
-                f"✅ Ваша заявка на вывод {balance:.2f} RUB одобрена. Деньги будут переведены в ближайшее время."
+                f"✅ Ваша заявка на вывод {balance:.2f} RUB одобрена. Деньги будут переведены в ближайшее время.",
+                priority=outbound.PRIORITY_PAYMENT,
             )
         except Exception as e:
             await message.answer(f"Ошибка: {e}")
@@ -2731,9 +2754,11 @@ def get_admin_router() -> Router:
         try:
             user_id = int(message.text.split("_")[-1])
             await message.answer(f"❌ Заявка пользователя {user_id} отклонена.")
-            await message.bot.send_message(
+            await outbound.send_message(
+                message.bot,
                 user_id,
-                "❌ Ваша заявка на вывод отклонена. Проверьте корректность реквизитов и попробуйте снова."
+                "❌ Ваша заявка на вывод отклонена. Проверьте корректность реквизитов и попробуйте снова.",
+                priority=outbound.PRIORITY_PAYMENT,
             )
         except Exception as e:
             await message.answer(f"Ошибка: {e}")
@@ -0,0 +1,135 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from shop_bot.data_manager.database import (
+    get_setting, get_fsm_record, save_fsm_record, delete_fsm_record, delete_expired_fsm_records
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_HOURS = 72
+# Сколько последних диалогов держать в памяти перед БД
+LRU_SIZE = 2048
+# Как часто удалять истёкшие записи из БД
+EVICT_INTERVAL_SECONDS = 600
+# Кэшированное значение TTL перечитывается из настроек не чаще этого интервала
+TTL_REFRESH_SECONDS = 300
+
+
+def _get_ttl_seconds() -> float:
+    try:
+        hours = float(get_setting("fsm_state_ttl_hours") or DEFAULT_TTL_HOURS)
+    except (TypeError, ValueError):
+        hours = DEFAULT_TTL_HOURS
+    return max(hours, 0.1) * 3600
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в таблице fsm_storage основной БД.
+
+    Записи живут fsm_state_ttl_hours с последнего изменения, истёкшие периодически удаляются.
+    Перед БД — LRU (включая «пустые» ключи), поэтому чтение состояния недавних пользователей не ходит в базу.
+    Рассчитано на один процесс: все изменения проходят через этот экземпляр.
+    """
+
+    def __init__(self, namespace: str, lru_size: int = LRU_SIZE):
+        self.namespace = namespace
+        self.lru_size = lru_size
+        # storage_key -> (state, data_json, expires_at)
+        self._lru: "OrderedDict[str, tuple[str | None, str | None, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._ttl = _get_ttl_seconds()
+        self._ttl_checked_at = time.monotonic()
+        self._last_evict = 0.0
+
+    def _key(self, key: StorageKey) -> str:
+        parts = [
+            self.namespace, key.bot_id, key.chat_id, key.user_id,
+            key.thread_id or "", getattr(key, "business_connection_id", None) or "", key.destiny,
+        ]
+        return ":".join(str(p) for p in parts)
+
+    def _ttl_seconds(self) -> float:
+        if time.monotonic() - self._ttl_checked_at > TTL_REFRESH_SECONDS:
+            self._ttl = _get_ttl_seconds()
+            self._ttl_checked_at = time.monotonic()
+        return self._ttl
+
+    def _load(self, storage_key: str) -> tuple[str | None, str | None]:
+        now = time.time()
+        with self._lock:
+            cached = self._lru.get(storage_key)
+            if cached is not None:
+                if cached[2] > now:
+                    self._lru.move_to_end(storage_key)
+                    return cached[0], cached[1]
+                del self._lru[storage_key]
+        record = get_fsm_record(storage_key, now)
+        if record is None:
+            # Пустое состояние тоже кэшируем: у большинства обновлений его нет, и в БД за ним ходить незачем
+            self._remember(storage_key, None, None, now + self._ttl_seconds())
+            return None, None
+        state, data_json, expires_at = record
+        self._remember(storage_key, state, data_json, expires_at)
+        return state, data_json
+
+    def _remember(self, storage_key: str, state: str | None, data_json: str | None, expires_at: float) -> None:
+        with self._lock:
+            self._lru[storage_key] = (state, data_json, expires_at)
+            self._lru.move_to_end(storage_key)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def _store(self, storage_key: str, state: str | None, data_json: str | None) -> None:
+        now = time.time()
+        if state is None and not data_json:
+            self._remember(storage_key, None, None, now + self._ttl_seconds())
+            delete_fsm_record(storage_key)
+        else:
+            expires_at = now + self._ttl_seconds()
+            self._remember(storage_key, state, data_json, expires_at)
+            save_fsm_record(storage_key, state, data_json, expires_at)
+        self._maybe_evict(now)
+
+    def _maybe_evict(self, now: float) -> None:
+        if now - self._last_evict < EVICT_INTERVAL_SECONDS:
+            return
+        self._last_evict = now
+        removed = delete_expired_fsm_records(now)
+        with self._lock:
+            for storage_key in [k for k, v in self._lru.items() if v[2] <= now]:
+                del self._lru[storage_key]
+        if removed:
+            logger.info(f"FSM ({self.namespace}): удалено устаревших состояний: {removed}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        _, data_json = self._load(storage_key)
+        value = state.state if isinstance(state, State) else state
+        self._store(storage_key, value, data_json)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        state, _ = self._load(storage_key)
+        data_json = json.dumps(data, ensure_ascii=False, default=str) if data else None
+        self._store(storage_key, state, data_json)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data_json = self._load(self._key(key))
+        # Каждый раз новый словарь: изменения вызывающего не должны попадать в кэш
+        return json.loads(data_json) if data_json else {}
+
+    async def close(self) -> None:
+        with self._lock:
+            self._lru.clear()
@@ -8,6 +8,7 @@ from decimal import Decimal
 from urllib.parse import urlencode
 
 from aiogram import Router, F, types, Bot
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -18,11 +19,19 @@ from shop_bot.data_manager.database import (
     update_transaction_status, update_user_balance,
     get_promo_code, use_promo_code, create_user_key, get_user_keys,
     get_transaction_by_payment_id, get_host_by_name, get_key_by_id, update_key_expiry,
-    register_user_if_not_exists, get_all_hosts, get_plans_for_host
+    register_user_if_not_exists, get_all_hosts, get_plans_for_host, get_user_keys_with_hosts,
+    get_user_key_with_host
 )
+from shop_bot import logging_setup
+from shop_bot.data_manager import tracing
 from shop_bot.modules import xui_api
+from shop_bot.modules import subscription
+from shop_bot.modules import host_health
+from shop_bot.modules import qr_service
 from shop_bot.bot import keyboards
+from shop_bot.bot import outbound
 from shop_bot.bot.states import PaymentProcess, TopUpProcess
+from shop_bot.config import get_purchase_success_text
 
 
 logger = logging.getLogger(__name__)
@@ -109,7 +118,8 @@ async def show_profile(callback: types.CallbackQuery):
 @user_router.callback_query(F.data == "buy_new_key")
 async def start_buy_process(callback: types.CallbackQuery, state: FSMContext):
     # Получаем список хостов/локаций
-    hosts = get_all_hosts()
+    # Недоступные хосты скрываем, перегруженные опускаем вниз списка
+    hosts = host_health.rank_hosts(get_all_hosts())
     if not hosts:
         await callback.answer("Нет доступных серверов", show_alert=True)
         return
@@ -140,8 +150,8 @@ async def select_host_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Сервер не найден", show_alert=True)
         return
         
-    # Сохраняем выбранный хост в состояние
-    await state.update_data(host_name=host['host_name'], action="buy_key")
+    # Сохраняем выбранный хост в состояние; key_id от прерванного продления не должен попасть в покупку
+    await state.update_data(host_name=host['host_name'], action="buy_key", key_id=None)
     
     # Получаем тарифы для хоста
     plans = get_plans_for_host(host['host_name'])
@@ -149,6 +159,12 @@ async def select_host_handler(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("Для этого сервера нет активных тарифов", show_alert=True)
         return
         
+    await callback.message.edit_text(
+        f"📋 Выберите тариф для {host['host_name']}:",
+        reply_markup=_select_plan_keyboard(plans, back_callback="buy_new_key")
+    )
+
+def _select_plan_keyboard(plans: list[dict], back_callback: str) -> types.InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for plan in plans:
         builder.button(
@@ -156,10 +172,35 @@ async def select_host_handler(callback: types.CallbackQuery, state: FSMContext):
             callback_data=f"select_plan:{plan['plan_id']}"
         )
         
-    builder.button(text="🔙 Назад", callback_data="buy_new_key")
+    builder.button(text="🔙 Назад", callback_data=back_callback)
     builder.adjust(1)
-    
-    await callback.message.edit_text(f"📋 Выберите тариф для {host['host_name']}:", reply_markup=builder.as_markup())
+    return builder.as_markup()
+
+@user_router.callback_query(F.data.startswith("extend_key_"))
+async def extend_key_handler(callback: types.CallbackQuery, state: FSMContext):
+    """Продление ключа (кнопки в карточке ключа и в напоминании об истечении): тарифы его хоста,
+    дальше — общий путь покупки; process_successful_payment продлевает ключ по key_id."""
+    try:
+        key_id = int(callback.data.removeprefix("extend_key_"))
+    except ValueError:
+        await callback.answer("Ошибка данных", show_alert=True)
+        return
+    key = _get_own_key(callback.from_user.id, key_id)
+    if not key:
+        await callback.answer("Ключ не найден", show_alert=True)
+        return
+    plans = get_plans_for_host(key['host_name'])
+    if not plans:
+        await callback.answer("Для сервера этого ключа нет активных тарифов", show_alert=True)
+        return
+
+    await state.update_data(host_name=key['host_name'], action="extend", key_id=key_id)
+    await _edit_or_answer(
+        callback,
+        f"📅 Продление ключа {key.get('key_email')} ({key['host_name']}).\nВыберите тариф:",
+        _select_plan_keyboard(plans, back_callback="manage_keys")
+    )
+    await callback.answer()
 
 @user_router.callback_query(F.data.startswith("select_plan:"))
 async def select_plan_handler(callback: types.CallbackQuery, state: FSMContext):
@@ -317,37 +358,122 @@ async def show_howto(callback: types.CallbackQuery):
     builder.button(text="🔙 Назад", callback_data="main_menu")
     await callback.message.edit_text(howto_text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
+# --- My keys ---
+KEYS_PAGE_SIZE = 8
+
+
+def _key_expiry(key: dict) -> tuple[str, bool]:
+    """Дата окончания для вывода и признак того, что ключ ещё действует."""
+    if not key.get('expiry_date'):
+        return "Бессрочно", True
+    expiry = datetime.fromisoformat(str(key['expiry_date']))
+    return expiry.strftime('%d.%m.%Y'), expiry > datetime.now()
+
+
+def _render_keys_page(user_id: int, page: int):
+    """Текст и клавиатура страницы «Мои ключи». Ключи с данными хостов — одним запросом."""
+    keys = get_user_keys_with_hosts(user_id)
+    if not keys:
+        return None, None
+    total_pages = (len(keys) + KEYS_PAGE_SIZE - 1) // KEYS_PAGE_SIZE
+    page = max(0, min(page, total_pages - 1))
+    start = page * KEYS_PAGE_SIZE
+    page_keys = keys[start:start + KEYS_PAGE_SIZE]
+
+    lines = [f"🔑 <b>Ваши ключи</b> ({len(keys)})", ""]
+    for offset, key in enumerate(page_keys):
+        expiry, active = _key_expiry(key)
+        until = f"до {expiry}" if key.get('expiry_date') else expiry.lower()
+        lines.append(f"{start + offset + 1}. {'✅' if active else '❌'} {key.get('host_name')} — {until}")
+    lines.append("")
+    lines.append("Выберите ключ, чтобы получить ссылку и QR-код.")
+    # Домен и токен подписки пришли вместе с ключами; токен создаётся только при первом показе
+    first = keys[0]
+    if first.get('user_sub_token'):
+        sub_url = subscription.build_user_subscription_url(first['user_sub_token'], first.get('panel_domain'))
+    elif (first.get('panel_domain') or '').strip():
+        sub_url = subscription.get_user_subscription_url(user_id)
+    else:
+        sub_url = None
+    if sub_url:
+        lines.append(f"\n📎 Подписка на все ключи:\n<code>{sub_url}</code>")
+    kb = keyboards.create_keys_page_keyboard(page_keys, page, total_pages, start + 1)
+    return "\n".join(lines), kb
+
+
+async def _edit_or_answer(callback: types.CallbackQuery, text: str, reply_markup) -> None:
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
+    except TelegramBadRequest as e:
+        # Та же страница повторно — Telegram отвечает "message is not modified"
+        if "not modified" not in str(e):
+            await callback.message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
+
+
 @user_router.callback_query(F.data == "manage_keys")
+@user_router.callback_query(F.data.startswith("keys_page:"))
 async def show_user_keys(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    keys = get_user_keys(user_id)
-    
-    if not keys:
+    page = 0
+    if callback.data.startswith("keys_page:"):
+        try:
+            page = int(callback.data.split(":", 1)[1])
+        except ValueError:
+            page = 0
+    text, kb = _render_keys_page(callback.from_user.id, page)
+    if not text:
         await callback.answer("У вас пока нет активных ключей", show_alert=True)
         return
-        
-    for key in keys:
-        # Показываем информацию о ключе
-        # key: {'id', 'key_id', 'host_name', 'key_email', 'expiry_time', 'is_active', ...}
-        expiry = datetime.fromtimestamp(key['expiry_time']/1000).strftime('%Y-%m-%d %H:%M') if key.get('expiry_time') else "Бессрочно"
-        
-        text = (
-            f"🔑 <b>Ключ:</b> {key.get('key_email')}\n"
-            f"🌍 <b>Сервер:</b> {key.get('host_name')}\n"
-            f"⏳ <b>Истекает:</b> {expiry}\n"
-            f"🔗 <code>{key.get('access_url')}</code>" # Предполагаем, что access_url есть или надо генерировать
-        )
-        
-        builder = InlineKeyboardBuilder()
-        builder.button(text="📅 Продлить", callback_data=f"renew_key:{key['id']}")
-        # Можно добавить кнопку "Инструкция" или "QR код"
-        
-        await callback.message.answer(text, reply_markup=builder.as_markup(), parse_mode="HTML")
-        
-    # В конце можно добавить кнопку возврата в меню
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🔙 В меню", callback_data="main_menu")
-    await callback.message.answer("---", reply_markup=builder.as_markup())
+    await _edit_or_answer(callback, text, kb)
+    await callback.answer()
+
+
+def _parse_key_callback(data: str) -> tuple[int, int] | None:
+    parts = data.split(":")
+    try:
+        return int(parts[1]), int(parts[2]) if len(parts) > 2 else 0
+    except (IndexError, ValueError):
+        return None
+
+
+def _get_own_key(user_id: int, key_id: int) -> dict | None:
+    """Ключ пользователя вместе с данными хоста: один ключ по key_id и владельцу."""
+    return get_user_key_with_host(user_id, key_id)
+
+
+@user_router.callback_query(F.data.startswith("key_view:"))
+async def show_key_details(callback: types.CallbackQuery):
+    parsed = _parse_key_callback(callback.data)
+    key = _get_own_key(callback.from_user.id, parsed[0]) if parsed else None
+    if not key:
+        await callback.answer("Ключ не найден", show_alert=True)
+        return
+    key_id, page = parsed
+    # Ссылка собирается только для открытого ключа
+    link = xui_api.get_key_link_from_row(key) or "—"
+    expiry, active = _key_expiry(key)
+    text = (
+        f"🔑 <b>Ключ:</b> {key.get('key_email')}\n"
+        f"🌍 <b>Сервер:</b> {key.get('host_name')}\n"
+        f"⏳ <b>{'Истекает' if active else 'Истёк'}:</b> {expiry}\n\n"
+        f"🔗 <code>{link}</code>"
+    )
+    await _edit_or_answer(callback, text, keyboards.create_key_view_keyboard(key_id, page))
+    await callback.answer()
+
+
+@user_router.callback_query(F.data.startswith("key_qr:"))
+async def show_key_qr(callback: types.CallbackQuery):
+    parsed = _parse_key_callback(callback.data)
+    key = _get_own_key(callback.from_user.id, parsed[0]) if parsed else None
+    link = xui_api.get_key_link_from_row(key) if key else None
+    if not link:
+        await callback.answer("Не удалось получить ссылку ключа", show_alert=True)
+        return
+    await callback.answer()
+    await qr_service.send_qr(
+        callback.bot, callback.message.chat.id, link,
+        caption=f"📱 QR-код ключа {key.get('key_email')}"
+    )
 
 @user_router.callback_query(F.data == "show_referral_program")
 async def show_referral_program(callback: types.CallbackQuery):
@@ -381,11 +507,36 @@ PAYMENT_METHODS = {}
 
 
 # --- Successful Payment Processor ---
+async def _send_purchase_success(bot: Bot, user_id: int, action: str, key_id: int | None, result: dict):
+    """Сообщение об успешной покупке/продлении: QR-код ссылки с текстом в подписи, при ошибке — просто текст."""
+    key_ids = [k['key_id'] for k in get_user_keys(user_id)]
+    key_id = int(key_id) if key_id else None
+    key_number = key_ids.index(key_id) + 1 if key_id in key_ids else len(key_ids)
+    expiry = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
+    connection_string = result.get('connection_string') or ""
+    text = get_purchase_success_text(action, key_number, expiry, connection_string)
+    if connection_string:
+        try:
+            await qr_service.send_qr(
+                bot, user_id, connection_string, caption=text, parse_mode="HTML",
+                priority=outbound.PRIORITY_PAYMENT
+            )
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось отправить QR-код пользователю {user_id}: {e}")
+    await outbound.send_message(bot, chat_id=user_id, text=text, parse_mode="HTML", priority=outbound.PRIORITY_PAYMENT)
+
 async def process_successful_payment(bot: Bot, metadata: dict):
     """
     Обработка успешного платежа.
     metadata: словарь с данными платежа (user_id, action, amount, payment_id, etc.)
     """
+    with logging_setup.log_context(payment_id=metadata.get('payment_id'), user_id=metadata.get('user_id')), \
+            tracing.span("payment.process", root_kind="payment", payment_id=metadata.get('payment_id'),
+                         user_id=metadata.get('user_id'), action=metadata.get('action')):
+        await _process_successful_payment(bot, metadata)
+
+async def _process_successful_payment(bot: Bot, metadata: dict):
     try:
         payment_id = metadata.get('payment_id')
         user_id = int(metadata.get('user_id'))
@@ -400,9 +551,11 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         if action == 'top_up':
             # Пополнение баланса
             new_balance = update_user_balance(user_id, amount)
-            await bot.send_message(
+            await outbound.send_message(
+                bot,
                 chat_id=user_id,
-                text=f"✅ Баланс успешно пополнен на {amount} RUB.\nТекущий баланс: {new_balance} RUB"
+                text=f"✅ Баланс успешно пополнен на {amount} RUB.\nТекущий баланс: {new_balance} RUB",
+                priority=outbound.PRIORITY_PAYMENT,
             )
             
         else:
@@ -428,14 +581,11 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                     
                     if result:
                         update_key_expiry(key_id, result['expiry_timestamp_ms'])
-                        await bot.send_message(
-                            chat_id=user_id, 
-                            text=f"✅ Ключ успешно продлен на {months} мес.\nНовая дата окончания: {datetime.fromtimestamp(result['expiry_timestamp_ms']/1000).strftime('%Y-%m-%d %H:%M')}"
-                        )
+                        await _send_purchase_success(bot, user_id, "extend", key_id, result)
                     else:
-                        await bot.send_message(chat_id=user_id, text="❌ Ошибка при продлении ключа на сервере. Обратитесь в поддержку.")
+                        await outbound.send_message(bot, chat_id=user_id, text="❌ Ошибка при продлении ключа на сервере. Обратитесь в поддержку.", priority=outbound.PRIORITY_PAYMENT)
                 else:
-                    await bot.send_message(chat_id=user_id, text="❌ Ключ не найден в базе данных.")
+                    await outbound.send_message(bot, chat_id=user_id, text="❌ Ключ не найден в базе данных.", priority=outbound.PRIORITY_PAYMENT)
             else:
                 # Создание нового ключа
                 # Генерируем email если нет
@@ -453,17 +603,12 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 
                 if client:
                     # Сохраняем в БД
-                    create_user_key(user_id, host_name, client['client_uuid'], email, client['expiry_timestamp_ms'])
+                    new_key_id = create_user_key(user_id, host_name, client['client_uuid'], email, client['expiry_timestamp_ms'], sub_token=client.get('sub_token'))
                     
-                    # Отправляем ключ пользователю
-                    msg = (
-                        f"✅ Оплата прошла успешно!\n\n"
-                        f"Ваш ключ доступа:\n`{client['connection_string']}`\n\n"
-                        f"Инструкции по настройке доступны в главном меню."
-                    )
-                    await bot.send_message(chat_id=user_id, text=msg, parse_mode="Markdown")
+                    # Отправляем ключ пользователю вместе с QR-кодом
+                    await _send_purchase_success(bot, user_id, "new", new_key_id, client)
                 else:
-                    await bot.send_message(chat_id=user_id, text="✅ Оплата прошла, но возникла ошибка при создании ключа. Обратитесь в поддержку.")
+                    await outbound.send_message(bot, chat_id=user_id, text="✅ Оплата прошла, но возникла ошибка при создании ключа. Обратитесь в поддержку.", priority=outbound.PRIORITY_PAYMENT)
                     logger.error(f"Failed to create client for payment {payment_id}")
 
             # Применяем промокод если был
@@ -9,6 +9,7 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMar
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shop_bot.data_manager.database import get_setting, normalize_host_name
+from shop_bot.modules import host_health
 
 logger = logging.getLogger(__name__)
 
@@ -49,14 +50,38 @@ def find_host_by_callback_token(hosts: list[dict], token: str) -> dict | None:
 
 
 # --- Generic builder from DB configs ---
-def _build_keyboard_from_db(
-    menu_type: str,
-    text_replacements: dict[str, str] | None = None,
-    filter_func: Callable[[dict], bool] | None = None,
-) -> InlineKeyboardMarkup | None:
-    """Build InlineKeyboardMarkup from button configs for a given menu_type.
-    Returns None if configs are missing or on error.
-    """
+# Скомпилированные раскладки: menu_type -> {"revision", "buttons", "packed"}.
+# buttons — активные кнопки без дублей в порядке строк/колонок; packed — упаковка в ряды
+# для каждого набора скрытых кнопок. Сбрасываются при изменении button_configs или настроек.
+_compiled_layouts: dict[str, dict] = {}
+_settings_cache: dict[str, str | None] = {}
+_settings_cache_revision = -1
+
+
+def _cached_setting(key: str) -> str | None:
+    """get_setting с кэшем до следующего update_setting."""
+    global _settings_cache, _settings_cache_revision
+    from shop_bot.data_manager.database import get_settings_revision
+    revision = get_settings_revision()
+    if revision != _settings_cache_revision:
+        _settings_cache = {}
+        _settings_cache_revision = revision
+    if key not in _settings_cache:
+        _settings_cache[key] = get_setting(key)
+    return _settings_cache[key]
+
+
+def _layout_revision() -> tuple[int, int]:
+    from shop_bot.data_manager.database import get_button_configs_revision, get_settings_revision
+    return get_button_configs_revision(), get_settings_revision()
+
+
+def _compile_layout(menu_type: str) -> dict | None:
+    # Ревизию берём до чтения БД: изменение во время компиляции сбросит результат при следующем вызове
+    revision = _layout_revision()
+    cached = _compiled_layouts.get(menu_type)
+    if cached and cached["revision"] == revision:
+        return cached
     try:
         from shop_bot.data_manager.database import get_button_configs
         configs = get_button_configs(menu_type)
@@ -64,116 +89,108 @@ def _build_keyboard_from_db(
         logger.warning(f"DB configs for {menu_type} not available: {e}")
         return None
 
-    if not configs:
-        return None
-
-    builder = InlineKeyboardBuilder()
-
-    # Group by row, keep positions and widths
-    rows: dict[int, list[dict]] = {}
+    buttons: list[dict] = []
     added: set[str] = set()
-
-    for cfg in configs:
+    for cfg in configs or []:
         if not cfg.get('is_active', True):
             continue
-        if filter_func and not filter_func(cfg):
-            continue
-
-        text = cfg.get('text', '') or ''
         callback_data = cfg.get('callback_data')
         url = cfg.get('url')
-        button_id = (cfg.get('button_id') or '').strip()
-
         if not callback_data and not url:
             continue
-
+        button_id = (cfg.get('button_id') or '').strip()
         # Deduplicate by button_id if provided
         if button_id:
             if button_id in added:
                 continue
             added.add(button_id)
-
-        # Apply text replacements (e.g., counts)
-        if text_replacements:
-            try:
-                for k, v in text_replacements.items():
-                    text = text.replace(k, str(v))
-            except Exception:
-                pass
-
-        row_pos = int(cfg.get('row_position', 0) or 0)
-        col_pos = int(cfg.get('column_position', 0) or 0)
-        sort_order = int(cfg.get('sort_order', 0) or 0)
-        width = int(cfg.get('button_width', 1) or 1)
-
-        rows.setdefault(row_pos, []).append({
-            'text': text,
+        buttons.append({
+            'cfg': cfg,
+            'text': cfg.get('text', '') or '',
             'callback_data': callback_data,
             'url': url,
-            'width': max(1, min(width, 3)),
-            'col': col_pos,
-            'sort': sort_order,
+            'row': int(cfg.get('row_position', 0) or 0),
+            'width': max(1, min(int(cfg.get('button_width', 1) or 1), 3)),
+            'col': int(cfg.get('column_position', 0) or 0),
+            'sort': int(cfg.get('sort_order', 0) or 0),
         })
+    buttons.sort(key=lambda b: (b['row'], b['col'], b['sort']))
+    compiled = {"revision": revision, "buttons": buttons, "packed": {}}
+    _compiled_layouts[menu_type] = compiled
+    return compiled
+
+
+def _pack_rows(buttons: list[dict], visible: tuple[int, ...]) -> list[list[int]]:
+    """Разложить видимые кнопки по рядам: ширина 2+ — весь ряд, две соседние ширины 1 — пара."""
+    rows: list[list[int]] = []
+    i = 0
+    while i < len(visible):
+        btn = buttons[visible[i]]
+        if btn['width'] == 1 and i + 1 < len(visible):
+            nxt = buttons[visible[i + 1]]
+            if nxt['row'] == btn['row'] and nxt['width'] == 1:
+                rows.append([visible[i], visible[i + 1]])
+                i += 2
+                continue
+        rows.append([visible[i]])
+        i += 1
+    return rows
+
+
+def _make_button(btn: dict, text_replacements: dict[str, str] | None) -> InlineKeyboardButton:
+    text = btn['text']
+    # Apply text replacements (e.g., counts)
+    if text_replacements:
+        for k, v in text_replacements.items():
+            if k in text:
+                text = text.replace(k, str(v))
+    if btn['callback_data']:
+        return InlineKeyboardButton(text=text, callback_data=btn['callback_data'])
+    return InlineKeyboardButton(text=text, url=btn['url'])
+
+
+def _build_keyboard_from_db(
+    menu_type: str,
+    text_replacements: dict[str, str] | None = None,
+    filter_func: Callable[[dict], bool] | None = None,
+) -> InlineKeyboardMarkup | None:
+    """Build InlineKeyboardMarkup from button configs for a given menu_type.
+    Uses the compiled layout; only per-user filtering and text substitutions run per call.
+    Returns None if configs are missing or on error.
+    """
+    compiled = _compile_layout(menu_type)
+    if not compiled or not compiled["buttons"]:
+        return None
 
-    if not rows:
+    buttons = compiled["buttons"]
+    visible = tuple(
+        idx for idx, btn in enumerate(buttons)
+        if not filter_func or filter_func(btn['cfg'])
+    )
+    if not visible:
         return None
 
-    # Build keyboard respecting row positions and button widths
     # In Telegram: width 1 = half row, width 2+ = full row
-    for row_idx in sorted(rows.keys()):
-        row_buttons = sorted(rows[row_idx], key=lambda b: (b['col'], b['sort']))
-        
-        # Process buttons for this row position
-        i = 0
-        while i < len(row_buttons):
-            btn = row_buttons[i]
-            button_width = btn['width']
-            
-            # Width 2+ means full row
-            if button_width >= 2:
-                # Add as single button in row
-                if btn['callback_data']:
-                    builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                elif btn['url']:
-                    builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                i += 1
-            else:
-                # Width 1 - try to pair with next button if it also has width 1
-                if i + 1 < len(row_buttons) and row_buttons[i + 1]['width'] == 1:
-                    # Add two buttons in one row
-                    btn2 = row_buttons[i + 1]
-                    buttons = []
-                    
-                    if btn['callback_data']:
-                        buttons.append(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                    elif btn['url']:
-                        buttons.append(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                    
-                    if btn2['callback_data']:
-                        buttons.append(InlineKeyboardButton(text=btn2['text'], callback_data=btn2['callback_data']))
-                    elif btn2['url']:
-                        buttons.append(InlineKeyboardButton(text=btn2['text'], url=btn2['url']))
-                    
-                    builder.row(*buttons)
-                    i += 2
-                else:
-                    # Single button with width 1 - add alone
-                    if btn['callback_data']:
-                        builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                    elif btn['url']:
-                        builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                    i += 1
+    packed = compiled["packed"].get(visible)
+    if packed is None:
+        packed = _pack_rows(buttons, visible)
+        compiled["packed"][visible] = packed
 
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [_make_button(buttons[idx], text_replacements) for idx in row]
+        for row in packed
+    ])
 
 
 def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin: bool) -> InlineKeyboardMarkup:
+    trial_enabled = _cached_setting("trial_enabled") == "true"
+
     # Prepare filters and replacements for main menu
     def _filter(cfg: dict) -> bool:
         button_id = (cfg.get('button_id') or '').strip()
         # Filter trial button
         if button_id == 'btn_try':
-            if not trial_available or get_setting("trial_enabled") != "true":
+            if not trial_available or not trial_enabled:
                 return False
         # Filter admin button
         if button_id == 'btn_admin' and not is_admin:
@@ -191,147 +208,27 @@ def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin:
     if kb:
         return kb
     
-    # Fallback to original implementation if DB config not available
-    builder = InlineKeyboardBuilder()
-    
-    # Try to get button configurations from database first
-    try:
-        from shop_bot.data_manager.database import get_button_configs
-        button_configs = get_button_configs('main_menu')
-
-        logger.info(f"Loaded {len(button_configs)} button configs from database")
-
-        if button_configs:
-            # Группируем по строкам с учётом позиций
-            rows: dict[int, list[dict]] = {}
-            added_buttons: set[str] = set()
-
-            for cfg in button_configs:
-                if not cfg.get('is_active', True):
-                    continue
-
-                text = cfg.get('text', '') or ''
-                callback_data = cfg.get('callback_data')
-                url = cfg.get('url')
-                button_id = cfg.get('button_id', '') or ''
-
-                # Пропускаем пустые действия
-                if not callback_data and not url:
-                    continue
-
-                # Фильтры по условиям (trial/admin)
-                if button_id == 'btn_try':
-                    if not trial_available or get_setting("trial_enabled") != "true":
-                        continue
-                if button_id == 'btn_admin' and not is_admin:
-                    continue
-
-                # Подстановка счётчика ключей
-                if button_id == 'btn_my_keys':
-                    try:
-                        text = text.replace('{count}', str(len(user_keys))).replace('((count))', f'({len(user_keys)})')
-                    except Exception:
-                        pass
-
-                # Исключаем дубликаты по button_id
-                if button_id:
-                    if button_id in added_buttons:
-                        logger.warning(f"Duplicate button detected: {button_id}, skipping")
-                        continue
-                    added_buttons.add(button_id)
-
-                row_pos = int(cfg.get('row_position', 0) or 0)
-                col_pos = int(cfg.get('column_position', 0) or 0)
-                sort_order = int(cfg.get('sort_order', 0) or 0)
-                width = int(cfg.get('button_width', 1) or 1)
-
-                rows.setdefault(row_pos, []).append({
-                    'text': text,
-                    'callback_data': callback_data,
-                    'url': url,
-                    'width': max(1, min(int(width), 3)),
-                    'col': col_pos,
-                    'sort': sort_order,
-                })
-
-            # Функция добавления кнопки в билдер
-            def _add(btn: dict):
-                if btn['callback_data']:
-                    builder.button(text=btn['text'], callback_data=btn['callback_data'])
-                elif btn['url']:
-                    builder.button(text=btn['text'], url=btn['url'])
-
-            # Build keyboard respecting row positions and button widths
-            # In Telegram: width 1 = half row, width 2+ = full row
-            for row_idx in sorted(rows.keys()):
-                row_buttons = sorted(rows[row_idx], key=lambda b: (b['col'], b['sort']))
-                
-                # Process buttons for this row position
-                i = 0
-                while i < len(row_buttons):
-                    btn = row_buttons[i]
-                    button_width = btn['width']
-                    
-                    # Width 2+ means full row
-                    if button_width >= 2:
-                        # Add as single button in row
-                        if btn['callback_data']:
-                            builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                        elif btn['url']:
-                            builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                        i += 1
-                    else:
-                        # Width 1 - try to pair with next button if it also has width 1
-                        if i + 1 < len(row_buttons) and row_buttons[i + 1]['width'] == 1:
-                            # Add two buttons in one row
-                            btn2 = row_buttons[i + 1]
-                            buttons = []
-                            
-                            if btn['callback_data']:
-                                buttons.append(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                            elif btn['url']:
-                                buttons.append(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                            
-                            if btn2['callback_data']:
-                                buttons.append(InlineKeyboardButton(text=btn2['text'], callback_data=btn2['callback_data']))
-                            elif btn2['url']:
-                                buttons.append(InlineKeyboardButton(text=btn2['text'], url=btn2['url']))
-                            
-                            builder.row(*buttons)
-                            i += 2
-                        else:
-                            # Single button with width 1 - add alone
-                            if btn['callback_data']:
-                                builder.row(InlineKeyboardButton(text=btn['text'], callback_data=btn['callback_data']))
-                            elif btn['url']:
-                                builder.row(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-                            i += 1
-
-
-            return builder.as_markup()
-    except Exception as e:
-        logger.warning(f"Failed to load button configs from database: {e}, falling back to settings")
-    
-    # Fallback to original hardcoded logic
+    # Fallback to hardcoded logic if DB config not available
     logger.info("Using fallback hardcoded button logic")
-    if trial_available and get_setting("trial_enabled") == "true":
-        builder.button(text=(get_setting("btn_try") or "🎁 Попробовать бесплатно"), callback_data="get_trial")
+    builder = InlineKeyboardBuilder()
+    if trial_available and trial_enabled:
+        builder.button(text=(_cached_setting("btn_try") or "🎁 Попробовать бесплатно"), callback_data="get_trial")
 
-    builder.button(text=(get_setting("btn_profile") or "👤 Мой профиль"), callback_data="show_profile")
-    keys_label_tpl = (get_setting("btn_my_keys") or "🔑 Мои ключи ({count})")
+    builder.button(text=(_cached_setting("btn_profile") or "👤 Мой профиль"), callback_data="show_profile")
+    keys_label_tpl = (_cached_setting("btn_my_keys") or "🔑 Мои ключи ({count})")
     builder.button(text=keys_label_tpl.replace("{count}", str(len(user_keys))), callback_data="manage_keys")
-    builder.button(text=(get_setting("btn_buy_key") or "💳 Купить ключ"), callback_data="buy_new_key")
-    builder.button(text=(get_setting("btn_top_up") or "➕ Пополнить баланс"), callback_data="top_up_start")
-    builder.button(text=(get_setting("btn_referral") or "🤝 Реферальная программа"), callback_data="show_referral_program")
-    builder.button(text=(get_setting("btn_support") or "🆘 Поддержка"), callback_data="show_help")
-    builder.button(text=(get_setting("btn_about") or "ℹ️ О проекте"), callback_data="show_about")
-    builder.button(text=(get_setting("btn_howto") or "❓ Как использовать"), callback_data="howto_vless")
-    builder.button(text=(get_setting("btn_speed") or "⚡ Тест скорости"), callback_data="user_speedtest")
+    builder.button(text=(_cached_setting("btn_buy_key") or "💳 Купить ключ"), callback_data="buy_new_key")
+    builder.button(text=(_cached_setting("btn_top_up") or "➕ Пополнить баланс"), callback_data="top_up_start")
+    builder.button(text=(_cached_setting("btn_referral") or "🤝 Реферальная программа"), callback_data="show_referral_program")
+    builder.button(text=(_cached_setting("btn_support") or "🆘 Поддержка"), callback_data="show_help")
+    builder.button(text=(_cached_setting("btn_about") or "ℹ️ О проекте"), callback_data="show_about")
+    builder.button(text=(_cached_setting("btn_howto") or "❓ Как использовать"), callback_data="howto_vless")
+    builder.button(text=(_cached_setting("btn_speed") or "⚡ Тест скорости"), callback_data="user_speedtest")
     if is_admin:
-        builder.button(text=(get_setting("btn_admin") or "⚙️ Админка"), callback_data="admin_menu")
+        builder.button(text=(_cached_setting("btn_admin") or "⚙️ Админка"), callback_data="admin_menu")
 
     layout = [
-        1 if trial_available and get_setting("trial_enabled") == "true" else 0,  # триал
+        1 if trial_available and trial_enabled else 0,  # триал
         2,  # профиль + мои ключи
         2,  # купить ключ + пополнить баланс
         1,  # рефералка
@@ -608,7 +505,7 @@ def create_host_selection_keyboard(hosts: list, action: str) -> InlineKeyboardMa
     else:
         base_action = action
     prefix = f"select_host:{base_action}:{extra}:"
-    for host in hosts:
+    for host in host_health.rank_hosts(hosts):
         token = encode_host_callback_token(host['host_name'])
         builder.button(text=host['host_name'], callback_data=f"{prefix}{token}")
     builder.button(text=(get_setting("btn_back_to_menu") or "⬅️ Назад в меню"), callback_data="manage_keys" if action == 'new' else "back_to_main_menu")
@@ -670,14 +567,14 @@ def create_payment_method_keyboard(
     if payment_methods and payment_methods.get("cryptobot"):
         builder.button(text="🤖 CryptoBot", callback_data="pay_cryptobot")
     if payment_methods and payment_methods.get("yoomoney"):
-                builder.button(text="💜 ЮMoney (кошелёк)", callback_data="pay_yoomoney")
-            if payment_methods and payment_methods.get("unitpay"):
-                builder.button(text="💳 Unitpay (Карта/СБП)", callback_data="pay_unitpay")
-            if payment_methods and payment_methods.get("freekassa"):
-                builder.button(text="🪙 Freekassa (Crypto/Card)", callback_data="pay_freekassa")
-            if payment_methods and payment_methods.get("enot"):
-                builder.button(text="🦝 Enot.io (Карта/Crypto)", callback_data="pay_enot")
-            if payment_methods and payment_methods.get("stars"):
+        builder.button(text="💜 ЮMoney (кошелёк)", callback_data="pay_yoomoney")
+    if payment_methods and payment_methods.get("unitpay"):
+        builder.button(text="💳 Unitpay (Карта/СБП)", callback_data="pay_unitpay")
+    if payment_methods and payment_methods.get("freekassa"):
+        builder.button(text="🪙 Freekassa (Crypto/Card)", callback_data="pay_freekassa")
+    if payment_methods and payment_methods.get("enot"):
+        builder.button(text="🦝 Enot.io (Карта/Crypto)", callback_data="pay_enot")
+    if payment_methods and payment_methods.get("stars"):
         builder.button(text="⭐ Telegram Stars", callback_data="pay_stars")
     if payment_methods and payment_methods.get("tonconnect"):
         callback_data_ton = "pay_tonconnect"
@@ -855,6 +752,51 @@ def create_keys_management_keyboard(keys: list) -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+def create_keys_page_keyboard(keys: list, page: int, total_pages: int, start_index: int) -> InlineKeyboardMarkup:
+    """Список ключей одной страницы: кнопка на ключ, навигация по страницам и возврат в меню."""
+    builder = InlineKeyboardBuilder()
+    for offset, key in enumerate(keys):
+        host_name = key.get('host_name') or 'Неизвестный хост'
+        builder.row(InlineKeyboardButton(
+            text=f"{start_index + offset}. {host_name}",
+            callback_data=f"key_view:{key['key_id']}:{page}"
+        ))
+    if total_pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"keys_page:{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data=f"keys_page:{page}"))
+        if page < total_pages - 1:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"keys_page:{page + 1}"))
+        builder.row(*nav)
+    builder.row(InlineKeyboardButton(text="🔙 В меню", callback_data="main_menu"))
+    return builder.as_markup()
+
+def create_key_view_keyboard(key_id: int, page: int) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text=(_cached_setting("btn_extend_key") or "📅 Продлить"), callback_data=f"extend_key_{key_id}")
+    builder.button(text=(_cached_setting("btn_show_qr") or "📱 Показать QR-код"), callback_data=f"key_qr:{key_id}:{page}")
+    builder.button(text=(_cached_setting("btn_back_to_keys") or "⬅️ Назад к списку ключей"), callback_data=f"keys_page:{page}")
+    builder.adjust(2, 1)
+    return builder.as_markup()
+
+# Telegram допускает до 100 кнопок, но длинная простыня неудобна — остальные ключи доступны через «Мои ключи»
+EXPIRY_REMINDER_MAX_BUTTONS = 10
+
+def create_expiry_reminder_keyboard(keys: list[dict]) -> InlineKeyboardMarkup:
+    """Клавиатура напоминания об истечении: по кнопке продления на каждый ключ + «Мои ключи»."""
+    builder = InlineKeyboardBuilder()
+    if len(keys) == 1:
+        builder.button(text="🔑 Мои ключи", callback_data="manage_keys")
+        builder.button(text="➕ Продлить ключ", callback_data=f"extend_key_{keys[0]['key_id']}")
+        builder.adjust(2)
+        return builder.as_markup()
+    for key in keys[:EXPIRY_REMINDER_MAX_BUTTONS]:
+        builder.button(text=f"➕ Продлить #{key['key_id']} ({key.get('host_name') or '—'})", callback_data=f"extend_key_{key['key_id']}")
+    builder.button(text="🔑 Мои ключи", callback_data="manage_keys")
+    builder.adjust(1)
+    return builder.as_markup()
+
 def create_key_info_keyboard(key_id: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text=(get_setting("btn_extend_key") or "➕ Продлить этот ключ"), callback_data=f"extend_key_{key_id}")
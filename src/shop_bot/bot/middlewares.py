@@ -1,8 +1,58 @@
+import time
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
+from aiogram.types import TelegramObject, Message, CallbackQuery, Chat, InlineKeyboardMarkup, Update
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from shop_bot.data_manager.database import get_user, get_setting
+from shop_bot import logging_setup
+from shop_bot.data_manager import latency
+from shop_bot.data_manager import tracing
+from shop_bot.data_manager.database import is_user_banned, get_setting, get_settings_revision, get_admin_ids
+
+BAN_MESSAGE_TEXT = "🚫 Вы заблокированы и не можете использовать этого бота."
+
+# Клавиатура поддержки для забаненных: собирается один раз и пересобирается после изменения настроек
+_ban_keyboard: InlineKeyboardMarkup | None = None
+_ban_keyboard_revision = -1
+
+
+def _build_ban_keyboard() -> InlineKeyboardMarkup:
+    # Соберём клавиатуру поддержки без кнопки "Назад в меню"
+    try:
+        support = (get_setting("support_bot_username") or get_setting("support_user") or "").strip()
+    except Exception:
+        support = ""
+    kb_builder = InlineKeyboardBuilder()
+    url: str | None = None
+    if support:
+        if support.startswith("@"):  # @username
+            url = f"tg://resolve?domain={support[1:]}"
+        elif support.startswith("tg://"):
+            url = support
+        elif support.startswith("http://") or support.startswith("https://"):
+            try:
+                part = support.split("/")[-1].split("?")[0]
+                if part:
+                    url = f"tg://resolve?domain={part}"
+            except Exception:
+                url = support
+        else:
+            url = f"tg://resolve?domain={support}"
+    if url:
+        kb_builder.button(text="🆘 Написать в поддержку", url=url)
+    else:
+        kb_builder.button(text="🆘 Поддержка", callback_data="show_help")
+    return kb_builder.as_markup()
+
+
+def get_ban_keyboard() -> InlineKeyboardMarkup:
+    global _ban_keyboard, _ban_keyboard_revision
+    revision = get_settings_revision()
+    if _ban_keyboard is None or _ban_keyboard_revision != revision:
+        _ban_keyboard = _build_ban_keyboard()
+        _ban_keyboard_revision = revision
+    return _ban_keyboard
+
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(
@@ -12,56 +62,276 @@ class BanMiddleware(BaseMiddleware):
         data: Dict[str, Any]
     ) -> Any:
         user = data.get('event_from_user')
-        if not user:
+        if not user or not is_user_banned(user.id):
             return await handler(event, data)
 
-        user_data = get_user(user.id)
-        if user_data and user_data.get('is_banned'):
-            ban_message_text = "🚫 Вы заблокированы и не можете использовать этого бота."
-            # Соберём клавиатуру поддержки без кнопки "Назад в меню"
+        ban_kb = get_ban_keyboard()
+        if isinstance(event, CallbackQuery):
+            # Показать алерт и дополнительно отправить сообщение с кнопкой поддержки
+            await event.answer(BAN_MESSAGE_TEXT, show_alert=True)
             try:
-                support = (get_setting("support_bot_username") or get_setting("support_user") or "").strip()
+                await event.bot.send_message(
+                    chat_id=event.from_user.id,
+                    text=BAN_MESSAGE_TEXT,
+                    reply_markup=ban_kb
+                )
             except Exception:
-                support = ""
-            kb_builder = InlineKeyboardBuilder()
-            url: str | None = None
-            if support:
-                if support.startswith("@"):  # @username
-                    url = f"tg://resolve?domain={support[1:]}"
-                elif support.startswith("tg://"):
-                    url = support
-                elif support.startswith("http://") or support.startswith("https://"):
-                    try:
-                        part = support.split("/")[-1].split("?")[0]
-                        if part:
-                            url = f"tg://resolve?domain={part}"
-                    except Exception:
-                        url = support
-                else:
-                    url = f"tg://resolve?domain={support}"
-            if url:
-                kb_builder.button(text="🆘 Написать в поддержку", url=url)
-            else:
-                kb_builder.button(text="🆘 Поддержка", callback_data="show_help")
-            ban_kb = kb_builder.as_markup()
-
-            if isinstance(event, CallbackQuery):
-                # Показать алерт и дополнительно отправить сообщение с кнопкой поддержки
-                await event.answer(ban_message_text, show_alert=True)
+                pass
+        elif isinstance(event, Message):
+            try:
+                await event.answer(BAN_MESSAGE_TEXT, reply_markup=ban_kb)
+            except Exception:
+                # Фолбэк без клавиатуры
+                await event.answer(BAN_MESSAGE_TEXT)
+        return
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешний middleware на update: каждое обновление — отдельная трасса (см. data_manager.tracing)."""
+
+    def __init__(self, bot_kind: str):
+        self.bot_kind = bot_kind
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        with tracing.trace(
+            f"update {LatencyMiddleware._route(event, data)}", "update",
+            bot=self.bot_kind, update_id=getattr(event, 'update_id', None), user_id=user.id if user else None,
+        ):
+            return await handler(event, data)
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot API: каждый запрос к Telegram — спан текущей трассы."""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, '__api_method__', None) or type(method).__name__
+        with tracing.span(f"telegram.{api_method}", chat_id=getattr(method, 'chat_id', None)):
+            return await make_request(bot, method)
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Внешний middleware на update: добавляет update_id и user_id ко всем логам, записанным при его обработке."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        token = logging_setup.bind_log_context(
+            update_id=getattr(event, 'update_id', None), user_id=user.id if user else None
+        )
+        try:
+            return await handler(event, data)
+        finally:
+            logging_setup.reset_log_context(token)
+
+
+class LatencyMiddleware(BaseMiddleware):
+    """Внешний middleware на update: меряет полное время обработки и относит его к маршруту
+    (префикс callback_data, команда, состояние FSM или тип сообщения)."""
+
+    def __init__(self, bot_kind: str):
+        self.bot_kind = bot_kind
+
+    @staticmethod
+    def _route(event: TelegramObject, data: Dict[str, Any]) -> str:
+        if isinstance(event, Update):
+            if event.callback_query:
+                return latency.route_for_callback(event.callback_query.data)
+            message = event.message or event.edited_message
+            if message:
+                return latency.route_for_message(message.text, message.content_type, data.get('raw_state'))
+            return event.event_type
+        return type(event).__name__
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        ctx = latency.begin(self.bot_kind, self._route(event, data))
+        try:
+            result = await handler(event, data)
+        except Exception:
+            latency.finish(ctx, error=True)
+            raise
+        latency.finish(ctx)
+        return result
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: запоминает, какой обработчик сработал, для статистики задержек."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        callback = getattr(handler_object, 'callback', None)
+        if callback is not None:
+            latency.set_handler(getattr(callback, '__qualname__', None) or repr(callback))
+        return await handler(event, data)
+
+
+# --- Анти-флуд ---
+
+# Классы действий: (префиксы callback_data, ключ настройки с лимитом в минуту, значение по умолчанию)
+THROTTLE_CLASSES: dict[str, tuple[tuple[str, ...], str, int]] = {
+    "payment": (("pay_", "topup_pay_"), "throttle_payment_per_minute", 6),
+    "purchase": (("buy_new_key", "select_host:", "select_plan:", "get_trial", "extend_key"), "throttle_purchase_per_minute", 20),
+    "keys": (("manage_keys", "keys_page:", "key_view:", "key_qr:", "user_speedtest"), "throttle_keys_per_minute", 30),
+    "callback": ((), "throttle_callback_per_minute", 60),
+    "message": ((), "throttle_message_per_minute", 30),
+}
+THROTTLE_TEXT = "⏳ Слишком часто. Подождите {seconds} сек."
+# Не чаще одного предупреждения пользователю за этот интервал — иначе сами ответы станут флудом
+THROTTLE_NOTICE_INTERVAL = 10.0
+# Бакеты, не тронутые дольше этого срока, уже полные — их можно выбросить
+BUCKET_IDLE_SECONDS = 600.0
+BUCKET_PRUNE_SIZE = 10000
+
+_throttle_limits: dict[str, tuple[float, float]] | None = None
+_throttle_enabled = True
+_throttle_admins: set[int] = set()
+_throttle_revision = -1
+
+
+def _load_throttle_settings() -> None:
+    """Лимиты и список админов — из настроек, один раз на ревизию настроек."""
+    global _throttle_limits, _throttle_enabled, _throttle_admins, _throttle_revision
+    revision = get_settings_revision()
+    if _throttle_limits is not None and _throttle_revision == revision:
+        return
+    limits: dict[str, tuple[float, float]] = {}
+    for action, (_, key, default) in THROTTLE_CLASSES.items():
+        try:
+            per_minute = int(get_setting(key) or default)
+        except (TypeError, ValueError):
+            per_minute = default
+        # 0 — без ограничения для этого класса
+        if per_minute > 0:
+            # Скорость пополнения в секунду и ёмкость: четверть минутного лимита можно потратить сразу
+            limits[action] = (per_minute / 60.0, float(max(2, per_minute // 4)))
+    _throttle_limits = limits
+    _throttle_enabled = (get_setting("throttle_enabled") or "true").strip().lower() == "true"
+    try:
+        _throttle_admins = get_admin_ids()
+    except Exception:
+        _throttle_admins = set()
+    _throttle_revision = revision
+
+
+def classify_callback(data: str | None) -> str:
+    if data:
+        for action, (prefixes, _, _) in THROTTLE_CLASSES.items():
+            if prefixes and data.startswith(prefixes):
+                return action
+    return "callback"
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Внешний middleware на message/callback_query: токен-бакеты на пользователя и класс действия.
+
+    Повторное нажатие той же кнопки, пока первое ещё обрабатывается, отвечается сразу и в обработчик не идёт.
+    Ограничиваются только личные чаты; администраторы не ограничиваются.
+    """
+
+    def __init__(self):
+        # (user_id, класс) -> [токены, время последнего пополнения]
+        self._buckets: dict[tuple[int, str], list[float]] = {}
+        self._in_flight: set[tuple[int, str]] = set()
+        self._last_notice: dict[int, float] = {}
+        self.throttled = 0
+        self.coalesced = 0
+
+    def _take(self, user_id: int, action: str, now: float) -> float:
+        """Списать токен. Возвращает 0, если можно, иначе сколько секунд ждать."""
+        limit = _throttle_limits.get(action) if _throttle_limits else None
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        bucket = self._buckets.get((user_id, action))
+        if bucket is None:
+            if len(self._buckets) >= BUCKET_PRUNE_SIZE:
+                self._prune(now)
+            bucket = self._buckets[(user_id, action)] = [burst, now]
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1.0:
+            bucket[0] = tokens - 1.0
+            return 0.0
+        bucket[0] = tokens
+        return (1.0 - tokens) / rate
+
+    def _prune(self, now: float) -> None:
+        for key in [k for k, b in self._buckets.items() if now - b[1] > BUCKET_IDLE_SECONDS]:
+            del self._buckets[key]
+        for user_id in [u for u, t in self._last_notice.items() if now - t > THROTTLE_NOTICE_INTERVAL]:
+            del self._last_notice[user_id]
+
+    def _should_notify(self, user_id: int, now: float) -> bool:
+        if now - self._last_notice.get(user_id, 0.0) < THROTTLE_NOTICE_INTERVAL:
+            return False
+        self._last_notice[user_id] = now
+        return True
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        if not user or (chat is not None and chat.type != "private"):
+            return await handler(event, data)
+        _load_throttle_settings()
+        if not _throttle_enabled or user.id in _throttle_admins:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if isinstance(event, CallbackQuery):
+            flight_key = (user.id, event.data or "")
+            if flight_key in self._in_flight:
+                self.coalesced += 1
                 try:
-                    await event.bot.send_message(
-                        chat_id=event.from_user.id,
-                        text=ban_message_text,
-                        reply_markup=ban_kb
-                    )
+                    await event.answer()
                 except Exception:
                     pass
-            elif isinstance(event, Message):
+                return
+            wait = self._take(user.id, classify_callback(event.data), now)
+            if wait:
+                self.throttled += 1
                 try:
-                    await event.answer(ban_message_text, reply_markup=ban_kb)
+                    await event.answer(THROTTLE_TEXT.format(seconds=max(1, round(wait))))
                 except Exception:
-                    # Фолбэк без клавиатуры
-                    await event.answer(ban_message_text)
-            return
-        
+                    pass
+                return
+            self._in_flight.add(flight_key)
+            try:
+                return await handler(event, data)
+            finally:
+                self._in_flight.discard(flight_key)
+
+        if isinstance(event, Message):
+            wait = self._take(user.id, "message", now)
+            if wait:
+                self.throttled += 1
+                if self._should_notify(user.id, now):
+                    try:
+                        await event.answer(THROTTLE_TEXT.format(seconds=max(1, round(wait))))
+                    except Exception:
+                        pass
+                return
         return await handler(event, data)
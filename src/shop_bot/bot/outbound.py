@@ -0,0 +1,252 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from shop_bot.data_manager import metrics
+from shop_bot.data_manager import tracing
+
+logger = logging.getLogger(__name__)
+
+# Приоритетные полосы исходящих сообщений: меньше — важнее
+PRIORITY_PAYMENT = 0
+PRIORITY_SUPPORT = 1
+PRIORITY_REMINDER = 2
+PRIORITY_MARKETING = 3
+
+LANES = {
+    PRIORITY_PAYMENT: "payments",
+    PRIORITY_SUPPORT: "support",
+    PRIORITY_REMINDER: "reminders",
+    PRIORITY_MARKETING: "marketing",
+}
+
+# Лимиты Telegram: ~30 сообщений/сек на бота, ~1/сек в один чат, ~20/мин в одну группу.
+# Берём с запасом.
+GLOBAL_RATE_PER_SECOND = 25
+GLOBAL_BURST = 25
+CHAT_RATE_PER_SECOND = 1
+CHAT_BURST = 3
+GROUP_RATE_PER_SECOND = 20 / 60
+GROUP_BURST = 5
+
+MAX_IN_FLIGHT = 16
+MAX_ATTEMPTS = 3
+# Бакеты чатов, не использовавшиеся дольше этого времени, удаляются при разрастании словаря
+CHAT_BUCKETS_PRUNE_THRESHOLD = 10_000
+CHAT_BUCKET_IDLE_SECONDS = 120
+
+
+class _Bucket:
+    """Token bucket в форме GCRA: хранит только теоретическое время следующей отправки."""
+
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.tat = 0.0
+
+    def delay(self, now: float) -> float:
+        return max(0.0, max(self.tat, now) - self.tolerance - now)
+
+    def reserve(self, now: float) -> float:
+        """Занять слот; возвращает, сколько нужно подождать до отправки."""
+        tat = max(self.tat, now)
+        wait = max(0.0, tat - self.tolerance - now)
+        self.tat = tat + self.interval
+        return wait
+
+
+class _Item:
+    __slots__ = ("bot", "method", "kwargs", "future", "priority", "attempts", "span")
+
+    def __init__(self, bot: Bot, method: str, kwargs: dict, future: asyncio.Future, priority: int,
+                 span: "tracing.Span | None" = None):
+        self.bot = bot
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.priority = priority
+        self.attempts = 0
+        # Спан отправителя: запрос к Bot API выполняется в задаче диспетчера, но попадает в его трассу
+        self.span = span
+
+
+class OutboundDispatcher:
+    """Единая очередь исходящих вызовов Bot API для всех отправителей (бот, планировщик, веб-панель).
+
+    Работает в основном цикле событий: выбирает сообщение с наивысшим приоритетом,
+    соблюдая общий лимит бота и лимит конкретного чата, и повторяет отправку после RetryAfter.
+    """
+
+    def __init__(self):
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.PriorityQueue | None = None
+        self._worker: asyncio.Task | None = None
+        self._in_flight: asyncio.Semaphore | None = None
+        self._seq = itertools.count()
+        self._global: dict[int, _Bucket] = {}
+        self._chats: dict[tuple[int, int], _Bucket] = {}
+        self._paused_until: dict[int, float] = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "sent": 0, "failed": 0, "retry_after": 0, "requeued": 0,
+            "lanes": {name: {"queued": 0, "sent": 0, "failed": 0} for name in LANES.values()},
+        }
+
+    def start(self, loop: asyncio.AbstractEventLoop | None = None) -> None:
+        """Запустить обработчик очереди. Вызывается из потока цикла событий."""
+        if self._worker and not self._worker.done():
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self._worker = self._loop.create_task(self._run())
+        logger.info("Диспетчер исходящих сообщений запущен.")
+
+    def _count(self, field: str, priority: int) -> None:
+        lane_name = LANES.get(priority, "marketing")
+        with self._stats_lock:
+            if field in self._stats:
+                self._stats[field] += 1
+            lane = self._stats["lanes"].get(lane_name)
+            if lane is not None and field in lane:
+                lane[field] += 1
+        if field == "retry_after":
+            metrics.OUTBOUND_RETRY_AFTER.inc(lane_name)
+        elif field in ("sent", "failed"):
+            metrics.OUTBOUND_SENDS.inc(lane_name, field)
+
+    async def call(self, bot: Bot, method: str, priority: int = PRIORITY_REMINDER, **kwargs):
+        """Поставить вызов bot.<method>(**kwargs) в очередь и дождаться результата."""
+        if not self._worker or self._worker.done():
+            self.start()
+        lane = LANES.get(priority, "marketing")
+        with tracing.span(f"outbound.{method}", lane=lane, chat_id=kwargs.get("chat_id")) as span:
+            future = self._loop.create_future()
+            self._count("queued", priority)
+            self._queue.put_nowait((priority, next(self._seq), _Item(bot, method, kwargs, future, priority, span)))
+            return await future
+
+    def call_threadsafe(self, bot: Bot, method: str, priority: int = PRIORITY_REMINDER, **kwargs) -> Future | None:
+        """То же из другого потока (Flask). Возвращает concurrent.futures.Future или None, если цикл не запущен."""
+        loop = self._loop
+        if not loop or not loop.is_running():
+            logger.warning(f"Диспетчер сообщений не запущен, {method} для {kwargs.get('chat_id')} пропущен.")
+            return None
+        return asyncio.run_coroutine_threadsafe(self.call(bot, method, priority, **kwargs), loop)
+
+    def _chat_bucket(self, bot_id: int, chat_id, now: float) -> _Bucket:
+        key = (bot_id, chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) > CHAT_BUCKETS_PRUNE_THRESHOLD:
+                self._chats = {
+                    k: b for k, b in self._chats.items() if b.tat > now - CHAT_BUCKET_IDLE_SECONDS
+                }
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = _Bucket(GROUP_RATE_PER_SECOND, GROUP_BURST) if is_group else _Bucket(CHAT_RATE_PER_SECOND, CHAT_BURST)
+            self._chats[key] = bucket
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            priority, seq, item = await self._queue.get()
+            if item.future.done():
+                continue
+            bot_id = item.bot.id
+            now = time.monotonic()
+            global_bucket = self._global.setdefault(bot_id, _Bucket(GLOBAL_RATE_PER_SECOND, GLOBAL_BURST))
+            wait = max(self._paused_until.get(bot_id, 0.0) - now, global_bucket.delay(now))
+            if wait > 0:
+                # Возвращаем в очередь и ждём: за это время может прийти более приоритетное сообщение
+                self._queue.put_nowait((priority, seq, item))
+                await asyncio.sleep(wait)
+                continue
+            chat_wait = self._chat_bucket(bot_id, item.kwargs.get("chat_id"), now).reserve(now)
+            if not chat_wait:
+                global_bucket.reserve(now)
+            # Если чат ещё ждёт своего слота, общий слот займёт _deliver в момент фактической отправки
+            self._loop.create_task(self._deliver(item, chat_wait))
+
+    async def _deliver(self, item: _Item, delay: float) -> None:
+        if delay:
+            await asyncio.sleep(delay)
+            bot_id = item.bot.id
+            now = time.monotonic()
+            if self._paused_until.get(bot_id, 0.0) > now:
+                # За время ожидания Telegram попросил паузу (RetryAfter) — возвращаем в очередь
+                self._queue.put_nowait((item.priority, next(self._seq), item))
+                return
+            global_wait = self._global.setdefault(bot_id, _Bucket(GLOBAL_RATE_PER_SECOND, GLOBAL_BURST)).reserve(now)
+            if global_wait:
+                await asyncio.sleep(global_wait)
+        async with self._in_flight:
+            try:
+                with tracing.resume(item.span):
+                    result = await getattr(item.bot, item.method)(**item.kwargs)
+            except TelegramRetryAfter as e:
+                self._count("retry_after", item.priority)
+                self._paused_until[item.bot.id] = time.monotonic() + e.retry_after
+                item.attempts += 1
+                logger.warning(f"Telegram просит подождать {e.retry_after} сек. (чат {item.kwargs.get('chat_id')}).")
+                if item.attempts < MAX_ATTEMPTS:
+                    self._count("requeued", item.priority)
+                    self._queue.put_nowait((item.priority, next(self._seq), item))
+                    return
+                self._count("failed", item.priority)
+                if not item.future.done():
+                    item.future.set_exception(e)
+            except Exception as e:
+                self._count("failed", item.priority)
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                self._count("sent", item.priority)
+                if not item.future.done():
+                    item.future.set_result(result)
+
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            stats = {
+                **{k: v for k, v in self._stats.items() if k != "lanes"},
+                "lanes": {name: dict(values) for name, values in self._stats["lanes"].items()},
+            }
+        stats["queue_size"] = self._queue.qsize() if self._queue else 0
+        now = time.monotonic()
+        stats["paused_seconds"] = max([until - now for until in self._paused_until.values()] + [0.0])
+        stats["chat_buckets"] = len(self._chats)
+        return stats
+
+
+dispatcher = OutboundDispatcher()
+metrics.OUTBOUND_QUEUE_SIZE.set_function(
+    lambda: {(): dispatcher._queue.qsize() if dispatcher._queue else 0}
+)
+
+
+def start(loop: asyncio.AbstractEventLoop | None = None) -> None:
+    dispatcher.start(loop)
+
+
+async def send_message(bot: Bot, chat_id, text: str, *, priority: int = PRIORITY_REMINDER, **kwargs):
+    return await dispatcher.call(bot, "send_message", priority, chat_id=chat_id, text=text, **kwargs)
+
+
+def send_message_threadsafe(bot: Bot, chat_id, text: str, *, priority: int = PRIORITY_REMINDER, **kwargs) -> Future | None:
+    return dispatcher.call_threadsafe(bot, "send_message", priority, chat_id=chat_id, text=text, **kwargs)
+
+
+async def call(bot: Bot, method: str, *, priority: int = PRIORITY_REMINDER, **kwargs):
+    """Любой метод отправки (send_document, copy_message, ...) через общую очередь."""
+    return await dispatcher.call(bot, method, priority, **kwargs)
+
+
+def get_stats() -> dict:
+    return dispatcher.get_stats()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import secrets
+import threading
+
+from aiogram import Bot, Dispatcher
+
+from shop_bot.data_manager.database import get_setting, update_setting
+
+logger = logging.getLogger(__name__)
+
+# Пути, на которые Telegram присылает обновления в режиме вебхука
+WEBHOOK_PATHS = {
+    "main": "/tg/webhook/main",
+    "support": "/tg/webhook/support",
+}
+
+DEFAULT_MAX_CONCURRENCY = 32
+# Сколько обновлений может ждать свободного слота; сверх этого отвечаем 503 и Telegram повторит доставку
+PENDING_PER_SLOT = 8
+
+
+def is_webhook_enabled() -> bool:
+    return str(get_setting("telegram_webhook_enabled") or "").lower() in ("true", "1", "yes", "on")
+
+
+def get_max_concurrency() -> int:
+    try:
+        return max(1, int(get_setting("telegram_webhook_max_concurrency") or DEFAULT_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return DEFAULT_MAX_CONCURRENCY
+
+
+def get_webhook_secret(kind: str) -> str:
+    """Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; создаётся при первом обращении."""
+    key = f"telegram_webhook_secret_{kind}"
+    secret = get_setting(key)
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        update_setting(key, secret)
+    return secret
+
+
+def build_webhook_url(kind: str) -> str | None:
+    domain = (get_setting("domain") or "").strip().rstrip("/")
+    if not domain:
+        return None
+    base = domain if domain.startswith(("http://", "https://")) else f"https://{domain}"
+    return f"{base}{WEBHOOK_PATHS[kind]}"
+
+
+class UpdateFeeder:
+    """Передаёт обновления из веб-потока в Dispatcher в основном цикле событий.
+
+    Каждое обновление обрабатывается отдельной задачей; одновременно — не больше max_concurrency.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, loop: asyncio.AbstractEventLoop, max_concurrency: int):
+        self._dp = dp
+        self._bot = bot
+        self._loop = loop
+        self._max_pending = max_concurrency * PENDING_PER_SLOT
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(self, update: dict) -> bool:
+        """Вызывается из потока Flask. False — приём закрыт или очередь переполнена."""
+        with self._lock:
+            if self._closed or self._pending >= self._max_pending:
+                return False
+            self._pending += 1
+        self._loop.call_soon_threadsafe(self._spawn, update)
+        return True
+
+    def _spawn(self, update: dict) -> None:
+        self._idle.clear()
+        self._loop.create_task(self._process(update))
+
+    async def _process(self, update: dict) -> None:
+        try:
+            async with self._semaphore:
+                await self._dp.feed_raw_update(self._bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {update.get('update_id')}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                idle = self._pending == 0
+            if idle:
+                self._idle.set()
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Перестать принимать обновления и дождаться уже принятых."""
+        with self._lock:
+            self._closed = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не все обновления успели обработаться до остановки вебхука.")
@@ -9,7 +9,9 @@ from aiogram.enums import ParseMode
 from shop_bot.data_manager import database
 from shop_bot.bot.handlers import get_user_router
 from shop_bot.bot.admin_handlers import get_admin_router
-from shop_bot.bot.middlewares import BanMiddleware
+from shop_bot.bot.middlewares import BanMiddleware, TracingMiddleware, TelegramTracingMiddleware, LogContextMiddleware, LatencyMiddleware, HandlerNameMiddleware, ThrottlingMiddleware
+from shop_bot.bot import webhook_mode
+from shop_bot.bot.fsm_storage import SQLiteStorage
 from shop_bot.bot import handlers
 
 logger = logging.getLogger(__name__)
@@ -21,6 +23,8 @@ class BotController:
         self._task = None
         self._is_running = False
         self._loop = None
+        self._feeder: webhook_mode.UpdateFeeder | None = None
+        self._mode: str | None = None
 
     def set_loop(self, loop: asyncio.AbstractEventLoop):
         self._loop = loop
@@ -31,6 +35,7 @@ class BotController:
 
     async def _start_polling(self):
         self._is_running = True
+        self._mode = "polling"
         logger.info("Запущен опрос Telegram (Основной-бот).")
         try:
             await self._dp.start_polling(self._bot)
@@ -41,12 +46,64 @@ class BotController:
         finally:
             logger.info("Опрос корректно остановлен.")
             self._is_running = False
+            self._mode = None
             self._task = None
             if self._bot:
                 await self._bot.close()
             self._bot = None
             self._dp = None
 
+    async def _start_webhook(self):
+        """Режим вебхука: Telegram присылает обновления на main-маршрут веб-панели.
+        Если вебхук установить не удалось — работаем через опрос, как раньше."""
+        url = webhook_mode.build_webhook_url("main")
+        try:
+            if not url:
+                raise ValueError("не задан домен (настройка domain)")
+            max_concurrency = webhook_mode.get_max_concurrency()
+            await self._bot.set_webhook(
+                url,
+                secret_token=webhook_mode.get_webhook_secret("main"),
+                allowed_updates=self._dp.resolve_used_update_types(),
+                max_connections=min(100, max_concurrency),
+            )
+        except Exception as e:
+            logger.error(f"Не удалось установить вебхук (Основной-бот), переключаюсь на опрос: {e}")
+            try:
+                await self._bot.delete_webhook()
+            except Exception:
+                pass
+            await self._start_polling()
+            return
+        self._feeder = webhook_mode.UpdateFeeder(self._dp, self._bot, asyncio.get_running_loop(), max_concurrency)
+        self._mode = "webhook"
+        self._is_running = True
+        logger.info(f"Вебхук установлен (Основной-бот): {url}, параллельная обработка до {max_concurrency} обновлений.")
+
+    async def _stop_webhook(self):
+        feeder, self._feeder = self._feeder, None
+        try:
+            if feeder:
+                await feeder.close()
+            if self._bot:
+                await self._bot.delete_webhook()
+        except Exception as e:
+            logger.warning(f"Не удалось снять вебхук (Основной-бот): {e}")
+        finally:
+            logger.info("Вебхук остановлен.")
+            if self._bot:
+                await self._bot.session.close()
+            self._is_running = False
+            self._mode = None
+            self._task = None
+            self._bot = None
+            self._dp = None
+
+    def feed_webhook_update(self, update: dict) -> bool:
+        """Принять обновление из веб-потока. False — бот не в режиме вебхука или перегружен."""
+        feeder = self._feeder
+        return feeder.submit(update) if feeder else False
+
     def start(self):
         if self._is_running:
             return {"status": "error", "message": "Бот уже запущен."}
@@ -66,12 +123,23 @@ class BotController:
 
         try:
             self._bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-            self._dp = Dispatcher()
+            self._bot.session.middleware(TelegramTracingMiddleware())
+            self._dp = Dispatcher(storage=SQLiteStorage("main"))
             
             # Вешаем BanMiddleware на уровни событий, где доступен event_from_user
             # Вместо уровня update, чтобы корректно отлавливать сообщения/колбэки забаненных пользователей
             self._dp.message.middleware(BanMiddleware())
             self._dp.callback_query.middleware(BanMiddleware())
+            # Трасса обновления, контекст логов, замер задержек (полное время + имя сработавшего обработчика)
+            self._dp.update.outer_middleware(TracingMiddleware("main"))
+            self._dp.update.outer_middleware(LogContextMiddleware())
+            self._dp.update.outer_middleware(LatencyMiddleware("main"))
+            self._dp.message.middleware(HandlerNameMiddleware())
+            self._dp.callback_query.middleware(HandlerNameMiddleware())
+            # Анти-флуд: один экземпляр на сообщения и колбэки, чтобы бакеты пользователя были общими
+            throttling = ThrottlingMiddleware()
+            self._dp.message.outer_middleware(throttling)
+            self._dp.callback_query.outer_middleware(throttling)
             
             user_router = get_user_router()
             admin_router = get_admin_router()
@@ -84,11 +152,6 @@ class BotController:
             self._dp.include_router(user_router)
             self._dp.include_router(admin_router)
             
-            try:
-                asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
-
             yookassa_shop_id = database.get_setting("yookassa_shop_id")
             yookassa_secret_key = database.get_setting("yookassa_secret_key")
             yookassa_enabled = bool(yookassa_shop_id and yookassa_secret_key)
@@ -108,44 +171,51 @@ class BotController:
             stars_flag = database.get_setting("stars_enabled")
             stars_enabled = str(stars_flag).lower() in ("true", "1", "yes", "on")
             # YooMoney (отдельная платёжка)
-        ym_flag = database.get_setting("yoomoney_enabled")
-        ym_wallet = database.get_setting("yoomoney_wallet")
-        yoomoney_enabled = (str(ym_flag).lower() in ("true", "1", "yes", "on")) and bool(ym_wallet)
-
-        # Unitpay
-        unitpay_flag = database.get_setting("unitpay_enabled")
-        unitpay_public = database.get_setting("unitpay_public_key")
-        unitpay_enabled = (str(unitpay_flag).lower() in ("true", "1", "yes", "on")) and bool(unitpay_public)
-
-        # Freekassa
-        freekassa_flag = database.get_setting("freekassa_enabled")
-        freekassa_shop = database.get_setting("freekassa_shop_id")
-        freekassa_enabled = (str(freekassa_flag).lower() in ("true", "1", "yes", "on")) and bool(freekassa_shop)
-
-        # Enot.io
-        enot_flag = database.get_setting("enot_enabled")
-        enot_shop = database.get_setting("enot_shop_id")
-        enot_enabled = (str(enot_flag).lower() in ("true", "1", "yes", "on")) and bool(enot_shop)
-
-        if yookassa_enabled:
-            Configuration.account_id = yookassa_shop_id
-            Configuration.secret_key = yookassa_secret_key
+            ym_flag = database.get_setting("yoomoney_enabled")
+            ym_wallet = database.get_setting("yoomoney_wallet")
+            yoomoney_enabled = (str(ym_flag).lower() in ("true", "1", "yes", "on")) and bool(ym_wallet)
+
+            # Unitpay
+            unitpay_flag = database.get_setting("unitpay_enabled")
+            unitpay_public = database.get_setting("unitpay_public_key")
+            unitpay_enabled = (str(unitpay_flag).lower() in ("true", "1", "yes", "on")) and bool(unitpay_public)
+
+            # Freekassa
+            freekassa_flag = database.get_setting("freekassa_enabled")
+            freekassa_shop = database.get_setting("freekassa_shop_id")
+            freekassa_enabled = (str(freekassa_flag).lower() in ("true", "1", "yes", "on")) and bool(freekassa_shop)
+
+            # Enot.io
+            enot_flag = database.get_setting("enot_enabled")
+            enot_shop = database.get_setting("enot_shop_id")
+            enot_enabled = (str(enot_flag).lower() in ("true", "1", "yes", "on")) and bool(enot_shop)
+
+            if yookassa_enabled:
+                Configuration.account_id = yookassa_shop_id
+                Configuration.secret_key = yookassa_secret_key
         
-        handlers.PAYMENT_METHODS = {
-            "yookassa": yookassa_enabled,
-            "heleket": heleket_enabled,
-            "cryptobot": cryptobot_enabled,
-            "tonconnect": tonconnect_enabled,
-            "stars": stars_enabled,
-            "yoomoney": yoomoney_enabled,
-            "unitpay": unitpay_enabled,
-            "freekassa": freekassa_enabled,
-            "enot": enot_enabled,
-        }
+            handlers.PAYMENT_METHODS = {
+                "yookassa": yookassa_enabled,
+                "heleket": heleket_enabled,
+                "cryptobot": cryptobot_enabled,
+                "tonconnect": tonconnect_enabled,
+                "stars": stars_enabled,
+                "yoomoney": yoomoney_enabled,
+                "unitpay": unitpay_enabled,
+                "freekassa": freekassa_enabled,
+                "enot": enot_enabled,
+            }
             handlers.TELEGRAM_BOT_USERNAME = bot_username
             handlers.ADMIN_ID = admin_id
 
-            self._task = asyncio.run_coroutine_threadsafe(self._start_polling(), self._loop)
+            if webhook_mode.is_webhook_enabled():
+                self._task = asyncio.run_coroutine_threadsafe(self._start_webhook(), self._loop)
+            else:
+                try:
+                    asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
+                except Exception as e:
+                    logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
+                self._task = asyncio.run_coroutine_threadsafe(self._start_polling(), self._loop)
             logger.info("Команда на запуск передана в цикл событий.")
             return {"status": "success", "message": "Команда на запуск бота отправлена."}
             
@@ -163,9 +233,12 @@ class BotController:
             return {"status": "error", "message": "Критическая ошибка: компоненты бота недоступны."}
 
         logger.info("Отправляю сигнал на корректную остановку...")
-        asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
+        if self._mode == "webhook":
+            asyncio.run_coroutine_threadsafe(self._stop_webhook(), self._loop)
+        else:
+            asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
         
         return {"status": "success", "message": "Команда на остановку бота отправлена."}
 
     def get_status(self):
-        return {"is_running": self._is_running}
\ No newline at end of file
+        return {"is_running": self._is_running, "mode": self._mode}
\ No newline at end of file
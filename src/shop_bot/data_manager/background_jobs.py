@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramForbiddenError
+
+from shop_bot.bot import outbound
+from shop_bot.data_manager.database import get_background_job, update_background_job
+
+logger = logging.getLogger(__name__)
+
+# Сколько уведомлений фоновой задачи ставится в очередь диспетчера за раз
+NOTIFY_CHUNK_SIZE = 200
+
+_runners: dict[str, Callable[[int, object], Awaitable[None]]] = {}
+_active: dict[int, Future] = {}
+_lock = threading.Lock()
+
+
+def register_runner(kind: str):
+    """Зарегистрировать корутину-исполнитель для задач вида kind: runner(job_id, bot_controller)."""
+    def decorator(func):
+        _runners[kind] = func
+        return func
+    return decorator
+
+
+def is_active(job_id: int) -> bool:
+    with _lock:
+        future = _active.get(job_id)
+        return future is not None and not future.done()
+
+
+def has_active(kind: str) -> bool:
+    with _lock:
+        job_ids = [job_id for job_id, future in _active.items() if not future.done()]
+    for job_id in job_ids:
+        job = get_background_job(job_id)
+        if job and job["kind"] == kind:
+            return True
+    return False
+
+
+def submit(job_id: int, loop: asyncio.AbstractEventLoop, bot_controller) -> bool:
+    """Запустить (или продолжить) задачу в основном цикле событий. False — уже выполняется или нет исполнителя."""
+    job = get_background_job(job_id)
+    if not job:
+        return False
+    runner = _runners.get(job["kind"])
+    if runner is None:
+        logger.error(f"Фоновые задачи: нет исполнителя для вида '{job['kind']}'")
+        return False
+    if not loop or not loop.is_running():
+        logger.error("Фоновые задачи: цикл событий не запущен.")
+        return False
+
+    async def _run():
+        try:
+            await runner(job_id, bot_controller)
+        except Exception as e:
+            logger.error(f"Фоновая задача #{job_id} завершилась с ошибкой: {e}", exc_info=True)
+            update_background_job(job_id, status="failed", error=str(e))
+
+    with _lock:
+        current = _active.get(job_id)
+        if current is not None and not current.done():
+            return False
+        update_background_job(job_id, status="running", error="")
+        _active[job_id] = asyncio.run_coroutine_threadsafe(_run(), loop)
+    return True
+
+
+def get_job_status(job_id: int) -> dict | None:
+    """Состояние задачи для админки. Задача в статусе running без живого исполнителя
+    (процесс перезапускался) отдаётся как 'interrupted' — её можно продолжить."""
+    job = get_background_job(job_id)
+    if not job:
+        return None
+    job["active"] = is_active(job_id)
+    if job["status"] == "running" and not job["active"]:
+        job["status"] = "interrupted"
+    return job
+
+
+async def send_rate_limited(bot, messages: list[tuple[int, str]],
+                            on_sent: Callable[[int], None] | None = None) -> int:
+    """Отправить сообщения (chat_id, text) через общий диспетчер исходящих сообщений.
+
+    Скорость и повторы после RetryAfter обеспечивает диспетчер. on_sent(chat_id) вызывается и для
+    доставленных, и для заблокировавших бота пользователей — повторно им писать бессмысленно.
+    Возвращает число доставленных сообщений.
+    """
+    delivered = 0
+
+    async def _send(chat_id: int, text: str) -> None:
+        nonlocal delivered
+        try:
+            await outbound.send_message(bot, chat_id, text, priority=outbound.PRIORITY_REMINDER)
+            delivered += 1
+            if on_sent:
+                on_sent(chat_id)
+        except TelegramForbiddenError:
+            if on_sent:
+                on_sent(chat_id)
+        except Exception as e:
+            logger.warning(f"Рассылка: не удалось отправить сообщение пользователю {chat_id}: {e}")
+
+    # Ставим в очередь порциями, чтобы не держать в памяти сотни тысяч ожидающих задач
+    for start in range(0, len(messages), NOTIFY_CHUNK_SIZE):
+        await asyncio.gather(*(_send(chat_id, text) for chat_id, text in messages[start:start + NOTIFY_CHUNK_SIZE]))
+    return delivered
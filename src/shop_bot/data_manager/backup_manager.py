@@ -1,6 +1,9 @@
+import hashlib
+import json
 import logging
 import shutil
 import sqlite3
+import time
 import zipfile
 from datetime import datetime
 from pathlib import Path
@@ -9,6 +12,13 @@ from aiogram import Bot
 from aiogram.types import FSInputFile
 
 from . import database
+from . import job_scheduler
+from shop_bot.bot import outbound
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен: без пакета бэкапы пакуются в zip
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
@@ -20,14 +30,123 @@ BACKUPS_DIR.mkdir(parents=True, exist_ok=True)
 DB_FILE: Path = database.DB_FILE
 
 
+# Шаг онлайн-бэкапа: копируем БД порциями страниц и отдаём блокировку писателям между порциями
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_SLEEP = 0.005
+# Размер блока потокового сжатия
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+DEFAULT_ZSTD_LEVEL = 3
+DEFAULT_ZIP_LEVEL = 6
+BACKUP_PATTERNS = ("db-backup-*.zip", "db-backup-*.db.zst")
+# Снимки БД телеметрии (если включены) лежат отдельно и администраторам не отправляются
+TELEMETRY_BACKUP_PATTERNS = ("telemetry-backup-*.zip", "telemetry-backup-*.db.zst")
+# Сводка последнего бэкапа для панели (переживает перезапуск)
+LAST_BACKUP_STATS_FILE = BACKUPS_DIR / "last-backup.json"
+# Что и когда последний раз отправлялось администраторам — чтобы не слать неизменившуюся БД
+LAST_DELIVERY_FILE = BACKUPS_DIR / "last-delivery.json"
+# Боты не могут загружать файлы больше 50 МБ — крупные архивы режутся на части с запасом
+DELIVERY_CHUNK_SIZE = 45 * 1024 * 1024
+
+
 def _timestamp() -> str:
     return datetime.now().strftime("%Y%m%d-%H%M%S")
 
 
+def zstd_available() -> bool:
+    return zstandard is not None
+
+
+def _compression_settings() -> tuple[str, int]:
+    """Кодек и уровень из настроек: zstd (если установлен пакет zstandard) или zip."""
+    codec = (database.get_setting("backup_compression") or "zstd").strip().lower()
+    if codec == "zstd" and zstandard is None:
+        codec = "zip"
+    default_level = DEFAULT_ZSTD_LEVEL if codec == "zstd" else DEFAULT_ZIP_LEVEL
+    try:
+        level = int(database.get_setting("backup_compression_level") or default_level)
+    except (TypeError, ValueError):
+        level = default_level
+    if codec == "zstd":
+        return codec, min(max(level, 1), 22)
+    return "zip", min(max(level, 0), 9)
+
+
+def list_backup_files(patterns: tuple[str, ...] = BACKUP_PATTERNS) -> list[Path]:
+    """Архивы бэкапов в BACKUPS_DIR, новые первыми."""
+    files: list[Path] = []
+    for pattern in patterns:
+        files.extend(BACKUPS_DIR.glob(pattern))
+    return sorted(files, key=lambda p: p.stat().st_mtime, reverse=True)
+
+
+def _copy_db_online(dst_path: Path, src_path: Path | None = None) -> None:
+    """Консистентная копия БД через backup API порциями по BACKUP_PAGES_PER_STEP страниц.
+
+    Между порциями блокировка отпускается, поэтому бот может писать; если БД изменилась,
+    SQLite сам перезапускает копирование, и результат остаётся консистентным.
+    """
+    with sqlite3.connect(src_path or DB_FILE) as src:
+        with sqlite3.connect(dst_path) as dst:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+
+
+def _compress(src_path: Path, dest_base: Path, codec: str, level: int, suffix: str = ".db") -> Path:
+    """Потоково сжимает файл блоками COMPRESS_CHUNK_SIZE, не читая его в память целиком."""
+    if codec == "zstd":
+        out_path = dest_base.with_name(dest_base.name + suffix + ".zst")
+        compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+        with open(src_path, "rb") as fin, open(out_path, "wb") as fout:
+            compressor.copy_stream(fin, fout, read_size=COMPRESS_CHUNK_SIZE, write_size=COMPRESS_CHUNK_SIZE)
+        return out_path
+    out_path = dest_base.with_name(dest_base.name + ".zip")
+    with zipfile.ZipFile(out_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
+        with open(src_path, "rb") as fin, zf.open(src_path.name, 'w', force_zip64=True) as fout:
+            shutil.copyfileobj(fin, fout, COMPRESS_CHUNK_SIZE)
+    return out_path
+
+
+def _decompress(archive_path: Path, dest_path: Path) -> None:
+    """Обратное к _compress: .zst или первый файл из .zip распаковывается в dest_path."""
+    if archive_path.name.lower().endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError("для архива .zst нужен пакет zstandard")
+        with open(archive_path, 'rb') as fin, open(dest_path, 'wb') as fout:
+            zstandard.ZstdDecompressor().copy_stream(fin, fout, read_size=COMPRESS_CHUNK_SIZE, write_size=COMPRESS_CHUNK_SIZE)
+        return
+    with zipfile.ZipFile(archive_path, 'r') as zf:
+        with zf.open(zf.namelist()[0]) as fin, open(dest_path, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, COMPRESS_CHUNK_SIZE)
+
+
+def _file_sha256(path: Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _save_backup_stats(stats: dict) -> None:
+    try:
+        tmp = LAST_BACKUP_STATS_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(stats, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(LAST_BACKUP_STATS_FILE)
+    except OSError as e:
+        logger.warning(f"Бэкап: не удалось сохранить статистику: {e}")
+
+
+def get_last_backup_stats() -> dict | None:
+    try:
+        return json.loads(LAST_BACKUP_STATS_FILE.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Бэкап: не удалось прочитать статистику: {e}")
+        return None
+
+
 def create_backup_file() -> Path | None:
     """
-    Создаёт zip-архив с консистентной копией SQLite-БД.
+    Создаёт архив (.db.zst или .zip) с консистентной копией SQLite-БД.
     Возвращает путь к архиву или None при ошибке.
+    Работает синхронно: из асинхронного кода вызывайте create_backup_file_async.
     """
     try:
         if not DB_FILE.exists():
@@ -35,35 +154,80 @@ def create_backup_file() -> Path | None:
             return None
         ts = _timestamp()
         tmp_db_copy = BACKUPS_DIR / f"users-{ts}.db"
-        zip_path = BACKUPS_DIR / f"db-backup-{ts}.zip"
-
-        # Безопасное резервное копирование через SQLite backup API
-        with sqlite3.connect(DB_FILE) as src:
-            with sqlite3.connect(tmp_db_copy) as dst:
-                src.backup(dst)
+        codec, level = _compression_settings()
 
-        # Упакуем в zip
-        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-            zf.write(tmp_db_copy, arcname=tmp_db_copy.name)
-
-        # Удалим временную копию .db
+        started = time.monotonic()
         try:
-            tmp_db_copy.unlink(missing_ok=True)
-        except Exception:
-            pass
+            _copy_db_online(tmp_db_copy)
+            copied = time.monotonic()
+            archive_path = _compress(tmp_db_copy, BACKUPS_DIR / f"db-backup-{ts}", codec, level)
+            db_size = tmp_db_copy.stat().st_size
+            db_sha256 = _file_sha256(tmp_db_copy)
+        finally:
+            # Удалим временную копию .db
+            try:
+                tmp_db_copy.unlink(missing_ok=True)
+            except Exception:
+                pass
+        finished = time.monotonic()
 
-        logger.info(f"Бэкап: создан файл {zip_path}")
-        return zip_path
+        archive_size = archive_path.stat().st_size
+        duration = finished - started
+        stats = {
+            "file": archive_path.name,
+            "codec": codec,
+            "level": level,
+            "db_bytes": db_size,
+            "archive_bytes": archive_size,
+            "db_sha256": db_sha256,
+            "ratio": round(db_size / archive_size, 2) if archive_size else None,
+            "copy_seconds": round(copied - started, 3),
+            "compress_seconds": round(finished - copied, 3),
+            "duration_seconds": round(duration, 3),
+            "throughput_mb_s": round(db_size / 1048576 / duration, 2) if duration > 0 else None,
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if (database.get_setting("backup_include_telemetry") or "false") == "true":
+            telemetry_path = _backup_telemetry(ts, codec, level)
+            if telemetry_path:
+                stats["telemetry_file"] = telemetry_path.name
+                stats["telemetry_archive_bytes"] = telemetry_path.stat().st_size
+        _save_backup_stats(stats)
+        logger.info(
+            f"Бэкап: создан файл {archive_path} — {db_size / 1048576:.1f} МБ → {archive_size / 1048576:.1f} МБ "
+            f"(x{stats['ratio']}, {codec}-{level}) за {duration:.2f} с "
+            f"(копирование {stats['copy_seconds']} с, сжатие {stats['compress_seconds']} с), {stats['throughput_mb_s']} МБ/с"
+        )
+        return archive_path
     except Exception as e:
         logger.error(f"Бэкап: не удалось создать архив: {e}", exc_info=True)
         return None
 
 
+def _backup_telemetry(ts: str, codec: str, level: int) -> Path | None:
+    """Отдельный архив БД телеметрии: в основной бэкап и рассылку админам она не входит."""
+    if not database.TELEMETRY_DB_FILE.exists():
+        return None
+    tmp_copy = BACKUPS_DIR / f"telemetry-{ts}.db"
+    try:
+        _copy_db_online(tmp_copy, database.TELEMETRY_DB_FILE)
+        return _compress(tmp_copy, BACKUPS_DIR / f"telemetry-backup-{ts}", codec, level)
+    except Exception as e:
+        logger.warning(f"Бэкап: не удалось сохранить БД телеметрии: {e}")
+        return None
+    finally:
+        tmp_copy.unlink(missing_ok=True)
+
+
+async def create_backup_file_async() -> Path | None:
+    """create_backup_file в рабочем потоке, чтобы не останавливать цикл событий бота."""
+    return await job_scheduler.to_thread(create_backup_file)
+
+
 def cleanup_old_backups(keep: int = 7) -> None:
     """Хранить только N последних архивов, остальные удалять."""
     try:
-        files = sorted(BACKUPS_DIR.glob("db-backup-*.zip"), key=lambda p: p.stat().st_mtime, reverse=True)
-        for f in files[keep:]:
+        for f in list_backup_files()[keep:] + list_backup_files(TELEMETRY_BACKUP_PATTERNS)[keep:]:
             try:
                 f.unlink(missing_ok=True)
             except Exception:
@@ -72,9 +236,84 @@ def cleanup_old_backups(keep: int = 7) -> None:
         logger.warning(f"Бэкап: не удалось очистить старые архивы: {e}")
 
 
-async def send_backup_to_admins(bot: Bot, zip_path: Path) -> int:
+def _read_json(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Бэкап: не удалось прочитать {path.name}: {e}")
+        return None
+
+
+def _content_hash(archive_path: Path) -> str:
+    """Хеш содержимого БД для архива: из статистики, если это последний созданный бэкап, иначе хеш файла."""
+    stats = get_last_backup_stats()
+    if stats and stats.get("file") == archive_path.name and stats.get("db_sha256"):
+        return stats["db_sha256"]
+    return _file_sha256(archive_path)
+
+
+def split_into_chunks(archive_path: Path, chunk_size: int = DELIVERY_CHUNK_SIZE) -> tuple[list[Path], Path]:
+    """Режет архив на части не больше chunk_size и пишет рядом .sha256 (формат sha256sum -c).
+
+    Собрать обратно: cat <имя>.part* > <имя>; проверить: sha256sum -c <имя>.sha256
+    """
+    parts_dir = BACKUPS_DIR / "parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    parts: list[Path] = []
+    lines: list[str] = []
+    with open(archive_path, "rb") as fin:
+        index = 1
+        while True:
+            part_path = parts_dir / f"{archive_path.name}.part{index:03d}"
+            digest = hashlib.sha256()
+            written = 0
+            with open(part_path, "wb") as fout:
+                while written < chunk_size:
+                    block = fin.read(min(COMPRESS_CHUNK_SIZE, chunk_size - written))
+                    if not block:
+                        break
+                    fout.write(block)
+                    digest.update(block)
+                    written += len(block)
+            if not written:
+                part_path.unlink(missing_ok=True)
+                break
+            parts.append(part_path)
+            lines.append(f"{digest.hexdigest()}  {part_path.name}")
+            index += 1
+    lines.append(f"{_file_sha256(archive_path)}  {archive_path.name}")
+    checksum_path = parts_dir / f"{archive_path.name}.sha256"
+    checksum_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return parts, checksum_path
+
+
+async def _fan_out_document(bot: Bot, admin_ids: list[int], path: Path, caption: str) -> list[int]:
+    """Загрузить файл один раз (первому доступному админу), остальным переслать по file_id.
+    Возвращает ID администраторов, которым файл дошёл."""
+    file_id: str | None = None
+    delivered: list[int] = []
+    for uid in admin_ids:
+        try:
+            message = await outbound.call(
+                bot, "send_document", priority=outbound.PRIORITY_SUPPORT,
+                chat_id=int(uid), document=file_id or FSInputFile(str(path)), caption=caption
+            )
+            delivered.append(uid)
+            if file_id is None and message is not None and message.document:
+                file_id = message.document.file_id
+        except Exception as e:
+            logger.error(f"Бэкап: не удалось отправить {path.name} администратору {uid}: {e}")
+    return delivered
+
+
+async def send_backup_to_admins(bot: Bot, zip_path: Path, force: bool = False) -> int:
     """
-    Отправляет архив всем администраторам. Возвращает число успешных отправок.
+    Отправляет архив всем администраторам. Возвращает число администраторов, получивших его целиком.
+    Файл загружается в Telegram один раз, остальным рассылается по file_id; крупный архив
+    уходит частями с файлом контрольных сумм. Если содержимое БД не изменилось с прошлой
+    отправки, ничего не отправляется (force=True — отправить всё равно).
     """
     cnt = 0
     try:
@@ -86,14 +325,47 @@ async def send_backup_to_admins(bot: Bot, zip_path: Path) -> int:
         if not admin_ids:
             logger.warning("Бэкап: нет администраторов для отправки архива")
             return 0
-        caption = f"🗄 Бэкап БД: {zip_path.name}"
-        file = FSInputFile(str(zip_path))
-        for uid in admin_ids:
+
+        content_hash = await job_scheduler.to_thread(_content_hash, zip_path)
+        last = _read_json(LAST_DELIVERY_FILE) or {}
+        if not force and last.get("content_sha256") == content_hash:
+            logger.info(f"Бэкап: БД не изменилась с отправки {last.get('file')} ({last.get('sent_at')}), {zip_path.name} не отправляю")
+            return 0
+
+        size = zip_path.stat().st_size
+        if size <= DELIVERY_CHUNK_SIZE:
+            cnt = len(await _fan_out_document(bot, admin_ids, zip_path, f"🗄 Бэкап БД: {zip_path.name}"))
+        else:
+            parts, checksum_path = await job_scheduler.to_thread(split_into_chunks, zip_path)
             try:
-                await bot.send_document(chat_id=int(uid), document=file, caption=caption)
-                cnt += 1
-            except Exception as e:
-                logger.error(f"Бэкап: не удалось отправить администратору {uid}: {e}")
+                delivered = {uid: 0 for uid in admin_ids}
+                for index, part in enumerate(parts, start=1):
+                    caption = f"🗄 Бэкап БД: {zip_path.name}, часть {index}/{len(parts)}"
+                    if index == 1:
+                        caption += (
+                            f"\nСобрать: cat {zip_path.name}.part* > {zip_path.name}"
+                            f"\nПроверить: sha256sum -c {checksum_path.name}"
+                        )
+                    # У каждой части свой file_id: загружаем её один раз и рассылаем
+                    for uid in await _fan_out_document(bot, admin_ids, part, caption):
+                        delivered[uid] += 1
+                for uid in await _fan_out_document(bot, admin_ids, checksum_path, f"🔐 Контрольные суммы: {zip_path.name}"):
+                    delivered[uid] += 1
+                cnt = sum(1 for n in delivered.values() if n == len(parts) + 1)
+            finally:
+                for p in [*parts, checksum_path]:
+                    p.unlink(missing_ok=True)
+            logger.info(f"Бэкап: {zip_path.name} ({size / 1048576:.1f} МБ) отправлен частями: {len(parts)}")
+
+        if cnt:
+            try:
+                LAST_DELIVERY_FILE.write_text(json.dumps({
+                    "content_sha256": content_hash,
+                    "file": zip_path.name,
+                    "sent_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                }, ensure_ascii=False), encoding="utf-8")
+            except OSError as e:
+                logger.warning(f"Бэкап: не удалось сохранить отметку об отправке: {e}")
         return cnt
     except Exception as e:
         logger.error(f"Бэкап: ошибка при рассылке архива: {e}", exc_info=True)
@@ -123,9 +395,10 @@ def validate_db_file(db_path: Path) -> bool:
         return False
 
 
-def restore_from_file(uploaded_path: Path) -> bool:
+def restore_from_file(uploaded_path: Path, until: datetime | None = None) -> bool:
     """
-    Восстанавливает основную БД из переданного файла .db или .zip (внутри .db).
+    Восстанавливает основную БД из переданного файла .db, .zip (внутри .db) или .db.zst.
+    Для manifest.json инкрементальной цепочки БД собирается на момент until (None — на последний сегмент).
     Делает резервную копию текущей БД на случай отката.
     """
     try:
@@ -149,6 +422,22 @@ def restore_from_file(uploaded_path: Path) -> bool:
             except Exception as e:
                 logger.error(f"Восстановление: не удалось распаковать архив: {e}")
                 return False
+        elif uploaded_path.name.lower().endswith('.zst'):
+            try:
+                candidate_db = tmp_dir / (uploaded_path.name[:-4] if uploaded_path.name.lower().endswith('.db.zst') else uploaded_path.stem + '.db')
+                _decompress(uploaded_path, candidate_db)
+            except Exception as e:
+                logger.error(f"Восстановление: не удалось распаковать архив: {e}")
+                return False
+        elif uploaded_path.name == "manifest.json":
+            # Цепочка инкрементальных бэкапов: базовый снимок + сегменты WAL до момента until
+            from . import incremental_backup
+            try:
+                candidate_db = tmp_dir / "pitr.db"
+                incremental_backup.materialize(uploaded_path.parent, candidate_db, until)
+            except Exception as e:
+                logger.error(f"Восстановление: не удалось собрать БД из цепочки {uploaded_path.parent.name}: {e}")
+                return False
         else:
             # Ожидаем, что это .db
             candidate_db = uploaded_path
@@ -163,9 +452,9 @@ def restore_from_file(uploaded_path: Path) -> bool:
             return False
 
         # Бэкап текущей БД
-        backup_before = BACKUPS_DIR / f"before-restore-{_timestamp()}.zip"
         cur_backup = create_backup_file()
         if cur_backup and cur_backup.exists():
+            backup_before = BACKUPS_DIR / cur_backup.name.replace("db-backup-", f"before-restore-{_timestamp()}-", 1)
             try:
                 shutil.copy(cur_backup, backup_before)
             except Exception:
@@ -181,6 +470,8 @@ def restore_from_file(uploaded_path: Path) -> bool:
             database.run_migration()
         except Exception:
             pass
+        # В восстановленной базе другие ключи, настройки, кнопки и баны: сбрасываем кэши во всех экземплярах
+        database.bump_all_revisions()
 
         logger.info("Восстановление: база данных успешно заменена")
         return True
@@ -4,11 +4,201 @@ import logging
 from pathlib import Path
 import json
 import re
+import secrets
+import sys
+import threading
+import time
+
+from shop_bot.data_manager import latency
+from shop_bot.data_manager import metrics
 
 logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path("/app/project") if Path("/app/project").exists() else Path(".")
 DB_FILE = PROJECT_ROOT / "users.db"
+# Телеметрия (метрики ресурсов, спидтесты) — отдельный файл: частые вставки не спорят
+# с платежами за блокировку записи и не раздувают бэкапы основной БД
+TELEMETRY_DB_FILE = PROJECT_ROOT / "telemetry.db"
+TELEMETRY_TABLES = ("host_speedtests", "host_metrics", "resource_metrics")
+TELEMETRY_MIGRATION_BATCH = 5000
+TELEMETRY_PRUNE_BATCH = 5000
+# Отметка в telemetry_meta: перенос таблиц из основной БД выполнен и больше не повторяется
+TELEMETRY_MIGRATED_MARKER = "legacy_tables_migrated"
+
+# Пока работают инкрементальные бэкапы, чекпойнты WAL делает только incremental_backup:
+# иначе изменения могли бы попасть в основной файл БД мимо отправленных сегментов.
+# Это касается каждого процесса на общей БД, а не только лидера, поэтому включён ли режим,
+# _connect() узнаёт из настройки (не чаще раза в WAL_POLICY_TTL_SECONDS).
+_wal_autocheckpoint = True
+WAL_POLICY_TTL_SECONDS = 30.0
+# Совпадает с incremental_backup.DEFAULT_INTERVAL_MIN: пустая настройка — режим включён
+_INCREMENTAL_DEFAULT_INTERVAL_MIN = 15
+_incremental_enabled = False
+_wal_policy_checked_at: float | None = None
+
+def set_wal_autocheckpoint(enabled: bool) -> None:
+    global _wal_autocheckpoint
+    _wal_autocheckpoint = enabled
+
+def _incremental_backups_enabled(conn: sqlite3.Connection) -> bool:
+    global _incremental_enabled, _wal_policy_checked_at
+    now = time.monotonic()
+    if _wal_policy_checked_at is None or now - _wal_policy_checked_at >= WAL_POLICY_TTL_SECONDS:
+        try:
+            row = conn.execute(
+                "SELECT value FROM bot_settings WHERE key = 'backup_incremental_interval_min'"
+            ).fetchone()
+        except sqlite3.Error:
+            # Таблицы ещё нет (первый запуск) — оставляем прошлое решение и спросим в следующий раз
+            return _incremental_enabled
+        try:
+            _incremental_enabled = int((row[0] if row else None) or _INCREMENTAL_DEFAULT_INTERVAL_MIN) > 0
+        except (TypeError, ValueError):
+            _incremental_enabled = True
+        _wal_policy_checked_at = now
+    return _incremental_enabled
+
+class _TimedConnection(sqlite3.Connection):
+    """Соединение, которое при выходе из with записывает время работы хелпера в метрики."""
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            metrics.DB_QUERY_DURATION.observe(time.perf_counter() - self.started_at, self.db_name, self.helper)
+
+def _open_timed(path: Path, db_name: str, helper: str) -> _TimedConnection:
+    conn = sqlite3.connect(path, factory=_TimedConnection)
+    conn.db_name = db_name
+    conn.helper = helper
+    conn.started_at = time.perf_counter()
+    return conn
+
+def _connect() -> sqlite3.Connection:
+    """Соединение с DB_FILE; внутри обработчика обновления вызов учитывается в статистике задержек."""
+    helper = sys._getframe(1).f_code.co_name
+    if latency.is_tracking():
+        latency.count_db_call(helper)
+    conn = _open_timed(DB_FILE, "main", helper)
+    if not _wal_autocheckpoint or _incremental_backups_enabled(conn):
+        conn.execute("PRAGMA wal_autocheckpoint=0")
+    return conn
+
+def _connect_telemetry() -> sqlite3.Connection:
+    """Соединение с TELEMETRY_DB_FILE: потеря последних метрик при сбое питания допустима, поэтому synchronous=NORMAL."""
+    helper = sys._getframe(1).f_code.co_name
+    if latency.is_tracking():
+        latency.count_db_call(helper)
+    conn = _open_timed(TELEMETRY_DB_FILE, "telemetry", helper)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def attach_telemetry(conn: sqlite3.Connection) -> None:
+    """Подключить БД телеметрии к соединению с основной как схему telemetry (для JOIN)."""
+    conn.execute("ATTACH DATABASE ? AS telemetry", (str(TELEMETRY_DB_FILE),))
+
+# Общие ревизии кэшей в таблице cache_revisions: их видят все экземпляры, работающие с этой БД.
+# Процесс перечитывает таблицу не чаще раза в REVISION_POLL_SECONDS, свои изменения видит сразу.
+# Новое значение — не меньше time.time_ns(), чтобы после восстановления БД из бэкапа ревизия
+# не совпала со старой.
+REVISION_POLL_SECONDS = 2.0
+REVISION_NAMES = ("keys", "settings", "button_configs", "banned")
+_revisions: dict[str, int] = {}
+_revisions_loaded_at = 0.0
+_revisions_lock = threading.Lock()
+
+def _bump_revision(name: str) -> None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO cache_revisions (name, revision) VALUES (?, ?)
+                ON CONFLICT(name) DO UPDATE SET revision = MAX(revision + 1, excluded.revision)
+                RETURNING revision
+                """,
+                (name, time.time_ns())
+            )
+            revision = cursor.fetchone()[0]
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось обновить ревизию '{name}': {e}")
+        # Хотя бы в этом процессе кэш должен сброситься
+        revision = time.time_ns()
+    with _revisions_lock:
+        _revisions[name] = revision
+
+def _get_revision(name: str) -> int:
+    global _revisions_loaded_at
+    now = time.monotonic()
+    if now - _revisions_loaded_at >= REVISION_POLL_SECONDS:
+        try:
+            with _connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT name, revision FROM cache_revisions")
+                loaded = dict(cursor.fetchall())
+            with _revisions_lock:
+                _revisions.clear()
+                _revisions.update(loaded)
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось прочитать ревизии кэшей: {e}")
+        _revisions_loaded_at = now
+    return _revisions.get(name, 0)
+
+def bump_all_revisions() -> None:
+    """Сбросить все кэши во всех экземплярах — после замены БД (восстановление из бэкапа)."""
+    for name in REVISION_NAMES:
+        _bump_revision(name)
+
+# Ревизия ключей/хостов: кэши, собранные из vpn_keys (подписки и т.п.),
+# сравнивают сохранённую ревизию с текущей и пересобираются при расхождении.
+def _bump_keys_revision():
+    _bump_revision("keys")
+
+def get_keys_revision() -> int:
+    return _get_revision("keys")
+
+# Ревизия настроек: растёт при каждом update_setting, по ней сбрасываются кэши,
+# зависящие от bot_settings (клавиатуры и т.п.).
+def get_settings_revision() -> int:
+    return _get_revision("settings")
+
+# Ревизия button_configs: клавиатуры меню компилируются один раз и пересобираются при её изменении.
+def _bump_button_configs_revision():
+    _bump_revision("button_configs")
+
+def get_button_configs_revision() -> int:
+    return _get_revision("button_configs")
+
+# Множество забаненных telegram_id: BanMiddleware проверяет его на каждом обновлении
+# вместо запроса к БД. ban_user/unban_user (в любом экземпляре) двигают ревизию 'banned',
+# и множество перечитывается, когда она расходится с загруженной.
+_banned_ids: set[int] | None = None
+_banned_ids_revision: int | None = None
+_banned_ids_lock = threading.Lock()
+
+def load_banned_ids() -> int:
+    """(Пере)загрузить множество забаненных из БД. Возвращает их число."""
+    global _banned_ids, _banned_ids_revision
+    # Ревизию берём до чтения: бан, сохранённый во время загрузки, вызовет ещё одну перезагрузку
+    revision = _get_revision("banned")
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT telegram_id FROM users WHERE is_banned = 1")
+            banned = {row[0] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось загрузить список забаненных: {e}")
+        return len(_banned_ids or ())
+    with _banned_ids_lock:
+        _banned_ids = banned
+        _banned_ids_revision = revision
+    return len(banned)
+
+def is_user_banned(telegram_id: int) -> bool:
+    if _banned_ids is None or _get_revision("banned") != _banned_ids_revision:
+        load_banned_ids()
+    return telegram_id in (_banned_ids or ())
 
 def normalize_host_name(name: str | None) -> str:
     """Normalize host name by trimming and removing invisible/unicode spaces.
@@ -21,7 +211,9 @@ def normalize_host_name(name: str | None) -> str:
 
 def initialize_db():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
+            # WAL: читатели не блокируют писателей, и на нём построены инкрементальные бэкапы
+            conn.execute("PRAGMA journal_mode=WAL")
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -119,42 +311,6 @@ def initialize_db():
                     FOREIGN KEY (ticket_id) REFERENCES support_tickets (ticket_id)
                 )
             ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS host_speedtests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    host_name TEXT NOT NULL,
-                    method TEXT NOT NULL, -- 'ssh' | 'net'
-                    ping_ms REAL,
-                    jitter_ms REAL,
-                    download_mbps REAL,
-                    upload_mbps REAL,
-                    server_name TEXT,
-                    server_id TEXT,
-                    ok INTEGER NOT NULL DEFAULT 1,
-                    error TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_speedtests_host_time ON host_speedtests(host_name, created_at DESC)")
-            
-            # Таблица для метрик ресурсов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS resource_metrics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    scope TEXT NOT NULL,                -- 'local' | 'host' | 'target'
-                    object_name TEXT NOT NULL,          -- 'panel' | host_name | target_name
-                    cpu_percent REAL,
-                    mem_percent REAL,
-                    disk_percent REAL,
-                    load1 REAL,
-                    net_bytes_sent INTEGER,
-                    net_bytes_recv INTEGER,
-                    raw_json TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_resource_metrics_scope_time ON resource_metrics(scope, object_name, created_at DESC)")
-            
             # Таблица для конфигураций кнопок
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS button_configs (
@@ -273,6 +429,29 @@ def initialize_db():
                 "yoomoney_client_id": None,
                 "yoomoney_client_secret": None,
                 "yoomoney_redirect_uri": None,
+                # Telegram webhook mode (иначе — long polling)
+                "telegram_webhook_enabled": "false",
+                "telegram_webhook_max_concurrency": "32",
+                # Сколько часов хранить незавершённые диалоги (покупка, пополнение, рассылка, поддержка)
+                "fsm_state_ttl_hours": "72",
+                # Анти-флуд: лимиты нажатий/сообщений в минуту на пользователя (0 — без ограничения)
+                "throttle_enabled": "true",
+                "throttle_payment_per_minute": "6",
+                "throttle_purchase_per_minute": "20",
+                "throttle_keys_per_minute": "30",
+                "throttle_callback_per_minute": "60",
+                "throttle_message_per_minute": "30",
+                # Сжатие бэкапов: zstd (нужен пакет zstandard) или zip; уровень для выбранного кодека
+                "backup_compression": "zstd",
+                "backup_compression_level": "3",
+                # Инкрементальные бэкапы (сегменты WAL) каждые N минут, 0 — выключены
+                "backup_incremental_interval_min": "15",
+                # Сохранять ли рядом с бэкапом отдельный архив БД телеметрии
+                "backup_include_telemetry": "false",
+                # Сколько дней хранить строки телеметрии (метрики, спидтесты); 0 — не удалять
+                "telemetry_retention_days": "30",
+                # Bearer-токен для /metrics; пусто — эндпоинт выключен (403)
+                "metrics_token": "",
             }
             run_migration()
             for key, value in default_settings.items():
@@ -332,7 +511,7 @@ def create_promo_code(
     if (discount_percent or 0) <= 0 and (discount_amount or 0) <= 0:
         raise ValueError("discount must be positive")
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cols = _promo_columns(conn)
             # prefer valid_to in this project; migration didn't add valid_until
@@ -372,7 +551,7 @@ def get_promo_code(code: str) -> dict | None:
     if not code_s:
         return None
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM promo_codes WHERE code = ?", (code_s,))
@@ -390,7 +569,7 @@ def list_promo_codes(include_inactive: bool = True) -> list[dict]:
         query += " WHERE COALESCE(is_active, active, 1) = 1"
     query += " ORDER BY created_at DESC"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(query)
@@ -406,7 +585,7 @@ def check_promo_code_available(code: str, user_id: int) -> tuple[dict | None, st
         return None, "empty_code"
     user_id_i = int(user_id)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cols = _promo_columns(conn)
@@ -500,7 +679,7 @@ def update_promo_code_status(code: str, *, is_active: bool | None = None) -> boo
         return False
     params.append(code_s)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(f"UPDATE promo_codes SET {', '.join(sets)} WHERE code = ?", params)
             conn.commit()
@@ -523,7 +702,7 @@ def redeem_promo_code(
     user_id_i = int(user_id)
     applied_amount_f = float(applied_amount)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cols = _promo_columns(conn)
@@ -607,6 +786,170 @@ def redeem_promo_code(
         logging.error(f"Ошибка использования промокода: {e}")
         return None
 
+def initialize_telemetry_db():
+    """Создаёт таблицы телеметрии в TELEMETRY_DB_FILE (WAL, инкрементальный auto_vacuum)."""
+    try:
+        with _connect_telemetry() as conn:
+            # auto_vacuum меняется только до создания первой таблицы — для новой БД этого достаточно
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS host_speedtests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    host_name TEXT NOT NULL,
+                    method TEXT NOT NULL, -- 'ssh' | 'net'
+                    ping_ms REAL,
+                    jitter_ms REAL,
+                    download_mbps REAL,
+                    upload_mbps REAL,
+                    server_name TEXT,
+                    server_id TEXT,
+                    ok INTEGER NOT NULL DEFAULT 1,
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_speedtests_host_time ON host_speedtests(host_name, created_at DESC)")
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS host_metrics (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    host_name TEXT NOT NULL,
+                    cpu_percent REAL,
+                    mem_percent REAL,
+                    mem_used INTEGER,
+                    mem_total INTEGER,
+                    disk_percent REAL,
+                    disk_used INTEGER,
+                    disk_total INTEGER,
+                    load1 REAL,
+                    load5 REAL,
+                    load15 REAL,
+                    uptime_seconds REAL,
+                    ok INTEGER NOT NULL DEFAULT 1,
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_metrics_host_time ON host_metrics(host_name, created_at DESC)")
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS resource_metrics (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    scope TEXT NOT NULL,                -- 'local' | 'host' | 'target'
+                    object_name TEXT NOT NULL,          -- 'panel' | host_name | target_name
+                    cpu_percent REAL,
+                    mem_percent REAL,
+                    disk_percent REAL,
+                    load1 REAL,
+                    net_bytes_sent INTEGER,
+                    net_bytes_recv INTEGER,
+                    raw_json TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_resource_metrics_scope_time ON resource_metrics(scope, object_name, created_at DESC)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS telemetry_meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось инициализировать БД телеметрии: {e}")
+
+def prune_telemetry(retention_days: int) -> int:
+    """Удалить строки телеметрии старше retention_days и вернуть освободившиеся страницы файлу.
+
+    Удаление идёт порциями (каждая — своя транзакция), затем PRAGMA incremental_vacuum
+    (файл создан с auto_vacuum=INCREMENTAL). Возвращает число удалённых строк.
+    """
+    if retention_days <= 0:
+        return 0
+    deleted = 0
+    try:
+        with _connect_telemetry() as conn:
+            cursor = conn.cursor()
+            for table in TELEMETRY_TABLES:
+                while True:
+                    cursor.execute(
+                        f"DELETE FROM {table} WHERE id IN ("
+                        f"SELECT id FROM {table} WHERE datetime(created_at) < datetime('now', ?) LIMIT ?)",
+                        (f"-{int(retention_days)} days", TELEMETRY_PRUNE_BATCH),
+                    )
+                    removed = cursor.rowcount
+                    conn.commit()
+                    deleted += removed
+                    if removed < TELEMETRY_PRUNE_BATCH:
+                        break
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось очистить старую телеметрию: {e}")
+    return deleted
+
+def migrate_telemetry_tables():
+    """Переносит строки телеметрии из основной БД в TELEMETRY_DB_FILE порциями и удаляет старые таблицы.
+
+    Выполняется один раз: по завершении в telemetry_meta ставится отметка, и повторные вызовы
+    (в том числе после восстановления основной БД из старого бэкапа) ничего не переносят.
+    Порции переносятся отдельными транзакциями, чтобы не держать блокировку записи долго.
+    Транзакция над двумя файлами в режиме WAL не атомарна: при сбое между фиксациями строки
+    могут остаться и в telemetry, и в основной БД. Поэтому id переносится вместе со строкой,
+    а вставка идёт через INSERT OR IGNORE — повторный запуск пропускает уже перенесённые строки
+    и только удаляет их из основной БД. Перед переносом счётчик AUTOINCREMENT в telemetry
+    поднимается до максимального старого id, чтобы новые записи не занимали id переносимых строк.
+    """
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT name FROM sqlite_master WHERE type='table' AND name IN ({','.join('?' * len(TELEMETRY_TABLES))})",
+                TELEMETRY_TABLES,
+            )
+            legacy = [row[0] for row in cursor.fetchall()]
+            attach_telemetry(conn)
+            cursor.execute("SELECT value FROM telemetry.telemetry_meta WHERE key = ?", (TELEMETRY_MIGRATED_MARKER,))
+            marker = cursor.fetchone()
+            if marker:
+                if legacy:
+                    logging.warning(
+                        f"Телеметрия: в основной БД снова есть таблицы {', '.join(legacy)} (восстановлена из старого бэкапа?), "
+                        f"но перенос уже выполнялся {marker[0]} — пропускаю."
+                    )
+                cursor.execute("DETACH DATABASE telemetry")
+                return
+            for table in legacy:
+                main_cols = [r[1] for r in cursor.execute(f"PRAGMA main.table_info({table})").fetchall()]
+                tele_cols = {r[1] for r in cursor.execute(f"PRAGMA telemetry.table_info({table})").fetchall()}
+                cols = ", ".join(c for c in main_cols if c in tele_cols)
+                cursor.execute(f"SELECT MAX(id) FROM main.{table}")
+                max_id = cursor.fetchone()[0]
+                if max_id is not None:
+                    cursor.execute("UPDATE telemetry.sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (max_id, table))
+                    if cursor.rowcount == 0:
+                        cursor.execute("INSERT INTO telemetry.sqlite_sequence (name, seq) VALUES (?, ?)", (table, max_id))
+                    conn.commit()
+                moved = 0
+                while True:
+                    cursor.execute(f"SELECT MAX(id) FROM (SELECT id FROM main.{table} ORDER BY id LIMIT ?)", (TELEMETRY_MIGRATION_BATCH,))
+                    last_id = cursor.fetchone()[0]
+                    if last_id is None:
+                        break
+                    cursor.execute(
+                        f"INSERT OR IGNORE INTO telemetry.{table} ({cols}) SELECT {cols} FROM main.{table} WHERE id <= ? ORDER BY id",
+                        (last_id,),
+                    )
+                    cursor.execute(f"DELETE FROM main.{table} WHERE id <= ?", (last_id,))
+                    moved += cursor.rowcount
+                    conn.commit()
+                cursor.execute(f"DROP TABLE main.{table}")
+                conn.commit()
+                logging.info(f"Телеметрия: таблица '{table}' перенесена в {TELEMETRY_DB_FILE.name} (строк: {moved}).")
+            cursor.execute(
+                "INSERT OR REPLACE INTO telemetry.telemetry_meta (key, value) VALUES (?, datetime('now'))",
+                (TELEMETRY_MIGRATED_MARKER,),
+            )
+            conn.commit()
+            cursor.execute("DETACH DATABASE telemetry")
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось перенести таблицы телеметрии: {e}")
+
 def run_migration():
     if not DB_FILE.exists():
         logging.error("Файл базы данных users.db не найден. Мигрировать нечего.")
@@ -615,7 +958,7 @@ def run_migration():
     logging.info(f"Начинаю миграцию базы данных: {DB_FILE}")
 
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = _connect()
         cursor = conn.cursor()
 
         logging.info("Миграция таблицы 'users' ...")
@@ -652,13 +995,20 @@ def run_migration():
             logging.info(" -> Столбец 'referral_start_bonus_received' успешно добавлен.")
         else:
             logging.info(" -> Столбец 'referral_start_bonus_received' уже существует.")
-        
+
+        if 'sub_token' not in columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN sub_token TEXT")
+            logging.info(" -> Столбец 'sub_token' успешно добавлен.")
+        else:
+            logging.info(" -> Столбец 'sub_token' уже существует.")
+
         logging.info("Таблица 'users' успешно обновлена.")
 
         # Индексы для ускорения фильтрации/сортировки пользователей
         try:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_reg_date ON users(registration_date)")
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_sub_token ON users(sub_token)")
             conn.commit()
             logging.info(" -> Индексы для 'users' созданы/проверены.")
         except sqlite3.Error as e:
@@ -753,6 +1103,14 @@ def run_migration():
             if 'ssh_key_path' not in xh_columns:
                 cursor.execute("ALTER TABLE xui_hosts ADD COLUMN ssh_key_path TEXT")
                 logging.info(" -> Столбец 'ssh_key_path' успешно добавлен в 'xui_hosts'.")
+            # Параметры inbound (порт, reality) для локальной сборки ссылок подписки
+            if 'inbound_params' not in xh_columns:
+                cursor.execute("ALTER TABLE xui_hosts ADD COLUMN inbound_params TEXT")
+                logging.info(" -> Столбец 'inbound_params' успешно добавлен в 'xui_hosts'.")
+            # Число клиентов на панели по последней синхронизации: нагрузка для выбора хоста на всех экземплярах
+            if 'panel_clients' not in xh_columns:
+                cursor.execute("ALTER TABLE xui_hosts ADD COLUMN panel_clients INTEGER")
+                logging.info(" -> Столбец 'panel_clients' успешно добавлен в 'xui_hosts'.")
             # Clean up host_name values from invisible spaces and trim
             try:
                 cursor.execute(
@@ -775,63 +1133,157 @@ def run_migration():
                 logging.warning(f" -> Не удалось нормализовать существующие значения host_name: {e}")
         else:
             logging.warning("Таблица 'xui_hosts' не найдена, пропускаю её миграцию.")
-        # Create table for host speedtests
+        # Телеметрия живёт в отдельном файле: переносим старые таблицы из основной БД
+        initialize_telemetry_db()
+        migrate_telemetry_tables()
+
+        # Background jobs (host migration etc.) and per-key progress for resuming
         try:
             cursor = conn.cursor()
             cursor.execute(
                 '''
-                CREATE TABLE IF NOT EXISTS host_speedtests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    host_name TEXT NOT NULL,
-                    method TEXT NOT NULL, -- 'ssh' | 'net'
-                    ping_ms REAL,
-                    jitter_ms REAL,
-                    download_mbps REAL,
-                    upload_mbps REAL,
-                    server_name TEXT,
-                    server_id TEXT,
-                    ok INTEGER NOT NULL DEFAULT 1,
+                CREATE TABLE IF NOT EXISTS background_jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending', -- 'pending' | 'running' | 'done' | 'failed'
+                    params TEXT,
+                    progress TEXT,
                     error TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
                 )
                 '''
             )
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_speedtests_host_time ON host_speedtests(host_name, created_at DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_background_jobs_kind_time ON background_jobs(kind, created_at DESC)")
+            cursor.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS host_migration_items (
+                    job_id INTEGER NOT NULL,
+                    key_id INTEGER NOT NULL,
+                    user_id INTEGER,
+                    key_email TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending', -- 'pending' | 'moved' | 'done' | 'failed'
+                    error TEXT,
+                    notified INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (job_id, key_id)
+                )
+                '''
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_migration_items_status ON host_migration_items(job_id, status)")
             conn.commit()
-            logging.info("Таблица 'host_speedtests' готова к использованию.")
+            logging.info("Таблицы 'background_jobs' и 'host_migration_items' готовы к использованию.")
         except sqlite3.Error as e:
-            logging.error(f"Не удалось создать 'host_speedtests': {e}")
+            logging.error(f"Не удалось создать таблицы фоновых задач: {e}")
 
-        # Create table for host resource metrics (monitor history)
+        # Состояния FSM aiogram: переживают перезапуск, устаревшие удаляются по expires_at
         try:
             cursor = conn.cursor()
             cursor.execute(
                 '''
-                CREATE TABLE IF NOT EXISTS host_metrics (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    host_name TEXT NOT NULL,
-                    cpu_percent REAL,
-                    mem_percent REAL,
-                    mem_used INTEGER,
-                    mem_total INTEGER,
-                    disk_percent REAL,
-                    disk_used INTEGER,
-                    disk_total INTEGER,
-                    load1 REAL,
-                    load5 REAL,
-                    load15 REAL,
-                    uptime_seconds REAL,
-                    ok INTEGER NOT NULL DEFAULT 1,
-                    error TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    storage_key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    expires_at REAL NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                '''
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage(expires_at)")
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось создать таблицу fsm_storage: {e}")
+
+        # Telegram file_id загруженных QR-кодов: повторная отправка без загрузки картинки
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS qr_file_ids (
+                    content_hash TEXT NOT NULL,
+                    bot_id INTEGER NOT NULL,
+                    file_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (content_hash, bot_id)
                 )
                 '''
             )
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_host_metrics_host_time ON host_metrics(host_name, created_at DESC)")
             conn.commit()
-            logging.info("Таблица 'host_metrics' готова к использованию.")
         except sqlite3.Error as e:
-            logging.error(f"Не удалось создать 'host_metrics': {e}")
+            logging.error(f"Не удалось создать таблицу qr_file_ids: {e}")
+
+        # Состояние фоновых задач планировщика: переживает перезапуск, чтобы не повторять бэкапы и спидтесты
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    name TEXT PRIMARY KEY,
+                    last_started_at TEXT,
+                    last_finished_at TEXT,
+                    last_duration_ms INTEGER,
+                    last_status TEXT,
+                    last_error TEXT,
+                    next_run_at TEXT,
+                    run_count INTEGER NOT NULL DEFAULT 0,
+                    fail_count INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+                '''
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось создать таблицу scheduled_jobs: {e}")
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS leader_leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    token INTEGER NOT NULL DEFAULT 0,
+                    expires_at REAL NOT NULL,
+                    renewed_at REAL NOT NULL
+                )
+                '''
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось создать таблицу leader_leases: {e}")
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS cache_revisions (
+                    name TEXT PRIMARY KEY,
+                    revision INTEGER NOT NULL
+                )
+                '''
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось создать таблицу cache_revisions: {e}")
+
+        # Отправленные напоминания об истечении: общие для всех экземпляров, чтобы новый лидер не повторял их
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS expiry_reminders_sent (
+                    key_id INTEGER NOT NULL,
+                    hours_mark INTEGER NOT NULL,
+                    expiry_date TEXT NOT NULL,
+                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (key_id, hours_mark)
+                )
+                '''
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Не удалось создать таблицу expiry_reminders_sent: {e}")
 
         # Ensure extra columns for standalone keys and promo table
         try:
@@ -844,6 +1296,13 @@ def run_migration():
             if 'is_gift' not in vk_cols:
                 cursor.execute("ALTER TABLE vpn_keys ADD COLUMN is_gift BOOLEAN DEFAULT 0")
                 logging.info(" -> Добавлен столбец 'is_gift' в 'vpn_keys'.")
+            if 'sub_token' not in vk_cols:
+                cursor.execute("ALTER TABLE vpn_keys ADD COLUMN sub_token TEXT")
+                logging.info(" -> Добавлен столбец 'sub_token' в 'vpn_keys'.")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_sub_token ON vpn_keys(sub_token)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry ON vpn_keys(expiry_date)")
+            # expiry_date хранится то с 'T', то с пробелом — сравнение идёт по datetime(), индекс по выражению
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_dt ON vpn_keys(datetime(expiry_date))")
             conn.commit()
         except sqlite3.Error as e:
             logging.error(f"Не удалось мигрировать 'vpn_keys': {e}")
@@ -952,7 +1411,7 @@ def create_host(name: str, url: str, user: str, passwd: str, inbound: int, subsc
             pass
         subscription_url = (subscription_url or None)
 
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             try:
                 cursor.execute(
@@ -972,7 +1431,7 @@ def create_host(name: str, url: str, user: str, passwd: str, inbound: int, subsc
 def update_host_subscription_url(host_name: str, subscription_url: str | None) -> bool:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             exists = cursor.fetchone() is not None
@@ -993,7 +1452,7 @@ def update_host_subscription_url(host_name: str, subscription_url: str | None) -
 def set_referral_start_bonus_received(user_id: int) -> bool:
     """Пометить, что пользователь получил стартовый бонус за реферальную регистрацию."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET referral_start_bonus_received = 1 WHERE telegram_id = ?",
@@ -1010,7 +1469,7 @@ def update_host_url(host_name: str, new_url: str) -> bool:
     try:
         host_name = normalize_host_name(host_name)
         new_url = (new_url or "").strip()
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             if cursor.fetchone() is None:
@@ -1022,6 +1481,7 @@ def update_host_url(host_name: str, new_url: str) -> bool:
                 (new_url, host_name)
             )
             conn.commit()
+            _bump_keys_revision()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить host_url для хоста '{host_name}': {e}")
@@ -1035,7 +1495,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
         if not new_name_n:
             logging.warning("update_host_name: новое имя хоста пустое после нормализации")
             return False
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (old_name_n,))
             if cursor.fetchone() is None:
@@ -1060,6 +1520,7 @@ def update_host_name(old_name: str, new_name: str) -> bool:
                 (new_name_n, old_name_n)
             )
             conn.commit()
+            _bump_keys_revision()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось переименовать хост с '{old_name}' на '{new_name}': {e}")
@@ -1068,11 +1529,12 @@ def update_host_name(old_name: str, new_name: str) -> bool:
 def delete_host(host_name: str):
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
             conn.commit()
+            _bump_keys_revision()
             logging.info(f"Хост '{host_name}' и его тарифы успешно удалены.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка удаления хоста '{host_name}': {e}")
@@ -1080,7 +1542,7 @@ def delete_host(host_name: str):
 def get_host(host_name: str) -> dict | None:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name,))
@@ -1103,7 +1565,7 @@ def update_host_ssh_settings(
     """
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM xui_hosts WHERE TRIM(host_name) = TRIM(?)", (host_name_n,))
             if cursor.fetchone() is None:
@@ -1133,11 +1595,12 @@ def update_host_ssh_settings(
 
 def delete_key_by_id(key_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_id = ?", (key_id,))
             affected = cursor.rowcount
             conn.commit()
+            _bump_keys_revision()
             return affected > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось удалить ключ по id {key_id}: {e}")
@@ -1145,7 +1608,7 @@ def delete_key_by_id(key_id: int) -> bool:
 
 def get_key_by_id(key_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
@@ -1159,10 +1622,11 @@ def update_key_expiry(key_id: int, expiry_timestamp_ms: int) -> bool:
     try:
         # Convert ms timestamp to datetime string
         expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET expiry_date = ? WHERE key_id = ?", (expiry_date, key_id))
             conn.commit()
+            _bump_keys_revision()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Error updating key expiry for {key_id}: {e}")
@@ -1170,7 +1634,7 @@ def update_key_expiry(key_id: int, expiry_timestamp_ms: int) -> bool:
 
 def update_key_comment(key_id: int, comment: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET comment = ? WHERE key_id = ?", (comment, key_id))
             conn.commit()
@@ -1181,7 +1645,7 @@ def update_key_comment(key_id: int, comment: str) -> bool:
 
 def get_all_hosts() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts")
@@ -1201,7 +1665,7 @@ def get_speedtests(host_name: str, limit: int = 20) -> list[dict]:
     """Получить последние результаты спидтестов по хосту (ssh/net), новые сверху."""
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             try:
@@ -1229,7 +1693,7 @@ def get_latest_speedtest(host_name: str) -> dict | None:
     """Получить последний по времени спидтест для хоста."""
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -1257,7 +1721,7 @@ def find_and_complete_pending_transaction(
     amount_currency: float | None = None,
 ) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
 
@@ -1298,7 +1762,7 @@ def find_and_complete_pending_transaction(
 def update_transaction_status(payment_id: str, status: str, amount_rub: float = None, payment_method: str = None) -> bool:
     """Обновить статус транзакции (например, на 'paid' или 'failed')."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Строим динамический запрос
@@ -1326,7 +1790,7 @@ def update_transaction_status(payment_id: str, status: str, amount_rub: float =
 def update_user_balance(user_id: int, amount: float) -> float:
     """Обновляет баланс пользователя и возвращает новое значение."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
@@ -1357,7 +1821,7 @@ def insert_host_speedtest(
         method_s = (method or '').strip().lower()
         if method_s not in ('ssh', 'net'):
             method_s = 'ssh'
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -1403,7 +1867,7 @@ def get_admin_stats() -> dict:
         "today_issued_keys": 0,
     }
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             # users
             cursor.execute("SELECT COUNT(*) FROM users")
@@ -1460,7 +1924,7 @@ def get_admin_stats() -> dict:
 
 def get_all_keys() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys")
@@ -1471,7 +1935,7 @@ def get_all_keys() -> list[dict]:
 
 def get_keys_for_user(user_id: int) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY created_date DESC", (user_id,))
@@ -1480,17 +1944,18 @@ def get_keys_for_user(user_id: int) -> list[dict]:
         logging.error(f"Не удалось get keys for user {user_id}: {e}")
         return []
 
-def create_user_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int) -> int | None:
+def create_user_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int, sub_token: str | None = None) -> int | None:
     try:
         host_name = normalize_host_name(host_name)
         expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000).isoformat()
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
-                (user_id, host_name, xui_client_uuid, key_email, expiry_date)
+                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, sub_token) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, host_name, xui_client_uuid, key_email, expiry_date, sub_token)
             )
             conn.commit()
+            _bump_keys_revision()
             return cursor.lastrowid
     except sqlite3.IntegrityError as e:
         logging.error(f"Не удалось создать ключ для пользователя {user_id}: дублирующийся email {key_email}: {e}")
@@ -1502,7 +1967,7 @@ def create_user_key(user_id: int, host_name: str, xui_client_uuid: str, key_emai
 
 def get_key_by_id(key_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
@@ -1514,10 +1979,11 @@ def get_key_by_id(key_id: int) -> dict | None:
 
 def update_key_email(key_id: int, new_email: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET key_email = ? WHERE key_id = ?", (new_email, key_id))
             conn.commit()
+            _bump_keys_revision()
             return cursor.rowcount > 0
     except sqlite3.IntegrityError as e:
         logging.error(f"Нарушение уникальности email для ключа {key_id}: {e}")
@@ -1528,10 +1994,11 @@ def update_key_email(key_id: int, new_email: str) -> bool:
 
 def update_key_host(key_id: int, new_host_name: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vpn_keys SET host_name = ? WHERE key_id = ?", (normalize_host_name(new_host_name), key_id))
             conn.commit()
+            _bump_keys_revision()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить хост ключа для {key_id}: {e}")
@@ -1544,13 +2011,14 @@ def create_gift_key(user_id: int, host_name: str, key_email: str, months: int, x
         host_name = normalize_host_name(host_name)
         from datetime import timedelta
         expiry = datetime.now() + timedelta(days=30 * int(months or 1))
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
                 (user_id, host_name, xui_client_uuid or f"GIFT-{user_id}-{int(datetime.now().timestamp())}", key_email, expiry.isoformat())
             )
             conn.commit()
+            _bump_keys_revision()
             return cursor.lastrowid
     except sqlite3.IntegrityError as e:
         logging.error(f"Не удалось создать подарочный ключ для пользователя {user_id}: дублирующийся email {key_email}: {e}")
@@ -1561,7 +2029,7 @@ def create_gift_key(user_id: int, host_name: str, key_email: str, months: int, x
 
 def get_setting(key: str) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
             result = cursor.fetchone()
@@ -1621,7 +2089,7 @@ def get_referrals_for_user(user_id: int) -> list[dict]:
     Поля: telegram_id, username, registration_date, total_spent.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -1642,7 +2110,7 @@ def get_referrals_for_user(user_id: int) -> list[dict]:
 def get_all_settings() -> dict:
     settings = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT key, value FROM bot_settings")
@@ -1655,18 +2123,19 @@ def get_all_settings() -> dict:
 
 def update_setting(key: str, value: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
             logging.info(f"Настройка '{key}' обновлена.")
+        _bump_revision("settings")
     except sqlite3.Error as e:
         logging.error(f"Не удалось обновить настройку '{key}': {e}")
 
 def create_plan(host_name: str, plan_name: str, months: int, price: float):
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price) VALUES (?, ?, ?, ?)",
@@ -1680,7 +2149,7 @@ def create_plan(host_name: str, plan_name: str, months: int, price: float):
 def get_plans_for_host(host_name: str) -> list[dict]:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE TRIM(host_name) = TRIM(?) ORDER BY months", (host_name,))
@@ -1692,7 +2161,7 @@ def get_plans_for_host(host_name: str) -> list[dict]:
 
 def get_plan_by_id(plan_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
@@ -1704,7 +2173,7 @@ def get_plan_by_id(plan_id: int) -> dict | None:
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
             conn.commit()
@@ -1714,7 +2183,7 @@ def delete_plan(plan_id: int):
 
 def update_plan(plan_id: int, plan_name: str, months: int, price: float) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE plans SET plan_name = ?, months = ?, price = ? WHERE plan_id = ?",
@@ -1732,7 +2201,7 @@ def update_plan(plan_id: int, plan_name: str, months: int, price: float) -> bool
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referred_by FROM users WHERE telegram_id = ?", (telegram_id,))
             row = cursor.fetchone()
@@ -1758,7 +2227,7 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
 
 def add_to_referral_balance(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
@@ -1767,7 +2236,7 @@ def add_to_referral_balance(user_id: int, amount: float):
 
 def set_referral_balance(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = ? WHERE telegram_id = ?", (value, user_id))
             conn.commit()
@@ -1776,7 +2245,7 @@ def set_referral_balance(user_id: int, value: float):
 
 def set_referral_balance_all(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?", (value, user_id))
             conn.commit()
@@ -1785,7 +2254,7 @@ def set_referral_balance_all(user_id: int, value: float):
 
 def add_to_referral_balance_all(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET referral_balance_all = referral_balance_all + ? WHERE telegram_id = ?",
@@ -1797,7 +2266,7 @@ def add_to_referral_balance_all(user_id: int, amount: float):
 
 def get_referral_balance_all(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referral_balance_all FROM users WHERE telegram_id = ?", (user_id,))
             row = cursor.fetchone()
@@ -1808,7 +2277,7 @@ def get_referral_balance_all(user_id: int) -> float:
 
 def get_referral_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -1819,7 +2288,7 @@ def get_referral_balance(user_id: int) -> float:
 
 def get_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -1831,7 +2300,7 @@ def get_balance(user_id: int) -> float:
 def adjust_user_balance(user_id: int, delta: float) -> bool:
     """Скорректировать баланс пользователя на указанную дельту (может быть отрицательной)."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = COALESCE(balance, 0) + ? WHERE telegram_id = ?", (float(delta), user_id))
             conn.commit()
@@ -1842,7 +2311,7 @@ def adjust_user_balance(user_id: int, delta: float) -> bool:
 
 def set_balance(user_id: int, value: float) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = ? WHERE telegram_id = ?", (value, user_id))
             conn.commit()
@@ -1853,7 +2322,7 @@ def set_balance(user_id: int, value: float) -> bool:
 
 def add_to_balance(user_id: int, amount: float) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
@@ -1867,7 +2336,7 @@ def deduct_from_balance(user_id: int, amount: float) -> bool:
     if amount <= 0:
         return True
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("BEGIN IMMEDIATE")
             cursor.execute("SELECT balance FROM users WHERE telegram_id = ?", (user_id,))
@@ -1888,7 +2357,7 @@ def deduct_from_referral_balance(user_id: int, amount: float) -> bool:
     if amount <= 0:
         return True
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("BEGIN IMMEDIATE")
             cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
@@ -1906,7 +2375,7 @@ def deduct_from_referral_balance(user_id: int, amount: float) -> bool:
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
             return cursor.fetchone()[0] or 0
@@ -1916,7 +2385,7 @@ def get_referral_count(user_id: int) -> int:
 
 def get_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
@@ -1928,7 +2397,7 @@ def get_user(telegram_id: int):
 
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
@@ -1938,7 +2407,7 @@ def set_terms_agreed(telegram_id: int):
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?", (amount_spent, months_purchased, telegram_id))
             conn.commit()
@@ -1947,7 +2416,7 @@ def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: i
 
 def get_user_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users")
             return cursor.fetchone()[0] or 0
@@ -1957,7 +2426,7 @@ def get_user_count() -> int:
 
 def get_total_keys_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM vpn_keys")
             return cursor.fetchone()[0] or 0
@@ -1967,7 +2436,7 @@ def get_total_keys_count() -> int:
 
 def get_total_spent_sum() -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             # Consider only completed/paid transactions when summing total spent
             cursor.execute(
@@ -1986,7 +2455,7 @@ def get_total_spent_sum() -> float:
 
 def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?, ?)",
@@ -2000,7 +2469,7 @@ def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float,
 
 def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -2024,7 +2493,7 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
 
 def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """INSERT INTO transactions
@@ -2041,7 +2510,7 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
     transactions = []
     total = 0
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -2076,7 +2545,7 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
@@ -2084,17 +2553,18 @@ def set_trial_used(telegram_id: int):
     except sqlite3.Error as e:
         logging.error(f"Не удалось отметить пробный период как использованный для пользователя {telegram_id}: {e}")
 
-def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int):
+def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int, sub_token: str | None = None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             cursor.execute(
-                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
-                (user_id, host_name, xui_client_uuid, key_email, expiry_date)
+                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, sub_token) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, host_name, xui_client_uuid, key_email, expiry_date, sub_token)
             )
             new_key_id = cursor.lastrowid
             conn.commit()
+            _bump_keys_revision()
             return new_key_id
     except sqlite3.Error as e:
         logging.error(f"Не удалось add new key for user {user_id}: {e}")
@@ -2102,11 +2572,12 @@ def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: s
 
 def delete_key_by_email(email: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (email,))
             affected = cursor.rowcount
             conn.commit()
+            _bump_keys_revision()
             logger.debug(f"delete_key_by_email('{email}') затронуто={affected}")
             return affected > 0
     except sqlite3.Error as e:
@@ -2115,7 +2586,7 @@ def delete_key_by_email(email: str) -> bool:
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
@@ -2125,9 +2596,43 @@ def get_user_keys(user_id: int):
         logging.error(f"Не удалось get keys for user {user_id}: {e}")
         return []
 
+# Ключ с данными хоста, доменом панели и токеном общей подписки владельца — всё, что нужно для ссылок
+_KEYS_WITH_HOSTS_SELECT = """
+    SELECT k.*, h.host_url, h.subscription_url,
+           (SELECT value FROM bot_settings WHERE key = 'domain') AS panel_domain,
+           (SELECT sub_token FROM users WHERE telegram_id = k.user_id) AS user_sub_token
+    FROM vpn_keys k
+    LEFT JOIN xui_hosts h ON h.host_name = k.host_name
+"""
+
+def get_user_keys_with_hosts(user_id: int) -> list[dict]:
+    """Ключи пользователя вместе с данными хоста и доменом панели — всё, что нужно для ссылок, одним запросом."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(_KEYS_WITH_HOSTS_SELECT + " WHERE k.user_id = ? ORDER BY k.key_id", (user_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось get keys with hosts for user {user_id}: {e}")
+        return []
+
+def get_user_key_with_host(user_id: int, key_id: int) -> dict | None:
+    """Один ключ пользователя с данными хоста (None — если ключ чужой или не найден)."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(_KEYS_WITH_HOSTS_SELECT + " WHERE k.key_id = ? AND k.user_id = ?", (key_id, user_id))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось get key {key_id} with host for user {user_id}: {e}")
+        return None
+
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
@@ -2139,7 +2644,7 @@ def get_key_by_id(key_id: int):
 
 def get_key_by_email(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
@@ -2151,11 +2656,12 @@ def get_key_by_email(key_email: str):
 
 def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
             cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_id = ?", (new_xui_uuid, expiry_date, key_id))
             conn.commit()
+            _bump_keys_revision()
     except sqlite3.Error as e:
         logging.error(f"Не удалось update key {key_id}: {e}")
  
@@ -2163,7 +2669,7 @@ def update_key_host_and_info(key_id: int, new_host_name: str, new_xui_uuid: str,
     """Update key's host, UUID and expiry in a single transaction."""
     try:
         new_host_name = normalize_host_name(new_host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
             cursor.execute(
@@ -2171,6 +2677,7 @@ def update_key_host_and_info(key_id: int, new_host_name: str, new_xui_uuid: str,
                 (new_host_name, new_xui_uuid, expiry_date, key_id)
             )
             conn.commit()
+            _bump_keys_revision()
     except sqlite3.Error as e:
         logging.error(f"Не удалось update key {key_id} host and info: {e}")
 
@@ -2181,7 +2688,7 @@ def get_next_key_number(user_id: int) -> int:
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
         host_name = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE TRIM(host_name) = TRIM(?)", (host_name,))
@@ -2193,7 +2700,7 @@ def get_keys_for_host(host_name: str) -> list[dict]:
 
 def get_all_vpn_users():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
@@ -2205,7 +2712,7 @@ def get_all_vpn_users():
 
 def update_key_status_from_server(key_email: str, xui_client_data):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             if xui_client_data:
                 expiry_date = datetime.fromtimestamp(xui_client_data.expiry_time / 1000)
@@ -2213,13 +2720,14 @@ def update_key_status_from_server(key_email: str, xui_client_data):
             else:
                 cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (key_email,))
             conn.commit()
+            _bump_keys_revision()
     except sqlite3.Error as e:
         logging.error(f"Не удалось update key status for {key_email}: {e}")
 
 def get_daily_stats_for_charts(days: int = 30) -> dict:
     stats = {'users': {}, 'keys': {}}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             query_users = """
                 SELECT date(registration_date) as day, COUNT(*)
@@ -2250,7 +2758,7 @@ def get_daily_stats_for_charts(days: int = 30) -> dict:
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             query = """
@@ -2274,7 +2782,7 @@ def get_recent_transactions(limit: int = 15) -> list[dict]:
 
 def get_all_users() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
@@ -2298,7 +2806,7 @@ def get_users_paginated(page: int = 1, per_page: int = 20, q: str | None = None)
     users: list[dict] = []
     total = 0
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             if q:
@@ -2343,34 +2851,39 @@ def get_users_paginated(page: int = 1, per_page: int = 20, q: str | None = None)
 
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            _bump_keys_revision()
+        _bump_revision("banned")
     except sqlite3.Error as e:
         logging.error(f"Не удалось ban user {telegram_id}: {e}")
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            _bump_keys_revision()
+        _bump_revision("banned")
     except sqlite3.Error as e:
         logging.error(f"Не удалось unban user {telegram_id}: {e}")
 
 def delete_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
             conn.commit()
+            _bump_keys_revision()
     except sqlite3.Error as e:
         logging.error(f"Не удалось delete keys for user {user_id}: {e}")
 
 def create_support_ticket(user_id: int, subject: str | None = None) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO support_tickets (user_id, subject) VALUES (?, ?)",
@@ -2384,7 +2897,7 @@ def create_support_ticket(user_id: int, subject: str | None = None) -> int | Non
 
 def add_support_message(ticket_id: int, sender: str, content: str) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO support_messages (ticket_id, sender, content) VALUES (?, ?, ?)",
@@ -2402,7 +2915,7 @@ def add_support_message(ticket_id: int, sender: str, content: str) -> int | None
 
 def update_ticket_thread_info(ticket_id: int, forum_chat_id: str | None, message_thread_id: int | None) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE support_tickets SET forum_chat_id = ?, message_thread_id = ?, updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?",
@@ -2416,7 +2929,7 @@ def update_ticket_thread_info(ticket_id: int, forum_chat_id: str | None, message
 
 def get_ticket(ticket_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM support_tickets WHERE ticket_id = ?", (ticket_id,))
@@ -2428,7 +2941,7 @@ def get_ticket(ticket_id: int) -> dict | None:
 
 def get_ticket_by_thread(forum_chat_id: str, message_thread_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2443,7 +2956,7 @@ def get_ticket_by_thread(forum_chat_id: str, message_thread_id: int) -> dict | N
 
 def get_user_tickets(user_id: int, status: str | None = None) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             if status:
@@ -2463,7 +2976,7 @@ def get_user_tickets(user_id: int, status: str | None = None) -> list[dict]:
 
 def get_ticket_messages(ticket_id: int) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2477,7 +2990,7 @@ def get_ticket_messages(ticket_id: int) -> list[dict]:
 
 def set_ticket_status(ticket_id: int, status: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE support_tickets SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?",
@@ -2491,7 +3004,7 @@ def set_ticket_status(ticket_id: int, status: str) -> bool:
 
 def update_ticket_subject(ticket_id: int, subject: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE support_tickets SET subject = ?, updated_at = CURRENT_TIMESTAMP WHERE ticket_id = ?",
@@ -2505,7 +3018,7 @@ def update_ticket_subject(ticket_id: int, subject: str) -> bool:
 
 def delete_ticket(ticket_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "DELETE FROM support_messages WHERE ticket_id = ?",
@@ -2524,7 +3037,7 @@ def delete_ticket(ticket_id: int) -> bool:
 def get_tickets_paginated(page: int = 1, per_page: int = 20, status: str | None = None) -> tuple[list[dict], int]:
     offset = (page - 1) * per_page
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             if status:
@@ -2548,7 +3061,7 @@ def get_tickets_paginated(page: int = 1, per_page: int = 20, status: str | None
 
 def get_open_tickets_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM support_tickets WHERE status = 'open'")
             return cursor.fetchone()[0] or 0
@@ -2558,7 +3071,7 @@ def get_open_tickets_count() -> int:
 
 def get_closed_tickets_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM support_tickets WHERE status = 'closed'")
             return cursor.fetchone()[0] or 0
@@ -2568,7 +3081,7 @@ def get_closed_tickets_count() -> int:
 
 def get_all_tickets_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM support_tickets")
             return cursor.fetchone()[0] or 0
@@ -2582,7 +3095,7 @@ def insert_host_metrics(host_name: str, metrics: dict) -> bool:
         host_name_n = normalize_host_name(host_name)
         m = metrics or {}
         load = m.get('loadavg') or {}
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -2619,7 +3132,7 @@ def insert_host_metrics(host_name: str, metrics: dict) -> bool:
 def get_host_metrics_recent(host_name: str, limit: int = 60) -> list[dict]:
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2643,7 +3156,7 @@ def get_host_metrics_recent(host_name: str, limit: int = 60) -> list[dict]:
 def get_latest_host_metrics(host_name: str) -> dict | None:
     try:
         host_name_n = normalize_host_name(host_name)
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -2660,14 +3173,51 @@ def get_latest_host_metrics(host_name: str) -> dict | None:
         logging.error(f"get_latest_host_metrics failed for '{host_name}': {e}")
         return None
 
-# --- Button Configs Functions ---
-def get_button_configs(menu_type: str = None) -> list[dict]:
-    """Get all button configurations, optionally filtered by menu_type."""
+
+def get_latest_hosts_cpu(max_age_minutes: int = 15) -> dict[str, float]:
+    """CPU каждого хоста по последнему успешному замеру не старше max_age_minutes: {host_name: cpu_percent}."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect_telemetry() as conn:
             cursor = conn.cursor()
-            
+            # Голый столбец при MAX() берётся из той же строки, что и максимум
+            cursor.execute(
+                '''
+                SELECT host_name, cpu_percent, MAX(created_at)
+                FROM host_metrics
+                WHERE ok = 1 AND cpu_percent IS NOT NULL AND created_at >= datetime('now', ?)
+                GROUP BY host_name
+                ''', (f"-{int(max_age_minutes)} minutes",)
+            )
+            return {normalize_host_name(row[0]): row[1] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить последние замеры CPU хостов: {e}")
+        return {}
+
+
+def set_host_panel_clients(host_name: str, clients: int) -> bool:
+    """Сохранить число клиентов на панели хоста (пишет синхронизация с панелями)."""
+    try:
+        host_name = normalize_host_name(host_name)
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE xui_hosts SET panel_clients = ? WHERE TRIM(host_name) = TRIM(?)",
+                (int(clients), host_name)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить число клиентов хоста '{host_name}': {e}")
+        return False
+
+# --- Button Configs Functions ---
+def get_button_configs(menu_type: str = None) -> list[dict]:
+    """Get all button configurations, optionally filtered by menu_type."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            
             if menu_type:
                 cursor.execute(
                     "SELECT * FROM button_configs WHERE menu_type = ? ORDER BY sort_order, id",
@@ -2686,7 +3236,7 @@ def get_button_configs(menu_type: str = None) -> list[dict]:
 def get_button_config(button_id: int) -> dict | None:
     """Get a specific button configuration by ID."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM button_configs WHERE id = ?", (button_id,))
@@ -2699,7 +3249,7 @@ def get_button_config(button_id: int) -> dict | None:
 def create_button_config(config: dict) -> int | None:
     """Create a new button configuration. Returns the new ID or None on error."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -2721,6 +3271,8 @@ def create_button_config(config: dict) -> int | None:
                     config.get('is_active', True)
                 )
             )
+            conn.commit()
+            _bump_button_configs_revision()
             return cursor.lastrowid
     except sqlite3.Error as e:
         logging.error(f"Не удалось create button config: {e}")
@@ -2729,7 +3281,7 @@ def create_button_config(config: dict) -> int | None:
 def update_button_config(button_id: int, config: dict) -> bool:
     """Update an existing button configuration."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -2751,6 +3303,8 @@ def update_button_config(button_id: int, config: dict) -> bool:
                     button_id
                 )
             )
+            conn.commit()
+            _bump_button_configs_revision()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось update button config {button_id}: {e}")
@@ -2759,9 +3313,11 @@ def update_button_config(button_id: int, config: dict) -> bool:
 def delete_button_config(button_id: int) -> bool:
     """Delete a button configuration."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM button_configs WHERE id = ?", (button_id,))
+            conn.commit()
+            _bump_button_configs_revision()
             return cursor.rowcount > 0
     except sqlite3.Error as e:
         logging.error(f"Не удалось delete button config {button_id}: {e}")
@@ -2773,7 +3329,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
     column_position, and button_width.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             for order_data in button_orders:
                 sort_order = int(order_data.get('sort_order', 0) or 0)
@@ -2805,6 +3361,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
                     (sort_order, row_pos, col_pos, btn_width, btn_id, menu_type)
                 )
             conn.commit()
+            _bump_button_configs_revision()
             return True
     except sqlite3.Error as e:
         logging.error(f"Не удалось reorder button configs for {menu_type}: {e}")
@@ -2813,7 +3370,7 @@ def reorder_button_configs(menu_type: str, button_orders: list[dict]) -> bool:
 def migrate_existing_buttons() -> bool:
     """Migrate existing button configurations from settings to button_configs table."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Define button configurations for all menu types
@@ -2920,6 +3477,8 @@ def migrate_existing_buttons() -> bool:
                     GROUP BY menu_type, button_id
                 )
             """)
+            conn.commit()
+            _bump_button_configs_revision()
             
             return True
             
@@ -2930,7 +3489,7 @@ def migrate_existing_buttons() -> bool:
 def cleanup_duplicate_buttons() -> bool:
     """Remove duplicate button configurations."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Remove duplicates, keeping the first occurrence
@@ -2947,6 +3506,8 @@ def cleanup_duplicate_buttons() -> bool:
             deleted_count = cursor.rowcount
             if deleted_count > 0:
                 logging.info(f"Удалено {deleted_count} дублирующихся конфигураций кнопок")
+                conn.commit()
+                _bump_button_configs_revision()
             
             return True
             
@@ -2957,7 +3518,7 @@ def cleanup_duplicate_buttons() -> bool:
 def reset_button_migration() -> bool:
     """Reset button migration to re-run with correct layout."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             
             # Only delete if explicitly requested (for force migration)
@@ -2981,12 +3542,13 @@ def force_button_migration() -> bool:
         logging.info("Начинаю принудительную миграцию кнопок...")
         
         # Force delete all existing button configs
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM button_configs")
             deleted_count = cursor.rowcount
             logging.info(f"Принудительно удалено {deleted_count} существующих конфигураций кнопок")
             conn.commit()
+        _bump_button_configs_revision()
         
         # Now migrate with fresh data
         migrate_existing_buttons()
@@ -3012,7 +3574,7 @@ def insert_resource_metric(
 ) -> int | None:
     """Insert a resource metric record."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''
@@ -3038,7 +3600,7 @@ def insert_resource_metric(
 def get_latest_resource_metric(scope: str, object_name: str) -> dict | None:
     """Get the latest resource metric for a scope/object."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute(
@@ -3060,7 +3622,7 @@ def get_latest_resource_metric(scope: str, object_name: str) -> dict | None:
 def get_metrics_series(scope: str, object_name: str, *, since_hours: int = 24, limit: int = 500) -> list[dict]:
     """Get a series of resource metrics for a scope/object."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect_telemetry() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
@@ -3098,7 +3660,7 @@ def get_metrics_series(scope: str, object_name: str, *, since_hours: int = 24, l
 
 def get_transaction_by_payment_id(payment_id: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE payment_id = ?", (payment_id,))
@@ -3111,3 +3673,625 @@ def get_transaction_by_payment_id(payment_id: str) -> dict | None:
 def get_host_by_name(host_name: str) -> dict | None:
     return get_host(host_name)
 
+
+# --- Subscription helpers ---
+def update_host_inbound_params(host_name: str, params: dict) -> bool:
+    """Сохранить параметры inbound хоста (порт, reality), нужные для локальной сборки ссылок."""
+    try:
+        host_name = normalize_host_name(host_name)
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE xui_hosts SET inbound_params = ? WHERE TRIM(host_name) = TRIM(?) AND COALESCE(inbound_params, '') != ?",
+                (payload, host_name, payload)
+            )
+            conn.commit()
+            if cursor.rowcount > 0:
+                _bump_keys_revision()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить параметры inbound для хоста '{host_name}': {e}")
+        return False
+
+def get_or_create_user_sub_token(user_id: int) -> str | None:
+    """Вернуть токен общей подписки пользователя, создав его при первом обращении."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT sub_token FROM users WHERE telegram_id = ?", (user_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            if row[0]:
+                return row[0]
+            token = secrets.token_urlsafe(16)
+            cursor.execute(
+                "UPDATE users SET sub_token = ? WHERE telegram_id = ? AND sub_token IS NULL",
+                (token, user_id)
+            )
+            conn.commit()
+            cursor.execute("SELECT sub_token FROM users WHERE telegram_id = ?", (user_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить токен подписки для пользователя {user_id}: {e}")
+        return None
+
+def get_user_by_sub_token(sub_token: str) -> dict | None:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM users WHERE sub_token = ?", (sub_token,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось найти пользователя по токену подписки: {e}")
+        return None
+
+def update_key_sub_token(key_email: str, sub_token: str | None) -> bool:
+    if not sub_token:
+        return False
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE vpn_keys SET sub_token = ? WHERE key_email = ? AND COALESCE(sub_token, '') != ?",
+                (sub_token, key_email, sub_token)
+            )
+            conn.commit()
+            if cursor.rowcount > 0:
+                _bump_keys_revision()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить sub_token для ключа '{key_email}': {e}")
+        return False
+
+def bulk_update_key_sub_tokens(pairs: list[tuple[str, str]]) -> int:
+    """Записать пары (key_email, sub_token) одной транзакцией. Возвращает число обновлённых строк."""
+    if not pairs:
+        return 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE vpn_keys SET sub_token = ? WHERE key_email = ?",
+                [(token, email) for email, token in pairs]
+            )
+            conn.commit()
+            _bump_keys_revision()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось массово сохранить sub_token ключей: {e}")
+        return 0
+
+def get_keys_missing_sub_token() -> list[dict]:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT key_id, host_name, key_email FROM vpn_keys WHERE sub_token IS NULL OR sub_token = ''")
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить ключи без sub_token: {e}")
+        return []
+
+def get_key_by_sub_token(sub_token: str) -> dict | None:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM vpn_keys WHERE sub_token = ?", (sub_token,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось найти ключ по sub_token: {e}")
+        return None
+
+
+# --- Background jobs ---
+def _decode_job_row(row) -> dict:
+    job = dict(row)
+    for field in ("params", "progress"):
+        try:
+            job[field] = json.loads(job[field]) if job.get(field) else {}
+        except (TypeError, ValueError):
+            job[field] = {}
+    return job
+
+def create_background_job(kind: str, params: dict | None = None) -> int | None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO background_jobs (kind, status, params, progress) VALUES (?, 'pending', ?, '{}')",
+                (kind, json.dumps(params or {}, ensure_ascii=False))
+            )
+            conn.commit()
+            return cursor.lastrowid
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось создать фоновую задачу '{kind}': {e}")
+        return None
+
+def update_background_job(job_id: int, status: str | None = None, progress: dict | None = None, error: str | None = None) -> bool:
+    sets = ["updated_at = CURRENT_TIMESTAMP"]
+    values = []
+    if status is not None:
+        sets.append("status = ?")
+        values.append(status)
+        if status in ("done", "failed"):
+            sets.append("finished_at = CURRENT_TIMESTAMP")
+    if progress is not None:
+        sets.append("progress = ?")
+        values.append(json.dumps(progress, ensure_ascii=False))
+    if error is not None:
+        sets.append("error = ?")
+        values.append(error)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE background_jobs SET {', '.join(sets)} WHERE job_id = ?", (*values, job_id))
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось обновить фоновую задачу {job_id}: {e}")
+        return False
+
+def get_background_job(job_id: int) -> dict | None:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM background_jobs WHERE job_id = ?", (job_id,))
+            row = cursor.fetchone()
+            return _decode_job_row(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить фоновую задачу {job_id}: {e}")
+        return None
+
+def get_recent_background_jobs(kind: str | None = None, limit: int = 10) -> list[dict]:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            if kind:
+                cursor.execute(
+                    "SELECT * FROM background_jobs WHERE kind = ? ORDER BY job_id DESC LIMIT ?", (kind, limit)
+                )
+            else:
+                cursor.execute("SELECT * FROM background_jobs ORDER BY job_id DESC LIMIT ?", (limit,))
+            return [_decode_job_row(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить список фоновых задач: {e}")
+        return []
+
+def add_host_migration_items(job_id: int, keys: list[dict]) -> int:
+    """Зафиксировать состав переноса. Повторный вызов не дублирует уже добавленные ключи."""
+    if not keys:
+        return 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO host_migration_items (job_id, key_id, user_id, key_email) VALUES (?, ?, ?, ?)",
+                [(job_id, k['key_id'], k.get('user_id'), k['key_email']) for k in keys]
+            )
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить состав переноса для задачи {job_id}: {e}")
+        return 0
+
+def get_host_migration_items(job_id: int, status: str | None = None) -> list[dict]:
+    """Элементы переноса вместе с актуальными данными ключа из vpn_keys."""
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            query = (
+                "SELECT i.job_id, i.key_id, i.user_id, i.key_email, i.status, i.error, i.notified, "
+                "k.host_name, k.xui_client_uuid, k.expiry_date, k.sub_token "
+                "FROM host_migration_items i LEFT JOIN vpn_keys k ON k.key_id = i.key_id "
+                "WHERE i.job_id = ?"
+            )
+            params: list = [job_id]
+            if status:
+                query += " AND i.status = ?"
+                params.append(status)
+            cursor.execute(query + " ORDER BY i.key_id", params)
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить элементы переноса задачи {job_id}: {e}")
+        return []
+
+def set_host_migration_items_status(job_id: int, key_ids: list[int], status: str, error: str | None = None) -> int:
+    if not key_ids:
+        return 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE host_migration_items SET status = ?, error = ? WHERE job_id = ? AND key_id = ?",
+                [(status, error, job_id, key_id) for key_id in key_ids]
+            )
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось обновить статус элементов переноса задачи {job_id}: {e}")
+        return 0
+
+def mark_host_migration_items_notified(job_id: int, key_ids: list[int]) -> int:
+    if not key_ids:
+        return 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE host_migration_items SET notified = 1 WHERE job_id = ? AND key_id = ?",
+                [(job_id, key_id) for key_id in key_ids]
+            )
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось отметить уведомления переноса задачи {job_id}: {e}")
+        return 0
+
+def count_host_migration_items(job_id: int) -> dict:
+    """Сводка по задаче переноса: число ключей в каждом статусе и число отправленных уведомлений."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT status, COUNT(*), SUM(notified) FROM host_migration_items WHERE job_id = ? GROUP BY status",
+                (job_id,)
+            )
+            counts = {"total": 0, "pending": 0, "moved": 0, "done": 0, "failed": 0, "notified": 0}
+            for status, count, notified in cursor.fetchall():
+                counts[status] = count
+                counts["total"] += count
+                counts["notified"] += notified or 0
+            return counts
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось посчитать элементы переноса задачи {job_id}: {e}")
+        return {}
+
+def get_expired_keys(now: datetime | None = None) -> list[dict]:
+    """Ключи с истёкшим сроком (по индексу idx_vpn_keys_expiry_dt), отсортированные по хосту.
+
+    Сравнение через datetime(): в expiry_date встречаются оба разделителя isoformat ('T' и пробел),
+    и строковое сравнение пропускало ключи, истёкшие сегодня.
+    """
+    now = now or datetime.now()
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT key_id, user_id, host_name, xui_client_uuid, key_email, expiry_date FROM vpn_keys "
+                "WHERE expiry_date IS NOT NULL AND datetime(expiry_date) <= datetime(?) ORDER BY host_name",
+                (now.isoformat(sep=" "),)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить истёкшие ключи: {e}")
+        return []
+
+def delete_expired_keys_by_ids(key_ids: list[int], expired_before: datetime) -> set[int]:
+    """Удалить ключи, если их срок всё ещё не позже expired_before. Возвращает id удалённых.
+
+    Повторная проверка срока в самом DELETE: ключ, продлённый пользователем, пока шла очистка, не удаляется.
+    """
+    if not key_ids:
+        return set()
+    deleted: set[int] = set()
+    cutoff = expired_before.isoformat(sep=" ")
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(key_ids), 500):
+                chunk = key_ids[start:start + 500]
+                cursor.execute(
+                    f"DELETE FROM vpn_keys WHERE key_id IN ({','.join('?' * len(chunk))}) "
+                    "AND datetime(expiry_date) <= datetime(?) RETURNING key_id",
+                    (*chunk, cutoff)
+                )
+                deleted.update(row[0] for row in cursor.fetchall())
+            conn.commit()
+            if deleted:
+                _bump_keys_revision()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось массово удалить истёкшие ключи: {e}")
+        return set()
+    return deleted
+
+def bulk_move_keys_to_host(moves: list[tuple[int, str, str, int, str | None]]) -> int:
+    """Перенести ключи на другой хост одной транзакцией.
+
+    moves: (key_id, host_name, xui_client_uuid, expiry_ms, sub_token); пустой sub_token не затирает старый.
+    """
+    if not moves:
+        return 0
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE vpn_keys SET host_name = ?, xui_client_uuid = ?, expiry_date = ?, "
+                "sub_token = COALESCE(?, sub_token) WHERE key_id = ?",
+                [
+                    (normalize_host_name(host_name), client_uuid, datetime.fromtimestamp(expiry_ms / 1000), sub_token or None, key_id)
+                    for key_id, host_name, client_uuid, expiry_ms, sub_token in moves
+                ]
+            )
+            conn.commit()
+            _bump_keys_revision()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось массово перенести ключи: {e}")
+        return 0
+
+# --- QR file_id cache ---
+
+def get_qr_file_id(content_hash: str, bot_id: int) -> str | None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_id FROM qr_file_ids WHERE content_hash = ? AND bot_id = ?",
+                (content_hash, bot_id)
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить file_id QR-кода: {e}")
+        return None
+
+def save_qr_file_id(content_hash: str, bot_id: int, file_id: str) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO qr_file_ids (content_hash, bot_id, file_id) VALUES (?, ?, ?)",
+                (content_hash, bot_id, file_id)
+            )
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить file_id QR-кода: {e}")
+        return False
+
+def delete_qr_file_id(content_hash: str, bot_id: int) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM qr_file_ids WHERE content_hash = ? AND bot_id = ?", (content_hash, bot_id))
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось удалить file_id QR-кода: {e}")
+        return False
+
+# --- FSM storage ---
+
+def get_fsm_record(storage_key: str, now: float) -> tuple[str | None, str | None, float] | None:
+    """(state, data_json, expires_at) для ключа или None, если записи нет или она истекла."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT state, data, expires_at FROM fsm_storage WHERE storage_key = ? AND expires_at > ?",
+                (storage_key, now)
+            )
+            row = cursor.fetchone()
+            return (row[0], row[1], row[2]) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось прочитать состояние FSM {storage_key}: {e}")
+        return None
+
+def save_fsm_record(storage_key: str, state: str | None, data_json: str | None, expires_at: float) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO fsm_storage (storage_key, state, data, expires_at, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(storage_key) DO UPDATE SET
+                    state = excluded.state, data = excluded.data,
+                    expires_at = excluded.expires_at, updated_at = CURRENT_TIMESTAMP
+                """,
+                (storage_key, state, data_json, expires_at)
+            )
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить состояние FSM {storage_key}: {e}")
+        return False
+
+def delete_fsm_record(storage_key: str) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось удалить состояние FSM {storage_key}: {e}")
+        return False
+
+def delete_expired_fsm_records(now: float) -> int:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fsm_storage WHERE expires_at <= ?", (now,))
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось удалить устаревшие состояния FSM: {e}")
+        return 0
+
+# --- Scheduled jobs ---
+
+def get_job_states() -> dict[str, dict]:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM scheduled_jobs")
+            return {row["name"]: dict(row) for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить состояние фоновых задач: {e}")
+        return {}
+
+def save_job_state(name: str, state: dict) -> bool:
+    """Сохранить состояние задачи: last_*, next_run_at, счётчики запусков и ошибок."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                INSERT INTO scheduled_jobs (
+                    name, last_started_at, last_finished_at, last_duration_ms, last_status, last_error,
+                    next_run_at, run_count, fail_count, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(name) DO UPDATE SET
+                    last_started_at = excluded.last_started_at, last_finished_at = excluded.last_finished_at,
+                    last_duration_ms = excluded.last_duration_ms, last_status = excluded.last_status,
+                    last_error = excluded.last_error, next_run_at = excluded.next_run_at,
+                    run_count = excluded.run_count, fail_count = excluded.fail_count,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (
+                    name, state.get("last_started_at"), state.get("last_finished_at"), state.get("last_duration_ms"),
+                    state.get("last_status"), state.get("last_error"), state.get("next_run_at"),
+                    int(state.get("run_count") or 0), int(state.get("fail_count") or 0),
+                )
+            )
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось сохранить состояние задачи {name}: {e}")
+        return False
+
+# --- Expiry reminders ---
+
+def claim_expiry_reminders(candidates: list[tuple[int, int, str]]) -> set[tuple[int, int]]:
+    """Отметить напоминания (key_id, порог, expiry_date) отправленными; вернуть только те, что ещё не отправлялись.
+
+    Отметка привязана к дате истечения: после продления ключа пороги срабатывают заново.
+    """
+    if not candidates:
+        return set()
+    claimed: set[tuple[int, int]] = set()
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for key_id, hours_mark, expiry_date in candidates:
+                cursor.execute(
+                    """
+                    INSERT INTO expiry_reminders_sent (key_id, hours_mark, expiry_date, sent_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(key_id, hours_mark) DO UPDATE SET
+                        expiry_date = excluded.expiry_date, sent_at = excluded.sent_at
+                    WHERE expiry_reminders_sent.expiry_date != excluded.expiry_date
+                    """,
+                    (key_id, hours_mark, expiry_date)
+                )
+                if cursor.rowcount > 0:
+                    claimed.add((key_id, hours_mark))
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось отметить отправленные напоминания об истечении: {e}")
+        return set()
+    return claimed
+
+def delete_stale_expiry_reminders() -> int:
+    """Удалить отметки напоминаний для ключей, которых больше нет."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM expiry_reminders_sent WHERE key_id NOT IN (SELECT key_id FROM vpn_keys)")
+            conn.commit()
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось очистить отметки напоминаний об истечении: {e}")
+        return 0
+
+# --- Leader lease ---
+
+def acquire_lease(name: str, holder: str, ttl_seconds: float) -> int | None:
+    """Взять или продлить аренду name на ttl_seconds.
+
+    Возвращает fencing-токен (растёт при каждой смене владельца) или None, если аренда у другого экземпляра.
+    """
+    now = time.time()
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT holder, token, expires_at FROM leader_leases WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            if row is None:
+                token = 1
+                cursor.execute(
+                    "INSERT INTO leader_leases (name, holder, token, expires_at, renewed_at) VALUES (?, ?, ?, ?, ?)",
+                    (name, holder, token, now + ttl_seconds, now)
+                )
+            elif row[0] == holder and row[2] > now:
+                token = row[1]
+                cursor.execute(
+                    "UPDATE leader_leases SET expires_at = ?, renewed_at = ? WHERE name = ?",
+                    (now + ttl_seconds, now, name)
+                )
+            elif row[2] <= now:
+                token = row[1] + 1
+                cursor.execute(
+                    "UPDATE leader_leases SET holder = ?, token = ?, expires_at = ?, renewed_at = ? WHERE name = ?",
+                    (holder, token, now + ttl_seconds, now, name)
+                )
+            else:
+                conn.rollback()
+                return None
+            conn.commit()
+            return token
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось обновить аренду {name}: {e}")
+        return None
+
+def release_lease(name: str, holder: str) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE leader_leases SET expires_at = 0 WHERE name = ? AND holder = ?", (name, holder))
+            conn.commit()
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось освободить аренду {name}: {e}")
+        return False
+
+def is_lease_valid(name: str, holder: str, token: int) -> bool:
+    """Проверка fencing-токена: аренда всё ещё у holder с тем же токеном и не истекла."""
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT 1 FROM leader_leases WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?",
+                (name, holder, token, time.time())
+            )
+            return cursor.fetchone() is not None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось проверить аренду {name}: {e}")
+        return False
+
+def get_lease(name: str) -> dict | None:
+    try:
+        with _connect() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM leader_leases WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Не удалось получить аренду {name}: {e}")
+        return None
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from shop_bot.data_manager import background_jobs
+from shop_bot.data_manager.database import (
+    get_host, get_key_by_id, get_expired_keys, delete_expired_keys_by_ids, create_background_job, update_background_job
+)
+from shop_bot.modules import xui_api
+
+logger = logging.getLogger(__name__)
+
+JOB_KIND = "expired_sweep"
+
+# Клиентов за одно обновление inbound при удалении с панели
+SWEEP_BATCH_SIZE = 1000
+
+
+def create_sweep_job() -> tuple[int | None, str | None]:
+    if background_jobs.has_active(JOB_KIND):
+        return None, "Удаление истёкших ключей уже выполняется"
+    job_id = create_background_job(JOB_KIND, {"started_at": datetime.now().isoformat(timespec="seconds")})
+    if not job_id:
+        return None, "Не удалось создать задачу"
+    return job_id, None
+
+
+async def _sweep_host(host_name: str, keys: list[dict], cutoff: datetime) -> tuple[list[dict], list[dict], str | None]:
+    """Удалить истёкших клиентов хоста в одной сессии панели и их строки в БД, порциями.
+
+    Срок перепроверяется на панели (продлённый там клиент не удаляется) и в DELETE. Ключ, продлённый
+    в БД уже после удаления клиента с панели, возвращается на панель в той же сессии.
+    Возвращает удалённые ключи, продлённые за время очистки и ошибку.
+    """
+    host = get_host(host_name)
+    if not host:
+        # Хоста уже нет — на панели удалять нечего, чистим только БД
+        deleted = delete_expired_keys_by_ids([k["key_id"] for k in keys], cutoff)
+        return [k for k in keys if k["key_id"] in deleted], [k for k in keys if k["key_id"] not in deleted], None
+    api, inbound = await asyncio.to_thread(
+        xui_api.login_to_host,
+        host["host_url"], host["host_username"], host["host_pass"], host["host_inbound_id"]
+    )
+    if not api or not inbound:
+        return [], [], f"не удалось войти на хост '{host_name}'"
+    cutoff_ms = int(cutoff.timestamp() * 1000)
+    removed: list[dict] = []
+    renewed: list[dict] = []
+    for start in range(0, len(keys), SWEEP_BATCH_SIZE):
+        batch = keys[start:start + SWEEP_BATCH_SIZE]
+        try:
+            renewed_emails = await asyncio.to_thread(
+                xui_api.remove_expired_clients_batch, api, inbound.id, {k["key_email"] for k in batch}, cutoff_ms
+            )
+        except Exception as e:
+            return removed, renewed, f"ошибка удаления на хосте '{host_name}': {e}"
+        renewed += [k for k in batch if k["key_email"] in renewed_emails]
+        candidates = [k for k in batch if k["key_email"] not in renewed_emails]
+        deleted = delete_expired_keys_by_ids([k["key_id"] for k in candidates], cutoff)
+        removed += [k for k in candidates if k["key_id"] in deleted]
+        restore = [get_key_by_id(k["key_id"]) for k in candidates if k["key_id"] not in deleted]
+        restore = [k for k in restore if k]
+        if restore:
+            try:
+                await asyncio.to_thread(xui_api.add_clients_batch, api, inbound.id, [{
+                    "email": k["key_email"],
+                    "uuid": k["xui_client_uuid"],
+                    "expiry_ms": int(datetime.fromisoformat(k["expiry_date"]).timestamp() * 1000),
+                    "sub_token": k.get("sub_token"),
+                } for k in restore])
+            except Exception as e:
+                return removed, renewed, f"не удалось вернуть на панель '{host_name}' продлённые ключи: {e}"
+            renewed += restore
+    return removed, renewed, None
+
+
+@background_jobs.register_runner(JOB_KIND)
+async def run_sweep_job(job_id: int, bot_controller) -> None:
+    """Удалить все истёкшие ключи: по одной сессии на хост, строки БД — одной транзакцией на хост.
+
+    Список берётся один раз, а очистка идёт долго, поэтому срок перепроверяется и на панели,
+    и в DELETE: ключ, продлённый за это время, остаётся.
+    """
+    cutoff = datetime.now()
+    expired = get_expired_keys(cutoff)
+    by_host: dict[str, list[dict]] = {}
+    for key in expired:
+        by_host.setdefault(key.get("host_name") or "", []).append(key)
+
+    progress = {
+        "stage": "panels",
+        "total": len(expired),
+        "hosts_total": len(by_host),
+        "hosts_done": 0,
+        "removed": 0,
+        "renewed": 0,
+        "failed": 0,
+        "notified": 0,
+        "errors": [],
+    }
+    update_background_job(job_id, progress=progress)
+    logger.info(f"Очистка #{job_id}: истёкших ключей {len(expired)} на {len(by_host)} хостах.")
+
+    notifications: list[tuple[int, str]] = []
+    for host_name, keys in by_host.items():
+        removed, renewed, error = await _sweep_host(host_name, keys, cutoff)
+        progress["removed"] += len(removed)
+        progress["renewed"] += len(renewed)
+        progress["failed"] += len(keys) - len(removed) - len(renewed)
+        progress["hosts_done"] += 1
+        if error:
+            progress["errors"].append(error)
+            logger.warning(f"Очистка #{job_id}: {error}")
+        for k in removed:
+            if k.get("user_id"):
+                notifications.append((k["user_id"], (
+                    "Ваш ключ был автоматически удалён по истечении срока.\n"
+                    f"Хост: {k.get('host_name')}\nEmail: {k.get('key_email')}\n"
+                    "При необходимости вы можете оформить новый ключ."
+                )))
+        update_background_job(job_id, progress=progress)
+
+    bot = bot_controller.get_bot_instance() if bot_controller else None
+    if notifications and bot:
+        progress["stage"] = "notify"
+        update_background_job(job_id, progress=progress)
+
+        def on_sent(_chat_id: int):
+            progress["notified"] += 1
+            if progress["notified"] % 50 == 0:
+                update_background_job(job_id, progress=progress)
+
+        await background_jobs.send_rate_limited(bot, notifications, on_sent=on_sent)
+
+    progress["stage"] = "finished"
+    error = "; ".join(progress["errors"]) or None
+    update_background_job(job_id, status="done", progress=progress, error=error)
+    logger.info(
+        f"Очистка #{job_id} завершена: удалено {progress['removed']}, продлено за время очистки "
+        f"{progress['renewed']}, ошибок {progress['failed']}."
+    )
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from shop_bot.data_manager import background_jobs
+from shop_bot.data_manager.database import (
+    get_host, get_keys_for_host, create_background_job, get_background_job, update_background_job,
+    add_host_migration_items, get_host_migration_items, set_host_migration_items_status,
+    mark_host_migration_items_notified, count_host_migration_items, bulk_move_keys_to_host,
+    normalize_host_name
+)
+from shop_bot.modules import xui_api
+
+logger = logging.getLogger(__name__)
+
+JOB_KIND = "host_migration"
+
+# Клиентов за один запрос addClient к целевой панели
+MIGRATION_BATCH_SIZE = 200
+# Клиентов за одно обновление inbound при удалении с исходной панели
+CLEANUP_BATCH_SIZE = 1000
+
+
+def create_migration_job(source_host: str, target_host: str, key_ids: list[int] | None = None,
+                         dry_run: bool = False) -> tuple[int | None, str | None]:
+    """Проверить параметры и создать задачу переноса. Возвращает (job_id, ошибка)."""
+    source_host = normalize_host_name(source_host)
+    target_host = normalize_host_name(target_host)
+    if not source_host or not target_host:
+        return None, "Укажите исходный и целевой хосты"
+    if source_host == target_host:
+        return None, "Исходный и целевой хосты совпадают"
+    if not get_host(source_host) or not get_host(target_host):
+        return None, "Хост не найден"
+    if background_jobs.has_active(JOB_KIND):
+        return None, "Перенос уже выполняется"
+    params = {
+        "source_host": source_host,
+        "target_host": target_host,
+        "key_ids": sorted(set(key_ids)) if key_ids else None,
+        "dry_run": bool(dry_run),
+    }
+    job_id = create_background_job(JOB_KIND, params)
+    if not job_id:
+        return None, "Не удалось создать задачу"
+    return job_id, None
+
+
+def _expiry_ms(item: dict, source_client) -> int:
+    """Точный срок ключа: берём из исходной панели, при её недоступности — из БД."""
+    if source_client is not None and getattr(source_client, "expiry_time", None):
+        return int(source_client.expiry_time)
+    value = item.get("expiry_date")
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return int(value.timestamp() * 1000) if value else 0
+
+
+async def _login(host: dict):
+    return await asyncio.to_thread(
+        xui_api.login_to_host,
+        host["host_url"], host["host_username"], host["host_pass"], host["host_inbound_id"]
+    )
+
+
+def _progress(job_id: int, stage: str, **extra) -> dict:
+    progress = {"stage": stage, **count_host_migration_items(job_id), **extra}
+    update_background_job(job_id, progress=progress)
+    return progress
+
+
+def _clients_by_email(inbound) -> dict:
+    try:
+        return {c.email: c for c in (inbound.settings.clients or [])}
+    except Exception:
+        return {}
+
+
+async def _dry_run(job_id: int, items: list[dict], source_clients: dict | None, target_clients: dict) -> None:
+    on_target = sum(1 for i in items if i["key_email"] in target_clients)
+    missing_on_source = None
+    if source_clients is not None:
+        missing_on_source = sum(1 for i in items if i["key_email"] not in source_clients)
+    now_ms = int(datetime.now().timestamp() * 1000)
+    expired = sum(
+        1 for i in items
+        if _expiry_ms(i, (source_clients or {}).get(i["key_email"])) < now_ms
+    )
+    progress = _progress(
+        job_id, "dry_run",
+        users=len({i["user_id"] for i in items if i.get("user_id")}),
+        already_on_target=on_target,
+        missing_on_source=missing_on_source,
+        expired=expired,
+        source_reachable=source_clients is not None,
+    )
+    update_background_job(job_id, status="done", progress=progress)
+    logger.info(f"Перенос #{job_id} (пробный запуск): {progress}")
+
+
+async def _copy_to_target(job_id: int, target_host: str, dst_api, dst_inbound, source_clients: dict | None,
+                          target_clients: dict, batch_size: int) -> None:
+    pending = get_host_migration_items(job_id, status="pending")
+    for start in range(0, len(pending), batch_size):
+        batch = [i for i in pending[start:start + batch_size] if i.get("host_name")]
+        missing = [i["key_id"] for i in pending[start:start + batch_size] if not i.get("host_name")]
+        set_host_migration_items_status(job_id, missing, "failed", "ключ удалён из БД")
+        if not batch:
+            continue
+        specs = []
+        for item in batch:
+            source_client = (source_clients or {}).get(item["key_email"])
+            specs.append({
+                "email": item["key_email"],
+                "uuid": getattr(source_client, "id", None) or item.get("xui_client_uuid"),
+                "expiry_ms": _expiry_ms(item, source_client),
+                "sub_token": (xui_api.get_client_sub_token(source_client) if source_client is not None else None)
+                             or item.get("sub_token"),
+            })
+        try:
+            created = await asyncio.to_thread(xui_api.add_clients_batch, dst_api, dst_inbound.id, specs, target_clients)
+        except Exception as e:
+            logger.error(f"Перенос #{job_id}: не удалось создать пачку клиентов на '{target_host}': {e}")
+            set_host_migration_items_status(job_id, [i["key_id"] for i in batch], "failed", str(e))
+            _progress(job_id, "copy")
+            continue
+
+        moves = []
+        not_created = []
+        for item in batch:
+            info = created.get(item["key_email"])
+            if info:
+                moves.append((item["key_id"], target_host, info["client_uuid"], info["expiry_timestamp_ms"], info["sub_token"]))
+            else:
+                not_created.append(item["key_id"])
+        set_host_migration_items_status(job_id, not_created, "failed", "клиент не создан на целевом хосте")
+        moved_ids = [m[0] for m in moves]
+        if moves and bulk_move_keys_to_host(moves) != len(moves):
+            # Запись в БД не удалась или часть ключей удалили во время переноса: сверяемся с vpn_keys
+            current = {i["key_id"]: i.get("host_name") for i in get_host_migration_items(job_id, status="pending")}
+            stale = [key_id for key_id in moved_ids if current.get(key_id) != target_host]
+            moved_ids = [key_id for key_id in moved_ids if current.get(key_id) == target_host]
+            logger.error(f"Перенос #{job_id}: не удалось обновить в БД ключей: {len(stale)}")
+            set_host_migration_items_status(job_id, stale, "failed", "не удалось обновить ключ в БД")
+        set_host_migration_items_status(job_id, moved_ids, "moved")
+        _progress(job_id, "copy")
+        # Отдаём цикл событий боту между пачками
+        await asyncio.sleep(0)
+
+
+async def _cleanup_source(job_id: int, src_api, src_inbound, source_clients: dict) -> None:
+    moved = get_host_migration_items(job_id, status="moved")
+    for start in range(0, len(moved), CLEANUP_BATCH_SIZE):
+        batch = moved[start:start + CLEANUP_BATCH_SIZE]
+        emails = {i["key_email"] for i in batch if i["key_email"] in source_clients}
+        try:
+            if emails:
+                await asyncio.to_thread(xui_api.remove_clients_batch, src_api, src_inbound.id, emails)
+        except Exception as e:
+            logger.error(f"Перенос #{job_id}: не удалось удалить клиентов с исходного хоста: {e}")
+            _progress(job_id, "cleanup", cleanup_error=str(e))
+            return
+        set_host_migration_items_status(job_id, [i["key_id"] for i in batch], "done")
+        _progress(job_id, "cleanup")
+
+
+async def _notify_users(job_id: int, target_host: str, bot_controller) -> None:
+    bot = bot_controller.get_bot_instance() if bot_controller else None
+    if not bot:
+        logger.warning(f"Перенос #{job_id}: бот не запущен, уведомления будут отправлены при повторном запуске задачи.")
+        return
+    keys_by_user: dict[int, list[int]] = {}
+    for item in get_host_migration_items(job_id):
+        if item["status"] in ("moved", "done") and not item["notified"] and item.get("user_id"):
+            keys_by_user.setdefault(item["user_id"], []).append(item["key_id"])
+    if not keys_by_user:
+        return
+    text = (
+        "🔄 Ваш VPN-ключ перенесён на другой сервер.\n"
+        f"Новый сервер: {target_host}\n"
+        "Срок действия не изменился.\n"
+        "Обновите подписку в приложении или откройте «Мои ключи», чтобы получить актуальную ссылку."
+    )
+    messages = [(user_id, text) for user_id in keys_by_user]
+    sent_count = 0
+
+    def on_sent(chat_id: int):
+        nonlocal sent_count
+        mark_host_migration_items_notified(job_id, keys_by_user.get(chat_id, []))
+        sent_count += 1
+        if sent_count % 50 == 0:
+            _progress(job_id, "notify")
+
+    await background_jobs.send_rate_limited(bot, messages, on_sent=on_sent)
+
+
+@background_jobs.register_runner(JOB_KIND)
+async def run_migration_job(job_id: int, bot_controller) -> None:
+    """Перенос ключей между хостами. Повторный запуск продолжает с места остановки:
+    статус каждого ключа хранится в host_migration_items."""
+    job = get_background_job(job_id)
+    params = job["params"]
+    source_host, target_host = params["source_host"], params["target_host"]
+    batch_size = int(params.get("batch_size") or MIGRATION_BATCH_SIZE)
+
+    if not count_host_migration_items(job_id).get("total"):
+        keys = get_keys_for_host(source_host)
+        if params.get("key_ids"):
+            wanted = set(params["key_ids"])
+            keys = [k for k in keys if k["key_id"] in wanted]
+        add_host_migration_items(job_id, keys)
+    else:
+        # Повторный запуск: ключи, не перенесённые в прошлый раз, пробуем снова
+        failed = [i["key_id"] for i in get_host_migration_items(job_id, status="failed")]
+        set_host_migration_items_status(job_id, failed, "pending")
+    items = get_host_migration_items(job_id)
+    logger.info(f"Перенос #{job_id}: '{source_host}' → '{target_host}', ключей: {len(items)}")
+    _progress(job_id, "login")
+
+    src_host, dst_host = get_host(source_host), get_host(target_host)
+    if not src_host or not dst_host:
+        update_background_job(job_id, status="failed", error="Хост не найден")
+        return
+    dst_api, dst_inbound = await _login(dst_host)
+    if not dst_api or not dst_inbound:
+        update_background_job(job_id, status="failed", error=f"Не удалось войти на целевой хост '{target_host}'")
+        return
+    src_api, src_inbound = await _login(src_host)
+    # Исходный хост может быть уже недоступен — тогда переносим по данным БД, а удаление откладываем
+    source_clients = _clients_by_email(src_inbound) if src_api and src_inbound else None
+    target_clients = _clients_by_email(dst_inbound)
+
+    if params.get("dry_run"):
+        await _dry_run(job_id, items, source_clients, target_clients)
+        return
+
+    await _copy_to_target(job_id, target_host, dst_api, dst_inbound, source_clients, target_clients, batch_size)
+    xui_api.remember_inbound_params(target_host, dst_inbound)
+
+    if source_clients is not None:
+        await _cleanup_source(job_id, src_api, src_inbound, source_clients)
+    else:
+        logger.warning(f"Перенос #{job_id}: исходный хост '{source_host}' недоступен, клиенты на нём не удалены.")
+
+    _progress(job_id, "notify", source_reachable=source_clients is not None)
+    await _notify_users(job_id, target_host, bot_controller)
+
+    progress = _progress(job_id, "finished", source_reachable=source_clients is not None)
+    error = None
+    if progress.get("failed"):
+        error = f"Не удалось перенести ключей: {progress['failed']}"
+    elif source_clients is None:
+        error = "Исходный хост недоступен: клиенты на нём не удалены, запустите задачу повторно"
+    update_background_job(job_id, status="done", progress=progress, error=error)
+    logger.info(f"Перенос #{job_id} завершён: {progress}")
@@ -0,0 +1,341 @@
+import hashlib
+import json
+import logging
+import shutil
+import sqlite3
+import struct
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from . import database
+from . import backup_manager
+from . import job_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Цепочка = базовый снимок + сегменты WAL; каждая цепочка лежит в своей папке с manifest.json
+INCREMENTAL_DIR = backup_manager.BACKUPS_DIR / "incremental"
+MANIFEST_NAME = "manifest.json"
+# Новая цепочка (полный снимок) не реже раза в сутки; хранится KEEP_CHAINS последних
+CHAIN_MAX_AGE = timedelta(hours=24)
+KEEP_CHAINS = 7
+DEFAULT_INTERVAL_MIN = 15
+
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+WAL_MAGIC = (0x377F0682, 0x377F0683)
+
+# Повторно входимая: stop() берёт её и сам, и внутри run_incremental_cycle
+_lock = threading.RLock()
+# Постоянное соединение: пока оно открыто, закрытие последнего рабочего соединения
+# не делает чекпойнт и не удаляет WAL, то есть не рвёт цепочку
+_keeper: sqlite3.Connection | None = None
+_chain_dir: Path | None = None
+_chain_started_at: datetime | None = None
+# Размер и mtime основного файла БД после нашего последнего чекпойнта: если они изменились,
+# кто-то другой сделал чекпойнт (или БД заменили), и цепочку нужно начинать заново
+_db_signature: tuple[int, int] | None = None
+_last_segment_sha: str | None = None
+
+
+def get_interval_minutes() -> int:
+    try:
+        return int(database.get_setting("backup_incremental_interval_min") or DEFAULT_INTERVAL_MIN)
+    except (TypeError, ValueError):
+        return DEFAULT_INTERVAL_MIN
+
+
+def _wal_path(db_path: Path) -> Path:
+    return db_path.with_name(db_path.name + "-wal")
+
+
+def _signature() -> tuple[int, int]:
+    st = backup_manager.DB_FILE.stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def _committed_wal_length(data: bytes) -> int:
+    """Длина префикса WAL до последнего кадра-коммита текущего поколения (0 — коммитов нет).
+
+    После сброса WAL новые кадры пишутся с начала файла с новыми salt, а хвост от прошлого
+    поколения остаётся — такие кадры отсекаются по несовпадению salt с заголовком.
+    """
+    if len(data) < WAL_HEADER_SIZE:
+        return 0
+    magic, _, page_size, _, salt1, salt2 = struct.unpack(">IIIIII", data[:24])
+    if magic not in WAL_MAGIC or page_size < 512:
+        return 0
+    frame_size = WAL_FRAME_HEADER_SIZE + page_size
+    committed = 0
+    offset = WAL_HEADER_SIZE
+    while offset + frame_size <= len(data):
+        _, commit_size, frame_salt1, frame_salt2 = struct.unpack(">IIII", data[offset:offset + 16])
+        if (frame_salt1, frame_salt2) != (salt1, salt2):
+            break
+        offset += frame_size
+        if commit_size:
+            committed = offset
+    return committed
+
+
+def _read_manifest(chain_dir: Path) -> dict:
+    return json.loads((chain_dir / MANIFEST_NAME).read_text(encoding="utf-8"))
+
+
+def _write_manifest(chain_dir: Path, manifest: dict) -> None:
+    tmp = chain_dir / (MANIFEST_NAME + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    tmp.replace(chain_dir / MANIFEST_NAME)
+
+
+def _ensure_keeper() -> None:
+    global _keeper
+    if _keeper is None:
+        _keeper = sqlite3.connect(backup_manager.DB_FILE, check_same_thread=False)
+        _keeper.execute("PRAGMA wal_autocheckpoint=0")
+        # Соединение открывает файл лениво — прочитаем что-нибудь, чтобы оно держало БД
+        _keeper.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+    database.set_wal_autocheckpoint(False)
+
+
+def stop() -> None:
+    """Выключить инкрементальный режим: вернуть автоматические чекпойнты и закрыть цепочку.
+
+    Ждёт окончания текущего шага цикла, поэтому из цикла событий вызывать через поток.
+    """
+    global _keeper, _chain_dir, _db_signature
+    with _lock:
+        database.set_wal_autocheckpoint(True)
+        if _keeper is not None:
+            try:
+                _keeper.close()
+            except sqlite3.Error:
+                pass
+            _keeper = None
+        _chain_dir = None
+        _db_signature = None
+
+
+def _start_chain() -> Path:
+    global _chain_dir, _chain_started_at, _db_signature, _last_segment_sha
+    now = datetime.now()
+    chain_dir = INCREMENTAL_DIR / f"chain-{now.strftime('%Y%m%d-%H%M%S')}"
+    chain_dir.mkdir(parents=True, exist_ok=True)
+    codec, level = backup_manager._compression_settings()
+    # Подпись снимаем до копирования: чужой чекпойнт во время копирования тоже оборвёт цепочку
+    signature = _signature()
+    tmp_db = chain_dir / "base.db"
+    try:
+        backup_manager._copy_db_online(tmp_db)
+        db_bytes = tmp_db.stat().st_size
+        base_path = backup_manager._compress(tmp_db, chain_dir / "base", codec, level)
+    finally:
+        tmp_db.unlink(missing_ok=True)
+    manifest = {
+        "chain": chain_dir.name,
+        "created_at": now.isoformat(timespec="seconds"),
+        "base": {"file": base_path.name, "db_bytes": db_bytes, "archive_bytes": base_path.stat().st_size},
+        "segments": [],
+    }
+    job_scheduler.ensure_leader()
+    _write_manifest(chain_dir, manifest)
+    _chain_dir, _chain_started_at, _db_signature, _last_segment_sha = chain_dir, now, signature, None
+    logger.info(f"Инкрементальный бэкап: новая цепочка {chain_dir.name}, базовый снимок {db_bytes / 1048576:.1f} МБ")
+    return chain_dir
+
+
+def _ship_segment() -> dict | None:
+    """Забирает закоммиченные кадры WAL в новый сегмент и делает чекпойнт.
+
+    На время копирования берётся блокировка записи (BEGIN IMMEDIATE), поэтому между
+    копированием и чекпойнтом в WAL ничего не допишется. Чекпойнт PASSIVE не ждёт читателей;
+    если он не успел перенести всё, следующий сегмент просто повторит часть кадров.
+    """
+    global _db_signature, _last_segment_sha
+    segment = None
+    conn = sqlite3.connect(backup_manager.DB_FILE, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            wal_path = _wal_path(backup_manager.DB_FILE)
+            data = wal_path.read_bytes() if wal_path.exists() else b""
+            length = _committed_wal_length(data)
+            digest = hashlib.sha256(data[:length]).hexdigest() if length else None
+            # Новый лидер уже может вести свою цепочку — не пишем сегмент и не делаем чекпойнт за него
+            job_scheduler.ensure_leader()
+            if digest and digest != _last_segment_sha:
+                segment = _write_segment(data[:length], digest)
+                _last_segment_sha = digest
+            checkpointer = sqlite3.connect(backup_manager.DB_FILE)
+            try:
+                checkpointer.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            finally:
+                checkpointer.close()
+        finally:
+            conn.execute("ROLLBACK")
+    finally:
+        conn.close()
+    _db_signature = _signature()
+    return segment
+
+
+def _write_segment(wal_bytes: bytes, digest: str) -> dict:
+    manifest = _read_manifest(_chain_dir)
+    seq = len(manifest["segments"]) + 1
+    codec, level = backup_manager._compression_settings()
+    tmp = _chain_dir / f"seg-{seq:06d}"
+    tmp.write_bytes(wal_bytes)
+    try:
+        archive = backup_manager._compress(tmp, _chain_dir / f"seg-{seq:06d}", codec, level, suffix=".wal")
+    finally:
+        tmp.unlink(missing_ok=True)
+    segment = {
+        "seq": seq,
+        "file": archive.name,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "wal_bytes": len(wal_bytes),
+        "archive_bytes": archive.stat().st_size,
+        "sha256": digest,
+    }
+    manifest["segments"].append(segment)
+    _write_manifest(_chain_dir, manifest)
+    return segment
+
+
+def cleanup_old_chains(keep: int = KEEP_CHAINS) -> None:
+    chains = sorted(INCREMENTAL_DIR.glob("chain-*"), reverse=True)
+    for chain_dir in chains[keep:]:
+        if chain_dir == _chain_dir:
+            continue
+        shutil.rmtree(chain_dir, ignore_errors=True)
+
+
+def run_incremental_cycle() -> dict | None:
+    """Один шаг инкрементального бэкапа (синхронно). Возвращает описание нового сегмента или None."""
+    with _lock:
+        if get_interval_minutes() <= 0:
+            if _keeper is not None:
+                stop()
+                logger.info("Инкрементальный бэкап: выключен, автоматические чекпойнты WAL возвращены")
+            return None
+        if not backup_manager.DB_FILE.exists():
+            return None
+        try:
+            _ensure_keeper()
+            now = datetime.now()
+            if _chain_dir is None or not _chain_dir.exists():
+                _start_chain()
+            elif _db_signature != _signature():
+                logger.warning("Инкрементальный бэкап: основной файл БД изменён вне цепочки, начинаю новую")
+                _start_chain()
+            elif now - _chain_started_at >= CHAIN_MAX_AGE:
+                _ship_segment()
+                _start_chain()
+            else:
+                segment = _ship_segment()
+                if segment:
+                    logger.info(
+                        f"Инкрементальный бэкап: сегмент {segment['file']} — WAL {segment['wal_bytes'] / 1024:.1f} КБ, "
+                        f"архив {segment['archive_bytes'] / 1024:.1f} КБ"
+                    )
+                return segment
+            cleanup_old_chains()
+            return None
+        except job_scheduler.FenceError as e:
+            logger.warning(f"Инкрементальный бэкап: {e}, цепочка закрыта")
+            stop()
+            raise
+        except Exception as e:
+            logger.error(f"Инкрементальный бэкап: ошибка: {e}", exc_info=True)
+            return None
+
+
+async def run_incremental_cycle_async() -> dict | None:
+    return await job_scheduler.to_thread(run_incremental_cycle)
+
+
+def _apply_wal(db_path: Path, wal_bytes: bytes) -> None:
+    """Накатить сегмент: положить его как -wal рядом с БД и сделать полный чекпойнт."""
+    db_path.with_name(db_path.name + "-shm").unlink(missing_ok=True)
+    _wal_path(db_path).write_bytes(wal_bytes)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
+
+
+def materialize(chain_dir: Path, dest_path: Path, until: datetime | None = None) -> datetime:
+    """Собирает БД из цепочки: базовый снимок + сегменты, созданные не позже until.
+
+    Возвращает момент, на который получилась БД (время последнего применённого сегмента или базы).
+    """
+    manifest = _read_manifest(chain_dir)
+    backup_manager._decompress(chain_dir / manifest["base"]["file"], dest_path)
+    # Сегменты применяются как WAL, поэтому база должна быть в режиме WAL
+    conn = sqlite3.connect(dest_path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+    point = datetime.fromisoformat(manifest["created_at"])
+    tmp_wal = dest_path.with_name(dest_path.name + ".segment")
+    try:
+        for segment in manifest["segments"]:
+            created_at = datetime.fromisoformat(segment["created_at"])
+            if until is not None and created_at > until:
+                break
+            backup_manager._decompress(chain_dir / segment["file"], tmp_wal)
+            wal_bytes = tmp_wal.read_bytes()
+            if hashlib.sha256(wal_bytes).hexdigest() != segment["sha256"]:
+                raise ValueError(f"сегмент {segment['file']} повреждён (не совпадает sha256)")
+            _apply_wal(dest_path, wal_bytes)
+            point = created_at
+    finally:
+        tmp_wal.unlink(missing_ok=True)
+    return point
+
+
+def list_chains() -> list[dict]:
+    """Цепочки для панели: новые первыми, с диапазоном доступных точек восстановления."""
+    chains = []
+    for chain_dir in sorted(INCREMENTAL_DIR.glob("chain-*"), reverse=True):
+        try:
+            manifest = _read_manifest(chain_dir)
+        except (OSError, ValueError):
+            continue
+        segments = manifest.get("segments") or []
+        chains.append({
+            "name": manifest.get("chain") or chain_dir.name,
+            "created_at": manifest.get("created_at"),
+            "last_point": segments[-1]["created_at"] if segments else manifest.get("created_at"),
+            "segments": len(segments),
+            "base_bytes": (manifest.get("base") or {}).get("archive_bytes", 0),
+            "segments_bytes": sum(s.get("archive_bytes", 0) for s in segments),
+        })
+    return chains
+
+
+def find_chain_for(until: datetime) -> Path | None:
+    """Самая свежая цепочка, начатая не позже until."""
+    for chain_dir in sorted(INCREMENTAL_DIR.glob("chain-*"), reverse=True):
+        try:
+            if datetime.fromisoformat(_read_manifest(chain_dir)["created_at"]) <= until:
+                return chain_dir
+        except (OSError, ValueError, KeyError):
+            continue
+    return None
+
+
+def restore_to_point(until: datetime) -> bool:
+    """Восстановить основную БД на момент until (с точностью до интервала сегментов)."""
+    chain_dir = find_chain_for(until)
+    if chain_dir is None:
+        logger.error(f"Восстановление: нет инкрементальной цепочки, начатой до {until}")
+        return False
+    with _lock:
+        ok = backup_manager.restore_from_file(chain_dir / MANIFEST_NAME, until=until)
+    if ok:
+        logger.info(f"Восстановление: БД восстановлена на {until} из цепочки {chain_dir.name}")
+    return ok
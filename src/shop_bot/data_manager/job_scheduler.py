@@ -0,0 +1,448 @@
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from . import database
+from . import metrics
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних запусков каждой задачи держать в памяти для страницы статуса
+HISTORY_SIZE = 20
+# Спящая задача просыпается не реже этого интервала — чтобы подхватить изменения настроек
+MAX_SLEEP_SECONDS = 60.0
+DEFAULT_INITIAL_DELAY = 10.0
+# Пауза перед повторной попыткой, если проверка аренды лидера перед запуском не прошла
+FENCE_RETRY_SECONDS = 5.0
+
+
+# Задача планировщика, в рамках запуска которой выполняется текущий код (для учёта потоков в to_thread)
+_current_job: contextvars.ContextVar["Job | None"] = contextvars.ContextVar("current_job", default=None)
+
+
+class FenceError(RuntimeError):
+    """Экземпляр потерял аренду лидера посреди запуска задачи — продолжать запись нельзя."""
+
+
+def _fmt(dt: datetime | None) -> str | None:
+    return dt.isoformat(timespec="seconds") if dt else None
+
+
+def _parse(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+class CronSchedule:
+    """Расписание в формате cron из пяти полей: минута, час, день месяца, месяц, день недели (0 — воскресенье).
+
+    Поддерживаются *, числа, списки через запятую, диапазоны a-b и шаги */n, a-b/n.
+    """
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron: ожидалось 5 полей, получено {len(fields)}: {expr!r}")
+        self.expr = expr
+        parsed = [self._parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = parsed
+        # Как в cron: если ограничены и день месяца, и день недели, подходит любой из них
+        self._dom_any = fields[2] == "*"
+        self._dow_any = fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, lo: int, hi: int) -> set[int]:
+        values: set[int] = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_s = part.split("/", 1)
+                step = int(step_s)
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                a, b = part.split("-", 1)
+                start, end = int(a), int(b)
+            else:
+                start = end = int(part)
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError(f"cron: значение вне диапазона {lo}-{hi}: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._dom_any:
+            return dow
+        if self._dow_any:
+            return dom
+        return dom or dow
+
+    def next_after(self, dt: datetime) -> datetime:
+        candidate = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366)
+        while candidate < limit:
+            if candidate.month not in self.months or not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+                continue
+            if candidate.minute in self.minutes:
+                return candidate
+            candidate += timedelta(minutes=1)
+        raise ValueError(f"cron: нет подходящего времени в течение года: {self.expr!r}")
+
+
+class Job:
+    """Фоновая задача: корутина, интервал (секунды; число или функция от настроек) или cron, джиттер и лимиты.
+
+    timeout — жёсткий лимит: по его истечении запуск отменяется. max_runtime — мягкий:
+    запуск дольше него помечается в логе как медленный.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        title: str,
+        func: Callable[[], Awaitable[None]],
+        *,
+        interval: float | Callable[[], float | None] | None = None,
+        cron: str | None = None,
+        jitter: float = 0.0,
+        timeout: float | None = None,
+        max_runtime: float | None = None,
+        initial_delay: float = DEFAULT_INITIAL_DELAY,
+    ):
+        if interval is None and cron is None:
+            raise ValueError(f"Задача {name}: нужен interval или cron")
+        self.name = name
+        self.title = title
+        self.func = func
+        self.interval = interval
+        self.cron = CronSchedule(cron) if cron else None
+        self.jitter = jitter
+        self.timeout = timeout
+        self.max_runtime = max_runtime
+        self.initial_delay = initial_delay
+
+        self.running = False
+        self.next_run: datetime | None = None
+        self.last_started_at: datetime | None = None
+        self.last_finished_at: datetime | None = None
+        self.last_duration_ms: int | None = None
+        self.last_status: str | None = None
+        self.last_error: str | None = None
+        self.run_count = 0
+        self.fail_count = 0
+        self.history: deque[dict] = deque(maxlen=HISTORY_SIZE)
+        self.scheduler: "JobScheduler | None" = None
+        self._wake = asyncio.Event()
+        # Потоки, запущенные через to_thread и ещё не завершившиеся (в том числе после таймаута запуска)
+        self._threads = 0
+        self._threads_lock = threading.Lock()
+
+    @property
+    def busy_threads(self) -> int:
+        return self._threads
+
+    def _thread_started(self) -> None:
+        with self._threads_lock:
+            self._threads += 1
+
+    def _thread_finished(self) -> None:
+        with self._threads_lock:
+            self._threads -= 1
+
+    def interval_seconds(self) -> float | None:
+        value = self.interval() if callable(self.interval) else self.interval
+        return value if value and value > 0 else None
+
+    def schedule_text(self) -> str:
+        if self.cron:
+            return f"cron {self.cron.expr}"
+        seconds = self.interval_seconds()
+        if not seconds:
+            return "выключена"
+        if seconds % 86400 == 0:
+            return f"каждые {int(seconds // 86400)} дн."
+        if seconds % 3600 == 0:
+            return f"каждые {int(seconds // 3600)} ч"
+        if seconds % 60 == 0:
+            return f"каждые {int(seconds // 60)} мин"
+        return f"каждые {int(seconds)} с"
+
+    def compute_next(self, after: datetime) -> datetime | None:
+        """Следующий запуск после after (для интервала — от начала предыдущего запуска) с джиттером."""
+        if self.cron:
+            base = self.cron.next_after(after)
+        else:
+            seconds = self.interval_seconds()
+            if not seconds:
+                return None
+            base = after + timedelta(seconds=seconds)
+        if self.jitter:
+            base += timedelta(seconds=random.uniform(0, self.jitter))
+        return base
+
+    def load_state(self, state: dict, restored: bool = True) -> None:
+        self.last_started_at = _parse(state.get("last_started_at"))
+        self.last_finished_at = _parse(state.get("last_finished_at"))
+        self.last_duration_ms = state.get("last_duration_ms")
+        self.last_status = state.get("last_status")
+        self.last_error = state.get("last_error")
+        self.next_run = _parse(state.get("next_run_at"))
+        self.run_count = int(state.get("run_count") or 0)
+        self.fail_count = int(state.get("fail_count") or 0)
+        if restored and self.last_status == "running":
+            # Процесс завершился посреди запуска
+            self.last_status = "interrupted"
+
+    def state(self) -> dict:
+        return {
+            "last_started_at": _fmt(self.last_started_at),
+            "last_finished_at": _fmt(self.last_finished_at),
+            "last_duration_ms": self.last_duration_ms,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "next_run_at": _fmt(self.next_run),
+            "run_count": self.run_count,
+            "fail_count": self.fail_count,
+        }
+
+    def status(self) -> dict:
+        durations = [h["duration_ms"] for h in self.history]
+        return {
+            "name": self.name,
+            "title": self.title,
+            "schedule": self.schedule_text(),
+            "jitter_s": self.jitter,
+            "timeout_s": self.timeout,
+            "max_runtime_s": self.max_runtime,
+            "running": self.running,
+            "busy_threads": self.busy_threads,
+            **self.state(),
+            "avg_duration_ms": int(sum(durations) / len(durations)) if durations else None,
+            "max_duration_ms": max(durations) if durations else None,
+            "history": list(self.history),
+        }
+
+
+class JobScheduler:
+    """Планировщик: у каждой задачи свой цикл, поэтому долгая задача не задерживает остальные.
+
+    Повторный запуск задачи, пока предыдущий не закончился, не выполняется.
+    Последний и следующий запуск сохраняются в таблице scheduled_jobs.
+    С elector (см. leader.LeaderElector) перед каждым запуском проверяется, что этот экземпляр — лидер.
+    """
+
+    def __init__(self, elector=None):
+        self.jobs: dict[str, Job] = {}
+        self.elector = elector
+        self.active = False
+        self._tasks: list[asyncio.Task] = []
+
+    def add(self, job: Job) -> None:
+        job.scheduler = self
+        self.jobs[job.name] = job
+
+    def start(self) -> None:
+        if self.active:
+            return
+        self.active = True
+        metrics.SCHEDULER_LEADER.set(1)
+        states = database.get_job_states()
+        now = datetime.now()
+        for job in self.jobs.values():
+            if job.name in states:
+                job.load_state(states[job.name])
+            if job.next_run is None:
+                if job.cron:
+                    job.next_run = job.compute_next(now)
+                else:
+                    job.next_run = now + timedelta(seconds=job.initial_delay + random.uniform(0, job.jitter))
+            self._tasks.append(asyncio.create_task(self._job_loop(job), name=f"job:{job.name}"))
+        logger.info(f"Планировщик: запущено задач: {len(self.jobs)}")
+
+    def stop(self) -> None:
+        self.active = False
+        metrics.SCHEDULER_LEADER.set(0)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    async def _job_loop(self, job: Job) -> None:
+        while True:
+            now = datetime.now()
+            if job.next_run is None:
+                # Задача была выключена: проверяем, не включили ли её в настройках
+                job.next_run = job.compute_next(job.last_started_at or now)
+                if job.next_run is not None and job.next_run < now:
+                    job.next_run = now
+            if job.next_run is not None and job.next_run <= now:
+                if not await self.run_job(job):
+                    await asyncio.sleep(FENCE_RETRY_SECONDS)
+                continue
+            wait = MAX_SLEEP_SECONDS if job.next_run is None else (job.next_run - now).total_seconds()
+            job._wake.clear()
+            try:
+                await asyncio.wait_for(job._wake.wait(), timeout=min(wait, MAX_SLEEP_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_job(self, job: Job) -> bool:
+        """Выполнить задачу сейчас. False — если она уже выполняется или экземпляр не лидер."""
+        if job.running:
+            return False
+        if job.busy_threads:
+            # Таймаут отменил корутину, но поток прошлого запуска ещё работает — не запускаем второй поверх
+            logger.warning(
+                f"Планировщик: задача '{job.name}' пропущена — поток прошлого запуска ещё выполняется "
+                f"({job.busy_threads} шт.)"
+            )
+            metrics.JOB_RUNS.inc(job.name, "skipped")
+            job.next_run = job.compute_next(datetime.now())
+            database.save_job_state(job.name, job.state())
+            return True
+        if self.elector is not None and not await self.elector.validate():
+            logger.warning(f"Планировщик: задача '{job.name}' пропущена — экземпляр не держит аренду лидера")
+            return False
+        job.running = True
+        started = datetime.now()
+        started_mono = time.monotonic()
+        job.last_started_at = started
+        job.last_status = "running"
+        database.save_job_state(job.name, job.state())
+        error: str | None = None
+        trace_span, trace_tokens = tracing.begin_trace(f"job {job.name}", "job", job=job.name)
+        job_token = _current_job.set(job)
+        try:
+            if job.timeout:
+                await asyncio.wait_for(job.func(), timeout=job.timeout)
+            else:
+                await job.func()
+            status = "ok"
+        except asyncio.TimeoutError:
+            status, error = "timeout", f"Превышен лимит {int(job.timeout)} с"
+            logger.error(f"Планировщик: задача '{job.name}' прервана по таймауту ({int(job.timeout)} с)")
+            if job.busy_threads:
+                logger.error(
+                    f"Планировщик: после таймаута задачи '{job.name}' продолжают работать потоки "
+                    f"({job.busy_threads} шт.); новые запуски пропускаются до их завершения"
+                )
+        except FenceError as e:
+            status, error = "fenced", str(e)
+            logger.warning(f"Планировщик: задача '{job.name}' остановлена: {e}")
+        except asyncio.CancelledError:
+            job.running = False
+            _current_job.reset(job_token)
+            tracing.end(trace_span, trace_tokens, "отменена")
+            raise
+        except Exception as e:
+            status, error = "error", f"{type(e).__name__}: {e}"
+            logger.error(f"Планировщик: ошибка задачи '{job.name}': {e}", exc_info=True)
+        _current_job.reset(job_token)
+        tracing.end(trace_span, trace_tokens, error)
+        duration_ms = int((time.monotonic() - started_mono) * 1000)
+        metrics.JOB_RUNS.inc(job.name, status)
+        metrics.JOB_DURATION.observe(duration_ms / 1000, job.name)
+        if status == "ok" and job.max_runtime and duration_ms > job.max_runtime * 1000:
+            logger.warning(f"Планировщик: задача '{job.name}' выполнялась {duration_ms / 1000:.1f} с (ожидалось до {job.max_runtime} с)")
+
+        job.running = False
+        job.last_finished_at = datetime.now()
+        job.last_duration_ms = duration_ms
+        job.last_status = status
+        job.last_error = error
+        job.run_count += 1
+        if status != "ok":
+            job.fail_count += 1
+        job.history.appendleft({
+            "started_at": _fmt(started), "duration_ms": duration_ms, "status": status, "error": error,
+        })
+        next_run = job.compute_next(started if not job.cron else job.last_finished_at)
+        # Если запуск длился дольше интервала, не пытаемся «догонять» пропущенные запуски
+        if next_run is not None and next_run <= job.last_finished_at:
+            next_run = job.compute_next(job.last_finished_at)
+        job.next_run = next_run
+        database.save_job_state(job.name, job.state())
+        logger.debug(f"Планировщик: '{job.name}' — {status} за {duration_ms} мс, следующий запуск {_fmt(job.next_run)}")
+        return True
+
+    def run_now(self, name: str) -> bool:
+        """Запланировать немедленный запуск (вызывать из цикла событий). False — задача не найдена или уже идёт."""
+        job = self.jobs.get(name)
+        if job is None or job.running or job.busy_threads:
+            return False
+        job.next_run = datetime.now()
+        job._wake.set()
+        return True
+
+    def get_status(self) -> list[dict]:
+        if not self.active:
+            # Задачи выполняет другой экземпляр — показываем его состояние из БД
+            states = database.get_job_states()
+            for job in self.jobs.values():
+                if job.name in states:
+                    job.load_state(states[job.name], restored=False)
+        return [job.status() for job in self.jobs.values()]
+
+
+def ensure_leader() -> None:
+    """Проверить fencing-токен перед записью в рамках долгой задачи; FenceError — аренда потеряна.
+
+    Синхронная: вызывается и из корутины задачи, и из её потоков (to_thread переносит контекст).
+    Вне задачи планировщика или без выбора лидера ничего не проверяет.
+    """
+    job = _current_job.get()
+    elector = job.scheduler.elector if job is not None and job.scheduler is not None else None
+    if elector is not None and not elector.validate_sync():
+        raise FenceError("экземпляр больше не держит аренду лидера")
+
+
+async def to_thread(func, /, *args, **kwargs):
+    """Как asyncio.to_thread, но поток учитывается за задачей планировщика, из которой он запущен.
+
+    Отмена (например, по таймауту задачи) не останавливает уже работающий поток; пока он не
+    завершится, run_job пропускает новые запуски этой задачи. Вне задачи — обычный asyncio.to_thread.
+    """
+    job = _current_job.get()
+    if job is None:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    ctx = contextvars.copy_context()
+
+    def run():
+        # Счётчик увеличивается в самом потоке: если запуск отменят до старта, поток не появится вовсе
+        job._thread_started()
+        try:
+            return ctx.run(func, *args, **kwargs)
+        finally:
+            job._thread_finished()
+
+    return await asyncio.get_running_loop().run_in_executor(None, run)
+
+
+_scheduler: JobScheduler | None = None
+
+
+def get_scheduler() -> JobScheduler | None:
+    return _scheduler
+
+
+def set_scheduler(scheduler: JobScheduler) -> None:
+    global _scheduler
+    _scheduler = scheduler
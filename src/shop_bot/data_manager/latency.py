@@ -0,0 +1,179 @@
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from shop_bot.data_manager import metrics
+
+# Границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Обновления дольше этого порога попадают в журнал медленных с разбивкой по вызовам
+SLOW_UPDATE_MS = 1000
+SLOW_UPDATES_KEPT = 50
+# Сколько имён вызовов БД/панели хранить в разбивке одного обновления
+BREAKDOWN_LIMIT = 30
+
+_current: ContextVar[dict | None] = ContextVar("latency_current_update", default=None)
+_lock = threading.Lock()
+_routes: dict[tuple[str, str], dict] = {}
+_slow: deque = deque(maxlen=SLOW_UPDATES_KEPT)
+_started_at = time.time()
+
+_TRAILING_ID = re.compile(r"[_:-]?\d+$")
+
+
+def route_for_callback(data: str | None) -> str:
+    """Ключ маршрута по callback_data: префикс до первого ':' без хвостовых идентификаторов."""
+    if not data:
+        return "callback:-"
+    prefix = data.split(":", 1)[0]
+    return f"callback:{_TRAILING_ID.sub('', prefix) or prefix}"
+
+
+def route_for_message(text: str | None, content_type: str | None, state: str | None) -> str:
+    if text and text.startswith("/"):
+        return f"command:{text.split()[0].split('@')[0]}"
+    if state:
+        return f"state:{state}"
+    return f"message:{content_type or 'text'}"
+
+
+def begin(bot_kind: str, route: str) -> dict:
+    ctx = {
+        "bot": bot_kind,
+        "route": route,
+        "handler": None,
+        "started": time.perf_counter(),
+        "db_calls": 0,
+        "panel_calls": 0,
+        "panel_ms": 0.0,
+        "breakdown": Counter(),
+    }
+    ctx["token"] = _current.set(ctx)
+    return ctx
+
+
+def is_tracking() -> bool:
+    return _current.get() is not None
+
+
+def set_handler(name: str) -> None:
+    ctx = _current.get()
+    if ctx is not None:
+        ctx["handler"] = name
+
+
+def count_db_call(name: str) -> None:
+    ctx = _current.get()
+    if ctx is not None:
+        ctx["db_calls"] += 1
+        if len(ctx["breakdown"]) < BREAKDOWN_LIMIT or f"db:{name}" in ctx["breakdown"]:
+            ctx["breakdown"][f"db:{name}"] += 1
+
+
+def count_panel_call(name: str, elapsed_ms: float) -> None:
+    ctx = _current.get()
+    if ctx is not None:
+        ctx["panel_calls"] += 1
+        ctx["panel_ms"] += elapsed_ms
+        if len(ctx["breakdown"]) < BREAKDOWN_LIMIT or f"panel:{name}" in ctx["breakdown"]:
+            ctx["breakdown"][f"panel:{name}"] += 1
+
+
+def finish(ctx: dict, error: bool = False) -> float:
+    elapsed_ms = (time.perf_counter() - ctx["started"]) * 1000
+    _current.reset(ctx["token"])
+    metrics.UPDATES.inc(ctx["bot"], ctx["route"], "error" if error else "ok")
+    metrics.UPDATE_DURATION.observe(elapsed_ms / 1000, ctx["bot"], ctx["route"])
+    key = (ctx["bot"], ctx["route"])
+    with _lock:
+        stats = _routes.get(key)
+        if stats is None:
+            stats = _routes[key] = {
+                "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "db_calls": 0, "panel_calls": 0, "panel_ms": 0.0, "slow": 0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                "handler": None,
+            }
+        stats["count"] += 1
+        stats["errors"] += 1 if error else 0
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["db_calls"] += ctx["db_calls"]
+        stats["panel_calls"] += ctx["panel_calls"]
+        stats["panel_ms"] += ctx["panel_ms"]
+        if ctx["handler"]:
+            stats["handler"] = ctx["handler"]
+        idx = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound), len(LATENCY_BUCKETS_MS))
+        stats["buckets"][idx] += 1
+        if elapsed_ms >= SLOW_UPDATE_MS:
+            stats["slow"] += 1
+            _slow.append({
+                "at": time.time(),
+                "bot": ctx["bot"],
+                "route": ctx["route"],
+                "handler": ctx["handler"],
+                "duration_ms": round(elapsed_ms, 1),
+                "db_calls": ctx["db_calls"],
+                "panel_calls": ctx["panel_calls"],
+                "panel_ms": round(ctx["panel_ms"], 1),
+                "breakdown": dict(ctx["breakdown"].most_common(BREAKDOWN_LIMIT)),
+                "error": error,
+            })
+    return elapsed_ms
+
+
+def _percentile(buckets: list[int], count: int, q: float) -> float | None:
+    """Оценка перцентиля по гистограмме: верхняя граница корзины, в которую он попал."""
+    if not count:
+        return None
+    target = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= target:
+            return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else None
+    return None
+
+
+def get_snapshot() -> dict:
+    with _lock:
+        routes = [(key, dict(stats, buckets=list(stats["buckets"]))) for key, stats in _routes.items()]
+        slow = list(_slow)
+    items = []
+    for (bot_kind, route), stats in routes:
+        count = stats["count"]
+        items.append({
+            "bot": bot_kind,
+            "route": route,
+            "handler": stats["handler"],
+            "count": count,
+            "errors": stats["errors"],
+            "slow": stats["slow"],
+            "avg_ms": round(stats["total_ms"] / count, 1) if count else 0.0,
+            "max_ms": round(stats["max_ms"], 1),
+            "p50_ms": _percentile(stats["buckets"], count, 0.5),
+            "p95_ms": _percentile(stats["buckets"], count, 0.95),
+            "p99_ms": _percentile(stats["buckets"], count, 0.99),
+            "db_calls_avg": round(stats["db_calls"] / count, 2) if count else 0.0,
+            "panel_calls_avg": round(stats["panel_calls"] / count, 2) if count else 0.0,
+            "panel_ms_avg": round(stats["panel_ms"] / count, 1) if count else 0.0,
+            "buckets": stats["buckets"],
+        })
+    items.sort(key=lambda r: r["avg_ms"] * r["count"], reverse=True)
+    return {
+        "since": _started_at,
+        "bucket_bounds_ms": list(LATENCY_BUCKETS_MS),
+        "slow_threshold_ms": SLOW_UPDATE_MS,
+        "routes": items,
+        "slow_updates": list(reversed(slow)),
+    }
+
+
+def reset() -> None:
+    global _started_at
+    with _lock:
+        _routes.clear()
+        _slow.clear()
+        _started_at = time.time()
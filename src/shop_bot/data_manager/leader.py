@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "scheduler"
+# Лидер продлевает аренду каждые HEARTBEAT_SECONDS; если он умер, другой экземпляр
+# заберёт её не позже чем через LEASE_TTL_SECONDS + HEARTBEAT_SECONDS
+LEASE_TTL_SECONDS = 15.0
+HEARTBEAT_SECONDS = 5.0
+# Лидер считает себя лидером чуть меньше TTL от начала успешного продления —
+# чтобы сложить полномочия раньше, чем аренду сможет забрать другой экземпляр
+SAFETY_MARGIN_SECONDS = 2.0
+
+
+def default_instance_id() -> str:
+    return os.getenv("SHOPBOT_INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class LeaderElector:
+    """Выбор лидера через аренду в общей БД (таблица leader_leases).
+
+    Фоновые задачи выполняет только лидер. Каждая смена владельца увеличивает fencing-токен;
+    перед запуском задачи validate() сверяет его с БД, так что экземпляр, потерявший аренду
+    (например, после долгой паузы процесса), не запустит задачу вместе с новым лидером.
+    При штатной остановке аренда освобождается, и другой экземпляр забирает её за один heartbeat.
+    """
+
+    def __init__(
+        self,
+        name: str = LEASE_NAME,
+        instance_id: str | None = None,
+        *,
+        ttl: float = LEASE_TTL_SECONDS,
+        heartbeat: float = HEARTBEAT_SECONDS,
+        on_elected: Callable[[], None] | None = None,
+        on_revoked: Callable[[], None] | None = None,
+    ):
+        self.name = name
+        self.instance_id = instance_id or default_instance_id()
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.token: int | None = None
+        self._valid_until = 0.0
+        self._leader_since: float | None = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    async def validate(self) -> bool:
+        """Аренда всё ещё наша (проверка fencing-токена в БД)."""
+        if not self.is_leader:
+            return False
+        return await asyncio.to_thread(self.validate_sync)
+
+    def validate_sync(self) -> bool:
+        """То же, что validate(), для кода в рабочих потоках задач."""
+        token = self.token
+        if token is None or not self.is_leader:
+            return False
+        return database.is_lease_valid(self.name, self.instance_id, token)
+
+    def _elect(self, token: int) -> None:
+        self.token = token
+        self._leader_since = time.time()
+        logger.info(f"Лидер: экземпляр {self.instance_id} стал лидером (токен {token}).")
+        if self.on_elected:
+            self.on_elected()
+
+    def _revoke(self, reason: str) -> None:
+        logger.warning(f"Лидер: экземпляр {self.instance_id} больше не лидер: {reason}.")
+        self.token = None
+        self._leader_since = None
+        if self.on_revoked:
+            self.on_revoked()
+
+    async def _tick(self) -> None:
+        started = time.monotonic()
+        token = await asyncio.to_thread(database.acquire_lease, self.name, self.instance_id, self.ttl)
+        if token is not None:
+            self._valid_until = started + self.ttl - SAFETY_MARGIN_SECONDS
+            if self.token is None:
+                self._elect(token)
+            elif token != self.token:
+                # Аренда успела истечь и была взята заново — это уже другой «срок»
+                self._revoke("аренда истекла до продления")
+                self._elect(token)
+        elif self.token is not None and time.monotonic() >= self._valid_until:
+            self._revoke("не удалось продлить аренду")
+
+    async def run(self) -> None:
+        logger.info(f"Лидер: экземпляр {self.instance_id} участвует в выборе лидера ({self.name}).")
+        try:
+            while True:
+                try:
+                    await self._tick()
+                except Exception as e:
+                    logger.error(f"Лидер: ошибка продления аренды: {e}", exc_info=True)
+                # Без ответа БД лидер слагает полномочия сам, не дожидаясь следующего heartbeat
+                wait = self.heartbeat
+                if self.token is not None:
+                    wait = max(0.0, min(wait, self._valid_until - time.monotonic()))
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            if self.token is not None:
+                database.release_lease(self.name, self.instance_id)
+                self._revoke("остановка процесса")
+            raise
+
+    def status(self) -> dict:
+        lease = database.get_lease(self.name) or {}
+        expires_at = lease.get("expires_at")
+        return {
+            "instance_id": self.instance_id,
+            "is_leader": self.is_leader,
+            "token": self.token,
+            "leader_since": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self._leader_since)) if self._leader_since else None,
+            "lease_holder": lease.get("holder") if expires_at and expires_at > time.time() else None,
+            "lease_token": lease.get("token"),
+            "lease_expires_in_s": round(expires_at - time.time(), 1) if expires_at and expires_at > time.time() else None,
+        }
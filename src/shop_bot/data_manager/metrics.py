@@ -0,0 +1,230 @@
+import asyncio
+import bisect
+import threading
+import time
+from typing import Callable, Iterable
+
+# Метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+# Каждая метрика — словарь «значения меток -> число» под собственной блокировкой,
+# поэтому инструменты можно вызывать и из потока Flask, и из цикла событий.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# Защита от взрыва числа рядов (например, маршрут с непредусмотренным id в callback_data):
+# сверх лимита новые сочетания меток попадают в ряд со значениями "_other"
+MAX_SERIES_PER_METRIC = 1000
+LOOP_LAG_INTERVAL_SECONDS = 1.0
+
+_registry: list["_Metric"] = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, values: tuple) -> tuple:
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name}: ожидались метки {self.labels}, получено {values}")
+        key = tuple(str(v) for v in values)
+        if key not in self._values and len(self._values) >= MAX_SERIES_PER_METRIC:
+            return ("_other",) * len(self.labels)
+        return key
+
+    def _samples(self) -> list[tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        with self._lock:
+            key = self._key(label_values)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [("", _format_labels(self.labels, key), value) for key, value in items]
+
+
+class Gauge(_Metric):
+    """Значение на момент чтения: set() или функция, опрашиваемая при каждом запросе /metrics."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._function: Callable[[], dict[tuple, float]] | None = None
+
+    def set(self, value: float, *label_values) -> None:
+        with self._lock:
+            self._values[self._key(label_values)] = value
+
+    def set_function(self, function: Callable[[], dict[tuple, float]]) -> None:
+        """function() -> {значения меток: число}; для метрики без меток ключ — ()."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                items = list(self._function().items())
+            except Exception:
+                items = []
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [("", _format_labels(self.labels, key), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values) -> None:
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(label_values)
+            series = self._values.get(key)
+            if series is None:
+                # [счётчики корзин (последняя — +Inf), сумма, количество]
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._values.items()]
+        samples = []
+        le_names = self.labels + ("le",)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                samples.append(("_bucket", _format_labels(le_names, key + (_format_value(bound),)), cumulative))
+            labels = _format_labels(self.labels, key)
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+# --- Бот ---
+UPDATES = Counter(
+    "shopbot_updates_total", "Обработанные обновления Telegram по боту, маршруту и результату.",
+    ("bot", "route", "outcome"),
+)
+UPDATE_DURATION = Histogram(
+    "shopbot_update_duration_seconds", "Полное время обработки обновления.", ("bot", "route"),
+)
+
+# --- БД ---
+DB_QUERY_DURATION = Histogram(
+    "shopbot_db_query_duration_seconds",
+    "Время работы хелпера БД от открытия соединения до выхода из with (_count — число вызовов).",
+    ("db", "helper"), buckets=DB_BUCKETS,
+)
+
+# --- Панели 3x-ui ---
+PANEL_CALLS = Counter(
+    "shopbot_panel_calls_total", "Обращения к панелям 3x-ui по хосту, вызову и результату.",
+    ("host", "call", "outcome"),
+)
+PANEL_CALL_DURATION = Histogram(
+    "shopbot_panel_call_duration_seconds", "Длительность обращений к панелям 3x-ui.", ("host", "call"),
+)
+
+# --- Платежи ---
+PAYMENT_WEBHOOKS = Counter(
+    "shopbot_payment_webhooks_total", "Вебхуки платёжных систем по провайдеру и HTTP-статусу ответа.",
+    ("provider", "status"),
+)
+PAYMENT_WEBHOOK_DURATION = Histogram(
+    "shopbot_payment_webhook_duration_seconds", "Время обработки вебхука платёжной системы.", ("provider",),
+)
+
+# --- Планировщик ---
+JOB_RUNS = Counter("shopbot_job_runs_total", "Запуски фоновых задач по результату.", ("job", "status"))
+JOB_DURATION = Histogram(
+    "shopbot_job_duration_seconds", "Длительность запусков фоновых задач.", ("job",), buckets=JOB_BUCKETS,
+)
+SCHEDULER_LEADER = Gauge("shopbot_scheduler_leader", "1 — этот экземпляр выполняет фоновые задачи (лидер).")
+
+# --- Исходящие сообщения ---
+OUTBOUND_SENDS = Counter(
+    "shopbot_outbound_sends_total", "Вызовы Telegram Bot API через диспетчер по полосе и результату.",
+    ("lane", "outcome"),
+)
+OUTBOUND_RETRY_AFTER = Counter(
+    "shopbot_outbound_retry_after_total", "Ответы Telegram 429 (RetryAfter) по полосе.", ("lane",),
+)
+OUTBOUND_QUEUE_SIZE = Gauge("shopbot_outbound_queue_size", "Сообщений в очереди диспетчера.")
+
+# --- Хосты и процесс ---
+HOST_PROBE_DURATION = Histogram(
+    "shopbot_host_probe_duration_seconds", "Длительность проб хостов (сетевая проба, сбор метрик по SSH).",
+    ("host", "kind", "outcome"), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+EVENT_LOOP_LAG = Histogram(
+    "shopbot_event_loop_lag_seconds", "Задержка пробуждения цикла событий относительно запланированного.",
+    buckets=LOOP_LAG_BUCKETS,
+)
+START_TIME = Gauge("shopbot_start_time_seconds", "Время запуска процесса (unix).")
+START_TIME.set(time.time())
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL_SECONDS) -> None:
+    """Раз в interval засыпает на interval и меряет, насколько позже цикл событий её разбудил."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
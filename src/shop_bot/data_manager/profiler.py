@@ -0,0 +1,214 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+
+# Сэмплирующий профилировщик по требованию: поток, вызвавший sample(), раз в interval снимает
+# sys._current_frames() всех остальных потоков (цикл событий, Flask, asyncio.to_thread, писатель логов)
+# и считает одинаковые стеки. Результат — collapsed stacks ("поток;модуль:функция;... число"),
+# их понимают flamegraph.pl, speedscope и inferno. Внешние сервисы и зависимости не нужны.
+
+MIN_SECONDS = 1.0
+MAX_SECONDS = 60.0
+MIN_INTERVAL_MS = 5.0
+MAX_INTERVAL_MS = 100.0
+MAX_STACK_DEPTH = 100
+TOP_FUNCTIONS = 30
+# Задача, которая живёт дольше, подсвечивается в дампе задач как долгая
+LONG_TASK_SECONDS = 60.0
+
+# Листовые фреймы «спящих» потоков: ожидание select/epoll, условных переменных, очередей
+IDLE_LEAVES = frozenset({
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("handlers.py", "dequeue"),
+    ("socketserver.py", "serve_forever"),
+})
+
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_run_lock = threading.Lock()
+_last_result: dict | None = None
+_task_created: "weakref.WeakKeyDictionary[asyncio.Task, float]" = weakref.WeakKeyDictionary()
+
+
+def _short_path(filename: str) -> str:
+    if filename.startswith(_PACKAGE_ROOT):
+        return "shop_bot" + filename[len(_PACKAGE_ROOT):].replace(os.sep, "/")
+    marker = f"site-packages{os.sep}"
+    idx = filename.rfind(marker)
+    if idx != -1:
+        return filename[idx + len(marker):].replace(os.sep, "/")
+    return os.path.basename(filename)
+
+
+def _frame_label(code, labels: dict) -> str:
+    label = labels.get(code)
+    if label is None:
+        name = getattr(code, "co_qualname", code.co_name)
+        label = labels[code] = f"{_short_path(code.co_filename)}:{name}"
+    return label
+
+
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES
+
+
+def sample(seconds: float, interval_ms: float = 10.0, include_idle: bool = False) -> dict:
+    """Снимать стеки всех потоков seconds секунд с шагом interval_ms. Блокирует вызывающий поток.
+
+    Одновременно выполняется только один сеанс; если уже идёт другой — RuntimeError.
+    """
+    global _last_result
+    seconds = min(max(float(seconds), MIN_SECONDS), MAX_SECONDS)
+    interval = min(max(float(interval_ms), MIN_INTERVAL_MS), MAX_INTERVAL_MS) / 1000
+    if not _run_lock.acquire(blocking=False):
+        raise RuntimeError("Профилирование уже выполняется")
+    try:
+        own_ident = threading.get_ident()
+        stacks: Counter = Counter()
+        leaves: Counter = Counter()
+        threads: dict[str, dict] = {}
+        labels: dict = {}
+        ticks = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        next_tick = started
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                thread_name = names.get(ident, f"thread-{ident}")
+                stats = threads.setdefault(thread_name, {"samples": 0, "busy": 0})
+                stats["samples"] += 1
+                idle = _is_idle(frame)
+                if not idle:
+                    stats["busy"] += 1
+                elif not include_idle:
+                    continue
+                parts = []
+                f = frame
+                while f is not None and len(parts) < MAX_STACK_DEPTH:
+                    parts.append(_frame_label(f.f_code, labels))
+                    f = f.f_back
+                leaves[parts[0]] += 1
+                parts.append(thread_name)
+                stacks[";".join(reversed(parts))] += 1
+            # Не держать чужие фреймы живыми во время сна
+            frame = f = None
+            ticks += 1
+            next_tick += interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Не успеваем (много потоков или GIL занят) — не копим отставание
+                next_tick = time.monotonic()
+        elapsed = time.monotonic() - started
+    finally:
+        _run_lock.release()
+
+    total = sum(stacks.values()) or 1
+    result = {
+        "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "duration_s": round(elapsed, 2),
+        "interval_ms": round(interval * 1000, 1),
+        "ticks": ticks,
+        "include_idle": include_idle,
+        "samples": sum(stacks.values()),
+        "threads": [
+            {"name": name, "samples": s["samples"], "busy": s["busy"],
+             "busy_pct": round(s["busy"] / s["samples"] * 100, 1) if s["samples"] else 0.0}
+            for name, s in sorted(threads.items(), key=lambda kv: kv[1]["busy"], reverse=True)
+        ],
+        "top_functions": [
+            {"function": name, "samples": n, "pct": round(n / total * 100, 1)}
+            for name, n in leaves.most_common(TOP_FUNCTIONS)
+        ],
+        "collapsed": collapsed(stacks),
+    }
+    _last_result = result
+    return result
+
+
+def collapsed(stacks: Counter) -> str:
+    """Формат flamegraph.pl: одна строка на уникальный стек — "кадр;кадр;... число"."""
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+def is_running() -> bool:
+    return _run_lock.locked()
+
+
+def get_last_result() -> dict | None:
+    return _last_result
+
+
+# --- asyncio-задачи ---
+
+def install_task_tracking(loop: asyncio.AbstractEventLoop) -> None:
+    """Фабрика задач, запоминающая время создания каждой задачи — для возраста в дампе."""
+    previous = loop.get_task_factory()
+
+    def factory(loop, coro, **kwargs):
+        if previous is not None:
+            task = previous(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        _task_created[task] = time.time()
+        return task
+
+    loop.set_task_factory(factory)
+
+
+def _await_chain(coro) -> tuple[list[str], str | None]:
+    """Цепочка await от корутины задачи вглубь: где именно она сейчас ждёт."""
+    frames: list[str] = []
+    current = coro
+    while current is not None and len(frames) < MAX_STACK_DEPTH:
+        frame = getattr(current, "cr_frame", None) or getattr(current, "gi_frame", None) \
+            or getattr(current, "ag_frame", None)
+        if frame is None:
+            break
+        code = frame.f_code
+        frames.append(f"{_short_path(code.co_filename)}:{frame.f_lineno} {getattr(code, 'co_qualname', code.co_name)}")
+        awaited = getattr(current, "cr_await", None) or getattr(current, "gi_yieldfrom", None) \
+            or getattr(current, "ag_await", None)
+        if awaited is None:
+            return frames, None
+        current = awaited
+    return frames, type(current).__name__ if current is not None else None
+
+
+async def dump_tasks() -> list[dict]:
+    """Все задачи цикла событий: имя, корутина, возраст и где она ждёт. Вызывать в цикле событий."""
+    now = time.time()
+    this = asyncio.current_task()
+    tasks = []
+    for task in asyncio.all_tasks():
+        if task is this:
+            continue
+        coro = task.get_coro()
+        created = _task_created.get(task)
+        frames, waiting_on = _await_chain(coro)
+        age = round(now - created, 1) if created else None
+        tasks.append({
+            "name": task.get_name(),
+            "coro": getattr(coro, "__qualname__", type(coro).__name__),
+            "age_s": age,
+            "long": age is not None and age >= LONG_TASK_SECONDS,
+            "cancelling": bool(getattr(task, "cancelling", lambda: 0)()),
+            "waiting_on": waiting_on,
+            "stack": frames,
+        })
+    tasks.sort(key=lambda t: (t["age_s"] is None, -(t["age_s"] or 0)))
+    return tasks
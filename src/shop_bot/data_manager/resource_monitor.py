@@ -9,6 +9,7 @@ from typing import Any, Dict, List, Tuple
 import paramiko
 
 from shop_bot.data_manager import database
+from shop_bot.data_manager import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -165,6 +166,15 @@ def _ssh_exec(ssh: paramiko.SSHClient, cmd: str, timeout: int = 20) -> Tuple[int
 
 
 def get_host_metrics_via_ssh(host_row: dict) -> Dict[str, Any]:
+    started = time.perf_counter()
+    res = _get_host_metrics_via_ssh(host_row)
+    metrics.HOST_PROBE_DURATION.observe(
+        time.perf_counter() - started, host_row.get('host_name') or '-', 'ssh_metrics', 'ok' if res.get('ok') else 'fail'
+    )
+    return res
+
+
+def _get_host_metrics_via_ssh(host_row: dict) -> Dict[str, Any]:
     res: Dict[str, Any] = {
         'ok': False,
         'host_name': host_row.get('host_name'),
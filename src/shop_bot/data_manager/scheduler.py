@@ -1,35 +1,54 @@
 ﻿import asyncio
+import html
 import logging
 import json
 
 from datetime import datetime, timedelta
 
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import Bot
 
 from shop_bot.bot_controller import BotController
 from shop_bot.data_manager import database
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.data_manager import backup_manager
+from shop_bot.data_manager import incremental_backup
+from shop_bot.data_manager import job_scheduler
+from shop_bot.data_manager.job_scheduler import Job, JobScheduler, set_scheduler
+from shop_bot.data_manager.leader import LeaderElector
 from shop_bot.data_manager import resource_monitor
 
 from shop_bot.modules import xui_api
+from shop_bot.modules import host_health
 from shop_bot.bot import keyboards
+from shop_bot.bot import outbound
 
 CHECK_INTERVAL_SECONDS = 300
 NOTIFY_BEFORE_HOURS = {72, 48, 24, 1}
-notified_users = {}
+# Напоминания одного тика растягиваются на это окно (меньше интервала проверки), но не реже раза в секунду
+REMINDER_SPREAD_SECONDS = 240
+REMINDER_MAX_GAP_SECONDS = 1.0
+_reminder_task: asyncio.Task | None = None
 
 logger = logging.getLogger(__name__)
 
 # Запуск обоих видов измерений 3 раза в сутки (каждые 8 часов)
-SPEEDTEST_INTERVAL_SECONDS = 8 * 3600
-_last_speedtests_run_at: datetime | None = None
-_last_backup_run_at: datetime | None = None
+SPEEDTEST_CRON = "0 */8 * * *"
 
 # Сбор метрик ресурсов (каждые 5 минут)
 METRICS_INTERVAL_SECONDS = 5 * 60
-_last_metrics_run_at: datetime | None = None
+
+# Очистка старой телеметрии (раз в сутки, ночью)
+TELEMETRY_PRUNE_CRON = "30 4 * * *"
+
+# Фоновая проба хостов с открытым circuit (перевод в half-open)
+HOST_PROBE_INTERVAL_SECONDS = 15
+_probe_task: asyncio.Task | None = None
+_elector_task: asyncio.Task | None = None
+
+# Разовая дозагрузка sub_token для старых ключей: хосты, где она прошла, больше не опрашиваются;
+# флаг ставится, только когда все хосты обработаны без ошибок
+_sub_tokens_backfilled = False
+_sub_tokens_done_hosts: set[str] = set()
 
 def format_time_left(hours: int) -> str:
     if hours >= 24:
@@ -48,63 +67,59 @@ def format_time_left(hours: int) -> str:
         else:
             return f"{hours} часов"
 
-async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, time_left_hours: int, expiry_date: datetime):
-    try:
-        time_text = format_time_left(time_left_hours)
-        expiry_str = expiry_date.strftime('%d.%m.%Y в %H:%M')
-        
-        message = (
-            f"⚠️ **Внимание!** ⚠️\n\n"
-            f"Срок действия вашей подписки истекает через **{time_text}**.\n"
-            f"Дата окончания: **{expiry_str}**\n\n"
+def _build_expiry_reminder_text(keys: list[dict], time_left_hours: int) -> str:
+    time_text = format_time_left(time_left_hours)
+    if len(keys) == 1:
+        expiry_str = keys[0]['expiry'].strftime('%d.%m.%Y в %H:%M')
+        return (
+            f"⚠️ <b>Внимание!</b> ⚠️\n\n"
+            f"Срок действия вашей подписки истекает через <b>{time_text}</b>.\n"
+            f"Дата окончания: <b>{expiry_str}</b>\n\n"
             f"Продлите подписку, чтобы не остаться без доступа к VPN!"
         )
-        
-        builder = InlineKeyboardBuilder()
-        builder.button(text="🔑 Мои ключи", callback_data="manage_keys")
-        builder.button(text="➕ Продлить ключ", callback_data=f"extend_key_{key_id}")
-        builder.adjust(2)
-        
-        await bot.send_message(chat_id=user_id, text=message, reply_markup=builder.as_markup(), parse_mode='Markdown')
-        logger.debug(f"Scheduler: Отправлено уведомление пользователю {user_id} по ключу {key_id} (осталось {time_left_hours} ч).")
-        
+    lines = [
+        f"⚠️ <b>Внимание!</b> ⚠️\n",
+        f"Через <b>{time_text}</b> истекает срок действия ваших ключей ({len(keys)}):",
+    ]
+    for key in keys:
+        host = html.escape(key.get('host_name') or '—')
+        lines.append(f"• #{key['key_id']} {host} — до {key['expiry'].strftime('%d.%m.%Y %H:%M')}")
+    lines.append("\nПродлите подписки, чтобы не остаться без доступа к VPN!")
+    return "\n".join(lines)
+
+async def send_expiry_reminder(bot: Bot, user_id: int, keys: list[dict], time_left_hours: int):
+    """Одно сообщение на пользователя и порог: все его ключи, истекающие к этой отметке."""
+    try:
+        await outbound.send_message(
+            bot, user_id, _build_expiry_reminder_text(keys, time_left_hours), priority=outbound.PRIORITY_REMINDER,
+            reply_markup=keyboards.create_expiry_reminder_keyboard(keys), parse_mode='HTML'
+        )
+        logger.debug(f"Scheduler: Отправлено напоминание пользователю {user_id} по {len(keys)} ключ(ам) (осталось {time_left_hours} ч).")
     except Exception as e:
         logger.error(f"Scheduler: Ошибка отправки уведомления пользователю {user_id}: {e}")
 
-def _cleanup_notified_users(all_db_keys: list[dict]):
-    if not notified_users:
-        return
-
-    logger.debug("Scheduler: Очищаю кэш уведомлений...")
-    
-    active_key_ids = {key['key_id'] for key in all_db_keys}
-    
-    users_to_check = list(notified_users.keys())
-    
-    cleaned_users = 0
-    cleaned_keys = 0
-
-    for user_id in users_to_check:
-        keys_to_check = list(notified_users[user_id].keys())
-        for key_id in keys_to_check:
-            if key_id not in active_key_ids:
-                del notified_users[user_id][key_id]
-                cleaned_keys += 1
-        
-        if not notified_users[user_id]:
-            del notified_users[user_id]
-            cleaned_users += 1
-    
-    if cleaned_users > 0 or cleaned_keys > 0:
-        logger.debug(f"Scheduler: Очистка завершена. Удалено записей пользователей: {cleaned_users}, ключей: {cleaned_keys}.")
+async def _send_expiry_reminders_spread(bot: Bot, reminders: list[tuple[int, int, list[dict]]]):
+    """Рассылает напоминания равномерно внутри окна тика, не блокируя основной цикл."""
+    gap = min(REMINDER_MAX_GAP_SECONDS, REMINDER_SPREAD_SECONDS / len(reminders))
+    for index, (user_id, hours_mark, keys) in enumerate(reminders):
+        if index:
+            await asyncio.sleep(gap)
+        await send_expiry_reminder(bot, user_id, keys, hours_mark)
+    logger.info(f"Scheduler: Отправлено напоминаний об истечении: {len(reminders)} "
+                f"(ключей: {sum(len(k) for _, _, k in reminders)}).")
 
 async def check_expiring_subscriptions(bot: Bot):
+    global _reminder_task
     logger.debug("Scheduler: Проверяю истекающие подписки...")
     current_time = datetime.now()
     all_keys = database.get_all_keys()
-    
-    _cleanup_notified_users(all_keys)
-    
+
+    removed = database.delete_stale_expiry_reminders()
+    if removed:
+        logger.debug(f"Scheduler: Удалено отметок напоминаний для удалённых ключей: {removed}.")
+
+    # Ключи, пересёкшие порог; отметка об отправке хранится в БД и общая для всех экземпляров
+    candidates: list[tuple[dict, int]] = []
     for key in all_keys:
         try:
             expiry_date = datetime.fromisoformat(key['expiry_date'])
@@ -114,21 +129,39 @@ async def check_expiring_subscriptions(bot: Bot):
                 continue
 
             total_hours_left = int(time_left.total_seconds() / 3600)
-            user_id = key['user_id']
-            key_id = key['key_id']
 
             for hours_mark in NOTIFY_BEFORE_HOURS:
                 if hours_mark - 1 < total_hours_left <= hours_mark:
-                    notified_users.setdefault(user_id, {}).setdefault(key_id, set())
-                    
-                    if hours_mark not in notified_users[user_id][key_id]:
-                        await send_subscription_notification(bot, user_id, key_id, hours_mark, expiry_date)
-                        notified_users[user_id][key_id].add(hours_mark)
-                    break 
-                    
+                    candidates.append((key, hours_mark))
+                    break
+
         except Exception as e:
             logger.error(f"Scheduler: Ошибка обработки истечения для ключа {key.get('key_id')}: {e}")
 
+    if not candidates:
+        return
+    claimed = database.claim_expiry_reminders(
+        [(key['key_id'], hours_mark, key['expiry_date']) for key, hours_mark in candidates]
+    )
+
+    # (user_id, порог) -> ключи, которые пересекли этот порог в текущем тике
+    due: dict[tuple[int, int], list[dict]] = {}
+    for key, hours_mark in candidates:
+        if (key['key_id'], hours_mark) not in claimed:
+            continue
+        due.setdefault((key['user_id'], hours_mark), []).append(
+            {'key_id': key['key_id'], 'host_name': key.get('host_name'),
+             'expiry': datetime.fromisoformat(key['expiry_date'])}
+        )
+
+    if not due:
+        return
+    reminders = [
+        (user_id, hours_mark, sorted(keys, key=lambda k: k['expiry']))
+        for (user_id, hours_mark), keys in sorted(due.items(), key=lambda item: item[0][1])
+    ]
+    _reminder_task = asyncio.create_task(_send_expiry_reminders_spread(bot, reminders))
+
 async def sync_keys_with_panels():
     logger.debug("Scheduler: Запускаю синхронизацию с XUI-панелями...")
     total_affected_records = 0
@@ -140,6 +173,8 @@ async def sync_keys_with_panels():
 
     for host in all_hosts:
         host_name = host['host_name']
+        # Синхронизация долгая: аренду могли потерять, пока обрабатывались прошлые хосты
+        job_scheduler.ensure_leader()
         logger.debug(f"Scheduler: Обрабатываю хост: '{host_name}'")
         
         try:
@@ -153,10 +188,12 @@ async def sync_keys_with_panels():
             if not api or not inbound:
                 logger.error(f"Scheduler: Не удалось авторизоваться на хосте '{host_name}'. Пропускаю его.")
                 continue
-            
+            xui_api.remember_inbound_params(host_name, inbound)
+
             full_inbound_details = api.inbound.get_by_id(inbound.id)
             clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
             logger.debug(f"Scheduler: Найдено клиентов на панели '{host_name}': {len(clients_on_server)}")
+            database.set_host_panel_clients(host_name, len(clients_on_server))
 
             keys_in_db = database.get_keys_for_host(host_name)
             
@@ -238,6 +275,7 @@ async def sync_keys_with_panels():
                             xui_client_uuid=str(client_uuid),
                             key_email=orphan_email,
                             expiry_timestamp_ms=expiry_ms,
+                            sub_token=xui_api.get_client_sub_token(orphan_client),
                         )
                         if new_id:
                             logger.info(
@@ -259,48 +297,125 @@ async def sync_keys_with_panels():
             
     logger.debug(f"Scheduler: Синхронизация с XUI-панелями завершена. Затронуто записей: {total_affected_records}.")
 
-async def periodic_subscription_check(bot_controller: BotController):
-    logger.info("Scheduler: Планировщик фоновых задач запущен.")
-    await asyncio.sleep(10)
-
-    while True:
-        try:
-            await sync_keys_with_panels()
+def _running_bot(bot_controller: BotController) -> Bot | None:
+    if not bot_controller.get_status().get("is_running"):
+        return None
+    bot = bot_controller.get_bot_instance()
+    if not bot:
+        logger.warning("Scheduler: Бот помечен как запущенный, но экземпляр недоступен.")
+    return bot
 
-            # Периодические измерения скорости по всем хостам (оба варианта: SSH и сетевой)
-            await _maybe_run_periodic_speedtests()
-            await _maybe_collect_host_metrics()
+def _backup_interval_seconds() -> float | None:
+    # Интервал из настроек (в днях). 0 или пусто — автобэкап выключен.
+    try:
+        s = database.get_setting("backup_interval_days") or "1"
+        days = int(str(s).strip() or "1")
+    except Exception:
+        days = 1
+    return days * 24 * 3600 if days > 0 else None
 
-            # Ежедневный автобэкап БД с отправкой админам
-            bot = bot_controller.get_bot_instance() if bot_controller.get_status().get("is_running") else None
-            if bot:
-                await _maybe_run_daily_backup(bot)
+def build_jobs(bot_controller: BotController) -> list[Job]:
+    async def panel_sync():
+        await _maybe_backfill_sub_tokens()
+        await sync_keys_with_panels()
 
-            if bot_controller.get_status().get("is_running"):
-                bot = bot_controller.get_bot_instance()
-                if bot:
-                    await check_expiring_subscriptions(bot)
-                else:
-                    logger.warning("Scheduler: Бот помечен как запущенный, но экземпляр недоступен.")
-            else:
-                logger.debug("Scheduler: Бот остановлен, уведомления пользователям пропущены.")
+    async def expiry_reminders():
+        bot = _running_bot(bot_controller)
+        if bot:
+            await check_expiring_subscriptions(bot)
+        else:
+            logger.debug("Scheduler: Бот остановлен, уведомления пользователям пропущены.")
+
+    async def daily_backup():
+        await run_daily_backup(_running_bot(bot_controller))
+
+    return [
+        Job("panel_sync", "Синхронизация ключей с панелями", panel_sync,
+            interval=CHECK_INTERVAL_SECONDS, jitter=30, timeout=1200, max_runtime=240),
+        Job("expiry_reminders", "Напоминания об истечении подписок", expiry_reminders,
+            interval=CHECK_INTERVAL_SECONDS, jitter=10, timeout=300, max_runtime=60),
+        Job("host_metrics", "Сбор метрик ресурсов", collect_host_metrics,
+            interval=METRICS_INTERVAL_SECONDS, jitter=30, timeout=240, max_runtime=120),
+        Job("speedtests", "Speedtest всех хостов", _run_speedtests_for_all_hosts,
+            cron=SPEEDTEST_CRON, jitter=300, timeout=3 * 3600, max_runtime=1800),
+        Job("telemetry_prune", "Очистка старой телеметрии", prune_telemetry,
+            cron=TELEMETRY_PRUNE_CRON, jitter=600, timeout=1800, max_runtime=300),
+        # При выключенном режиме задача раз в 5 минут проверяет настройку (и закрывает цепочку)
+        Job("incremental_backup", "Инкрементальный бэкап (WAL)", incremental_backup.run_incremental_cycle_async,
+            interval=lambda: (incremental_backup.get_interval_minutes() or 5) * 60, jitter=15, timeout=900, max_runtime=120),
+        Job("daily_backup", "Автобэкап БД с отправкой админам", daily_backup,
+            interval=_backup_interval_seconds, jitter=600, timeout=3600, max_runtime=600),
+    ]
+
+async def start_jobs(bot_controller: BotController) -> JobScheduler:
+    """Запускает фоновые задачи: у каждой свой цикл, интервал, таймаут; состояние хранится в БД.
+
+    При нескольких экземплярах на общей БД задачи выполняет только лидер (аренда в leader_leases).
+    """
+    elector = LeaderElector()
+    scheduler = JobScheduler(elector=elector)
+    for job in build_jobs(bot_controller):
+        scheduler.add(job)
+    elector.on_elected = scheduler.start
+    elector.on_revoked = lambda: _on_leadership_revoked(scheduler)
+    set_scheduler(scheduler)
+    global _elector_task
+    _elector_task = asyncio.create_task(elector.run(), name="leader_elector")
+    # Проверка доступности хостов нужна каждому экземпляру: по ней выбирается хост для новых ключей
+    global _probe_task
+    _probe_task = asyncio.create_task(host_health_probe_loop(), name="host_health_probe")
+    logger.info("Scheduler: Планировщик фоновых задач запущен.")
+    return scheduler
+
+def _on_leadership_revoked(scheduler: JobScheduler) -> None:
+    scheduler.stop()
+    # Цепочку WAL ведёт только лидер; stop() ждёт текущий шаг бэкапа, поэтому — в потоке
+    asyncio.get_running_loop().run_in_executor(None, incremental_backup.stop)
+
+async def stop_jobs() -> None:
+    """Остановить фоновые циклы, запущенные start_jobs; аренда лидера освобождается."""
+    global _probe_task, _elector_task
+    if _elector_task is not None:
+        _elector_task.cancel()
+        try:
+            await _elector_task
+        except asyncio.CancelledError:
+            pass
+        _elector_task = None
+    if _probe_task is not None:
+        _probe_task.cancel()
+        try:
+            await _probe_task
+        except asyncio.CancelledError:
+            pass
+        _probe_task = None
 
+async def host_health_probe_loop():
+    """Проверять сетевой пробой хосты, у которых истекла пауза circuit breaker."""
+    while True:
+        await asyncio.sleep(HOST_PROBE_INTERVAL_SECONDS)
+        try:
+            for h in host_health.hosts_due_for_probe(database.get_all_hosts()):
+                res = await speedtest_runner.net_probe_for_host(h)
+                logger.info(f"Scheduler: Проба хоста '{h.get('host_name')}' с открытым circuit: {'ok' if res.get('ok') else res.get('error')}")
         except Exception as e:
-            logger.error(f"Scheduler: Необработанная ошибка в основном цикле: {e}", exc_info=True)
-            
-        logger.info(f"Scheduler: Цикл завершён. Следующая проверка через {CHECK_INTERVAL_SECONDS} сек.")
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+            logger.error(f"Scheduler: Ошибка фоновой пробы хостов: {e}", exc_info=True)
 
-async def _maybe_run_periodic_speedtests():
-    global _last_speedtests_run_at
-    now = datetime.now()
-    if _last_speedtests_run_at and (now - _last_speedtests_run_at).total_seconds() < SPEEDTEST_INTERVAL_SECONDS:
+async def _maybe_backfill_sub_tokens():
+    global _sub_tokens_backfilled
+    if _sub_tokens_backfilled:
         return
     try:
-        await _run_speedtests_for_all_hosts()
-        _last_speedtests_run_at = now
+        saved, done, failed = await xui_api.backfill_sub_tokens_from_panels(skip_hosts=_sub_tokens_done_hosts)
+        if saved:
+            logger.info(f"Scheduler: Дозагружены sub_token для {saved} ключ(ей).")
+        _sub_tokens_done_hosts.update(done)
+        if failed:
+            logger.info(f"Scheduler: Дозагрузка sub_token будет повторена для хостов: {', '.join(sorted(failed))}")
+        else:
+            _sub_tokens_backfilled = True
     except Exception as e:
-        logger.error(f"Scheduler: Ошибка запуска speedtests: {e}", exc_info=True)
+        logger.error(f"Scheduler: Ошибка дозагрузки sub_token: {e}", exc_info=True)
 
 async def _run_speedtests_for_all_hosts():
     hosts = database.get_all_hosts()
@@ -332,44 +447,43 @@ async def _run_speedtests_for_all_hosts():
         except Exception as e:
             logger.error(f"Scheduler: Ошибка выполнения speedtest для '{host_name}': {e}", exc_info=True)
 
-async def _maybe_run_daily_backup(bot: Bot):
-    global _last_backup_run_at
-    now = datetime.now()
-    # Считаем интервал из настроек (в днях). 0 или пусто — автобэкап выключен.
+async def run_daily_backup(bot: Bot | None):
+    """Создать архив БД; если бот запущен — разослать администраторам."""
+    zip_path = await backup_manager.create_backup_file_async()
+    if not zip_path or not zip_path.exists():
+        raise RuntimeError("не удалось создать архив БД")
+    job_scheduler.ensure_leader()
+    if bot:
+        try:
+            sent = await backup_manager.send_backup_to_admins(bot, zip_path)
+            logger.info(f"Scheduler: Создан бэкап {zip_path.name}, отправлен {sent} адм.")
+        except Exception as e:
+            logger.error(f"Scheduler: Не удалось отправить бэкап: {e}")
+    else:
+        logger.info(f"Scheduler: Создан бэкап {zip_path.name}; бот остановлен, рассылка пропущена.")
     try:
-        s = database.get_setting("backup_interval_days") or "1"
-        days = int(str(s).strip() or "1")
+        backup_manager.cleanup_old_backups(keep=7)
     except Exception:
-        days = 1
-    if days <= 0:
-        return
-    interval_seconds = max(1, days) * 24 * 3600
-    if _last_backup_run_at and (now - _last_backup_run_at).total_seconds() < interval_seconds:
-        return
+        pass
+
+def _telemetry_retention_days() -> int:
     try:
-        zip_path = backup_manager.create_backup_file()
-        if zip_path and zip_path.exists():
-            try:
-                sent = await backup_manager.send_backup_to_admins(bot, zip_path)
-                logger.info(f"Scheduler: Создан бэкап {zip_path.name}, отправлен {sent} адм.")
-            except Exception as e:
-                logger.error(f"Scheduler: Не удалось отправить бэкап: {e}")
-            try:
-                backup_manager.cleanup_old_backups(keep=7)
-            except Exception:
-                pass
-        _last_backup_run_at = now
-    except Exception as e:
-        logger.error(f"Scheduler: Критическая ошибка при создании и отправке бэкапа: {e}", exc_info=True)
-async def _maybe_collect_host_metrics():
-    global _last_metrics_run_at
-    now = datetime.now()
-    if _last_metrics_run_at and (now - _last_metrics_run_at).total_seconds() < METRICS_INTERVAL_SECONDS:
+        return int(str(database.get_setting("telemetry_retention_days") or "30").strip() or "30")
+    except (TypeError, ValueError):
+        return 30
+
+async def prune_telemetry():
+    days = _telemetry_retention_days()
+    if days <= 0:
         return
-    
+    deleted = await job_scheduler.to_thread(database.prune_telemetry, days)
+    if deleted:
+        logger.info(f"Scheduler: Удалено строк телеметрии старше {days} дн.: {deleted}")
+
+async def collect_host_metrics():
     # Собираем локальные метрики
     try:
-        local_metrics = await asyncio.wait_for(asyncio.to_thread(resource_monitor.get_local_metrics), timeout=10)
+        local_metrics = await asyncio.wait_for(job_scheduler.to_thread(resource_monitor.get_local_metrics), timeout=10)
         if local_metrics and local_metrics.get('ok'):
             database.insert_resource_metric(
                 'local', 'panel',
@@ -387,7 +501,6 @@ async def _maybe_collect_host_metrics():
     # Собираем метрики хостов
     hosts = database.get_all_hosts()
     if not hosts:
-        _last_metrics_run_at = now
         return
     for h in hosts:
         host_name = h.get('host_name')
@@ -397,9 +510,9 @@ async def _maybe_collect_host_metrics():
             continue
         try:
             try:
-                m = await asyncio.wait_for(asyncio.to_thread(resource_monitor.get_host_metrics_via_ssh, h), timeout=30)
+                m = await asyncio.wait_for(job_scheduler.to_thread(resource_monitor.get_host_metrics_via_ssh, h), timeout=30)
             except AttributeError:
-                m = await asyncio.wait_for(asyncio.to_thread(resource_monitor.get_host_metrics_via_ssh, h), timeout=30)
+                m = await asyncio.wait_for(job_scheduler.to_thread(resource_monitor.get_host_metrics_via_ssh, h), timeout=30)
             try:
                 database.insert_host_metrics(host_name, m)
                 # Также сохраняем в resource_metrics для графиков
@@ -418,4 +531,3 @@ async def _maybe_collect_host_metrics():
             logger.warning(f"Scheduler: Таймаут сбора метрик для хоста '{host_name}'")
         except Exception as e:
             logger.error(f"Scheduler: Ошибка сбора метрик для '{host_name}': {e}")
-    _last_metrics_run_at = now
@@ -2,12 +2,16 @@ import asyncio
 import json
 import logging
 import re
+import time
 from urllib.parse import urlparse
 
 import aiohttp
 import paramiko
 
 from shop_bot.data_manager import database
+from shop_bot.data_manager import job_scheduler
+from shop_bot.data_manager import metrics
+from shop_bot.modules import host_health
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +32,20 @@ def _parse_host_port_from_url(url: str) -> tuple[str | None, int | None, bool]:
 async def net_probe_for_host(host_row: dict) -> dict:
     """Lightweight network probe from panel to host_url: TCP connect + HTTP GET / (HEAD).
     Returns dict with ok, ping_ms (TCP connect time), http_ms, error (if any).
+    The result is also reported to the host health registry.
     """
+    started = time.perf_counter()
+    result = await _net_probe(host_row)
+    metrics.HOST_PROBE_DURATION.observe(
+        time.perf_counter() - started, host_row.get('host_name') or '-', 'net', 'ok' if result.get('ok') else 'fail'
+    )
+    host_health.record_probe(
+        host_row.get('host_url'), bool(result.get('ok')), ping_ms=result.get('ping_ms'), error=result.get('error')
+    )
+    return result
+
+
+async def _net_probe(host_row: dict) -> dict:
     url = (host_row.get('host_url') or '').strip()
     target_host, target_port, _ = _parse_host_port_from_url(url)
     result = {
@@ -217,8 +234,7 @@ async def ssh_speedtest_for_host(host_row: dict) -> dict:
         return {'ok': False, 'error': err or 'unknown'}
 
     try:
-        loop = asyncio.get_event_loop()
-        out = await loop.run_in_executor(None, _run_ssh)
+        out = await job_scheduler.to_thread(_run_ssh)
         result.update(out)
     except Exception as e:
         result['error'] = str(e)
@@ -243,6 +259,9 @@ async def run_and_store_net_probe(host_name: str) -> dict:
         ok=bool(res.get('ok')),
         error=res.get('error'),
     )
+    host_health.record_speedtest(
+        host.get('host_url'), bool(res.get('ok')), ping_ms=res.get('ping_ms'), download_mbps=res.get('download_mbps')
+    )
     return res
 
 
@@ -263,6 +282,9 @@ async def run_and_store_ssh_speedtest(host_name: str) -> dict:
         ok=bool(res.get('ok')),
         error=res.get('error'),
     )
+    host_health.record_speedtest(
+        host.get('host_url'), bool(res.get('ok')), ping_ms=res.get('ping_ms'), download_mbps=res.get('download_mbps')
+    )
     return res
 
 
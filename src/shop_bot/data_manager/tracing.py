@@ -0,0 +1,273 @@
+import contextlib
+import functools
+import inspect
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar, Token
+
+from shop_bot import logging_setup
+
+# Лёгкая встроенная трассировка: трасса начинается на входе (обновление Telegram, вебхук оплаты,
+# фоновая задача), спаны вложенных операций (обработка платежа, панель 3x-ui, вызовы Bot API)
+# привязываются к текущему спану через ContextVar. Контекст сам переходит в задачи asyncio,
+# в asyncio.to_thread и через run_coroutine_threadsafe из потока Flask.
+# Завершённые трассы хранятся в памяти: по кольцевому буферу на каждый вид входа.
+
+TRACES_PER_KIND = 300
+MAX_SPANS_PER_TRACE = 200
+# Атрибуты спанов, которые поднимаются в трассу — по ним ищут на странице трасс
+SEARCH_FIELDS = ("user_id", "payment_id", "host", "email")
+
+_current: ContextVar["Span | None"] = ContextVar("trace_current_span", default=None)
+_lock = threading.Lock()
+_traces: dict[str, "OrderedDict[str, dict]"] = {}
+_index: dict[str, dict] = {}
+
+
+def _new_id(nbytes: int) -> str:
+    return secrets.token_hex(nbytes)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "started_at", "_t0", "duration_ms", "error")
+
+    def __init__(self, trace_id: str, parent_id: str | None, name: str, attrs: dict):
+        self.trace_id = trace_id
+        self.span_id = _new_id(4)
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = {k: v for k, v in attrs.items() if v is not None}
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.duration_ms: float | None = None
+        self.error: str | None = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update({k: v for k, v in attrs.items() if v is not None})
+
+    def fail(self, error: str) -> None:
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "attrs": dict(self.attrs),
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "error": self.error,
+        }
+
+
+def current_span() -> Span | None:
+    return _current.get()
+
+
+def current_trace_id() -> str | None:
+    span = _current.get()
+    return span.trace_id if span else None
+
+
+def _register_trace(root: Span, kind: str) -> None:
+    record = {
+        "trace_id": root.trace_id,
+        "kind": kind,
+        "name": root.name,
+        "started_at": root.started_at,
+        "ended_at": root.started_at,
+        "error": None,
+        "attrs": {k: root.attrs[k] for k in SEARCH_FIELDS if k in root.attrs},
+        "spans": [],
+        "dropped_spans": 0,
+    }
+    with _lock:
+        ring = _traces.setdefault(kind, OrderedDict())
+        ring[root.trace_id] = record
+        _index[root.trace_id] = record
+        while len(ring) > TRACES_PER_KIND:
+            old_id, _ = ring.popitem(last=False)
+            _index.pop(old_id, None)
+
+
+def _finish(span: Span) -> None:
+    span.duration_ms = round((time.perf_counter() - span._t0) * 1000, 2)
+    with _lock:
+        record = _index.get(span.trace_id)
+        if record is None:
+            return
+        if len(record["spans"]) < MAX_SPANS_PER_TRACE:
+            record["spans"].append(span.to_dict())
+        else:
+            record["dropped_spans"] += 1
+        record["ended_at"] = max(record["ended_at"], span.started_at + span.duration_ms / 1000)
+        if span.error and record["error"] is None:
+            record["error"] = f"{span.name}: {span.error}"
+        for key in SEARCH_FIELDS:
+            if key in span.attrs and key not in record["attrs"]:
+                record["attrs"][key] = span.attrs[key]
+
+
+def begin_trace(name: str, kind: str, **attrs) -> tuple[Span, tuple[Token, Token]]:
+    """Начать новую трассу (точка входа). Вернуть корневой спан и токены для end()."""
+    root = Span(_new_id(8), None, name, attrs)
+    _register_trace(root, kind)
+    tokens = (_current.set(root), logging_setup.bind_log_context(trace_id=root.trace_id))
+    return root, tokens
+
+
+def begin_span(name: str, **attrs) -> tuple[Span | None, tuple[Token, ...] | None]:
+    parent = _current.get()
+    if parent is None:
+        return None, None
+    span = Span(parent.trace_id, parent.span_id, name, attrs)
+    return span, (_current.set(span),)
+
+
+def end(span: Span | None, tokens: tuple[Token, ...] | None, error: BaseException | str | None = None) -> None:
+    if span is None:
+        return
+    if error is not None and span.error is None:
+        span.fail(error if isinstance(error, str) else f"{type(error).__name__}: {error}")
+    _finish(span)
+    if tokens:
+        _current.reset(tokens[0])
+        if len(tokens) > 1:
+            logging_setup.reset_log_context(tokens[1])
+
+
+@contextlib.contextmanager
+def trace(name: str, kind: str, **attrs):
+    span, tokens = begin_trace(name, kind, **attrs)
+    try:
+        yield span
+    except BaseException as e:
+        end(span, tokens, e)
+        raise
+    end(span, tokens)
+
+
+@contextlib.contextmanager
+def span(name: str, *, root_kind: str | None = None, **attrs):
+    """Дочерний спан текущей трассы. Вне трассы — ничего не пишет (yield None),
+    а с root_kind — начинает новую трассу этого вида."""
+    if _current.get() is None and root_kind:
+        with trace(name, root_kind, **attrs) as root:
+            yield root
+        return
+    current, tokens = begin_span(name, **attrs)
+    try:
+        yield current
+    except BaseException as e:
+        end(current, tokens, e)
+        raise
+    end(current, tokens)
+
+
+@contextlib.contextmanager
+def resume(parent: Span | None):
+    """Сделать parent текущим спаном (для работы, выполняемой в чужой задаче, например в диспетчере сообщений)."""
+    if parent is None:
+        yield
+        return
+    token = _current.set(parent)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def traced(name: str | None = None):
+    """Декоратор: вызов функции (обычной или async) — дочерний спан текущей трассы."""
+    def decorator(func):
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _summary(record: dict) -> dict:
+    return {
+        "trace_id": record["trace_id"],
+        "kind": record["kind"],
+        "name": record["name"],
+        "started_at": record["started_at"],
+        "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["started_at"])),
+        "duration_ms": round((record["ended_at"] - record["started_at"]) * 1000, 1),
+        "error": record["error"],
+        "attrs": dict(record["attrs"]),
+        "span_count": len(record["spans"]) + record["dropped_spans"],
+    }
+
+
+def get_kinds() -> list[str]:
+    with _lock:
+        return sorted(_traces)
+
+
+def get_traces(kind: str | None = None, failed_only: bool = False, order: str = "slowest",
+               query: str | None = None, limit: int = 50) -> list[dict]:
+    """Сводки трасс: самые медленные или последние, при failed_only — только с ошибками.
+
+    query ищет по trace_id и по атрибутам user_id, payment_id, host, email (точное совпадение).
+    """
+    with _lock:
+        rings = [_traces.get(kind, {})] if kind else list(_traces.values())
+        items = [_summary(r) for ring in rings for r in ring.values()]
+    if failed_only:
+        items = [t for t in items if t["error"]]
+    if query:
+        q = query.strip()
+        items = [t for t in items if t["trace_id"] == q or q in (str(v) for v in t["attrs"].values())]
+    if order == "recent":
+        items.sort(key=lambda t: t["started_at"], reverse=True)
+    else:
+        items.sort(key=lambda t: t["duration_ms"], reverse=True)
+    return items[:limit]
+
+
+def get_trace(trace_id: str) -> dict | None:
+    """Трасса со спанами по времени начала; у каждого спана — смещение от начала трассы и глубина."""
+    with _lock:
+        record = _index.get(trace_id)
+        if record is None:
+            return None
+        spans = [dict(s, attrs=dict(s["attrs"])) for s in record["spans"]]
+        result = _summary(record)
+    depth: dict[str, int] = {}
+    by_id = {s["span_id"]: s for s in spans}
+
+    def _depth(s: dict) -> int:
+        if s["span_id"] not in depth:
+            parent = by_id.get(s["parent_id"])
+            depth[s["span_id"]] = 0 if parent is None else _depth(parent) + 1
+        return depth[s["span_id"]]
+
+    total_ms = result["duration_ms"] or 1.0
+    for s in spans:
+        s["depth"] = _depth(s)
+        s["offset_ms"] = round((s["started_at"] - result["started_at"]) * 1000, 1)
+        s["offset_pct"] = round(min(100.0, s["offset_ms"] / total_ms * 100), 2)
+        s["width_pct"] = round(max(0.3, min(100.0 - s["offset_pct"], (s["duration_ms"] or 0) / total_ms * 100)), 2)
+    spans.sort(key=lambda s: (s["started_at"], s["depth"]))
+    result["spans"] = spans
+    result["dropped_spans"] = record["dropped_spans"]
+    return result
+
+
+def reset() -> None:
+    with _lock:
+        _traces.clear()
+        _index.clear()
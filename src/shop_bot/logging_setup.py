@@ -0,0 +1,252 @@
+import atexit
+import contextlib
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+from contextvars import ContextVar, Token
+from datetime import datetime
+
+# Логи пишутся в отдельном потоке: обработчики в цикле событий и в потоке Flask только кладут
+# запись в очередь (QueueHandler), а форматирование и вывод делает QueueListener.
+#
+# Переменные окружения:
+#   SHOPBOT_LOG_LEVEL   — уровень корневого логгера (по умолчанию INFO);
+#   SHOPBOT_LOG_FORMAT  — text (цветной вывод, по умолчанию) или json (одна запись — одна строка JSON);
+#   SHOPBOT_LOG_SAMPLE  — доля пропускаемых записей уровня INFO и ниже по логгерам,
+#                         например "aiogram.event=0.1,shop_bot.modules.xui_api=0.5".
+#                         WARNING и выше не отбрасываются никогда.
+
+_context: ContextVar[dict] = ContextVar("log_context", default={})
+_listener: logging.handlers.QueueListener | None = None
+
+
+def bind_log_context(**fields) -> Token:
+    """Добавить поля (user_id, update_id, host, payment_id, ...) к контексту логов текущей задачи/потока.
+
+    Возвращает токен для reset_log_context.
+    """
+    merged = dict(_context.get())
+    merged.update({k: v for k, v in fields.items() if v is not None})
+    return _context.set(merged)
+
+
+def reset_log_context(token: Token) -> None:
+    _context.reset(token)
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    token = bind_log_context(**fields)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ColoredFormatter(logging.Formatter):
+    """Компактный формат "[12:34:56] [INFO] текст" с цветным уровнем; форматтеры по уровням создаются один раз."""
+
+    COLORS = {
+        'DEBUG': '\x1b[36m',    # Cyan
+        'INFO': '\x1b[32m',     # Green
+        'WARNING': '\x1b[33m',  # Yellow
+        'ERROR': '\x1b[31m',    # Red
+        'CRITICAL': '\x1b[41m', # Red background
+    }
+    RESET = '\x1b[0m'
+    FMT = "%(asctime)s [%(levelname)s] %(message)s"
+    DATEFMT = "%H:%M:%S"
+
+    def __init__(self):
+        super().__init__(fmt=self.FMT, datefmt=self.DATEFMT)
+        self._by_level = {
+            level: logging.Formatter(
+                fmt=f"%(asctime)s {color}[%(levelname)s]{self.RESET} %(message)s", datefmt=self.DATEFMT
+            )
+            for level, color in self.COLORS.items()
+        }
+
+    def format(self, record: logging.LogRecord) -> str:
+        formatter = self._by_level.get(record.levelname)
+        return formatter.format(record) if formatter else super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, логгер, сообщение, поля контекста и трейсбек."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        entry.update(getattr(record, "ctx", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Копирует поля контекста в запись. Стоит на QueueHandler, то есть выполняется в потоке,
+    который пишет лог, — там, где контекст (ContextVar) ещё доступен."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = _context.get()
+        if ctx:
+            record.ctx = ctx
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает лишь долю записей уровня INFO и ниже для указанных логгеров (и их потомков)."""
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: dict[str, float | None] = {}
+
+    def _rate(self, name: str) -> float | None:
+        if name in self._resolved:
+            return self._resolved[name]
+        rate = None
+        candidate = name
+        while candidate:
+            if candidate in self.rates:
+                rate = self.rates[candidate]
+                break
+            candidate = candidate.rpartition(".")[0]
+        self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        rate = self._rate(record.name)
+        return rate is None or random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Готовит запись к передаче в другой поток: подставляет аргументы и рендерит трейсбек,
+    но не форматирует строку целиком — это делает поток-писатель."""
+
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_UPDATE_HANDLED_RE = re.compile(
+    r"Update id=(\d+)\s+is\s+(not handled|handled)\.\s+Duration\s+(\d+)\s+ms\s+by bot id=(\d+)"
+)
+
+
+class RussianizeAiogramFilter(logging.Filter):
+    """Переводит строки aiogram.event "Update id=... is handled. Duration ... ms by bot id=..."."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        try:
+            # Быстрый путь: aiogram логирует шаблоном с четырьмя аргументами — регулярка не нужна
+            if isinstance(record.msg, str) and record.msg.startswith("Update id=") and isinstance(record.args, tuple) \
+                    and len(record.args) == 4:
+                upd_id, state, dur_ms, bot_id = record.args
+                state_ru = 'не обработано' if state == 'not handled' else 'обработано'
+                record.msg = f"Обновление {upd_id} {state_ru} за {dur_ms} мс (бот {bot_id})"
+                record.args = ()
+                return True
+            msg = record.getMessage()
+            if 'Update id=' in msg:
+                m = _UPDATE_HANDLED_RE.search(msg)
+                if m:
+                    upd_id, state, dur_ms, bot_id = m.groups()
+                    state_ru = 'не обработано' if state == 'not handled' else 'обработано'
+                    record.msg = f"Обновление {upd_id} {state_ru} за {dur_ms} мс (бот {bot_id})"
+                else:
+                    record.msg = msg.replace('Update id=', 'Обновление ').replace(' is handled.', ' обработано.') \
+                        .replace(' is not handled.', ' не обработано.')
+                record.args = ()
+        except Exception:
+            pass
+        return True
+
+
+def _parse_sample_rates(spec: str) -> dict[str, float]:
+    rates: dict[str, float] = {}
+    for part in spec.split(","):
+        name, sep, value = part.strip().partition("=")
+        if not sep or not name:
+            continue
+        try:
+            rates[name.strip()] = min(max(float(value), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+def configure() -> None:
+    """Настроить корневой логгер: очередь + фоновый писатель в stderr, форматы и фильтры из окружения."""
+    global _listener
+    level_name = (os.getenv("SHOPBOT_LOG_LEVEL") or "INFO").upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        level = logging.INFO
+    use_json = (os.getenv("SHOPBOT_LOG_FORMAT") or "text").strip().lower() == "json"
+    rates = _parse_sample_rates(os.getenv("SHOPBOT_LOG_SAMPLE") or "")
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setLevel(level)
+    stream.setFormatter(JsonFormatter() if use_json else ColoredFormatter())
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.setLevel(level)
+    if rates:
+        queue_handler.addFilter(SamplingFilter(rates))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    # Clean existing handlers to avoid duplicate logs
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(queue_handler)
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+    # Suppress noisy third-party loggers
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    # aiogram.event оставляем на INFO, но переводим сообщения фильтром
+    aio_event_logger = logging.getLogger('aiogram.event')
+    aio_event_logger.setLevel(logging.INFO)
+    aio_event_logger.addFilter(RussianizeAiogramFilter())
+    logging.getLogger('aiogram.dispatcher').setLevel(logging.WARNING)
+    logging.getLogger('aiohttp').setLevel(logging.WARNING)
+    logging.getLogger('paramiko').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+
+def shutdown() -> None:
+    """Дописать записи, оставшиеся в очереди, и остановить поток-писатель."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,280 @@
+import logging
+import threading
+import time
+
+from shop_bot.data_manager.database import get_latest_hosts_cpu, get_setting, get_speedtests
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker: после FAILURE_THRESHOLD ошибок подряд хост считается недоступным
+# (open) и обращения к панели отклоняются сразу. Через OPEN_COOLDOWN_SECONDS фоновая
+# проба переводит его в half-open: пропускается одна пробная попытка входа.
+FAILURE_THRESHOLD = 3
+OPEN_COOLDOWN_SECONDS = 60
+MAX_COOLDOWN_SECONDS = 15 * 60
+HALF_OPEN_TRIAL_TIMEOUT_SECONDS = 30
+
+# Веса факторов при выборе хоста: каждый фактор нормируется к [0, 1] по всем хостам списка
+RANK_WEIGHT_CLIENTS = 1.0
+RANK_WEIGHT_PING = 0.5
+RANK_WEIGHT_DOWNLOAD = 1.0
+
+# Нагрузка хостов берётся из общей БД (её пишет лидер); замеры CPU перечитываются не чаще раза в минуту
+LOAD_REFRESH_SECONDS = 60
+LOAD_MAX_AGE_MINUTES = 15
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+_hosts: dict[str, dict] = {}
+_lock = threading.Lock()
+_cpu_by_host: dict[str, float] = {}
+_cpu_loaded_at = 0.0
+
+
+def _key(host_url: str | None) -> str:
+    return (host_url or "").strip().rstrip("/").lower()
+
+
+def _entry(key: str) -> dict:
+    entry = _hosts.get(key)
+    if entry is None:
+        entry = {
+            "state": STATE_CLOSED,
+            "failures": 0,
+            "opened_at": 0.0,
+            "cooldown": OPEN_COOLDOWN_SECONDS,
+            "trial_started_at": 0.0,
+            "last_error": None,
+            "last_success_at": None,
+            "last_failure_at": None,
+            "clients": None,
+            "cpu_percent": None,
+            "ping_ms": None,
+            "speedtest_loaded": False,
+            "speedtest_ok": None,
+            "speedtest_ping_ms": None,
+            "download_mbps": None,
+        }
+        _hosts[key] = entry
+    return entry
+
+
+def allow_request(host_url: str) -> bool:
+    """Можно ли сейчас обращаться к панели. В open — сразу False, в half-open — одна пробная попытка."""
+    now = time.monotonic()
+    with _lock:
+        entry = _entry(_key(host_url))
+        if entry["state"] == STATE_CLOSED:
+            return True
+        if entry["state"] == STATE_OPEN:
+            return False
+        # half-open: пропускаем одну попытку; зависшую пробу через таймаут разрешаем повторить
+        if entry["trial_started_at"] and now - entry["trial_started_at"] < HALF_OPEN_TRIAL_TIMEOUT_SECONDS:
+            return False
+        entry["trial_started_at"] = now
+        return True
+
+
+def record_success(host_url: str, source: str = "panel") -> None:
+    with _lock:
+        entry = _entry(_key(host_url))
+        if entry["state"] != STATE_CLOSED:
+            logger.info(f"Хост '{host_url}' снова доступен ({source}), circuit закрыт.")
+        entry.update(
+            state=STATE_CLOSED, failures=0, trial_started_at=0.0,
+            cooldown=OPEN_COOLDOWN_SECONDS, last_success_at=time.time(), last_error=None,
+        )
+
+
+def record_failure(host_url: str, source: str = "panel", error: str | None = None) -> None:
+    now = time.monotonic()
+    with _lock:
+        entry = _entry(_key(host_url))
+        entry["failures"] += 1
+        entry["last_error"] = f"{source}: {error}" if error else source
+        entry["last_failure_at"] = time.time()
+        if entry["state"] == STATE_HALF_OPEN:
+            # Пробная попытка не удалась — снова open с увеличенной паузой
+            entry["cooldown"] = min(entry["cooldown"] * 2, MAX_COOLDOWN_SECONDS)
+            entry.update(state=STATE_OPEN, opened_at=now, trial_started_at=0.0)
+            logger.warning(f"Хост '{host_url}': пробная попытка не удалась, circuit снова открыт на {entry['cooldown']} сек.")
+        elif entry["state"] == STATE_OPEN:
+            # Фоновая проба не прошла — отсчитываем паузу заново
+            entry["opened_at"] = now
+        elif entry["state"] == STATE_CLOSED and entry["failures"] >= FAILURE_THRESHOLD:
+            entry.update(state=STATE_OPEN, opened_at=now)
+            logger.warning(f"Хост '{host_url}': {entry['failures']} ошибок подряд, circuit открыт на {entry['cooldown']} сек.")
+
+
+def record_probe(host_url: str, ok: bool, ping_ms: float | None = None, error: str | None = None) -> None:
+    """Результат сетевой пробы (net_probe_for_host).
+
+    Успешная проба не закрывает circuit сама по себе: open переводится в half-open,
+    а закрывает его только успешный вход в панель.
+    """
+    with _lock:
+        entry = _entry(_key(host_url))
+        if ping_ms is not None:
+            entry["ping_ms"] = ping_ms
+        if ok and entry["state"] == STATE_CLOSED:
+            # Сбрасываем счётчик: circuit открывают только ошибки подряд, а не разрозненные сбои
+            entry["failures"] = 0
+        if ok and entry["state"] == STATE_OPEN:
+            entry.update(state=STATE_HALF_OPEN, trial_started_at=0.0)
+            logger.info(f"Хост '{host_url}': сетевая проба успешна, circuit в half-open.")
+    if not ok:
+        record_failure(host_url, "probe", error)
+
+
+def record_speedtest(host_url: str, ok: bool, *, ping_ms: float | None = None,
+                     download_mbps: float | None = None) -> None:
+    """Результат спидтеста хоста (ssh или net): влияет на порядок хостов при выборе."""
+    with _lock:
+        entry = _entry(_key(host_url))
+        entry["speedtest_loaded"] = True
+        entry["speedtest_ok"] = ok
+        if ping_ms is not None:
+            entry["speedtest_ping_ms"] = ping_ms
+        if download_mbps is not None:
+            entry["download_mbps"] = download_mbps
+
+
+def _load_speedtest(host: dict) -> None:
+    """Подтянуть последний спидтест из БД для хоста, о котором реестр ещё ничего не знает (после рестарта)."""
+    rows = get_speedtests(host.get("host_name") or "", limit=2)
+    latest = rows[0] if rows else None
+    with _lock:
+        entry = _entry(_key(host.get("host_url")))
+        if entry["speedtest_loaded"]:
+            return
+        entry["speedtest_loaded"] = True
+        if latest is None:
+            return
+        entry["speedtest_ok"] = bool(latest.get("ok"))
+        # ping даёт net-проба, скорость — ssh-спидтест: берём последнее известное значение каждого
+        entry["speedtest_ping_ms"] = next((r["ping_ms"] for r in rows if r.get("ping_ms") is not None), None)
+        entry["download_mbps"] = next((r["download_mbps"] for r in rows if r.get("download_mbps") is not None), None)
+
+
+def refresh_load(hosts: list[dict]) -> None:
+    """Обновить нагрузку хостов из общей БД.
+
+    Число клиентов сохраняет синхронизация с панелями (xui_hosts.panel_clients), CPU — сбор метрик
+    (host_metrics). Обе задачи выполняет только лидер, поэтому остальные экземпляры берут данные из БД.
+    """
+    global _cpu_by_host, _cpu_loaded_at
+    now = time.monotonic()
+    if not _cpu_loaded_at or now - _cpu_loaded_at >= LOAD_REFRESH_SECONDS:
+        _cpu_by_host = get_latest_hosts_cpu(LOAD_MAX_AGE_MINUTES)
+        _cpu_loaded_at = now
+    with _lock:
+        for host in hosts:
+            entry = _entry(_key(host.get("host_url")))
+            entry["clients"] = host.get("panel_clients")
+            entry["cpu_percent"] = _cpu_by_host.get((host.get("host_name") or "").strip())
+
+
+def hosts_due_for_probe(hosts: list[dict]) -> list[dict]:
+    """Хосты в состоянии open, у которых истекла пауза, — их нужно проверить фоновой пробой."""
+    now = time.monotonic()
+    with _lock:
+        due = {
+            key for key, entry in _hosts.items()
+            if entry["state"] == STATE_OPEN and now - entry["opened_at"] >= entry["cooldown"]
+        }
+    return [h for h in hosts if _key(h.get("host_url")) in due]
+
+
+def is_available(host_url: str) -> bool:
+    with _lock:
+        entry = _hosts.get(_key(host_url))
+        return entry is None or entry["state"] != STATE_OPEN
+
+
+def get_host_state(host_url: str) -> dict:
+    with _lock:
+        entry = _hosts.get(_key(host_url))
+        return dict(entry) if entry else {"state": STATE_CLOSED, "failures": 0}
+
+
+def get_snapshot() -> dict[str, dict]:
+    with _lock:
+        return {key: dict(entry) for key, entry in _hosts.items()}
+
+
+def _float_setting(key: str, default: float) -> float:
+    try:
+        return float(get_setting(key) or default)
+    except (TypeError, ValueError):
+        return default
+
+
+def _normalized(values: list[float | None], invert: bool = False) -> list[float]:
+    """Привести значения к [0, 1] (0 — лучше). Неизвестное значение — середина шкалы."""
+    known = [v for v in values if v is not None]
+    if not known:
+        return [0.0] * len(values)
+    low, high = min(known), max(known)
+    span = high - low
+    result = []
+    for v in values:
+        if v is None:
+            result.append(0.5)
+        elif span == 0:
+            result.append(0.0)
+        else:
+            share = (v - low) / span
+            result.append(1.0 - share if invert else share)
+    return result
+
+
+def rank_hosts(hosts: list[dict]) -> list[dict]:
+    """Отсортировать хосты для выбора пользователем.
+
+    Хосты с открытым circuit скрываются (если доступных не осталось — возвращаем всё как есть).
+    Перегруженные по CPU, в half-open и с неудачным последним спидтестом уходят в конец;
+    внутри групп порядок задаёт взвешенная сумма: число клиентов, пинг и скорость последнего спидтеста.
+    """
+    if not hosts:
+        return hosts
+    cpu_threshold = _float_setting("monitoring_cpu_threshold", 90.0)
+    refresh_load(hosts)
+    for host in hosts:
+        entry = get_host_state(host.get("host_url"))
+        if not entry.get("speedtest_loaded"):
+            _load_speedtest(host)
+    snapshot = get_snapshot()
+
+    candidates = []
+    for index, host in enumerate(hosts):
+        entry = snapshot.get(_key(host.get("host_url")), {})
+        if entry.get("state") == STATE_OPEN:
+            continue
+        candidates.append((index, host, entry))
+    if not candidates:
+        return hosts
+
+    clients = _normalized([e.get("clients") for _, _, e in candidates])
+    pings = _normalized([
+        e.get("ping_ms") if e.get("ping_ms") is not None else e.get("speedtest_ping_ms") for _, _, e in candidates
+    ])
+    downloads = _normalized([e.get("download_mbps") for _, _, e in candidates], invert=True)
+
+    ranked = []
+    for i, (index, host, entry) in enumerate(candidates):
+        cpu = entry.get("cpu_percent")
+        demoted = (
+            (cpu is not None and cpu >= cpu_threshold)
+            or entry.get("state") == STATE_HALF_OPEN
+            or entry.get("speedtest_ok") is False
+        )
+        score = (
+            RANK_WEIGHT_CLIENTS * clients[i]
+            + RANK_WEIGHT_PING * pings[i]
+            + RANK_WEIGHT_DOWNLOAD * downloads[i]
+        )
+        ranked.append(((demoted, score, index), host))
+    ranked.sort(key=lambda item: item[0])
+    return [host for _, host in ranked]
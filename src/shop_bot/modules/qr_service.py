@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message
+
+from shop_bot.bot import outbound
+from shop_bot.data_manager.database import PROJECT_ROOT, get_qr_file_id, save_qr_file_id, delete_qr_file_id
+
+logger = logging.getLogger(__name__)
+
+QR_CACHE_DIR = PROJECT_ROOT / "qr_cache"
+# Меняется при изменении параметров картинки — старые файлы и file_id перестают совпадать
+QR_RENDER_VERSION = "1"
+QR_BOX_SIZE = 8
+QR_BORDER = 2
+MEMORY_CACHE_SIZE = 256
+FILE_ID_CACHE_SIZE = 4096
+RENDER_WORKERS = 2
+# Дисковый кэш: файлы старше TTL удаляются, сверх лимита — самые давно использованные.
+# Уборка идёт в пуле отрисовки раз в DISK_CLEANUP_EVERY новых файлов
+DISK_CACHE_MAX_FILES = 5000
+DISK_CACHE_TTL_SECONDS = 30 * 24 * 3600
+DISK_CLEANUP_EVERY = 100
+# Лимит подписи к фото в Telegram; более длинный текст уходит отдельным сообщением после картинки
+CAPTION_LIMIT = 1024
+# Ответы Telegram, означающие, что сохранённый file_id больше не действует
+STALE_FILE_ID_ERRORS = ("wrong file identifier", "file reference", "wrong remote file identifier")
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_memory: "OrderedDict[str, bytes]" = OrderedDict()
+_memory_lock = threading.Lock()
+_file_ids: "OrderedDict[tuple[str, int], str]" = OrderedDict()
+_file_ids_lock = threading.Lock()
+_writes_since_cleanup = DISK_CLEANUP_EVERY
+_cleanup_lock = threading.Lock()
+
+
+def content_hash(data: str) -> str:
+    return hashlib.sha256(f"{QR_RENDER_VERSION}:{data}".encode("utf-8")).hexdigest()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="qr-render")
+        return _executor
+
+
+def _remember(digest: str, png: bytes) -> None:
+    with _memory_lock:
+        _memory[digest] = png
+        _memory.move_to_end(digest)
+        while len(_memory) > MEMORY_CACHE_SIZE:
+            _memory.popitem(last=False)
+
+
+def _render(data: str) -> bytes:
+    import qrcode
+    qr = qrcode.QRCode(box_size=QR_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buf = io.BytesIO()
+    qr.make_image().save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def cleanup_disk_cache(max_files: int = DISK_CACHE_MAX_FILES, ttl_seconds: float = DISK_CACHE_TTL_SECONDS) -> int:
+    """Удалить из qr_cache/ просроченные файлы и самые давно использованные сверх лимита. Возвращает число удалённых."""
+    try:
+        entries = []
+        for entry in os.scandir(QR_CACHE_DIR):
+            if entry.is_file():
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.warning(f"QR: не удалось просмотреть {QR_CACHE_DIR}: {e}")
+        return 0
+    entries.sort()
+    cutoff = time.time() - ttl_seconds
+    excess = len(entries) - max_files
+    removed = 0
+    for index, (mtime, path) in enumerate(entries):
+        if mtime >= cutoff and index >= excess:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        logger.info(f"QR: из дискового кэша удалено файлов: {removed}")
+    return removed
+
+
+def _load_or_render(digest: str, data: str) -> bytes:
+    """Выполняется в пуле: файл с диска или новая картинка, атомарно сохранённая в кэш."""
+    global _writes_since_cleanup
+    path = QR_CACHE_DIR / f"{digest}.png"
+    try:
+        png = path.read_bytes()
+        try:
+            # mtime — время последнего использования: по нему уборка выбирает, что удалить
+            os.utime(path)
+        except OSError:
+            pass
+        return png
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"QR: не удалось прочитать {path}: {e}")
+    png = _render(data)
+    try:
+        QR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(png)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"QR: не удалось сохранить {path}: {e}")
+    with _cleanup_lock:
+        _writes_since_cleanup += 1
+        due = _writes_since_cleanup >= DISK_CLEANUP_EVERY
+        if due:
+            _writes_since_cleanup = 0
+    if due:
+        cleanup_disk_cache()
+    return png
+
+
+async def get_png(data: str) -> bytes:
+    """PNG с QR-кодом для data: из памяти, с диска или отрисовка в пуле потоков."""
+    digest = content_hash(data)
+    with _memory_lock:
+        png = _memory.get(digest)
+        if png is not None:
+            _memory.move_to_end(digest)
+            return png
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(_get_executor(), _load_or_render, digest, data)
+    _remember(digest, png)
+    return png
+
+
+def _cached_file_id(digest: str, bot_id: int) -> str | None:
+    key = (digest, bot_id)
+    with _file_ids_lock:
+        file_id = _file_ids.get(key)
+        if file_id is not None:
+            _file_ids.move_to_end(key)
+            return file_id
+    file_id = get_qr_file_id(digest, bot_id)
+    if file_id:
+        _remember_file_id(digest, bot_id, file_id)
+    return file_id
+
+
+def _remember_file_id(digest: str, bot_id: int, file_id: str) -> None:
+    with _file_ids_lock:
+        _file_ids[(digest, bot_id)] = file_id
+        _file_ids.move_to_end((digest, bot_id))
+        while len(_file_ids) > FILE_ID_CACHE_SIZE:
+            _file_ids.popitem(last=False)
+
+
+def _forget_file_id(digest: str, bot_id: int) -> None:
+    with _file_ids_lock:
+        _file_ids.pop((digest, bot_id), None)
+    delete_qr_file_id(digest, bot_id)
+
+
+def _is_stale_file_id_error(error: TelegramBadRequest) -> bool:
+    text = str(error).lower()
+    return any(marker in text for marker in STALE_FILE_ID_ERRORS)
+
+
+async def _send_photo(bot: Bot, priority: int | None, **kwargs) -> Message:
+    if priority is None:
+        return await bot.send_photo(**kwargs)
+    return await outbound.call(bot, "send_photo", priority=priority, **kwargs)
+
+
+async def _send_message(bot: Bot, priority: int | None, **kwargs) -> Message:
+    if priority is None:
+        return await bot.send_message(**kwargs)
+    return await outbound.call(bot, "send_message", priority=priority, **kwargs)
+
+
+async def send_qr(bot: Bot, chat_id: int, data: str, caption: str | None = None,
+                  priority: int | None = None, **kwargs) -> Message:
+    """Отправить QR-код для data. После первой загрузки картинки повторно используется её file_id.
+
+    priority=None — прямой ответ из обработчика; иначе отправка через общий диспетчер.
+    Подпись длиннее CAPTION_LIMIT отправляется отдельным сообщением сразу после картинки.
+    """
+    if caption and len(caption) > CAPTION_LIMIT:
+        reply_markup = kwargs.pop("reply_markup", None)
+        parse_mode = kwargs.get("parse_mode")
+        await send_qr(bot, chat_id, data, caption=None, priority=priority, **kwargs)
+        return await _send_message(
+            bot, priority, chat_id=chat_id, text=caption, parse_mode=parse_mode, reply_markup=reply_markup
+        )
+
+    digest = content_hash(data)
+    file_id = _cached_file_id(digest, bot.id)
+    if file_id:
+        try:
+            return await _send_photo(bot, priority, chat_id=chat_id, photo=file_id, caption=caption, **kwargs)
+        except TelegramBadRequest as e:
+            if not _is_stale_file_id_error(e):
+                raise
+            # file_id устарел (например, сменился токен бота) — загрузим картинку заново
+            logger.info(f"QR: file_id для {digest[:12]} отклонён ({e}), загружаю картинку заново.")
+            _forget_file_id(digest, bot.id)
+
+    png = await get_png(data)
+    message = await _send_photo(
+        bot, priority,
+        chat_id=chat_id, photo=BufferedInputFile(png, filename=f"qr-{digest[:12]}.png"), caption=caption, **kwargs
+    )
+    if message and message.photo:
+        new_file_id = message.photo[-1].file_id
+        _remember_file_id(digest, bot.id, new_file_id)
+        save_qr_file_id(digest, bot.id, new_file_id)
+    return message
@@ -0,0 +1,254 @@
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote, urlparse
+
+from shop_bot.data_manager.database import (
+    get_all_hosts, get_key_by_sub_token, get_keys_revision, get_or_create_user_sub_token,
+    get_setting, get_user, get_user_by_sub_token, get_user_keys
+)
+from shop_bot.modules.xui_api import build_connection_string
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("v2ray", "clash", "singbox")
+
+# Размер LRU и время жизни записи: TTL нужен, чтобы истёкшие ключи
+# пропадали из подписки и без изменений в БД.
+CACHE_MAX_ENTRIES = 2048
+CACHE_TTL_SECONDS = 300
+PROFILE_UPDATE_INTERVAL_HOURS = 12
+
+_cache: "OrderedDict[tuple[str, str], dict]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def detect_format(fmt: str | None, user_agent: str | None) -> str:
+    """Определить формат подписки по параметру ?format= или User-Agent клиента."""
+    fmt = (fmt or "").strip().lower().replace("-", "")
+    if fmt in FORMATS:
+        return fmt
+    ua = (user_agent or "").lower()
+    if any(marker in ua for marker in ("clash", "mihomo", "stash")):
+        return "clash"
+    if any(marker in ua for marker in ("sing-box", "singbox", "sfa/", "sfi/", "sfm/")):
+        return "singbox"
+    return "v2ray"
+
+
+def invalidate_cache() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def _parse_expiry(value) -> datetime | None:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        try:
+            return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+
+
+def _load_host_params() -> dict[str, dict]:
+    result = {}
+    for host in get_all_hosts():
+        raw = host.get("inbound_params")
+        if not raw:
+            continue
+        try:
+            params = json.loads(raw)
+        except (TypeError, ValueError):
+            continue
+        result[host["host_name"]] = {"host_url": host.get("host_url") or "", "params": params}
+    return result
+
+
+def _collect_entries(keys: list[dict]) -> tuple[list[dict], datetime | None]:
+    """Собрать описания активных ключей; возвращает записи и ближайшую дату истечения."""
+    hosts = _load_host_params()
+    now = datetime.now()
+    entries = []
+    used_names: dict[str, int] = {}
+    nearest_expiry = None
+    for key in keys:
+        expiry = _parse_expiry(key.get("expiry_date"))
+        if expiry and expiry < now:
+            continue
+        host = hosts.get(key.get("host_name"))
+        if not host:
+            logger.debug(f"Подписка: нет сохранённых параметров inbound для хоста '{key.get('host_name')}'")
+            continue
+        base_name = key.get("host_name") or "VPN"
+        used_names[base_name] = used_names.get(base_name, 0) + 1
+        name = base_name if used_names[base_name] == 1 else f"{base_name} ({used_names[base_name]})"
+        params = host["params"]
+        entries.append({
+            "name": name,
+            "uuid": key.get("xui_client_uuid"),
+            "server": urlparse(host["host_url"]).hostname,
+            "host_url": host["host_url"],
+            "params": params,
+        })
+        if expiry and (nearest_expiry is None or expiry < nearest_expiry):
+            nearest_expiry = expiry
+    return entries, nearest_expiry
+
+
+def _render_v2ray(entries: list[dict]) -> tuple[bytes, str]:
+    links = [
+        build_connection_string(e["params"], e["uuid"], e["host_url"], quote(e["name"]))
+        for e in entries
+    ]
+    payload = "\n".join(link for link in links if link)
+    return base64.b64encode(payload.encode("utf-8")), "text/plain; charset=utf-8"
+
+
+def _render_clash(entries: list[dict]) -> tuple[bytes, str]:
+    # Строки сериализуются через json.dumps: JSON-строка является валидным YAML-скаляром.
+    lines = ["mixed-port: 7890", "mode: rule", "proxies:"]
+    for e in entries:
+        p = e["params"]
+        lines += [
+            f"  - name: {json.dumps(e['name'], ensure_ascii=False)}",
+            "    type: vless",
+            f"    server: {json.dumps(e['server'])}",
+            f"    port: {int(p['port'])}",
+            f"    uuid: {json.dumps(e['uuid'])}",
+            "    network: tcp",
+            "    tls: true",
+            "    udp: true",
+            "    flow: xtls-rprx-vision",
+            f"    servername: {json.dumps(p['sni'])}",
+            f"    client-fingerprint: {json.dumps(p.get('fingerprint') or 'chrome')}",
+            "    reality-opts:",
+            f"      public-key: {json.dumps(p['public_key'])}",
+            f"      short-id: {json.dumps(p['short_id'])}",
+        ]
+    names = [json.dumps(e["name"], ensure_ascii=False) for e in entries]
+    lines += [
+        "proxy-groups:",
+        "  - name: PROXY",
+        "    type: select",
+        f"    proxies: [{', '.join(names + ['DIRECT'])}]",
+        "rules:",
+        "  - MATCH,PROXY",
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8"), "text/yaml; charset=utf-8"
+
+
+def _render_singbox(entries: list[dict]) -> tuple[bytes, str]:
+    outbounds = []
+    for e in entries:
+        p = e["params"]
+        outbounds.append({
+            "type": "vless",
+            "tag": e["name"],
+            "server": e["server"],
+            "server_port": int(p["port"]),
+            "uuid": e["uuid"],
+            "flow": "xtls-rprx-vision",
+            "tls": {
+                "enabled": True,
+                "server_name": p["sni"],
+                "utls": {"enabled": True, "fingerprint": p.get("fingerprint") or "chrome"},
+                "reality": {"enabled": True, "public_key": p["public_key"], "short_id": p["short_id"]},
+            },
+        })
+    tags = [o["tag"] for o in outbounds]
+    config = {
+        "outbounds": [
+            {"type": "selector", "tag": "proxy", "outbounds": tags + ["direct"]},
+            *outbounds,
+            {"type": "direct", "tag": "direct"},
+        ],
+        "route": {"final": "proxy"},
+    }
+    return json.dumps(config, ensure_ascii=False, indent=2).encode("utf-8"), "application/json; charset=utf-8"
+
+
+_RENDERERS = {
+    "v2ray": _render_v2ray,
+    "clash": _render_clash,
+    "singbox": _render_singbox,
+}
+
+
+def _resolve_keys(token: str) -> list[dict] | None:
+    """Токен пользователя даёт все его ключи, токен ключа (vpn_keys.sub_token) — один ключ."""
+    user = get_user_by_sub_token(token)
+    if user:
+        return None if user.get("is_banned") else get_user_keys(user["telegram_id"])
+    key = get_key_by_sub_token(token)
+    if not key:
+        return None
+    owner = get_user(key["user_id"]) if key.get("user_id") else None
+    if owner and owner.get("is_banned"):
+        return None
+    return [key]
+
+
+def render_subscription(token: str, fmt: str = "v2ray") -> dict | None:
+    """Вернуть подписку по токену: {'body', 'content_type', 'etag', 'expire'}; None — токен неизвестен.
+
+    Результат берётся из LRU-кэша, пока не изменилась ревизия ключей в БД и не истёк TTL.
+    """
+    token = (token or "").strip()
+    if not token:
+        return None
+    fmt = fmt if fmt in _RENDERERS else "v2ray"
+    cache_key = (token, fmt)
+    revision = get_keys_revision()
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(cache_key)
+        if cached and cached["revision"] == revision and now - cached["built_at"] < CACHE_TTL_SECONDS:
+            _cache.move_to_end(cache_key)
+            return cached
+
+    keys = _resolve_keys(token)
+    if keys is None:
+        return None
+    entries, nearest_expiry = _collect_entries(keys)
+    body, content_type = _RENDERERS[fmt](entries)
+    result = {
+        "body": body,
+        "content_type": content_type,
+        "etag": hashlib.sha1(body).hexdigest(),
+        "expire": int(nearest_expiry.timestamp()) if nearest_expiry else 0,
+        "revision": revision,
+        "built_at": now,
+    }
+    with _cache_lock:
+        _cache[cache_key] = result
+        _cache.move_to_end(cache_key)
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return result
+
+
+def build_user_subscription_url(token: str | None, domain: str | None) -> str | None:
+    """Ссылка /sub/<token> по уже известным токену и домену — без запросов к БД."""
+    domain = (domain or "").strip().rstrip("/")
+    if not domain or not token:
+        return None
+    base = domain if domain.startswith(("http://", "https://")) else f"https://{domain}"
+    return f"{base}/sub/{token}"
+
+
+def get_user_subscription_url(user_id: int) -> str | None:
+    """Ссылка на общую подписку пользователя, обслуживаемую самим магазином (/sub/<token>)."""
+    domain = (get_setting("domain") or "").strip()
+    if not domain:
+        return None
+    return build_user_subscription_url(get_or_create_user_sub_token(user_id), domain)
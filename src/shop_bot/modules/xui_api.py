@@ -1,3 +1,6 @@
+import asyncio
+import functools
+import time
 import uuid
 from datetime import datetime, timedelta
 import logging
@@ -6,15 +9,70 @@ from typing import List, Dict
 
 from py3xui import Api, Client, Inbound
 
-from shop_bot.data_manager.database import get_host, get_key_by_email, get_setting
+from shop_bot.data_manager.database import (
+    get_host, get_key_by_email, get_setting, update_host_inbound_params,
+    update_key_sub_token, bulk_update_key_sub_tokens, get_keys_missing_sub_token
+)
+from shop_bot.modules import host_health
+from shop_bot import logging_setup
+from shop_bot.data_manager import latency
+from shop_bot.data_manager import metrics
+from shop_bot.data_manager import tracing
 
 logger = logging.getLogger(__name__)
 
+
+def _panel_host(target) -> str:
+    """Метка хоста для метрик: из host_url или из объекта Api (host хранится в его под-API)."""
+    url = target if isinstance(target, str) else getattr(getattr(target, "inbound", None), "host", None)
+    if not url:
+        return "unknown"
+    return urlparse(url).hostname or str(url)
+
+
+def _panel_call(func):
+    """Учитывает обращение к панели в метриках, в трассе и в статистике задержек текущего обновления бота.
+
+    Исключение — исход "error"; результат None или кортеж из одних None (так функции панели
+    сообщают о сбое, поймав исключение сами) — "fail".
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        host = _panel_host(args[0] if args else None)
+        token = logging_setup.bind_log_context(host=host)
+        span, span_tokens = tracing.begin_span(f"panel.{func.__name__}", host=host)
+        started = time.perf_counter()
+        outcome = "error"
+        error = None
+        try:
+            result = func(*args, **kwargs)
+            failed = result is None or (isinstance(result, tuple) and all(v is None for v in result))
+            outcome = "fail" if failed else "ok"
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            tracing.end(span, span_tokens, error if error is not None else ("fail" if outcome == "fail" else None))
+            logging_setup.reset_log_context(token)
+            metrics.PANEL_CALLS.inc(host, func.__name__, outcome)
+            metrics.PANEL_CALL_DURATION.observe(elapsed, host, func.__name__)
+            if latency.is_tracking():
+                latency.count_panel_call(func.__name__, elapsed * 1000)
+    return wrapper
+
+
+@_panel_call
 def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[Api | None, Inbound | None]:
+    if not host_health.allow_request(host_url):
+        logger.warning(f"Хост '{host_url}' временно помечен недоступным (circuit open), вход пропущен.")
+        return None, None
     try:
         api = Api(host=host_url, username=username, password=password)
         api.login()
         inbounds: List[Inbound] = api.inbound.get_list()
+        host_health.record_success(host_url)
         target_inbound = next((inbound for inbound in inbounds if inbound.id == inbound_id), None)
         
         if target_inbound is None:
@@ -22,67 +80,93 @@ def login_to_host(host_url: str, username: str, password: str, inbound_id: int)
             return None, None
         return api, target_inbound
     except Exception as e:
+        host_health.record_failure(host_url, "panel", str(e))
         logger.error(f"Не удалось выполнить вход или получить входящий трафик для хоста '{host_url}': {e}", exc_info=True)
         return None, None
 
-def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+def extract_inbound_link_params(inbound: Inbound) -> dict | None:
+    """Параметры inbound, достаточные для сборки vless-ссылки без обращения к панели."""
     if not inbound: return None
-    settings = inbound.stream_settings.reality_settings.get("settings")
+    try:
+        reality = inbound.stream_settings.reality_settings or {}
+    except Exception:
+        return None
+    settings = reality.get("settings")
     if not settings: return None
-    
+
     public_key = settings.get("publicKey")
-    fp = settings.get("fingerprint")
-    server_names = inbound.stream_settings.reality_settings.get("serverNames")
-    short_ids = inbound.stream_settings.reality_settings.get("shortIds")
-    port = inbound.port
-    
+    server_names = reality.get("serverNames")
+    short_ids = reality.get("shortIds")
     if not all([public_key, server_names, short_ids]): return None
-    
+
+    return {
+        "port": inbound.port,
+        "public_key": public_key,
+        "fingerprint": settings.get("fingerprint"),
+        "sni": server_names[0],
+        "short_id": short_ids[0],
+    }
+
+def build_connection_string(params: dict, user_uuid: str, host_url: str, remark: str) -> str | None:
+    if not params: return None
     parsed_url = urlparse(host_url)
-    short_id = short_ids[0]
-    
-    connection_string = (
-        f"vless://{user_uuid}@{parsed_url.hostname}:{port}"
-        f"?type=tcp&security=reality&pbk={public_key}&fp={fp}&sni={server_names[0]}"
-        f"&sid={short_id}&spx=%2F&flow=xtls-rprx-vision#{remark}"
+    return (
+        f"vless://{user_uuid}@{parsed_url.hostname}:{params['port']}"
+        f"?type=tcp&security=reality&pbk={params['public_key']}&fp={params.get('fingerprint')}&sni={params['sni']}"
+        f"&sid={params['short_id']}&spx=%2F&flow=xtls-rprx-vision#{remark}"
     )
-    return connection_string
 
-def get_subscription_link(user_uuid: str, host_url: str, host_name: str | None = None, sub_token: str | None = None) -> str:
+def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+    return build_connection_string(extract_inbound_link_params(inbound), user_uuid, host_url, remark)
+
+def remember_inbound_params(host_name: str, inbound: Inbound) -> None:
+    """Сохранить параметры inbound в БД, чтобы /sub/<token> собирал ссылки локально."""
+    try:
+        params = extract_inbound_link_params(inbound)
+        if params:
+            update_host_inbound_params(host_name, params)
+    except Exception as e:
+        logger.debug(f"Не удалось сохранить параметры inbound для '{host_name}': {e}")
+
+def get_subscription_link(user_uuid: str, host_url: str, host_name: str | None = None, sub_token: str | None = None,
+                          subscription_url: str | None = None, domain: str | None = None) -> str:
     """Build subscription URL with the following priority:
     1) Host-specific subscription_url (xui_hosts.subscription_url)
     2) Fallback: domain/host_url + default path
     Supports optional token replacement if base contains "{token}".
+    subscription_url/domain can be passed by callers that already loaded them, to skip the DB lookups.
     """
-    host_base = None
-    try:
-        if host_name:
-            host = get_host(host_name)
-            if host:
-                host_base = (host.get("subscription_url") or "").strip()
-    except Exception:
-        host_base = None
+    host_base = subscription_url
+    if host_base is None:
+        try:
+            if host_name:
+                host = get_host(host_name)
+                if host:
+                    host_base = (host.get("subscription_url") or "").strip()
+        except Exception:
+            host_base = None
 
     base = (host_base or "").strip()
 
+    if sub_token and base:
+        return base.replace("{token}", sub_token) if "{token}" in base else f"{base.rstrip('/')}/{sub_token}"
+    if not sub_token and base:
+        return base
+
+    domain = (get_setting("domain") if domain is None else domain) or ""
+    domain = domain.strip()
     if sub_token:
-        if base:
-            return base.replace("{token}", sub_token) if "{token}" in base else f"{base.rstrip('/')}/{sub_token}"
-        domain = (get_setting("domain") or "").strip()
         parsed = urlparse(host_url)
         hostname = domain if domain else (parsed.hostname or "")
         scheme = parsed.scheme if parsed.scheme in ("http", "https") else "https"
         return f"{scheme}://{hostname}/sub/{sub_token}"
 
-    if base:
-        return base
-
-    domain = (get_setting("domain") or "").strip()
     parsed = urlparse(host_url)
     hostname = domain if domain else (parsed.hostname or "")
     scheme = parsed.scheme if parsed.scheme in ("http", "https") else "https"
     return f"{scheme}://{hostname}/sub/{user_uuid}?format=v2ray"
 
+@_panel_call
 def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days_to_add: int | None = None, target_expiry_ms: int | None = None) -> tuple[str | None, int | None, str | None]:
     try:
         inbound_to_modify = api.inbound.get_by_id(inbound_id)
@@ -184,6 +268,7 @@ def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days
         logger.error(f"Ошибка в update_or_create_client_on_panel: {e}", exc_info=True)
         return None, None, None
 
+@tracing.traced("key.create_or_update")
 async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int | None = None, expiry_timestamp_ms: int | None = None) -> Dict | None:
     host_data = get_host(host_name)
     if not host_data:
@@ -199,6 +284,7 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
     if not api or not inbound:
         logger.error(f"Сбой рабочего процесса: Не удалось войти или найти inbound на хосте '{host_name}'.")
         return None
+    remember_inbound_params(host_name, inbound)
         
     # Prefer exact expiry when provided (e.g., switching hosts), otherwise add days (purchase/extend/trial)
     client_uuid, new_expiry_ms, client_sub_token = update_or_create_client_on_panel(
@@ -210,7 +296,8 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
         return None
     
     connection_string = get_subscription_link(client_uuid, host_data['host_url'], host_name, sub_token=client_sub_token)
-    
+    update_key_sub_token(email, client_sub_token)
+
     logger.info(f"Успешно обработан ключ для '{email}' на хосте '{host_name}'.")
     
     
@@ -219,9 +306,47 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
         "email": email,
         "expiry_timestamp_ms": new_expiry_ms,
         "connection_string": connection_string,
-        "host_name": host_name
+        "host_name": host_name,
+        "sub_token": client_sub_token
     }
 
+def get_client_sub_token(client) -> str | None:
+    candidate_fields = ("subId", "subscription", "sub_id", "subscriptionId", "subscription_token")
+    for attr in candidate_fields:
+        val = None
+        if hasattr(client, attr):
+            val = getattr(client, attr)
+        else:
+            try:
+                val = client.get(attr)
+            except Exception:
+                pass
+        if val:
+            return val
+    return None
+
+def get_key_connection_string(key_data: dict, host_data: dict | None = None) -> str | None:
+    """Собрать ссылку ключа из локальных данных (vpn_keys.sub_token + xui_hosts), без входа в панель."""
+    host_data = host_data or get_host(key_data.get('host_name') or '')
+    if not host_data:
+        return None
+    return get_subscription_link(
+        key_data['xui_client_uuid'], host_data['host_url'], host_data['host_name'],
+        sub_token=key_data.get('sub_token') or None,
+        subscription_url=host_data.get('subscription_url') or ""
+    )
+
+def get_key_link_from_row(key_row: dict) -> str | None:
+    """Ссылка ключа по строке get_user_keys_with_hosts: без дополнительных запросов к БД."""
+    if not key_row.get('host_url'):
+        return None
+    return get_subscription_link(
+        key_row['xui_client_uuid'], key_row['host_url'], key_row.get('host_name'),
+        sub_token=key_row.get('sub_token') or None,
+        subscription_url=key_row.get('subscription_url') or "",
+        domain=key_row.get('panel_domain') or ""
+    )
+
 async def get_key_details_from_host(key_data: dict) -> dict | None:
     host_name = key_data.get('host_name')
     if not host_name:
@@ -233,6 +358,10 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
         logger.error(f"Не удалось получить данные ключа: хост '{host_name}' не найден в базе данных.")
         return None
 
+    # Токен уже сохранён локально — панель не нужна
+    if key_data.get('sub_token'):
+        return {"connection_string": get_key_connection_string(key_data, host_db_data)}
+
     api, inbound = login_to_host(
         host_url=host_db_data['host_url'],
         username=host_db_data['host_username'],
@@ -240,31 +369,75 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
         inbound_id=host_db_data['host_inbound_id']
     )
     if not api or not inbound: return None
+    remember_inbound_params(host_name, inbound)
 
     client_sub_token = None
     try:
         if inbound.settings and inbound.settings.clients:
             for client in inbound.settings.clients:
-                if getattr(client, "id", None) == key_data['xui_client_uuid'] or getattr(client, "email", None) == key_data.get('email'):
-                    candidate_fields = ("subId", "subscription", "sub_id", "subscriptionId", "subscription_token")
-                    for attr in candidate_fields:
-                        val = None
-                        if hasattr(client, attr):
-                            val = getattr(client, attr)
-                        else:
-                            try:
-                                val = client.get(attr)
-                            except Exception:
-                                pass
-                        if val:
-                            client_sub_token = val
-                            break
+                if getattr(client, "id", None) == key_data['xui_client_uuid'] or getattr(client, "email", None) == key_data.get('key_email'):
+                    client_sub_token = get_client_sub_token(client)
                     break
     except Exception:
         pass
+    if client_sub_token and key_data.get('key_email'):
+        update_key_sub_token(key_data['key_email'], client_sub_token)
     connection_string = get_subscription_link(key_data['xui_client_uuid'], host_db_data['host_url'], host_name, sub_token=client_sub_token)
     return {"connection_string": connection_string}
 
+async def backfill_sub_tokens_from_panels(batch_size: int = 500, skip_hosts: set[str] | None = None) -> tuple[int, set[str], set[str]]:
+    """Разовая дозагрузка sub_token для ключей, созданных до появления колонки.
+
+    На каждый хост — один вход в панель и одна выгрузка клиентов; запись в БД пачками.
+    Возвращает (сохранено ключей, хосты, обработанные полностью, хосты с ошибкой входа или записи).
+    """
+    missing = get_keys_missing_sub_token()
+    if not missing:
+        return 0, set(), set()
+    emails_by_host: dict[str, set[str]] = {}
+    for key in missing:
+        if skip_hosts and key['host_name'] in skip_hosts:
+            continue
+        emails_by_host.setdefault(key['host_name'], set()).add(key['key_email'])
+
+    total = 0
+    done: set[str] = set()
+    failed: set[str] = set()
+    for host_name, emails in emails_by_host.items():
+        host_data = get_host(host_name)
+        if not host_data:
+            done.add(host_name)
+            continue
+        api, inbound = await asyncio.to_thread(
+            login_to_host,
+            host_data['host_url'], host_data['host_username'], host_data['host_pass'], host_data['host_inbound_id']
+        )
+        if not api or not inbound:
+            logger.warning(f"Дозагрузка sub_token: не удалось войти на хост '{host_name}', повторю позже.")
+            failed.add(host_name)
+            continue
+        remember_inbound_params(host_name, inbound)
+        pairs = []
+        for client in (inbound.settings.clients or []):
+            email = getattr(client, "email", None)
+            if email in emails:
+                token = get_client_sub_token(client)
+                if token:
+                    pairs.append((email, token))
+        saved_ok = True
+        for i in range(0, len(pairs), batch_size):
+            saved = bulk_update_key_sub_tokens(pairs[i:i + batch_size])
+            if not saved:
+                saved_ok = False
+            total += saved
+        if saved_ok:
+            done.add(host_name)
+            logger.info(f"Дозагрузка sub_token: хост '{host_name}' — сохранено {len(pairs)} из {len(emails)}.")
+        else:
+            failed.add(host_name)
+            logger.warning(f"Дозагрузка sub_token: хост '{host_name}' — не удалось записать токены в БД, повторю позже.")
+    return total, done, failed
+
 async def delete_client_on_host(host_name: str, client_email: str) -> bool:
     host_data = get_host(host_name)
     if not host_data:
@@ -294,4 +467,100 @@ async def delete_client_on_host(host_name: str, client_email: str) -> bool:
             
     except Exception as e:
         logger.error(f"Не удалось удалить клиента '{client_email}' с хоста '{host_name}': {e}", exc_info=True)
-        return False
\ No newline at end of file
+        return False
+
+
+def _assign_client_sub_token(client: Client, sub_token: str) -> None:
+    for attr in ("subId", "subscription", "sub_id"):
+        try:
+            setattr(client, attr, sub_token)
+        except Exception:
+            pass
+
+
+@_panel_call
+def add_clients_batch(api: Api, inbound_id: int, specs: list[dict], existing: dict | None = None) -> dict[str, dict]:
+    """Создать пачку клиентов в уже открытой сессии панели одним запросом addClient.
+
+    specs: {'email', 'uuid', 'expiry_ms', 'sub_token'}; срок переносится как есть, без пересчёта.
+    existing: клиенты inbound по email — уже созданные (например, при повторном запуске) не дублируются,
+    у них только выравнивается срок. Возвращает {email: {'client_uuid', 'expiry_timestamp_ms', 'sub_token'}}.
+    """
+    existing = existing or {}
+    new_clients: list[Client] = []
+    result: dict[str, dict] = {}
+    for spec in specs:
+        email = spec['email']
+        expiry_ms = int(spec['expiry_ms'])
+        client = existing.get(email)
+        if client is not None:
+            panel_sub_token = get_client_sub_token(client)
+            sub_token = panel_sub_token or spec.get('sub_token')
+            if not sub_token:
+                import secrets
+                sub_token = secrets.token_hex(12)
+            if client.expiry_time != expiry_ms or not client.enable or panel_sub_token != sub_token:
+                client.expiry_time = expiry_ms
+                client.enable = True
+                try:
+                    client.inbound_id = inbound_id
+                except Exception:
+                    pass
+                # Токен назначается до update, иначе он не попадёт на панель
+                _assign_client_sub_token(client, sub_token)
+                api.client.update(client.id, client)
+        else:
+            client = Client(
+                id=spec.get('uuid') or str(uuid.uuid4()),
+                email=email,
+                enable=True,
+                flow="xtls-rprx-vision",
+                expiry_time=expiry_ms
+            )
+            try:
+                setattr(client, "reset", 0)
+            except Exception:
+                pass
+            sub_token = spec.get('sub_token')
+            if not sub_token:
+                import secrets
+                sub_token = secrets.token_hex(12)
+            _assign_client_sub_token(client, sub_token)
+            new_clients.append(client)
+        result[email] = {
+            "client_uuid": client.id,
+            "expiry_timestamp_ms": expiry_ms,
+            "sub_token": sub_token,
+        }
+    if new_clients:
+        api.client.add(inbound_id, new_clients)
+    return result
+
+@_panel_call
+def remove_clients_batch(api: Api, inbound_id: int, emails: set[str]) -> int:
+    """Удалить клиентов по email одним обновлением inbound в открытой сессии. Возвращает число удалённых."""
+    inbound = api.inbound.get_by_id(inbound_id)
+    clients = (inbound.settings.clients or []) if inbound and inbound.settings else []
+    kept = [c for c in clients if getattr(c, "email", None) not in emails]
+    removed = len(clients) - len(kept)
+    if removed:
+        inbound.settings.clients = kept
+        api.inbound.update(inbound_id, inbound)
+    return removed
+
+
+@_panel_call
+def remove_expired_clients_batch(api: Api, inbound_id: int, emails: set[str], expired_before_ms: int) -> set[str]:
+    """Как remove_clients_batch, но клиент, у которого на панели срок уже продлён за expired_before_ms,
+    остаётся на месте. Возвращает email оставленных (продлённых) клиентов."""
+    inbound = api.inbound.get_by_id(inbound_id)
+    clients = (inbound.settings.clients or []) if inbound and inbound.settings else []
+    renewed = {
+        c.email for c in clients
+        if c.email in emails and (getattr(c, "expiry_time", 0) or 0) > expired_before_ms
+    }
+    kept = [c for c in clients if getattr(c, "email", None) not in emails or c.email in renewed]
+    if len(kept) != len(clients):
+        inbound.settings.clients = kept
+        api.inbound.update(inbound_id, inbound)
+    return renewed
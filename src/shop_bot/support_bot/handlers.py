@@ -24,6 +24,7 @@ from shop_bot.data_manager.database import (
     ban_user,
     unban_user,
 )
+from shop_bot.bot import outbound
 
 logger = logging.getLogger(__name__)
 
@@ -202,7 +203,7 @@ def get_support_router() -> Router:
                     f"Тема: {subj_display} — от @{message.from_user.username or message.from_user.full_name} (ID: {user_id})\n\n"
                     f"Сообщение:\n{message.text or ''}"
                 )
-                await bot.send_message(chat_id=chat_id, text=header, message_thread_id=thread_id, reply_markup=_admin_actions_kb(ticket_id))
+                await outbound.send_message(bot, chat_id=chat_id, text=header, message_thread_id=thread_id, reply_markup=_admin_actions_kb(ticket_id), priority=outbound.PRIORITY_SUPPORT)
             except Exception as e:
                 logger.warning(f"Не удалось создать форумную тему или отправить сообщение для тикета {ticket_id}: {e}")
         try:
@@ -211,19 +212,23 @@ def get_support_router() -> Router:
             thread_id = ticket and ticket.get('message_thread_id')
             if forum_chat_id and thread_id:
                 username = (message.from_user.username and f"@{message.from_user.username}") or message.from_user.full_name or str(message.from_user.id)
-                await bot.send_message(
+                await outbound.send_message(
+                    bot,
                     chat_id=int(forum_chat_id),
                     text=(
                         f"🆕 Новое обращение от {username} (ID: {message.from_user.id}) по тикету #{ticket_id}:" if created_new
                         else f"✉️ Новое сообщение по тикету #{ticket_id} от {username} (ID: {message.from_user.id}):"
                     ),
-                    message_thread_id=int(thread_id)
+                    message_thread_id=int(thread_id),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
-                await bot.copy_message(
+                await outbound.call(
+                    bot, "copy_message",
                     chat_id=int(forum_chat_id),
                     from_chat_id=message.chat.id,
                     message_id=message.message_id,
-                    message_thread_id=int(thread_id)
+                    message_thread_id=int(thread_id),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
         except Exception as e:
             logger.warning(f"Не удалось отзеркалить сообщение пользователя в форум: {e}")
@@ -242,7 +247,8 @@ def get_support_router() -> Router:
         try:
             for aid in get_admin_ids():
                 try:
-                    await bot.send_message(
+                    await outbound.send_message(
+                        bot,
                         int(aid),
                         (
                             "🆘 Новое обращение в поддержку\n"
@@ -250,7 +256,8 @@ def get_support_router() -> Router:
                             f"От пользователя: @{message.from_user.username or message.from_user.full_name} (ID: {user_id})\n"
                             f"Тема: {subject or '—'}\n\n"
                             f"Сообщение:\n{message.text or ''}"
-                        )
+                        ),
+                        priority=outbound.PRIORITY_SUPPORT,
                     )
                 except Exception:
                     pass
@@ -361,7 +368,7 @@ def get_support_router() -> Router:
                             f"Пользователь: ID {ticket.get('user_id')}\n"
                             f"Тема: {subj_display} — от ID {ticket.get('user_id')}"
                         )
-                        await bot.send_message(chat_id=chat_id, text=header, message_thread_id=thread_id, reply_markup=_admin_actions_kb(ticket_id))
+                        await outbound.send_message(bot, chat_id=chat_id, text=header, message_thread_id=thread_id, reply_markup=_admin_actions_kb(ticket_id), priority=outbound.PRIORITY_SUPPORT)
                     except Exception as e:
                         logger.warning(f"Не удалось автоматически создать форумную тему для тикета {ticket_id}: {e}")
             if forum_chat_id and thread_id:
@@ -381,25 +388,29 @@ def get_support_router() -> Router:
                 except Exception as e:
                     logger.warning(f"Не удалось переименовать существующую тему для тикета {ticket_id}: {e}")
                 username = (message.from_user.username and f"@{message.from_user.username}") or message.from_user.full_name or str(message.from_user.id)
-                await bot.send_message(
+                await outbound.send_message(
+                    bot,
                     chat_id=int(forum_chat_id),
                     text=f"✉️ Новое сообщение по тикету #{ticket_id} от {username} (ID: {message.from_user.id}):",
-                    message_thread_id=int(thread_id)
+                    message_thread_id=int(thread_id),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
-                await bot.copy_message(chat_id=int(forum_chat_id), from_chat_id=message.chat.id, message_id=message.message_id, message_thread_id=int(thread_id))
+                await outbound.call(bot, "copy_message", chat_id=int(forum_chat_id), from_chat_id=message.chat.id, message_id=message.message_id, message_thread_id=int(thread_id), priority=outbound.PRIORITY_SUPPORT)
         except Exception as e:
             logger.warning(f"Не удалось отзеркалить ответ пользователя в форум: {e}")
         admin_id = get_setting("admin_telegram_id")
         if admin_id:
             try:
-                await bot.send_message(
+                await outbound.send_message(
+                    bot,
                     int(admin_id),
                     (
                         "📩 Новое сообщение в тикете\n"
                         f"ID тикета: #{ticket_id}\n"
                         f"От пользователя: @{message.from_user.username or message.from_user.full_name} (ID: {message.from_user.id})\n\n"
                         f"Сообщение:\n{message.text or ''}"
-                    )
+                    ),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
             except Exception as e:
                 logger.warning(f"Не удалось уведомить администратора о сообщении тикета #{ticket_id}: {e}")
@@ -451,20 +462,24 @@ def get_support_router() -> Router:
             content = (message.text or message.caption or "").strip()
             if content:
                 add_support_message(ticket_id=int(ticket['ticket_id']), sender='admin', content=content)
-            header = await bot.send_message(
+            header = await outbound.send_message(
+                bot,
                 chat_id=user_id,
-                text=f"💬 Ответ поддержки по тикету #{ticket['ticket_id']}"
+                text=f"💬 Ответ поддержки по тикету #{ticket['ticket_id']}",
+                priority=outbound.PRIORITY_SUPPORT,
             )
             try:
-                await bot.copy_message(
+                await outbound.call(
+                    bot, "copy_message",
                     chat_id=user_id,
                     from_chat_id=message.chat.id,
                     message_id=message.message_id,
-                    reply_to_message_id=header.message_id
+                    reply_to_message_id=header.message_id,
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
             except Exception:
                 if content:
-                    await bot.send_message(chat_id=user_id, text=content)
+                    await outbound.send_message(bot, chat_id=user_id, text=content, priority=outbound.PRIORITY_SUPPORT)
         except Exception as e:
             logger.warning(f"Не удалось переслать сообщение из форумной темы: {e}")
 
@@ -487,16 +502,20 @@ def get_support_router() -> Router:
                 if forum_chat_id and thread_id:
                     try:
                         username = (callback.from_user.username and f"@{callback.from_user.username}") or callback.from_user.full_name or str(callback.from_user.id)
-                        await bot.send_message(
+                        await outbound.send_message(
+                            bot,
                             chat_id=int(forum_chat_id),
                             text=f"✅ Пользователь {username} закрыл тикет #{ticket_id}.",
-                            message_thread_id=int(thread_id)
+                            message_thread_id=int(thread_id),
+                            priority=outbound.PRIORITY_SUPPORT,
                         )
-                        await bot.send_message(
+                        await outbound.send_message(
+                            bot,
                             chat_id=int(forum_chat_id),
                             text="Панель управления тикетом:",
                             message_thread_id=int(thread_id),
-                            reply_markup=_admin_actions_kb(ticket_id)
+                            reply_markup=_admin_actions_kb(ticket_id),
+                            priority=outbound.PRIORITY_SUPPORT,
                         )
                     except Exception:
                         pass
@@ -544,7 +563,7 @@ def get_support_router() -> Router:
                     raise
             try:
                 user_id = int(ticket.get('user_id'))
-                await bot.send_message(chat_id=user_id, text=f"✅ Ваш тикет #{ticket_id} был закрыт администратором. Спасибо за обращение!")
+                await outbound.send_message(bot, chat_id=user_id, text=f"✅ Ваш тикет #{ticket_id} был закрыт администратором. Спасибо за обращение!", priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
         else:
@@ -583,7 +602,7 @@ def get_support_router() -> Router:
                     raise
             try:
                 user_id = int(ticket.get('user_id'))
-                await bot.send_message(chat_id=user_id, text=f"🔓 Ваш тикет #{ticket_id} был переоткрыт администратором. Вы можете продолжить переписку.")
+                await outbound.send_message(bot, chat_id=user_id, text=f"🔓 Ваш тикет #{ticket_id} был переоткрыт администратором. Вы можете продолжить переписку.", priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
         else:
@@ -674,10 +693,12 @@ def get_support_router() -> Router:
                 forum_chat_id = ticket.get('forum_chat_id')
                 if thread_id and forum_chat_id:
                     state_text = "включена" if not is_starred else "снята"
-                    msg = await bot.send_message(
+                    msg = await outbound.send_message(
+                        bot,
                         chat_id=int(forum_chat_id),
                         message_thread_id=int(thread_id),
-                        text=f"⭐ Важность {state_text} для тикета #{ticket_id}."
+                        text=f"⭐ Важность {state_text} для тикета #{ticket_id}.",
+                        priority=outbound.PRIORITY_SUPPORT,
                     )
                     if not is_starred:
                         try:
@@ -766,9 +787,11 @@ def get_support_router() -> Router:
         if currently_banned:
             status_text = f"✅ Пользователь {user_id} разбанен."
             try:
-                await bot.send_message(
+                await outbound.send_message(
+                    bot,
                     user_id,
-                    "✅ Ваш аккаунт разблокирован администратором. Вы снова можете пользоваться сервисом."
+                    "✅ Ваш аккаунт разблокирован администратором. Вы снова можете пользоваться сервисом.",
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
             except Exception:
                 pass
@@ -779,7 +802,7 @@ def get_support_router() -> Router:
             if support_contact:
                 ban_message += f"\nЕсли это ошибка, свяжитесь с поддержкой: {support_contact}"
             try:
-                await bot.send_message(user_id, ban_message)
+                await outbound.send_message(bot, user_id, ban_message, priority=outbound.PRIORITY_SUPPORT)
             except Exception:
                 pass
         try:
@@ -948,7 +971,7 @@ def get_support_router() -> Router:
                             f"Пользователь: @{message.from_user.username or message.from_user.full_name} (ID: {message.from_user.id})\n" \
                             f"Тема: {subj_display} — от @{message.from_user.username or message.from_user.full_name} (ID: {message.from_user.id})"
                         )
-                        await bot.send_message(chat_id=chat_id, text=header, message_thread_id=thread_id, reply_markup=_admin_actions_kb(ticket_id))
+                        await outbound.send_message(bot, chat_id=chat_id, text=header, message_thread_id=thread_id, reply_markup=_admin_actions_kb(ticket_id), priority=outbound.PRIORITY_SUPPORT)
                     except Exception as e:
                         logger.warning(f"Не удалось автоматически создать форумную тему для тикета {ticket_id}: {e}")
             if forum_chat_id and thread_id:
@@ -968,15 +991,17 @@ def get_support_router() -> Router:
                 except Exception as e:
                     logger.warning(f"Не удалось переименовать тему для тикета со свободным сообщением {ticket_id}: {e}")
                 username = (message.from_user.username and f"@{message.from_user.username}") or message.from_user.full_name or str(message.from_user.id)
-                await bot.send_message(
+                await outbound.send_message(
+                    bot,
                     chat_id=int(forum_chat_id),
                     text=(
                         f"🆘 Новое обращение от {username} (ID: {message.from_user.id}) по тикету #{ticket_id}:" if created_new
                         else f"✉️ Новое сообщение по тикету #{ticket_id} от {username} (ID: {message.from_user.id}):"
                     ),
-                    message_thread_id=int(thread_id)
+                    message_thread_id=int(thread_id),
+                    priority=outbound.PRIORITY_SUPPORT,
                 )
-                await bot.copy_message(chat_id=int(forum_chat_id), from_chat_id=message.chat.id, message_id=message.message_id, message_thread_id=int(thread_id))
+                await outbound.call(bot, "copy_message", chat_id=int(forum_chat_id), from_chat_id=message.chat.id, message_id=message.message_id, message_thread_id=int(thread_id), priority=outbound.PRIORITY_SUPPORT)
         except Exception as e:
             logger.warning(f"Не удалось отзеркалить свободное сообщение пользователя в форум для тикета {ticket_id}: {e}")
 
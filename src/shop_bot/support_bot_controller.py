@@ -8,7 +8,9 @@ from aiogram.enums import ParseMode
 from shop_bot.data_manager import database
 from shop_bot.data_manager.database import get_admin_ids
 from shop_bot.support_bot.handlers import get_support_router
-from shop_bot.bot.middlewares import BanMiddleware
+from shop_bot.bot.middlewares import BanMiddleware, TracingMiddleware, TelegramTracingMiddleware, LogContextMiddleware, LatencyMiddleware, HandlerNameMiddleware, ThrottlingMiddleware
+from shop_bot.bot import webhook_mode
+from shop_bot.bot.fsm_storage import SQLiteStorage
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +21,8 @@ class SupportBotController:
         self._task = None
         self._is_running = False
         self._loop: asyncio.AbstractEventLoop | None = None
+        self._feeder: webhook_mode.UpdateFeeder | None = None
+        self._mode: str | None = None
 
     def set_loop(self, loop: asyncio.AbstractEventLoop):
         self._loop = loop
@@ -29,6 +33,7 @@ class SupportBotController:
 
     async def _start_polling(self):
         self._is_running = True
+        self._mode = "polling"
         logger.info("Запущен опрос Telegram (Support-бот)...")
         try:
             await self._dp.start_polling(self._bot)
@@ -39,12 +44,64 @@ class SupportBotController:
         finally:
             logger.info("Опрос корректно остановлен.")
             self._is_running = False
+            self._mode = None
             self._task = None
             if self._bot:
                 await self._bot.close()
             self._bot = None
             self._dp = None
 
+    async def _start_webhook(self):
+        """Режим вебхука: Telegram присылает обновления на support-маршрут веб-панели.
+        Если вебхук установить не удалось — работаем через опрос, как раньше."""
+        url = webhook_mode.build_webhook_url("support")
+        try:
+            if not url:
+                raise ValueError("не задан домен (настройка domain)")
+            max_concurrency = webhook_mode.get_max_concurrency()
+            await self._bot.set_webhook(
+                url,
+                secret_token=webhook_mode.get_webhook_secret("support"),
+                allowed_updates=self._dp.resolve_used_update_types(),
+                max_connections=min(100, max_concurrency),
+            )
+        except Exception as e:
+            logger.error(f"Не удалось установить вебхук (Support-бот), переключаюсь на опрос: {e}")
+            try:
+                await self._bot.delete_webhook()
+            except Exception:
+                pass
+            await self._start_polling()
+            return
+        self._feeder = webhook_mode.UpdateFeeder(self._dp, self._bot, asyncio.get_running_loop(), max_concurrency)
+        self._mode = "webhook"
+        self._is_running = True
+        logger.info(f"Вебхук установлен (Support-бот): {url}, параллельная обработка до {max_concurrency} обновлений.")
+
+    async def _stop_webhook(self):
+        feeder, self._feeder = self._feeder, None
+        try:
+            if feeder:
+                await feeder.close()
+            if self._bot:
+                await self._bot.delete_webhook()
+        except Exception as e:
+            logger.warning(f"Не удалось снять вебхук (Support-бот): {e}")
+        finally:
+            logger.info("Вебхук остановлен.")
+            if self._bot:
+                await self._bot.session.close()
+            self._is_running = False
+            self._mode = None
+            self._task = None
+            self._bot = None
+            self._dp = None
+
+    def feed_webhook_update(self, update: dict) -> bool:
+        """Принять обновление из веб-потока. False — бот не в режиме вебхука или перегружен."""
+        feeder = self._feeder
+        return feeder.submit(update) if feeder else False
+
     def start(self):
         if self._is_running:
             return {"status": "error", "message": "Support-бот уже запущен."}
@@ -66,21 +123,34 @@ class SupportBotController:
 
         try:
             self._bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-            self._dp = Dispatcher()
+            self._bot.session.middleware(TelegramTracingMiddleware())
+            self._dp = Dispatcher(storage=SQLiteStorage("support"))
 
             # Подключаем BanMiddleware, чтобы заблокированные пользователи не писали в поддержку
             self._dp.message.middleware(BanMiddleware())
             self._dp.callback_query.middleware(BanMiddleware())
+            # Трасса обновления, контекст логов, замер задержек (полное время + имя сработавшего обработчика)
+            self._dp.update.outer_middleware(TracingMiddleware("support"))
+            self._dp.update.outer_middleware(LogContextMiddleware())
+            self._dp.update.outer_middleware(LatencyMiddleware("support"))
+            self._dp.message.middleware(HandlerNameMiddleware())
+            self._dp.callback_query.middleware(HandlerNameMiddleware())
+            # Анти-флуд: один экземпляр на сообщения и колбэки, чтобы бакеты пользователя были общими
+            throttling = ThrottlingMiddleware()
+            self._dp.message.outer_middleware(throttling)
+            self._dp.callback_query.outer_middleware(throttling)
             
             router = get_support_router()
             self._dp.include_router(router)
             
-            try:
-                asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
-
-            self._task = asyncio.run_coroutine_threadsafe(self._start_polling(), self._loop)
+            if webhook_mode.is_webhook_enabled():
+                self._task = asyncio.run_coroutine_threadsafe(self._start_webhook(), self._loop)
+            else:
+                try:
+                    asyncio.run_coroutine_threadsafe(self._bot.delete_webhook(drop_pending_updates=True), self._loop)
+                except Exception as e:
+                    logger.warning(f"Не удалось удалить вебхук перед запуском опроса: {e}")
+                self._task = asyncio.run_coroutine_threadsafe(self._start_polling(), self._loop)
             logger.info("Команда на запуск передана в цикл событий.")
             return {"status": "success", "message": "Команда на запуск support-бота отправлена."}
         except Exception as e:
@@ -97,8 +167,11 @@ class SupportBotController:
             return {"status": "error", "message": "Критическая ошибка: компоненты бота недоступны."}
 
         logger.info("Отправляю сигнал на корректную остановку...")
-        asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
+        if self._mode == "webhook":
+            asyncio.run_coroutine_threadsafe(self._stop_webhook(), self._loop)
+        else:
+            asyncio.run_coroutine_threadsafe(self._dp.stop_polling(), self._loop)
         return {"status": "success", "message": "Команда на остановку support-бота отправлена."}
 
     def get_status(self):
-        return {"is_running": self._is_running}
+        return {"is_running": self._is_running, "mode": self._mode}
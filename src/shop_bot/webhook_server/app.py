@@ -7,11 +7,12 @@ import html as html_escape
 import base64
 import time
 import uuid
+import concurrent.futures
 from hmac import compare_digest
 from datetime import datetime
 from functools import wraps
 from math import ceil
-from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app, jsonify, send_file
+from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app, jsonify, send_file, make_response, g
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 import secrets
 import urllib.parse
@@ -21,13 +22,27 @@ logger = logging.getLogger(__name__)
 logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 from shop_bot.modules import xui_api
+from shop_bot.modules import subscription
+from shop_bot.modules import host_health
 from shop_bot.bot import handlers
 from shop_bot.bot import keyboards
+from shop_bot.bot import webhook_mode
+from shop_bot.bot import outbound
+from shop_bot.bot.middlewares import get_ban_keyboard
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from shop_bot.support_bot_controller import SupportBotController
 from shop_bot.data_manager import speedtest_runner
 from shop_bot.data_manager import backup_manager
+from shop_bot.data_manager import incremental_backup
 from shop_bot.data_manager import resource_monitor
+from shop_bot.data_manager import background_jobs
+from shop_bot.data_manager import host_migration
+from shop_bot.data_manager import expired_sweep
+from shop_bot.data_manager import latency
+from shop_bot.data_manager import metrics
+from shop_bot.data_manager import tracing
+from shop_bot.data_manager import profiler
+from shop_bot.data_manager import job_scheduler
 from shop_bot.data_manager import database
 from shop_bot.data_manager.database import (
     get_all_settings, update_setting, get_all_hosts, get_plans_for_host,
@@ -71,14 +86,20 @@ ALL_SETTINGS_KEYS = [
     "referral_reward_type", "referral_on_start_referrer_amount",
     "support_forum_chat_id",
     "support_bot_token", "support_bot_username",
+    # Telegram webhook mode
+    "telegram_webhook_enabled", "telegram_webhook_max_concurrency", "fsm_state_ttl_hours",
+    # Anti-flood
+    "throttle_enabled", "throttle_payment_per_minute", "throttle_purchase_per_minute",
+    "throttle_keys_per_minute", "throttle_callback_per_minute", "throttle_message_per_minute",
     # UI
     "panel_brand_title",
     # Backups
-    "backup_interval_days",
+    "backup_interval_days", "backup_compression", "backup_compression_level", "backup_incremental_interval_min",
+    "backup_include_telemetry", "telemetry_retention_days",
     # Monitoring
     "monitoring_enabled", "monitoring_interval_sec",
     "monitoring_cpu_threshold", "monitoring_mem_threshold", "monitoring_disk_threshold",
-    "monitoring_alert_cooldown_sec",
+    "monitoring_alert_cooldown_sec", "metrics_token",
     # Telegram Stars
     "stars_enabled", "stars_per_rub", "stars_title", "stars_description",
     # YooMoney (separate)
@@ -142,6 +163,57 @@ def create_webhook_app(bot_controller_instance):
             return f(*args, **kwargs)
         return decorated_function
 
+    # --- Prometheus metrics and tracing of payment webhooks ---
+    payment_webhook_providers = {
+        'yookassa_webhook_handler': 'yookassa',
+        'cryptobot_webhook_handler': 'cryptobot',
+        'heleket_webhook_handler': 'heleket',
+        'ton_webhook_handler': 'ton',
+        'yoomoney_webhook_handler': 'yoomoney',
+        'unitpay_webhook_handler': 'unitpay',
+        'freekassa_webhook_handler': 'freekassa',
+        'enot_webhook_handler': 'enot',
+    }
+
+    @flask_app.before_request
+    def payment_webhook_started():
+        provider = payment_webhook_providers.get(request.endpoint)
+        if provider:
+            g.metrics_started = time.perf_counter()
+            # Обработка платежа уходит в цикл событий через run_coroutine_threadsafe и наследует эту трассу
+            g.trace = tracing.begin_trace(f"webhook {provider}", "payment", provider=provider)
+
+    @flask_app.after_request
+    def payment_webhook_finished(response):
+        provider = payment_webhook_providers.get(request.endpoint)
+        started = g.pop('metrics_started', None)
+        if provider and started is not None:
+            metrics.PAYMENT_WEBHOOKS.inc(provider, response.status_code)
+            metrics.PAYMENT_WEBHOOK_DURATION.observe(time.perf_counter() - started, provider)
+            trace = g.get('trace')
+            if trace:
+                trace[0].set(status=response.status_code)
+                if response.status_code >= 400:
+                    trace[0].fail(f"HTTP {response.status_code}")
+        return response
+
+    @flask_app.teardown_request
+    def payment_webhook_trace_end(exc):
+        trace = g.pop('trace', None)
+        if trace:
+            tracing.end(trace[0], trace[1], exc)
+
+    @flask_app.route('/metrics')
+    def metrics_route():
+        token = get_setting("metrics_token") or ""
+        if not token:
+            # За обратным прокси remote_addr всегда 127.0.0.1, так что без токена метрики закрыты полностью
+            return 'Forbidden', 403
+        auth = request.headers.get('Authorization') or ''
+        if not compare_digest(auth, f"Bearer {token}"):
+            return 'Unauthorized', 401
+        return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
     @flask_app.route('/login', methods=['GET', 'POST'])
     def login_page():
         settings = get_all_settings()
@@ -214,6 +286,172 @@ def create_webhook_app(bot_controller_instance):
         except Exception as e:
             return jsonify({"ok": False, "error": str(e)}), 500
 
+    @flask_app.route('/monitor/latency')
+    @login_required
+    def latency_page():
+        common_data = get_common_template_data()
+        return render_template('latency.html', snapshot=latency.get_snapshot(), **common_data)
+
+    @flask_app.route('/monitor/latency.json')
+    @login_required
+    def latency_json():
+        return jsonify({"ok": True, **latency.get_snapshot()})
+
+    @flask_app.route('/monitor/latency/reset', methods=['POST'])
+    @login_required
+    def latency_reset_route():
+        latency.reset()
+        flash('Статистика задержек сброшена.', 'success')
+        return redirect(url_for('latency_page'))
+
+    def _jobs_status() -> list[dict]:
+        scheduler = job_scheduler.get_scheduler()
+        return scheduler.get_status() if scheduler else []
+
+    def _leader_status() -> dict | None:
+        scheduler = job_scheduler.get_scheduler()
+        return scheduler.elector.status() if scheduler and scheduler.elector else None
+
+    @flask_app.route('/monitor/jobs')
+    @login_required
+    def jobs_page():
+        common_data = get_common_template_data()
+        return render_template('jobs.html', jobs=_jobs_status(), leader=_leader_status(), **common_data)
+
+    @flask_app.route('/monitor/jobs.json')
+    @login_required
+    def jobs_json():
+        return jsonify({"ok": True, "leader": _leader_status(), "jobs": _jobs_status()})
+
+    @flask_app.route('/monitor/jobs/<name>/run', methods=['POST'])
+    @login_required
+    def job_run_now_route(name):
+        scheduler = job_scheduler.get_scheduler()
+        loop = current_app.config.get('EVENT_LOOP')
+        if not scheduler or not loop or not loop.is_running():
+            flash('Планировщик не запущен.', 'danger')
+            return redirect(url_for('jobs_page'))
+        job = scheduler.jobs.get(name)
+        if job is None:
+            flash('Задача не найдена.', 'danger')
+        elif not scheduler.active:
+            flash('Фоновые задачи выполняет другой экземпляр (лидер) — запустите задачу из его панели.', 'warning')
+        elif job.running:
+            flash(f'Задача «{job.title}» уже выполняется.', 'warning')
+        else:
+            loop.call_soon_threadsafe(scheduler.run_now, name)
+            flash(f'Задача «{job.title}» запущена.', 'success')
+        return redirect(url_for('jobs_page'))
+
+    def _dump_event_loop_tasks():
+        """Дамп задач asyncio из цикла событий. (задачи, ошибка) — если цикл занят и не ответил, задач нет."""
+        loop = current_app.config.get('EVENT_LOOP')
+        if not loop or not loop.is_running():
+            return [], 'Цикл событий не запущен.'
+        future = asyncio.run_coroutine_threadsafe(profiler.dump_tasks(), loop)
+        try:
+            return future.result(timeout=5), None
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            return [], 'Цикл событий не ответил за 5 с — он заблокирован; смотрите стек потока MainThread в профиле.'
+        except Exception as e:
+            logger.error(f"Профилировщик: не удалось получить список задач asyncio: {e}", exc_info=True)
+            return [], str(e)
+
+    @flask_app.route('/monitor/profiler')
+    @login_required
+    def profiler_page():
+        common_data = get_common_template_data()
+        tasks, tasks_error = _dump_event_loop_tasks()
+        running_jobs = [j for j in _jobs_status() if j.get('running')]
+        return render_template(
+            'profiler.html',
+            result=profiler.get_last_result(), is_running=profiler.is_running(),
+            tasks=tasks, tasks_error=tasks_error, running_jobs=running_jobs,
+            long_task_seconds=int(profiler.LONG_TASK_SECONDS),
+            min_seconds=int(profiler.MIN_SECONDS), max_seconds=int(profiler.MAX_SECONDS),
+            **common_data
+        )
+
+    @flask_app.route('/monitor/profiler/run', methods=['POST'])
+    @login_required
+    def profiler_run_route():
+        # Сэмплирование идёт прямо в потоке этого запроса: сервер Flask многопоточный, остальное продолжает работать
+        try:
+            seconds = float(request.form.get('seconds') or 10)
+            interval_ms = float(request.form.get('interval_ms') or 10)
+        except ValueError:
+            flash('Некорректная длительность или интервал.', 'danger')
+            return redirect(url_for('profiler_page'))
+        include_idle = request.form.get('include_idle') == 'true'
+        try:
+            result = profiler.sample(seconds, interval_ms, include_idle=include_idle)
+        except RuntimeError as e:
+            flash(f'{e}.', 'warning')
+            return redirect(url_for('profiler_page'))
+        logger.info(f"Профилировщик: снято {result['samples']} стеков за {result['duration_s']} с")
+        if request.form.get('format') == 'collapsed':
+            return profiler_collapsed()
+        flash(f"Профиль снят: {result['samples']} стеков за {result['duration_s']} с.", 'success')
+        return redirect(url_for('profiler_page'))
+
+    @flask_app.route('/monitor/profiler/collapsed.txt')
+    @login_required
+    def profiler_collapsed():
+        result = profiler.get_last_result()
+        if not result:
+            return 'Профиль ещё не снимался.\n', 404, {"Content-Type": "text/plain; charset=utf-8"}
+        return result['collapsed'], 200, {
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Disposition": "attachment; filename=shopbot-profile.collapsed.txt",
+        }
+
+    @flask_app.route('/monitor/profiler/tasks.json')
+    @login_required
+    def profiler_tasks_json():
+        tasks, error = _dump_event_loop_tasks()
+        return jsonify({"ok": error is None, "error": error, "tasks": tasks})
+
+    @flask_app.route('/monitor/traces')
+    @login_required
+    def traces_page():
+        common_data = get_common_template_data()
+        kind = request.args.get('kind') or None
+        query = (request.args.get('q') or '').strip() or None
+        return render_template(
+            'traces.html',
+            kinds=tracing.get_kinds(), kind=kind, query=query, per_kind=tracing.TRACES_PER_KIND,
+            slowest=tracing.get_traces(kind=kind, query=query, order='slowest', limit=30),
+            failed=tracing.get_traces(kind=kind, query=query, failed_only=True, order='recent', limit=30),
+            **common_data
+        )
+
+    @flask_app.route('/monitor/traces.json')
+    @login_required
+    def traces_json():
+        kind = request.args.get('kind') or None
+        query = (request.args.get('q') or '').strip() or None
+        failed_only = request.args.get('failed') == '1'
+        order = 'recent' if request.args.get('order') == 'recent' else 'slowest'
+        return jsonify({"ok": True, "traces": tracing.get_traces(kind=kind, query=query, failed_only=failed_only, order=order)})
+
+    @flask_app.route('/monitor/traces/<trace_id>')
+    @login_required
+    def trace_detail_page(trace_id):
+        trace = tracing.get_trace(trace_id)
+        if trace is None:
+            flash('Трасса не найдена (возможно, уже вытеснена из буфера).', 'warning')
+            return redirect(url_for('traces_page'))
+        if request.args.get('format') == 'json':
+            return jsonify({"ok": True, "trace": trace})
+        common_data = get_common_template_data()
+        return render_template('trace_detail.html', trace=trace, **common_data)
+
+    @flask_app.route('/monitor/outbound.json')
+    @login_required
+    def monitor_outbound_json():
+        return jsonify({"ok": True, "stats": outbound.get_stats()})
+
     @flask_app.route('/')
     @login_required
     def index():
@@ -461,7 +699,7 @@ def create_webhook_app(bot_controller_instance):
                     text = f"💳 Ваш баланс был изменён администратором: {sign}{delta:.2f} RUB\nТекущий баланс: {get_balance(user_id):.2f} RUB"
                     loop = current_app.config.get('EVENT_LOOP')
                     if loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=user_id, text=text), loop)
+                        outbound.send_message_threadsafe(bot, chat_id=user_id, text=text, priority=outbound.PRIORITY_PAYMENT)
                         logger.info(f"Запланирована отправка уведомления о балансе пользователю {user_id}")
                     else:
                         # fallback, если по какой-то причине нет общего цикла (не рекомендуется, но лучше чем молча не отправить)
@@ -491,8 +729,18 @@ def create_webhook_app(bot_controller_instance):
             users = get_all_users()
         except Exception:
             users = []
+        migration_jobs = []
+        try:
+            migration_jobs = [
+                background_jobs.get_job_status(job['job_id'])
+                for job in database.get_recent_background_jobs(host_migration.JOB_KIND, limit=5)
+            ]
+        except Exception:
+            migration_jobs = []
         common_data = get_common_template_data()
-        return render_template('admin_keys.html', keys=keys, hosts=hosts, users=users, **common_data)
+        return render_template(
+            'admin_keys.html', keys=keys, hosts=hosts, users=users, migration_jobs=migration_jobs, **common_data
+        )
 
     # Partial: admin keys table tbody
     @flask_app.route('/admin/keys/table.partial')
@@ -559,7 +807,7 @@ def create_webhook_app(bot_controller_instance):
             pass
 
         # 2) Сохранить в БД
-        new_id = add_new_key(user_id, host_name, xui_uuid, key_email, expiry_ms or 0)
+        new_id = add_new_key(user_id, host_name, xui_uuid, key_email, expiry_ms or 0, sub_token=result.get('sub_token'))
         flash(('Ключ добавлен.' if new_id else 'Ошибка при добавлении ключа.'), 'success' if new_id else 'danger')
 
         # 3) Уведомление пользователю в Telegram (без email, с пометкой, что ключ выдан администратором)
@@ -576,9 +824,9 @@ def create_webhook_app(bot_controller_instance):
                     text += f"\nПодключение:\n<code>{cs}</code>"
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True),
-                        loop
+                    outbound.send_message_threadsafe(
+                        bot, chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True,
+                        priority=outbound.PRIORITY_SUPPORT,
                     )
                 else:
                     asyncio.run(bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True))
@@ -612,7 +860,7 @@ def create_webhook_app(bot_controller_instance):
             return jsonify({"ok": False, "error": "host_failed"}), 500
 
         # sync DB
-        new_id = add_new_key(user_id, host_name, result.get('client_uuid') or xui_uuid, key_email, result.get('expiry_timestamp_ms') or expiry_ms or 0)
+        new_id = add_new_key(user_id, host_name, result.get('client_uuid') or xui_uuid, key_email, result.get('expiry_timestamp_ms') or expiry_ms or 0, sub_token=result.get('sub_token'))
 
         # notify user (без email, с пометкой про администратора)
         try:
@@ -628,9 +876,9 @@ def create_webhook_app(bot_controller_instance):
                     text += f"\nПодключение:\n<pre><code>{cs}</code></pre>"
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True),
-                        loop
+                    outbound.send_message_threadsafe(
+                        bot, chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True,
+                        priority=outbound.PRIORITY_SUPPORT,
                     )
                 else:
                     asyncio.run(bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True))
@@ -703,7 +951,7 @@ def create_webhook_app(bot_controller_instance):
             logger.error("create_key_standalone_ajax_route: хост не вернул клиента")
             return jsonify({"ok": False, "error": "Ошибка: хост не вернул клиента"}), 500
 
-        new_id = add_new_key(user_id, host_name, result.get('client_uuid') or xui_uuid, key_email, result.get('expiry_timestamp_ms') or expiry_ms or 0)
+        new_id = add_new_key(user_id, host_name, result.get('client_uuid') or xui_uuid, key_email, result.get('expiry_timestamp_ms') or expiry_ms or 0, sub_token=result.get('sub_token'))
         if comment and new_id:
             try:
                 update_key_comment(int(new_id), comment)
@@ -724,9 +972,9 @@ def create_webhook_app(bot_controller_instance):
                         text += f"\nПодключение:\n<pre><code>{cs}</code></pre>"
                     loop = current_app.config.get('EVENT_LOOP')
                     if loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(
-                            bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True),
-                            loop
+                        outbound.send_message_threadsafe(
+                            bot, chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True,
+                            priority=outbound.PRIORITY_SUPPORT,
                         )
                     else:
                         asyncio.run(bot.send_message(chat_id=user_id, text=text, parse_mode='HTML', disable_web_page_preview=True))
@@ -843,7 +1091,7 @@ def create_webhook_app(bot_controller_instance):
                     bot = _bot_controller.get_bot_instance()
                     loop = current_app.config.get('EVENT_LOOP')
                     if bot and loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=user_id, text=text), loop)
+                        outbound.send_message_threadsafe(bot, chat_id=user_id, text=text, priority=outbound.PRIORITY_SUPPORT)
                     elif bot:
                         asyncio.run(bot.send_message(chat_id=user_id, text=text))
             except Exception:
@@ -856,59 +1104,69 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/admin/keys/sweep-expired', methods=['POST'])
     @login_required
     def sweep_expired_keys_route():
-        from datetime import datetime
-        removed = 0
-        failed = 0
-        now = datetime.utcnow()
-        keys = get_all_keys()
-        for k in keys:
-            exp = k.get('expiry_date')
-            exp_dt = None
-            try:
-                if isinstance(exp, str):
-                    try:
-                        from datetime import datetime as dt
-                        exp_dt = dt.fromisoformat(exp)
-                    except Exception:
-                        # fallback: если в БД дата как 'YYYY-MM-DD HH:MM:SS'
-                        try:
-                            exp_dt = datetime.strptime(exp, '%Y-%m-%d %H:%M:%S')
-                        except Exception:
-                            exp_dt = None
-                else:
-                    exp_dt = exp
-            except Exception:
-                exp_dt = None
-            if not exp_dt or exp_dt > now:
-                continue
-            # Истёкший — пробуем удалить на сервере и в БД, уведомляем пользователя
-            try:
-                try:
-                    asyncio.run(xui_api.delete_client_on_host(k.get('host_name'), k.get('key_email')))
-                except Exception:
-                    pass
-                delete_key_by_id(k.get('key_id'))
-                removed += 1
-                # Уведомление пользователю о автоудалении
-                try:
-                    bot = _bot_controller.get_bot_instance()
-                    loop = current_app.config.get('EVENT_LOOP')
-                    text = (
-                        "Ваш ключ был автоматически удалён по истечении срока.\n"
-                        f"Хост: {k.get('host_name')}\nEmail: {k.get('key_email')}\n"
-                        "При необходимости вы можете оформить новый ключ."
-                    )
-                    if bot and loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=k.get('user_id'), text=text), loop)
-                    else:
-                        asyncio.run(bot.send_message(chat_id=k.get('user_id'), text=text))
-                except Exception:
-                    pass
-            except Exception:
-                failed += 1
-        flash(f"Удалено истёкших ключей: {removed}. Ошибок: {failed}.", 'success' if failed == 0 else 'warning')
+        wants_json = 'application/json' in (request.headers.get('Accept') or '') or request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        job_id, error = expired_sweep.create_sweep_job()
+        if not error:
+            loop = current_app.config.get('EVENT_LOOP')
+            if not background_jobs.submit(job_id, loop, _bot_controller):
+                database.update_background_job(job_id, status="failed", error="Не удалось запустить задачу")
+                error = "Не удалось запустить задачу"
+        if wants_json:
+            if error:
+                return jsonify({"ok": False, "error": error}), 409
+            return jsonify({"ok": True, "job_id": job_id})
+        if error:
+            flash(error, 'warning')
+        else:
+            flash(f"Удаление истёкших ключей запущено в фоне (задача #{job_id}).", 'success')
         return redirect(request.referrer or url_for('admin_keys_page'))
 
+    # --- Host migration (background jobs) ---
+    @flask_app.route('/admin/hosts/migrate', methods=['POST'])
+    @login_required
+    def start_host_migration_route():
+        source_host = (request.form.get('source_host') or '').strip()
+        target_host = (request.form.get('target_host') or '').strip()
+        dry_run = (request.form.get('dry_run') or '').lower() in ('1', 'true', 'on', 'yes')
+        key_ids = None
+        raw_ids = (request.form.get('key_ids') or '').replace(';', ',').replace(' ', ',')
+        if raw_ids.strip(','):
+            try:
+                key_ids = [int(part) for part in raw_ids.split(',') if part]
+            except ValueError:
+                return jsonify({"ok": False, "error": "Некорректный список ID ключей"}), 400
+        job_id, error = host_migration.create_migration_job(source_host, target_host, key_ids=key_ids, dry_run=dry_run)
+        if error:
+            return jsonify({"ok": False, "error": error}), 400
+        loop = current_app.config.get('EVENT_LOOP')
+        if not background_jobs.submit(job_id, loop, _bot_controller):
+            database.update_background_job(job_id, status="failed", error="Не удалось запустить задачу")
+            return jsonify({"ok": False, "error": "Не удалось запустить задачу"}), 500
+        return jsonify({"ok": True, "job_id": job_id})
+
+    @flask_app.route('/admin/jobs/<int:job_id>.json')
+    @login_required
+    def background_job_status_json(job_id: int):
+        job = background_jobs.get_job_status(job_id)
+        if not job:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        return jsonify({"ok": True, "job": job})
+
+    @flask_app.route('/admin/jobs/<int:job_id>/resume', methods=['POST'])
+    @login_required
+    def resume_background_job_route(job_id: int):
+        job = background_jobs.get_job_status(job_id)
+        if not job:
+            return jsonify({"ok": False, "error": "not_found"}), 404
+        if job.get('active'):
+            return jsonify({"ok": False, "error": "Задача уже выполняется"}), 409
+        if (job.get('params') or {}).get('dry_run'):
+            return jsonify({"ok": False, "error": "Пробный запуск нельзя продолжить — запустите перенос заново"}), 400
+        loop = current_app.config.get('EVENT_LOOP')
+        if not background_jobs.submit(job_id, loop, _bot_controller):
+            return jsonify({"ok": False, "error": "Не удалось запустить задачу"}), 500
+        return jsonify({"ok": True, "job_id": job_id})
+
     @flask_app.route('/admin/keys/<int:key_id>/comment', methods=['POST'])
     @login_required
     def update_key_comment_route(key_id: int):
@@ -974,6 +1232,25 @@ def create_webhook_app(bot_controller_instance):
         except Exception as e:
             return jsonify({'ok': False, 'error': str(e)}), 500
 
+    @flask_app.route('/admin/hosts/health.json')
+    @login_required
+    def hosts_health_json():
+        items = []
+        hosts = get_all_hosts()
+        host_health.refresh_load(hosts)
+        for h in hosts:
+            entry = host_health.get_host_state(h.get('host_url'))
+            items.append({
+                'host_name': h.get('host_name'),
+                'state': entry.get('state'),
+                'failures': entry.get('failures'),
+                'last_error': entry.get('last_error'),
+                'clients': entry.get('clients'),
+                'cpu_percent': entry.get('cpu_percent'),
+                'ping_ms': entry.get('ping_ms'),
+            })
+        return jsonify({'ok': True, 'items': items})
+
     @flask_app.route('/admin/speedtests/run-all', methods=['POST'])
     @login_required
     def run_all_speedtests_route():
@@ -1095,7 +1372,7 @@ def create_webhook_app(bot_controller_instance):
                         user_chat_id = ticket.get('user_id')
                         if bot and loop and loop.is_running() and user_chat_id:
                             text = f"Ответ по тикету #{ticket_id}:\n\n{message}"
-                            asyncio.run_coroutine_threadsafe(bot.send_message(user_chat_id, text), loop)
+                            outbound.send_message_threadsafe(bot, user_chat_id, text, priority=outbound.PRIORITY_SUPPORT)
                         else:
                             logger.error("Ответ поддержки: support-бот или цикл событий недоступны; сообщение пользователю не отправлено.")
                     except Exception as e:
@@ -1107,9 +1384,9 @@ def create_webhook_app(bot_controller_instance):
                         thread_id = ticket.get('message_thread_id')
                         if bot and loop and loop.is_running() and forum_chat_id and thread_id:
                             text = f"💬 Ответ админа из панели по тикету #{ticket_id}:\n\n{message}"
-                            asyncio.run_coroutine_threadsafe(
-                                bot.send_message(chat_id=int(forum_chat_id), text=text, message_thread_id=int(thread_id)),
-                                loop
+                            outbound.send_message_threadsafe(
+                                bot, chat_id=int(forum_chat_id), text=text, message_thread_id=int(thread_id),
+                                priority=outbound.PRIORITY_SUPPORT,
                             )
                     except Exception as e:
                         logger.warning(f"Ответ поддержки: не удалось отзеркалить сообщение в тему форума для тикета {ticket_id}: {e}")
@@ -1135,7 +1412,7 @@ def create_webhook_app(bot_controller_instance):
                         user_chat_id = ticket.get('user_id')
                         if bot and loop and loop.is_running() and user_chat_id:
                             text = f"✅ Ваш тикет #{ticket_id} был закрыт администратором. Вы можете создать новое обращение при необходимости."
-                            asyncio.run_coroutine_threadsafe(bot.send_message(int(user_chat_id), text), loop)
+                            outbound.send_message_threadsafe(bot, int(user_chat_id), text, priority=outbound.PRIORITY_SUPPORT)
                     except Exception as e:
                         logger.warning(f"Закрытие тикета: не удалось уведомить пользователя {ticket.get('user_id')} о закрытии тикета #{ticket_id}: {e}")
                     flash('Тикет закрыт.', 'success')
@@ -1163,7 +1440,7 @@ def create_webhook_app(bot_controller_instance):
                         user_chat_id = ticket.get('user_id')
                         if bot and loop and loop.is_running() and user_chat_id:
                             text = f"🔓 Ваш тикет #{ticket_id} снова открыт. Вы можете продолжить переписку."
-                            asyncio.run_coroutine_threadsafe(bot.send_message(int(user_chat_id), text), loop)
+                            outbound.send_message_threadsafe(bot, int(user_chat_id), text, priority=outbound.PRIORITY_SUPPORT)
                     except Exception as e:
                         logger.warning(f"Открытие тикета: не удалось уведомить пользователя {ticket.get('user_id')} об открытии тикета #{ticket_id}: {e}")
                     flash('Тикет открыт.', 'success')
@@ -1244,7 +1521,7 @@ def create_webhook_app(bot_controller_instance):
                 update_setting('panel_password', request.form.get('panel_password'))
 
             # Обработка чекбоксов, где в форме идёт hidden=false + checkbox=true
-            checkbox_keys = ['force_subscription', 'sbp_enabled', 'trial_enabled', 'enable_referrals', 'enable_fixed_referral_bonus', 'stars_enabled', 'yoomoney_enabled', 'monitoring_enabled']
+            checkbox_keys = ['force_subscription', 'sbp_enabled', 'trial_enabled', 'enable_referrals', 'enable_fixed_referral_bonus', 'stars_enabled', 'yoomoney_enabled', 'monitoring_enabled', 'telegram_webhook_enabled', 'throttle_enabled', 'backup_include_telemetry']
             for checkbox_key in checkbox_keys:
                 values = request.form.getlist(checkbox_key)
                 value = values[-1] if values else 'false'
@@ -1276,8 +1553,7 @@ def create_webhook_app(bot_controller_instance):
         backups = []
         try:
             from pathlib import Path
-            bdir = backup_manager.BACKUPS_DIR
-            for p in sorted(bdir.glob('db-backup-*.zip'), key=lambda x: x.stat().st_mtime, reverse=True):
+            for p in backup_manager.list_backup_files():
                 try:
                     st = p.stat()
                     backups.append({
@@ -1291,7 +1567,12 @@ def create_webhook_app(bot_controller_instance):
             backups = []
 
         common_data = get_common_template_data()
-        return render_template('settings.html', settings=current_settings, hosts=hosts, backups=backups, **common_data)
+        return render_template(
+            'settings.html', settings=current_settings, hosts=hosts, backups=backups,
+            last_backup=backup_manager.get_last_backup_stats(), zstd_available=backup_manager.zstd_available(),
+            incremental_chains=incremental_backup.list_chains(),
+            **common_data
+        )
 
     # --- DB Backup/Restore ---
     @flask_app.route('/admin/db/backup', methods=['POST'])
@@ -1332,8 +1613,8 @@ def create_webhook_app(bot_controller_instance):
                     flash('Файл для восстановления не выбран.', 'warning')
                     return redirect(request.referrer or url_for('settings_page', tab='panel'))
                 filename = file.filename.lower()
-                if not (filename.endswith('.zip') or filename.endswith('.db')):
-                    flash('Поддерживаются только файлы .zip или .db', 'warning')
+                if not (filename.endswith('.zip') or filename.endswith('.db') or filename.endswith('.zst')):
+                    flash('Поддерживаются только файлы .zip, .db.zst или .db', 'warning')
                     return redirect(request.referrer or url_for('settings_page', tab='panel'))
                 ts = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
                 dest_dir = backup_manager.BACKUPS_DIR
@@ -1354,6 +1635,21 @@ def create_webhook_app(bot_controller_instance):
             flash('Ошибка при восстановлении БД.', 'danger')
             return redirect(request.referrer or url_for('settings_page', tab='panel'))
 
+    @flask_app.route('/admin/db/restore-point', methods=['POST'])
+    @login_required
+    def restore_db_point_route():
+        raw = (request.form.get('restore_point') or '').strip()
+        try:
+            until = datetime.fromisoformat(raw)
+        except ValueError:
+            flash('Укажите дату и время восстановления.', 'warning')
+            return redirect(request.referrer or url_for('settings_page', tab='panel'))
+        if incremental_backup.restore_to_point(until):
+            flash(f'База восстановлена на {until.strftime("%d.%m.%Y %H:%M")}.', 'success')
+        else:
+            flash('Восстановление на момент времени не удалось. Подробности в логах.', 'danger')
+        return redirect(request.referrer or url_for('settings_page', tab='panel'))
+
     @flask_app.route('/update-host-subscription', methods=['POST'])
     @login_required
     def update_host_subscription_route():
@@ -1488,39 +1784,12 @@ def create_webhook_app(bot_controller_instance):
             bot = _bot_controller.get_bot_instance()
             if bot:
                 text = "🚫 Ваш аккаунт заблокирован администратором. Если это ошибка — напишите в поддержку."
-                # Собираем клавиатуру из одной кнопки поддержки
-                try:
-                    support = (get_setting("support_bot_username") or get_setting("support_user") or "").strip()
-                except Exception:
-                    support = ""
-                kb = InlineKeyboardBuilder()
-                url: str | None = None
-                if support:
-                    if support.startswith("@"):  # @username
-                        url = f"tg://resolve?domain={support[1:]}"
-                    elif support.startswith("tg://"):
-                        url = support
-                    elif support.startswith("http://") or support.startswith("https://"):
-                        try:
-                            part = support.split("/")[-1].split("?")[0]
-                            if part:
-                                url = f"tg://resolve?domain={part}"
-                        except Exception:
-                            url = support
-                    else:
-                        url = f"tg://resolve?domain={support}"
-                if url:
-                    kb.button(text="🆘 Написать в поддержку", url=url)
-                else:
-                    kb.button(text="🆘 Поддержка", callback_data="show_help")
+                ban_kb = get_ban_keyboard()
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()),
-                        loop
-                    )
+                    outbound.send_message_threadsafe(bot, chat_id=user_id, text=text, reply_markup=ban_kb, priority=outbound.PRIORITY_SUPPORT)
                 else:
-                    asyncio.run(bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()))
+                    asyncio.run(bot.send_message(chat_id=user_id, text=text, reply_markup=ban_kb))
         except Exception as e:
             logger.warning(f"Не удалось отправить уведомление о бане пользователю {user_id}: {e}")
         return redirect(url_for('users_page'))
@@ -1539,10 +1808,7 @@ def create_webhook_app(bot_controller_instance):
                 text = "✅ Доступ к аккаунту восстановлен администратором."
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(
-                        bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()),
-                        loop
-                    )
+                    outbound.send_message_threadsafe(bot, chat_id=user_id, text=text, reply_markup=kb.as_markup(), priority=outbound.PRIORITY_SUPPORT)
                 else:
                     asyncio.run(bot.send_message(chat_id=user_id, text=text, reply_markup=kb.as_markup()))
         except Exception as e:
@@ -1575,7 +1841,7 @@ def create_webhook_app(bot_controller_instance):
                 )
                 loop = current_app.config.get('EVENT_LOOP')
                 if loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=user_id, text=text), loop)
+                    outbound.send_message_threadsafe(bot, chat_id=user_id, text=text, priority=outbound.PRIORITY_SUPPORT)
                 else:
                     asyncio.run(bot.send_message(chat_id=user_id, text=text))
         except Exception:
@@ -1659,6 +1925,26 @@ def create_webhook_app(bot_controller_instance):
             flash('Не удалось обновить тариф (возможно, он не найден).', 'danger')
         return redirect(url_for('settings_page', tab='hosts'))
 
+    # --- Telegram webhook ingestion ---
+    @csrf.exempt
+    @flask_app.route('/tg/webhook/<bot_kind>', methods=['POST'])
+    def telegram_webhook_handler(bot_kind: str):
+        controllers = {'main': _bot_controller, 'support': _support_bot_controller}
+        controller = controllers.get(bot_kind)
+        if controller is None:
+            return 'Not Found', 404
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token') or ''
+        if not compare_digest(secret, webhook_mode.get_webhook_secret(bot_kind)):
+            logger.warning(f"Вебхук Telegram ({bot_kind}): неверный секретный токен")
+            return 'Forbidden', 403
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict):
+            return 'Bad Request', 400
+        if not controller.feed_webhook_update(update):
+            # Бот не в режиме вебхука или очередь заполнена — Telegram повторит доставку позже
+            return 'Service Unavailable', 503
+        return 'OK', 200
+
     @csrf.exempt
     @flask_app.route('/yookassa-webhook', methods=['POST'])
     def yookassa_webhook_handler():
@@ -1803,6 +2089,28 @@ def create_webhook_app(bot_controller_instance):
             logger.error(f"Ошибка в обработчике вебхука TonAPI: {e}", exc_info=True)
             return 'Error', 500
 
+    # --- Subscription endpoint (served from local DB) ---
+    @flask_app.route('/sub/<token>')
+    def subscription_route(token: str):
+        fmt = subscription.detect_format(request.args.get('format'), request.headers.get('User-Agent'))
+        try:
+            result = subscription.render_subscription(token, fmt)
+        except Exception as e:
+            logger.error(f"Ошибка формирования подписки: {e}", exc_info=True)
+            return 'Error', 500
+        if result is None:
+            return 'Not Found', 404
+        response = make_response(result['body'])
+        response.headers['Content-Type'] = result['content_type']
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers['Profile-Update-Interval'] = str(subscription.PROFILE_UPDATE_INTERVAL_HOURS)
+        response.headers['Subscription-Userinfo'] = f"upload=0; download=0; total=0; expire={result['expire']}"
+        title = (get_setting('panel_brand_title') or '').strip()
+        if title:
+            response.headers['Profile-Title'] = 'base64:' + base64.b64encode(title.encode('utf-8')).decode()
+        response.set_etag(result['etag'])
+        return response.make_conditional(request)
+
     # --- YooMoney OAuth integration ---
     def _ym_get_redirect_uri():
         try:
@@ -0,0 +1,16 @@
+import pytest
+
+from shop_bot.data_manager import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая основная БД и БД телеметрии во временной папке."""
+    monkeypatch.setattr(database, "DB_FILE", tmp_path / "users.db")
+    monkeypatch.setattr(database, "TELEMETRY_DB_FILE", tmp_path / "telemetry.db")
+    monkeypatch.setattr(database, "_wal_policy_checked_at", None)
+    monkeypatch.setattr(database, "_revisions", {})
+    monkeypatch.setattr(database, "_revisions_loaded_at", 0.0)
+    monkeypatch.setattr(database, "_banned_ids", None)
+    database.initialize_db()
+    return database
@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+import pytest
+
+from shop_bot.data_manager import backup_manager
+
+
+@pytest.fixture
+def backups_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_manager, "BACKUPS_DIR", tmp_path)
+    return tmp_path
+
+
+def _archive(path, size: int):
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+
+def _check_sums(checksum_path):
+    for line in checksum_path.read_text(encoding="utf-8").splitlines():
+        digest, name = line.split("  ", 1)
+        candidates = [checksum_path.parent / name, checksum_path.parent.parent / name]
+        target = next(p for p in candidates if p.exists())
+        assert hashlib.sha256(target.read_bytes()).hexdigest() == digest, name
+
+
+def test_parts_reassemble_to_original(backups_dir):
+    archive = backups_dir / "db-backup-1.zip"
+    data = _archive(archive, 2500)
+    parts, checksum_path = backup_manager.split_into_chunks(archive, chunk_size=1000)
+
+    assert [p.name for p in parts] == [f"db-backup-1.zip.part{i:03d}" for i in (1, 2, 3)]
+    assert [p.stat().st_size for p in parts] == [1000, 1000, 500]
+    assert b"".join(p.read_bytes() for p in parts) == data
+    _check_sums(checksum_path)
+
+
+def test_exact_multiple_has_no_empty_part(backups_dir):
+    archive = backups_dir / "db-backup-2.zip"
+    _archive(archive, 2000)
+    parts, checksum_path = backup_manager.split_into_chunks(archive, chunk_size=1000)
+
+    assert len(parts) == 2
+    assert not (checksum_path.parent / "db-backup-2.zip.part003").exists()
+    # Строка на каждую часть плюс строка для архива целиком
+    assert len(checksum_path.read_text(encoding="utf-8").splitlines()) == 3
+
+
+def test_small_archive_is_a_single_part(backups_dir):
+    archive = backups_dir / "db-backup-3.zip"
+    data = _archive(archive, 10)
+    parts, checksum_path = backup_manager.split_into_chunks(archive, chunk_size=1000)
+
+    assert len(parts) == 1 and parts[0].read_bytes() == data
+    assert checksum_path.name == "db-backup-3.zip.sha256"
+
+
+def test_chunk_larger_than_read_block(backups_dir, monkeypatch):
+    monkeypatch.setattr(backup_manager, "COMPRESS_CHUNK_SIZE", 64)
+    archive = backups_dir / "db-backup-4.zip"
+    data = _archive(archive, 1000)
+    parts, checksum_path = backup_manager.split_into_chunks(archive, chunk_size=300)
+
+    assert [p.stat().st_size for p in parts] == [300, 300, 300, 100]
+    assert b"".join(p.read_bytes() for p in parts) == data
+    _check_sums(checksum_path)
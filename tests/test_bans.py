@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def users(db):
+    for user_id in (1, 2):
+        db.register_user_if_not_exists(user_id, f"user{user_id}", None)
+    return db
+
+
+def _other_instance(db, sql: str, *params):
+    """Изменение, сделанное другим экземпляром: напрямую в общей БД, мимо кэшей этого процесса."""
+    with sqlite3.connect(db.DB_FILE) as conn:
+        conn.execute(sql, params)
+        conn.commit()
+
+
+def test_ban_in_this_process_is_seen_immediately(users):
+    assert not users.is_user_banned(1)
+    users.ban_user(1)
+    assert users.is_user_banned(1)
+    users.unban_user(1)
+    assert not users.is_user_banned(1)
+
+
+def test_ban_by_other_instance_is_seen_after_poll(users, monkeypatch):
+    assert not users.is_user_banned(2)
+    _other_instance(users, "UPDATE users SET is_banned = 1 WHERE telegram_id = ?", 2)
+    _other_instance(users, "INSERT INTO cache_revisions (name, revision) VALUES ('banned', 1)")
+
+    # До следующего опроса ревизий работает загруженное множество
+    assert not users.is_user_banned(2)
+    monkeypatch.setattr(users, "_revisions_loaded_at", 0.0)
+    assert users.is_user_banned(2)
+
+
+def test_replaced_db_reloads_bans(users, monkeypatch):
+    users.ban_user(1)
+    assert users.is_user_banned(1)
+    # Восстановление из бэкапа: другой список банов и, возможно, старая ревизия
+    _other_instance(users, "UPDATE users SET is_banned = CASE telegram_id WHEN 2 THEN 1 ELSE 0 END")
+    _other_instance(users, "UPDATE cache_revisions SET revision = 1 WHERE name = 'banned'")
+    users.bump_all_revisions()
+    assert users.is_user_banned(2) and not users.is_user_banned(1)
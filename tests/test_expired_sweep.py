@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from shop_bot.data_manager import expired_sweep
+from shop_bot.modules import xui_api
+
+
+class FakePanel:
+    """Inbound панели 3x-ui в памяти: get_by_id / update, как у py3xui Api.inbound."""
+
+    def __init__(self, clients: dict[str, int]):
+        self.clients = [SimpleNamespace(email=email, expiry_time=ms) for email, ms in clients.items()]
+        self.inbound = self
+        self.client = SimpleNamespace(add=self.add)
+
+    def get_by_id(self, inbound_id):
+        return SimpleNamespace(id=inbound_id, settings=SimpleNamespace(clients=list(self.clients)))
+
+    def update(self, inbound_id, inbound):
+        self.clients = list(inbound.settings.clients)
+
+    def add(self, inbound_id, clients):
+        self.clients.extend(clients)
+
+    @property
+    def emails(self) -> set[str]:
+        return {c.email for c in self.clients}
+
+
+def _ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+@pytest.fixture
+def setup(db):
+    db.create_host("h1", "https://panel.example", "admin", "pw", 1)
+    db.register_user_if_not_exists(100, "user", None)
+    past = datetime.now() - timedelta(days=2)
+    ids = {email: db.add_new_key(100, "h1", f"uuid-{email}", email, _ms(past)) for email in ("a", "b", "c")}
+    return db, ids, past
+
+
+def test_keys_renewed_during_sweep_are_kept(setup, monkeypatch):
+    db, ids, past = setup
+    future = datetime.now() + timedelta(days=30)
+    # b уже продлён на панели (БД обновится чуть позже), c продлевают в БД, пока идёт очистка
+    panel = FakePanel({"a": _ms(past), "b": _ms(future), "c": _ms(past), "other": _ms(future)})
+
+    def login_to_host(*args):
+        db.update_key_info(ids["c"], "uuid-c", _ms(future))
+        return panel, SimpleNamespace(id=1)
+
+    monkeypatch.setattr(xui_api, "login_to_host", login_to_host)
+    job_id = db.create_background_job(expired_sweep.JOB_KIND)
+    asyncio.run(expired_sweep.run_sweep_job(job_id, None))
+
+    # c убран с панели раньше, чем DELETE увидел продление, — его вернули на панель с новым сроком
+    assert panel.emails == {"b", "c", "other"}
+    restored = next(c for c in panel.clients if c.email == "c")
+    assert restored.id == "uuid-c" and abs(restored.expiry_time - _ms(future)) < 1000
+    assert db.get_key_by_id(ids["a"]) is None
+    assert db.get_key_by_id(ids["b"]) is not None
+    assert db.get_key_by_id(ids["c"]) is not None
+    progress = db.get_background_job(job_id)["progress"]
+    assert (progress["removed"], progress["renewed"], progress["failed"]) == (1, 2, 0)
+
+
+def test_login_failure_keeps_everything(setup, monkeypatch):
+    db, ids, _ = setup
+    monkeypatch.setattr(xui_api, "login_to_host", lambda *a: (None, None))
+    job_id = db.create_background_job(expired_sweep.JOB_KIND)
+    asyncio.run(expired_sweep.run_sweep_job(job_id, None))
+
+    assert all(db.get_key_by_id(key_id) is not None for key_id in ids.values())
+    job = db.get_background_job(job_id)
+    assert job["progress"]["failed"] == 3 and job["error"]
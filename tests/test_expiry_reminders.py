@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+@pytest.fixture
+def key(db):
+    db.create_host("h1", "https://panel.example", "admin", "pw", 1)
+    db.register_user_if_not_exists(100, "user", None)
+    key_id = db.add_new_key(100, "h1", "uuid-a", "a", _ms(datetime.now() + timedelta(hours=23, minutes=30)))
+    return db.get_key_by_id(key_id)
+
+
+def test_reminder_is_claimed_once_across_instances(db, key):
+    candidate = [(key["key_id"], 24, key["expiry_date"])]
+    assert db.claim_expiry_reminders(candidate) == {(key["key_id"], 24)}
+    # Отметка в общей БД: другой экземпляр (новый лидер) не повторяет напоминание
+    assert db.claim_expiry_reminders(candidate) == set()
+    assert db.claim_expiry_reminders([(key["key_id"], 1, key["expiry_date"])]) == {(key["key_id"], 1)}
+
+
+def test_renewed_key_is_reminded_again(db, key):
+    assert db.claim_expiry_reminders([(key["key_id"], 24, key["expiry_date"])])
+    db.update_key_info(key["key_id"], "uuid-a", _ms(datetime.now() + timedelta(hours=23, minutes=50)))
+    renewed = db.get_key_by_id(key["key_id"])
+    assert db.claim_expiry_reminders([(key["key_id"], 24, renewed["expiry_date"])]) == {(key["key_id"], 24)}
+
+
+def test_marks_of_deleted_keys_are_removed(db, key):
+    db.claim_expiry_reminders([(key["key_id"], 24, key["expiry_date"])])
+    assert db.delete_stale_expiry_reminders() == 0
+    db.delete_key_by_email("a")
+    assert db.delete_stale_expiry_reminders() == 1
@@ -0,0 +1,39 @@
+import pytest
+
+from shop_bot.modules import host_health
+
+
+@pytest.fixture
+def hosts(db, monkeypatch):
+    monkeypatch.setattr(host_health, "_hosts", {})
+    monkeypatch.setattr(host_health, "_cpu_by_host", {})
+    monkeypatch.setattr(host_health, "_cpu_loaded_at", 0.0)
+    for name in ("busy", "hot", "idle"):
+        db.create_host(name, f"https://{name}.example", "admin", "pw", 1)
+    return db
+
+
+def _names(db) -> list[str]:
+    return [h["host_name"] for h in host_health.rank_hosts(db.get_all_hosts())]
+
+
+def test_rank_uses_load_stored_by_leader(hosts):
+    # Синхронизацию и сбор метрик выполнял другой экземпляр: в памяти этого процесса нагрузки нет
+    hosts.set_host_panel_clients("busy", 500)
+    hosts.set_host_panel_clients("hot", 10)
+    hosts.set_host_panel_clients("idle", 20)
+    hosts.insert_host_metrics("hot", {"ok": True, "cpu_percent": 99.0})
+
+    assert _names(hosts) == ["idle", "busy", "hot"]
+    assert host_health.get_host_state("https://busy.example")["clients"] == 500
+
+
+def test_failed_and_stale_cpu_samples_are_ignored(hosts):
+    hosts.insert_host_metrics("hot", {"ok": False, "cpu_percent": 99.0})
+    assert hosts.get_latest_hosts_cpu() == {}
+    hosts.insert_host_metrics("hot", {"ok": True, "cpu_percent": 42.0})
+    assert hosts.get_latest_hosts_cpu() == {"hot": 42.0}
+    with hosts._connect_telemetry() as conn:
+        conn.execute("UPDATE host_metrics SET created_at = datetime('now', '-1 hour')")
+        conn.commit()
+    assert hosts.get_latest_hosts_cpu() == {}
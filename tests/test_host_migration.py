@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from shop_bot.data_manager import host_migration
+from shop_bot.modules import xui_api
+
+
+class FakePanel:
+    """Целевая панель: addClient пачкой и список клиентов inbound."""
+
+    def __init__(self):
+        self.clients = []
+        self.client = SimpleNamespace(add=self.add)
+
+    def add(self, inbound_id, clients):
+        self.clients.extend(clients)
+
+    def inbound(self):
+        return SimpleNamespace(id=1, settings=SimpleNamespace(clients=list(self.clients)))
+
+
+@pytest.fixture
+def setup(db, monkeypatch):
+    db.create_host("src", "https://src.example", "admin", "pw", 1)
+    db.create_host("dst", "https://dst.example", "admin", "pw", 1)
+    db.register_user_if_not_exists(100, "user", None)
+    expiry_ms = int((datetime.now() + timedelta(days=10)).timestamp() * 1000)
+    ids = [db.add_new_key(100, "src", f"uuid-{e}", e, expiry_ms) for e in ("a", "b", "c")]
+    panel = FakePanel()
+
+    async def login(host):
+        # Исходный хост недоступен: переносим по данным БД, удаление откладывается
+        return (panel, panel.inbound()) if host["host_name"] == "dst" else (None, None)
+
+    monkeypatch.setattr(host_migration, "_login", login)
+    monkeypatch.setattr(host_migration, "MIGRATION_BATCH_SIZE", 2)
+    monkeypatch.setattr(xui_api, "remember_inbound_params", lambda *a: None)
+    job_id, error = host_migration.create_migration_job("src", "dst")
+    assert error is None
+    return db, panel, job_id, ids
+
+
+def _statuses(db, job_id) -> dict[int, tuple[str, str | None]]:
+    return {i["key_id"]: (i["status"], i["error"]) for i in db.get_host_migration_items(job_id)}
+
+
+def test_failed_db_update_is_reported_and_retried_on_resume(setup, monkeypatch):
+    db, panel, job_id, ids = setup
+    real_move = host_migration.bulk_move_keys_to_host
+    calls = []
+
+    def flaky_move(moves):
+        calls.append(len(moves))
+        # Первая пачка: запись в БД не удалась
+        return 0 if len(calls) == 1 else real_move(moves)
+
+    real_add = xui_api.add_clients_batch
+    skip = {"c"}
+
+    def add_clients_batch(*args):
+        # Панель приняла запрос, но клиента c в ответе нет
+        return {email: info for email, info in real_add(*args).items() if email not in skip}
+
+    monkeypatch.setattr(host_migration, "bulk_move_keys_to_host", flaky_move)
+    monkeypatch.setattr(xui_api, "add_clients_batch", add_clients_batch)
+    asyncio.run(host_migration.run_migration_job(job_id, None))
+
+    assert calls == [2]
+    statuses = _statuses(db, job_id)
+    assert statuses[ids[0]] == statuses[ids[1]] == ("failed", "не удалось обновить ключ в БД")
+    assert statuses[ids[2]] == ("failed", "клиент не создан на целевом хосте")
+    job = db.get_background_job(job_id)
+    assert job["progress"]["failed"] == 3 and job["error"] == "Не удалось перенести ключей: 3"
+
+    # Повторный запуск: a, b и c уже есть на панели, ключи в БД переносятся без дублей клиентов
+    skip.clear()
+    asyncio.run(host_migration.run_migration_job(job_id, None))
+    assert {s for s, _ in _statuses(db, job_id).values()} == {"moved"}
+    assert all(db.get_key_by_id(key_id)["host_name"] == "dst" for key_id in ids)
+    assert sorted(c.email for c in panel.clients) == ["a", "b", "c"]
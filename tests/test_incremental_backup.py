@@ -0,0 +1,84 @@
+import shutil
+import sqlite3
+import struct
+
+from shop_bot.data_manager import incremental_backup as ib
+
+PAGE_SIZE = 512
+SALT = (0x1111, 0x2222)
+
+
+def _wal_header(salt=SALT, magic=ib.WAL_MAGIC[0], page_size=PAGE_SIZE) -> bytes:
+    return struct.pack(">IIIIII", magic, 3007000, page_size, 0, *salt) + b"\0" * 8
+
+
+def _frame(commit_size: int = 0, salt=SALT, page_no: int = 1) -> bytes:
+    header = struct.pack(">IIII", page_no, commit_size, *salt) + b"\0" * 8
+    return header + b"\xab" * PAGE_SIZE
+
+
+FRAME_SIZE = ib.WAL_FRAME_HEADER_SIZE + PAGE_SIZE
+
+
+def test_empty_or_truncated_header():
+    assert ib._committed_wal_length(b"") == 0
+    assert ib._committed_wal_length(_wal_header()[:20]) == 0
+
+
+def test_bad_magic_or_page_size():
+    assert ib._committed_wal_length(_wal_header(magic=0xDEADBEEF) + _frame(commit_size=1)) == 0
+    assert ib._committed_wal_length(_wal_header(page_size=256) + _frame(commit_size=1)) == 0
+
+
+def test_header_only_has_no_commits():
+    assert ib._committed_wal_length(_wal_header()) == 0
+
+
+def test_stops_at_last_commit_frame():
+    data = _wal_header() + _frame() + _frame(commit_size=2) + _frame()
+    assert ib._committed_wal_length(data) == ib.WAL_HEADER_SIZE + 2 * FRAME_SIZE
+
+
+def test_uncommitted_transaction_only():
+    data = _wal_header() + _frame() + _frame()
+    assert ib._committed_wal_length(data) == 0
+
+
+def test_frames_from_previous_generation_are_cut_off():
+    # После сброса WAL новые кадры пишутся поверх старых; хвост старого поколения с другими salt
+    data = _wal_header() + _frame(commit_size=1) + _frame(commit_size=5, salt=(7, 8))
+    assert ib._committed_wal_length(data) == ib.WAL_HEADER_SIZE + FRAME_SIZE
+
+
+def test_partial_trailing_frame_is_ignored():
+    data = _wal_header() + _frame(commit_size=1) + _frame(commit_size=2)[:100]
+    assert ib._committed_wal_length(data) == ib.WAL_HEADER_SIZE + FRAME_SIZE
+
+
+def test_real_wal_segment_replays_onto_base(tmp_path):
+    db = tmp_path / "src.db"
+    conn = sqlite3.connect(db)
+    conn.execute("PRAGMA page_size=4096")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    conn.execute("CREATE TABLE t (v TEXT)")
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    base = tmp_path / "base.db"
+    shutil.copy(db, base)
+
+    conn.executemany("INSERT INTO t VALUES (?)", [("a",), ("b",)])
+    conn.commit()
+    data = (tmp_path / "src.db-wal").read_bytes()
+
+    length = ib._committed_wal_length(data)
+    assert length == len(data)
+    assert (length - ib.WAL_HEADER_SIZE) % (ib.WAL_FRAME_HEADER_SIZE + 4096) == 0
+
+    ib._apply_wal(base, data[:length])
+    restored = sqlite3.connect(base)
+    try:
+        assert [r[0] for r in restored.execute("SELECT v FROM t ORDER BY v")] == ["a", "b"]
+    finally:
+        restored.close()
+        conn.close()
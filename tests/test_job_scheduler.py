@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import pytest
+
+from shop_bot.data_manager import job_scheduler
+from shop_bot.data_manager.job_scheduler import CronSchedule, Job, JobScheduler
+
+
+# --- Разбор cron ---
+
+def test_parse_wildcards_lists_ranges_and_steps():
+    cron = CronSchedule("*/15 0-6/2 1,15 * 1-5")
+    assert cron.minutes == {0, 15, 30, 45}
+    assert cron.hours == {0, 2, 4, 6}
+    assert cron.days == {1, 15}
+    assert cron.months == set(range(1, 13))
+    assert cron.weekdays == {1, 2, 3, 4, 5}
+
+
+@pytest.mark.parametrize("expr", [
+    "* * * *",
+    "* * * * * *",
+    "60 * * * *",
+    "* 24 * * *",
+    "* * 0 * *",
+    "* * * 13 *",
+    "* * * * 7",
+    "5-1 * * * *",
+    "*/0 * * * *",
+    "a * * * *",
+])
+def test_invalid_expressions(expr):
+    with pytest.raises(ValueError):
+        CronSchedule(expr)
+
+
+# --- Следующий запуск ---
+
+def test_next_after_is_strictly_later():
+    cron = CronSchedule("30 * * * *")
+    assert cron.next_after(datetime(2024, 1, 1, 10, 30, 0)) == datetime(2024, 1, 1, 11, 30)
+    assert cron.next_after(datetime(2024, 1, 1, 10, 29, 59)) == datetime(2024, 1, 1, 10, 30)
+
+
+def test_next_after_every_eight_hours():
+    cron = CronSchedule("0 */8 * * *")
+    assert cron.next_after(datetime(2024, 1, 1, 8, 0)) == datetime(2024, 1, 1, 16, 0)
+    assert cron.next_after(datetime(2024, 1, 1, 23, 59)) == datetime(2024, 1, 2, 0, 0)
+
+
+def test_next_after_rolls_over_month_and_year():
+    cron = CronSchedule("0 0 1 * *")
+    assert cron.next_after(datetime(2024, 1, 31, 12, 0)) == datetime(2024, 2, 1)
+    assert cron.next_after(datetime(2024, 12, 15)) == datetime(2025, 1, 1)
+
+
+def test_next_after_weekday_sunday_is_zero():
+    cron = CronSchedule("0 9 * * 0")
+    # 2024-01-03 — среда, ближайшее воскресенье — 7 января
+    assert cron.next_after(datetime(2024, 1, 3, 12, 0)) == datetime(2024, 1, 7, 9, 0)
+
+
+def test_day_of_month_or_day_of_week():
+    # Как в cron: если заданы оба поля, подходит любое из них
+    cron = CronSchedule("0 0 13 * 5")
+    assert cron.next_after(datetime(2024, 1, 1)) == datetime(2024, 1, 5)
+    assert cron.next_after(datetime(2024, 1, 12, 1)) == datetime(2024, 1, 13)
+
+
+def test_next_after_leap_day():
+    cron = CronSchedule("0 0 29 2 *")
+    assert cron.next_after(datetime(2023, 3, 1)) == datetime(2024, 2, 29)
+
+
+def test_impossible_date_raises():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 31 2 *").next_after(datetime(2024, 1, 1))
+
+
+def test_job_compute_next_with_jitter():
+    job = Job("j", "j", lambda: None, cron="0 4 * * *", jitter=60)
+    nxt = job.compute_next(datetime(2024, 1, 1, 5, 0))
+    assert datetime(2024, 1, 2, 4, 0) <= nxt <= datetime(2024, 1, 2, 4, 1)
+
+
+def test_interval_job_disabled_by_setting():
+    job = Job("j", "j", lambda: None, interval=lambda: 0)
+    assert job.compute_next(datetime(2024, 1, 1)) is None
+    assert job.schedule_text() == "выключена"
+
+
+# --- Потоки, пережившие таймаут ---
+
+def test_timed_out_thread_blocks_next_run(monkeypatch):
+    monkeypatch.setattr(job_scheduler.database, "save_job_state", lambda *a, **k: None)
+    release = threading.Event()
+
+    async def scenario():
+        async def func():
+            await job_scheduler.to_thread(release.wait, 5)
+
+        job = Job("stuck", "stuck", func, interval=60, timeout=0.05)
+        scheduler = JobScheduler()
+        scheduler.add(job)
+        await scheduler.run_job(job)
+        assert job.last_status == "timeout" and job.busy_threads == 1
+        runs = job.run_count
+        await scheduler.run_job(job)
+        assert job.run_count == runs
+        assert not scheduler.run_now("stuck")
+
+        release.set()
+        for _ in range(100):
+            if not job.busy_threads:
+                break
+            await asyncio.sleep(0.01)
+        assert job.busy_threads == 0
+        assert scheduler.run_now("stuck")
+
+    asyncio.run(scenario())
@@ -0,0 +1,86 @@
+import pytest
+
+from shop_bot.data_manager import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # Тестовые метрики не должны попадать в общий реестр процесса
+    monkeypatch.setattr(metrics, "_registry", [])
+    return metrics._registry
+
+
+def _lines(metric) -> list[str]:
+    return metric.render().splitlines()
+
+
+def test_counter_render(registry):
+    c = metrics.Counter("test_requests_total", "Запросы.", ("route", "status"))
+    c.inc("/a", 200)
+    c.inc("/a", 200)
+    c.inc("/b", 500, amount=0.5)
+    assert _lines(c) == [
+        "# HELP test_requests_total Запросы.",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{route="/a",status="200"} 2',
+        'test_requests_total{route="/b",status="500"} 0.5',
+    ]
+
+
+def test_label_values_are_escaped(registry):
+    c = metrics.Counter("test_escape_total", "x", ("v",))
+    c.inc('a"b\\c\nd')
+    assert _lines(c)[-1] == 'test_escape_total{v="a\\"b\\\\c\\nd"} 1'
+
+
+def test_wrong_label_count_raises(registry):
+    c = metrics.Counter("test_labels_total", "x", ("a",))
+    with pytest.raises(ValueError):
+        c.inc()
+
+
+def test_series_limit_folds_into_other(registry, monkeypatch):
+    monkeypatch.setattr(metrics, "MAX_SERIES_PER_METRIC", 2)
+    c = metrics.Counter("test_cap_total", "x", ("id",))
+    for i in range(5):
+        c.inc(i)
+    assert _lines(c)[2:] == [
+        'test_cap_total{id="0"} 1',
+        'test_cap_total{id="1"} 1',
+        'test_cap_total{id="_other"} 3',
+    ]
+
+
+def test_gauge_set_and_function(registry):
+    g = metrics.Gauge("test_gauge", "x")
+    g.set(3)
+    assert _lines(g)[-1] == "test_gauge 3"
+    g.set_function(lambda: {(): 7.5})
+    assert _lines(g)[-1] == "test_gauge 7.5"
+
+
+def test_gauge_function_error_renders_no_samples(registry):
+    g = metrics.Gauge("test_broken", "x")
+    g.set_function(lambda: 1 / 0)
+    assert _lines(g) == ["# HELP test_broken x", "# TYPE test_broken gauge"]
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    h = metrics.Histogram("test_seconds", "x", ("op",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 2.0):
+        h.observe(v, "q")
+    assert _lines(h)[2:] == [
+        'test_seconds_bucket{op="q",le="0.1"} 2',
+        'test_seconds_bucket{op="q",le="1"} 3',
+        'test_seconds_bucket{op="q",le="+Inf"} 4',
+        'test_seconds_sum{op="q"} 2.65',
+        'test_seconds_count{op="q"} 4',
+    ]
+
+
+def test_render_joins_registry(registry):
+    metrics.Counter("test_a_total", "a").inc()
+    metrics.Gauge("test_b", "b").set(1)
+    text = metrics.render()
+    assert text.endswith("\n")
+    assert text.index("# TYPE test_a_total counter") < text.index("# TYPE test_b gauge")
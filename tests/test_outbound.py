@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from shop_bot.bot import outbound
+
+
+def test_burst_is_sent_without_waiting():
+    bucket = outbound._Bucket(rate=1.0, burst=3)
+    assert [bucket.reserve(100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+
+
+def test_over_burst_waits_one_interval_per_message():
+    bucket = outbound._Bucket(rate=2.0, burst=2)
+    waits = [bucket.reserve(10.0) for _ in range(4)]
+    assert waits == pytest.approx([0.0, 0.0, 0.5, 1.0])
+
+
+def test_delay_does_not_consume_a_slot():
+    bucket = outbound._Bucket(rate=1.0, burst=1)
+    assert bucket.delay(5.0) == 0.0
+    assert bucket.reserve(5.0) == 0.0
+    assert bucket.delay(5.0) == pytest.approx(1.0)
+    assert bucket.delay(5.0) == pytest.approx(1.0)
+
+
+def test_bucket_refills_over_time():
+    bucket = outbound._Bucket(rate=1.0, burst=2)
+    bucket.reserve(0.0)
+    bucket.reserve(0.0)
+    assert bucket.delay(0.0) == pytest.approx(1.0)
+    assert bucket.delay(1.0) == 0.0
+    # Простой не копит запас сверх burst
+    for _ in range(2):
+        assert bucket.reserve(100.0) == 0.0
+    assert bucket.reserve(100.0) == pytest.approx(1.0)
+
+
+def test_chat_limits_are_stricter_than_global():
+    chat = outbound._Bucket(outbound.CHAT_RATE_PER_SECOND, outbound.CHAT_BURST)
+    waits = [chat.reserve(0.0) for _ in range(outbound.CHAT_BURST + 1)]
+    assert waits[-1] == pytest.approx(1.0 / outbound.CHAT_RATE_PER_SECOND)
+
+
+class _FakeBot:
+    id = 1
+
+    def __init__(self):
+        self.sent: list[tuple[str, float]] = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((text, outbound.time.monotonic()))
+        return text
+
+
+def test_delayed_message_waits_out_pause_set_after_dequeue(monkeypatch):
+    monkeypatch.setattr(outbound, "CHAT_RATE_PER_SECOND", 10)
+    monkeypatch.setattr(outbound, "CHAT_BURST", 1)
+
+    async def scenario():
+        dispatcher = outbound.OutboundDispatcher()
+        bot = _FakeBot()
+        first = asyncio.create_task(dispatcher.call(bot, "send_message", chat_id=5, text="a"))
+        second = asyncio.create_task(dispatcher.call(bot, "send_message", chat_id=5, text="b"))
+        await first
+        # Второе сообщение уже взято из очереди и ждёт слота чата; в это время приходит RetryAfter
+        resume_at = outbound.time.monotonic() + 0.3
+        dispatcher._paused_until[bot.id] = resume_at
+        assert await second == "b"
+        dispatcher._worker.cancel()
+        return bot.sent, resume_at
+
+    sent, resume_at = asyncio.run(scenario())
+    assert [text for text, _ in sent] == ["a", "b"]
+    assert sent[1][1] >= resume_at
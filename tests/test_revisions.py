@@ -0,0 +1,41 @@
+import sqlite3
+
+from shop_bot.data_manager import backup_manager
+
+
+def _revisions(db) -> dict[str, int]:
+    return {name: db._get_revision(name) for name in db.REVISION_NAMES}
+
+
+def test_same_process_write_is_seen_immediately(db):
+    before = db.get_settings_revision()
+    db.update_setting("support_user", "@help")
+    assert db.get_settings_revision() != before
+
+
+def test_write_by_other_instance_is_seen_after_poll(db, monkeypatch):
+    before = db.get_keys_revision()
+    with sqlite3.connect(db.DB_FILE) as conn:
+        conn.execute("INSERT OR REPLACE INTO cache_revisions (name, revision) VALUES ('keys', ?)", (before + 1,))
+        conn.commit()
+    assert db.get_keys_revision() == before
+    monkeypatch.setattr(db, "_revisions_loaded_at", 0.0)
+    assert db.get_keys_revision() == before + 1
+
+
+def test_restore_bumps_every_revision(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_manager, "DB_FILE", db.DB_FILE)
+    monkeypatch.setattr(backup_manager, "BACKUPS_DIR", tmp_path / "backups")
+    for name in db.REVISION_NAMES:
+        db._bump_revision(name)
+    snapshot = tmp_path / "snapshot.db"
+    with sqlite3.connect(db.DB_FILE) as src, sqlite3.connect(snapshot) as dst:
+        src.backup(dst)
+    # Ревизии в бэкапе совпадают с текущими: без сброса кэши остались бы прежними
+    before = _revisions(db)
+
+    assert backup_manager.restore_from_file(snapshot)
+    after = _revisions(db)
+    assert all(after[name] != before[name] for name in db.REVISION_NAMES)
+    monkeypatch.setattr(db, "_revisions_loaded_at", 0.0)
+    assert _revisions(db) == after
@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def legacy(db, monkeypatch):
+    """Основная БД старой версии: host_metrics ещё в ней, переноса не было."""
+    monkeypatch.setattr(db, "TELEMETRY_MIGRATION_BATCH", 4)
+    with sqlite3.connect(db.TELEMETRY_DB_FILE) as conn:
+        conn.execute("DELETE FROM telemetry_meta")
+        schema = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'host_metrics'").fetchone()[0]
+        conn.commit()
+    with sqlite3.connect(db.DB_FILE) as conn:
+        conn.execute(schema)
+        conn.executemany(
+            "INSERT INTO host_metrics (id, host_name, cpu_percent) VALUES (?, ?, ?)",
+            [(i, f"h{i}", float(i)) for i in range(1, 11)],
+        )
+        conn.commit()
+    return db
+
+
+def _telemetry_rows(db) -> list[tuple]:
+    with sqlite3.connect(db.TELEMETRY_DB_FILE) as conn:
+        return conn.execute("SELECT id, host_name, cpu_percent FROM host_metrics ORDER BY id").fetchall()
+
+
+def _main_tables(db) -> set[str]:
+    with sqlite3.connect(db.DB_FILE) as conn:
+        return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def test_rerun_after_crash_between_commits_does_not_duplicate(legacy):
+    # Сбой после фиксации в telemetry, но до удаления из основной БД: первая порция есть в обеих
+    with sqlite3.connect(legacy.DB_FILE) as conn:
+        conn.execute("ATTACH DATABASE ? AS telemetry", (str(legacy.TELEMETRY_DB_FILE),))
+        conn.execute("INSERT INTO telemetry.host_metrics (id, host_name, cpu_percent) "
+                     "SELECT id, host_name, cpu_percent FROM main.host_metrics WHERE id <= 4")
+        conn.commit()
+
+    legacy.migrate_telemetry_tables()
+
+    assert _telemetry_rows(legacy) == [(i, f"h{i}", float(i)) for i in range(1, 11)]
+    assert "host_metrics" not in _main_tables(legacy)
+
+
+def test_new_rows_do_not_take_legacy_ids(legacy):
+    legacy.migrate_telemetry_tables()
+    legacy.insert_host_metrics("new", {"ok": True, "cpu_percent": 1.0})
+    assert _telemetry_rows(legacy)[-1][:2] == (11, "new")
+    # Отметка стоит: повторный вызов ничего не трогает
+    legacy.migrate_telemetry_tables()
+    assert len(_telemetry_rows(legacy)) == 11
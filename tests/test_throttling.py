@@ -0,0 +1,56 @@
+import pytest
+
+from shop_bot.bot import middlewares
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    # 60 в минуту = 1 токен в секунду, ёмкость 3
+    monkeypatch.setattr(middlewares, "_throttle_limits", {"callback": (1.0, 3.0), "payment": (0.1, 2.0)})
+
+
+def test_classify_callback():
+    assert middlewares.classify_callback("pay_yookassa") == "payment"
+    assert middlewares.classify_callback("topup_pay_stars") == "payment"
+    assert middlewares.classify_callback("select_plan:1") == "purchase"
+    assert middlewares.classify_callback("keys_page:2") == "keys"
+    assert middlewares.classify_callback("main_menu") == "callback"
+    assert middlewares.classify_callback(None) == "callback"
+
+
+def test_burst_then_wait(limits):
+    mw = middlewares.ThrottlingMiddleware()
+    assert [mw._take(1, "callback", 0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert mw._take(1, "callback", 0.0) == pytest.approx(1.0)
+    assert mw._take(1, "callback", 0.5) == pytest.approx(0.5)
+    assert mw._take(1, "callback", 1.0) == 0.0
+
+
+def test_refill_is_capped_at_capacity(limits):
+    mw = middlewares.ThrottlingMiddleware()
+    mw._take(1, "callback", 0.0)
+    assert [mw._take(1, "callback", 1000.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert mw._take(1, "callback", 1000.0) > 0
+
+
+def test_buckets_are_per_user_and_class(limits):
+    mw = middlewares.ThrottlingMiddleware()
+    for _ in range(2):
+        mw._take(1, "payment", 0.0)
+    assert mw._take(1, "payment", 0.0) == pytest.approx(10.0)
+    assert mw._take(2, "payment", 0.0) == 0.0
+    assert mw._take(1, "callback", 0.0) == 0.0
+
+
+def test_unlimited_class(limits):
+    mw = middlewares.ThrottlingMiddleware()
+    assert all(mw._take(1, "message", 0.0) == 0.0 for _ in range(100))
+
+
+def test_idle_buckets_are_pruned(limits, monkeypatch):
+    monkeypatch.setattr(middlewares, "BUCKET_PRUNE_SIZE", 2)
+    mw = middlewares.ThrottlingMiddleware()
+    mw._take(1, "callback", 0.0)
+    mw._take(2, "callback", 0.0)
+    mw._take(3, "callback", middlewares.BUCKET_IDLE_SECONDS + 1)
+    assert set(mw._buckets) == {(3, "callback")}
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from shop_bot.data_manager import tracing
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    tracing.reset()
+    yield
+    tracing.reset()
+
+
+def _ids(kind=None, order="recent"):
+    return [t["trace_id"] for t in tracing.get_traces(kind, order=order, limit=1000)]
+
+
+def test_ring_buffer_keeps_last_traces_per_kind(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACES_PER_KIND", 3)
+    ids = []
+    for i in range(5):
+        with tracing.trace(f"update {i}", "update") as root:
+            ids.append(root.trace_id)
+    with tracing.trace("webhook", "payment") as other:
+        pass
+
+    assert set(_ids("update")) == set(ids[-3:])
+    # Вытесненные трассы недоступны и по id
+    assert tracing.get_trace(ids[0]) is None
+    assert tracing.get_trace(ids[-1]) is not None
+    # Буфер у каждого вида свой
+    assert _ids("payment") == [other.trace_id]
+    assert tracing.get_kinds() == ["payment", "update"]
+
+
+def test_spans_nest_under_current_span():
+    with tracing.trace("root", "job") as root:
+        with tracing.span("outer"):
+            with tracing.span("inner"):
+                pass
+
+    record = tracing.get_trace(root.trace_id)
+    assert [(s["name"], s["depth"]) for s in record["spans"]] == [("root", 0), ("outer", 1), ("inner", 2)]
+    assert all(0 <= s["offset_pct"] <= 100 for s in record["spans"])
+
+
+def test_spans_per_trace_are_capped(monkeypatch):
+    monkeypatch.setattr(tracing, "MAX_SPANS_PER_TRACE", 3)
+    with tracing.trace("root", "job") as root:
+        for i in range(5):
+            with tracing.span(f"step {i}"):
+                pass
+
+    record = tracing.get_trace(root.trace_id)
+    # Спаны записываются по завершении: корневой закончился последним и не поместился
+    assert [s["name"] for s in record["spans"]] == ["step 0", "step 1", "step 2"]
+    assert record["dropped_spans"] == 3
+    assert record["span_count"] == 6
+
+
+def test_error_and_search_attributes():
+    with pytest.raises(RuntimeError):
+        with tracing.trace("pay", "payment", payment_id="p-1"):
+            with tracing.span("panel", host="nl-1", user_id=42):
+                raise RuntimeError("boom")
+    with tracing.trace("ok", "payment"):
+        pass
+
+    failed = tracing.get_traces(failed_only=True)
+    assert len(failed) == 1
+    assert failed[0]["error"] == "panel: RuntimeError: boom"
+    assert failed[0]["attrs"] == {"payment_id": "p-1", "host": "nl-1", "user_id": 42}
+    assert [t["name"] for t in tracing.get_traces(query="42")] == ["pay"]
+    assert [t["name"] for t in tracing.get_traces(query="nl-1")] == ["pay"]
+    assert tracing.get_traces(query="nope") == []
+
+
+def test_span_outside_trace_is_noop():
+    with tracing.span("orphan") as s:
+        assert s is None
+    assert tracing.get_kinds() == []
+    with tracing.span("job", root_kind="job") as root:
+        assert root is not None and tracing.current_trace_id() == root.trace_id
+    assert tracing.current_span() is None
+    assert tracing.get_kinds() == ["job"]
+
+
+def test_context_follows_to_thread_and_tasks():
+    @tracing.traced()
+    def blocking():
+        return tracing.current_trace_id()
+
+    @tracing.traced("child task")
+    async def child():
+        return tracing.current_trace_id()
+
+    async def scenario():
+        with tracing.trace("root", "update") as root:
+            in_thread = await asyncio.to_thread(blocking)
+            in_task = await asyncio.create_task(child())
+        return root.trace_id, in_thread, in_task
+
+    trace_id, in_thread, in_task = asyncio.run(scenario())
+    assert in_thread == in_task == trace_id
+    assert {s["name"] for s in tracing.get_trace(trace_id)["spans"]} == {"root", "blocking", "child task"}